@@ -3,18 +3,20 @@ from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
 import logging
 from typing import Any, Callable, Dict, List, \
-    Optional, Tuple, Type, Union
+    Optional, Set, Tuple, Type, Union
 
 from django.conf import settings
-from django.db import connection, models
+from django.db import connection, models, transaction
 from django.db.models import F
 
 from analytics.models import Anomaly, BaseCount, \
-    FillState, InstallationCount, RealmCount, StreamCount, \
-    UserCount, installation_epoch, last_successful_fill
+    FillState, InstallationCount, InstallationRollupCount, RealmCount, \
+    RealmRollupCount, StreamCount, UserCount, installation_epoch, \
+    last_successful_fill
 from zerver.lib.logging_util import log_to_file
+from zerver.lib.parallel import run_parallel
 from zerver.lib.timestamp import ceiling_to_day, \
-    ceiling_to_hour, floor_to_hour, verify_UTC
+    ceiling_to_hour, floor_to_day, floor_to_hour, verify_UTC
 from zerver.models import Message, Realm, \
     Stream, UserActivityInterval, UserProfile, models
 
@@ -26,21 +28,36 @@ log_to_file(logger, settings.ANALYTICS_LOG_PATH)
 # You can't subtract timedelta.max from a datetime, so use this instead
 TIMEDELTA_MAX = timedelta(days=365*1000)
 
+# The most hours or days that process_count_stat fills with one
+# range_pull_function query.
+MAX_FILL_RANGE_STEPS = 7 * 24
+
 ## Class definitions ##
 
 class CountStat:
     HOUR = 'hour'
     DAY = 'day'
     FREQUENCIES = frozenset([HOUR, DAY])
+    # The frequencies of the rows in RealmRollupCount and
+    # InstallationRollupCount, finest first.
+    WEEK = 'week'
+    MONTH = 'month'
+    ROLLUP_FREQUENCIES = [WEEK, MONTH]
 
     def __init__(self, property: str, data_collector: 'DataCollector', frequency: str,
-                 interval: Optional[timedelta]=None) -> None:
+                 interval: Optional[timedelta]=None, additive: bool=True) -> None:
         self.property = property
         self.data_collector = data_collector
         # might have to do something different for bitfields
         if frequency not in self.FREQUENCIES:
             raise AssertionError("Unknown frequency: %s" % (frequency,))
         self.frequency = frequency
+        # Whether values at different end_times can be added up (e.g. a
+        # number of messages sent, but not a number of active users).
+        # The weekly or monthly rollup of an additive stat is the sum of
+        # its values in the week or month; that of any other stat is its
+        # value at the last end_time in the week or month.
+        self.additive = additive
         if interval is not None:
             self.interval = interval
         elif frequency == CountStat.HOUR:
@@ -57,15 +74,23 @@ class LoggingCountStat(CountStat):
 
 class DependentCountStat(CountStat):
     def __init__(self, property: str, data_collector: 'DataCollector', frequency: str,
-                 interval: Optional[timedelta]=None, dependencies: List[str]=[]) -> None:
-        CountStat.__init__(self, property, data_collector, frequency, interval=interval)
+                 interval: Optional[timedelta]=None, additive: bool=True,
+                 dependencies: List[str]=[]) -> None:
+        CountStat.__init__(self, property, data_collector, frequency, interval=interval,
+                           additive=additive)
         self.dependencies = dependencies
 
 class DataCollector:
     def __init__(self, output_table: Type[BaseCount],
-                 pull_function: Optional[Callable[[str, datetime, datetime], int]]) -> None:
+                 pull_function: Optional[Callable[[str, datetime, datetime], int]],
+                 range_pull_function: Optional[Callable[[str, datetime, datetime, str], int]]=None
+                 ) -> None:
         self.output_table = output_table
         self.pull_function = pull_function
+        # Optional; fills every hour or day (the last argument) ending
+        # in (start_time, end_time] at once.  Only makes sense for stats
+        # whose interval is their frequency.
+        self.range_pull_function = range_pull_function
 
 ## CountStat-level operations ##
 
@@ -109,6 +134,24 @@ def process_count_stat(stat: CountStat, fill_to_time: datetime) -> None:
             fill_to_time = min(fill_to_time, dependency_fill_time)
 
     currently_filled = currently_filled + time_increment
+    if stat.data_collector.range_pull_function is not None and stat.interval == time_increment:
+        # When catching up on more than one hour or day, fill up to
+        # MAX_FILL_RANGE_STEPS of them with one query.  Each range is
+        # filled in a transaction along with its FillState update, so
+        # a crash leaves the FillState DONE at the end of the last
+        # range filled, with nothing past it to undo.
+        while currently_filled < fill_to_time:
+            range_end = min(fill_to_time,
+                            currently_filled + (MAX_FILL_RANGE_STEPS - 1) * time_increment)
+            logger.info("START %s %s-%s" % (stat.property, currently_filled, range_end))
+            start = time.time()
+            with transaction.atomic():
+                do_fill_count_stat_for_range(stat, currently_filled, range_end)
+                do_update_fill_state(fill_state, range_end, FillState.DONE)
+            end = time.time()
+            currently_filled = range_end + time_increment
+            logger.info("DONE %s (%dms)" % (stat.property, (end-start)*1000))
+
     while currently_filled <= fill_to_time:
         logger.info("START %s %s" % (stat.property, currently_filled))
         start = time.time()
@@ -119,6 +162,70 @@ def process_count_stat(stat: CountStat, fill_to_time: datetime) -> None:
         currently_filled = currently_filled + time_increment
         logger.info("DONE %s (%dms)" % (stat.property, (end-start)*1000))
 
+def get_fill_waves(stats: List[CountStat]) -> List[List[CountStat]]:
+    """Splits stats into waves that can each be filled concurrently, with
+    each DependentCountStat in a later wave than any of its dependencies
+    that are among the stats."""
+    properties = {stat.property for stat in stats}
+    filled = set()  # type: Set[str]
+    remaining = list(stats)
+    waves = []  # type: List[List[CountStat]]
+    while remaining:
+        wave = [stat for stat in remaining
+                if not isinstance(stat, DependentCountStat) or
+                all(dependency in filled or dependency not in properties
+                    for dependency in stat.dependencies)]
+        if not wave:
+            raise AssertionError("Circular dependencies among %s" % (
+                [stat.property for stat in remaining],))
+        waves.append(wave)
+        filled.update(stat.property for stat in wave)
+        remaining = [stat for stat in remaining if stat.property not in filled]
+    return waves
+
+def process_count_stats(stats: List[CountStat], fill_to_time: datetime,
+                        processes: int=1) -> List[str]:
+    """Runs process_count_stat for each of the stats, in up to `processes`
+    forked processes at a time.  A stat failing doesn't stop the others,
+    except that stats depending on it are skipped.  Returns the properties
+    of the stats that failed or were skipped."""
+    if processes <= 1:
+        for stat in stats:
+            process_count_stat(stat, fill_to_time)
+        return []
+
+    def run_job(stat: CountStat) -> int:
+        try:
+            process_count_stat(stat, fill_to_time)
+        except Exception:
+            logger.exception("Error processing %s" % (stat.property,))
+            return 1
+        return 0
+
+    failed = []  # type: List[str]
+    for wave in get_fill_waves(stats):
+        runnable = []  # type: List[CountStat]
+        for stat in wave:
+            failed_dependencies = []  # type: List[str]
+            if isinstance(stat, DependentCountStat):
+                failed_dependencies = [dependency for dependency in stat.dependencies
+                                       if dependency in failed]
+            if failed_dependencies:
+                logger.warning("Skipping %s, since %s failed" % (
+                    stat.property, ', '.join(failed_dependencies)))
+                failed.append(stat.property)
+            else:
+                runnable.append(stat)
+
+        # The forked processes can't share our database connection;
+        # closing it makes each of them open its own.
+        connection.close()
+        for status, stat in run_parallel(run_job, runnable, threads=processes,
+                                         stop_on_error=False):
+            if status != 0:
+                failed.append(stat.property)
+    return failed
+
 def do_update_fill_state(fill_state: FillState, end_time: datetime, state: int) -> None:
     fill_state.end_time = end_time
     fill_state.state = state
@@ -136,6 +243,17 @@ def do_fill_count_stat_at_hour(stat: CountStat, end_time: datetime) -> None:
                     (stat.property, (time.time()-timer)*1000, rows_added))
     do_aggregate_to_summary_table(stat, end_time)
 
+def do_fill_count_stat_for_range(stat: CountStat, first_end_time: datetime,
+                                 last_end_time: datetime) -> None:
+    start_time = first_end_time - stat.interval
+    timer = time.time()
+    assert(stat.data_collector.range_pull_function is not None)
+    rows_added = stat.data_collector.range_pull_function(stat.property, start_time,
+                                                         last_end_time, stat.frequency)
+    logger.info("%s run range_pull_function (%dms/%sr)" %
+                (stat.property, (time.time()-timer)*1000, rows_added))
+    do_aggregate_to_summary_table(stat, last_end_time, first_end_time=first_end_time)
+
 def do_delete_counts_at_hour(stat: CountStat, end_time: datetime) -> None:
     if isinstance(stat, LoggingCountStat):
         InstallationCount.objects.filter(property=stat.property, end_time=end_time).delete()
@@ -146,8 +264,27 @@ def do_delete_counts_at_hour(stat: CountStat, end_time: datetime) -> None:
         StreamCount.objects.filter(property=stat.property, end_time=end_time).delete()
         RealmCount.objects.filter(property=stat.property, end_time=end_time).delete()
         InstallationCount.objects.filter(property=stat.property, end_time=end_time).delete()
-
-def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime) -> None:
+    # The rollups of the week and month containing end_time may
+    # include its rows, so we recompute them from the rows that are
+    # left, which end at the previous end_time at the latest.
+    for frequency in CountStat.ROLLUP_FREQUENCIES:
+        period_end = get_rollup_period(end_time, frequency)[1]
+        RealmRollupCount.objects.filter(property=stat.property, frequency=frequency,
+                                        end_time=period_end).delete()
+        InstallationRollupCount.objects.filter(property=stat.property, frequency=frequency,
+                                               end_time=period_end).delete()
+    if stat.frequency == CountStat.HOUR:
+        previous_end_time = end_time - timedelta(hours=1)
+    else:
+        previous_end_time = end_time - timedelta(days=1)
+    do_aggregate_to_rollup_tables(stat, previous_end_time, recompute=True)
+
+def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime,
+                                  first_end_time: Optional[datetime]=None) -> None:
+    # Aggregates the rows for every end_time from first_end_time (by
+    # default, just end_time) through end_time.
+    if first_end_time is None:
+        first_end_time = end_time
     cursor = connection.cursor()
 
     # Aggregate into RealmCount
@@ -158,19 +295,20 @@ def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime) -> None:
                 (realm_id, value, property, subgroup, end_time)
             SELECT
                 zerver_realm.id, COALESCE(sum(%(output_table)s.value), 0), '%(property)s',
-                %(output_table)s.subgroup, %%(end_time)s
+                %(output_table)s.subgroup, %(output_table)s.end_time
             FROM zerver_realm
             JOIN %(output_table)s
             ON
                 zerver_realm.id = %(output_table)s.realm_id
             WHERE
                 %(output_table)s.property = '%(property)s' AND
-                %(output_table)s.end_time = %%(end_time)s
-            GROUP BY zerver_realm.id, %(output_table)s.subgroup
+                %(output_table)s.end_time >= %%(first_end_time)s AND
+                %(output_table)s.end_time <= %%(end_time)s
+            GROUP BY zerver_realm.id, %(output_table)s.subgroup, %(output_table)s.end_time
         """ % {'output_table': output_table._meta.db_table,
                'property': stat.property}
         start = time.time()
-        cursor.execute(realmcount_query, {'end_time': end_time})
+        cursor.execute(realmcount_query, {'first_end_time': first_end_time, 'end_time': end_time})
         end = time.time()
         logger.info("%s RealmCount aggregation (%dms/%sr)" % (
             stat.property, (end - start) * 1000, cursor.rowcount))
@@ -180,22 +318,158 @@ def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime) -> None:
         INSERT INTO analytics_installationcount
             (value, property, subgroup, end_time)
         SELECT
-            sum(value), '%(property)s', analytics_realmcount.subgroup, %%(end_time)s
+            sum(value), '%(property)s', analytics_realmcount.subgroup, analytics_realmcount.end_time
         FROM analytics_realmcount
         WHERE
             property = '%(property)s' AND
-            end_time = %%(end_time)s
-        GROUP BY analytics_realmcount.subgroup
+            end_time >= %%(first_end_time)s AND
+            end_time <= %%(end_time)s
+        GROUP BY analytics_realmcount.subgroup, analytics_realmcount.end_time
     """ % {'property': stat.property}
     start = time.time()
-    cursor.execute(installationcount_query, {'end_time': end_time})
+    cursor.execute(installationcount_query, {'first_end_time': first_end_time, 'end_time': end_time})
     end = time.time()
     logger.info("%s InstallationCount aggregation (%dms/%sr)" % (
         stat.property, (end - start) * 1000, cursor.rowcount))
     cursor.close()
 
+    do_aggregate_to_rollup_tables(stat, end_time, first_end_time=first_end_time)
+
+def do_aggregate_to_rollup_tables(stat: CountStat, end_time: datetime,
+                                  first_end_time: Optional[datetime]=None,
+                                  recompute: bool=False) -> None:
+    # Updates, from RealmCount and InstallationCount, the rollups of
+    # every week and month containing an end_time from first_end_time
+    # (by default, just end_time) through end_time, which must be the
+    # end_times just filled.  For an additive stat, the rows at those
+    # end_times are added to the existing rollups; with `recompute`,
+    # the rollups are instead recomputed from every row in their
+    # period through end_time, which must then be the last end_time
+    # filled.  The rollup of any other stat is just its value at the
+    # last end_time, so it's always replaced.
+    if first_end_time is None:
+        first_end_time = end_time
+    cursor = connection.cursor()
+    rollup_query = """
+        INSERT INTO %(rollup_table)s
+            (%(id_column)s value, property, subgroup, frequency, end_time)
+        SELECT
+            %(id_column)s sum(value), '%(property)s', subgroup, '%(frequency)s', %%(period_end)s
+        FROM %(count_table)s
+        WHERE
+            property = '%(property)s' AND
+            end_time > %%(rows_start)s AND
+            end_time <= %%(rows_end)s
+        GROUP BY %(id_column)s subgroup
+    """
+    # PostgreSQL 9.3 and 9.4 don't have INSERT ... ON CONFLICT, so
+    # adding to the rollups is an UPDATE of the existing rows followed
+    # by an INSERT of the missing ones.
+    increment_query = """
+        UPDATE %(rollup_table)s AS rollup
+        SET value = rollup.value + new_counts.value
+        FROM (
+            SELECT %(id_column)s subgroup, sum(value) AS value
+            FROM %(count_table)s
+            WHERE
+                property = '%(property)s' AND
+                end_time > %%(rows_start)s AND
+                end_time <= %%(rows_end)s
+            GROUP BY %(id_column)s subgroup
+        ) AS new_counts
+        WHERE
+            rollup.property = '%(property)s' AND
+            rollup.frequency = '%(frequency)s' AND
+            rollup.end_time = %%(period_end)s AND
+            rollup.subgroup IS NOT DISTINCT FROM new_counts.subgroup
+            %(id_match)s
+    """
+    insert_missing_query = """
+        INSERT INTO %(rollup_table)s
+            (%(id_column)s value, property, subgroup, frequency, end_time)
+        SELECT
+            %(id_column)s sum(value), '%(property)s', subgroup, '%(frequency)s', %%(period_end)s
+        FROM %(count_table)s AS new_counts
+        WHERE
+            property = '%(property)s' AND
+            end_time > %%(rows_start)s AND
+            end_time <= %%(rows_end)s AND
+            NOT EXISTS (
+                SELECT 1
+                FROM %(rollup_table)s AS rollup
+                WHERE
+                    rollup.property = '%(property)s' AND
+                    rollup.frequency = '%(frequency)s' AND
+                    rollup.end_time = %%(period_end)s AND
+                    rollup.subgroup IS NOT DISTINCT FROM new_counts.subgroup
+                    %(id_match)s
+            )
+        GROUP BY %(id_column)s subgroup
+    """
+    rollup_tables = [
+        (RealmRollupCount, RealmCount, 'realm_id,', 'AND rollup.realm_id = new_counts.realm_id'),
+        (InstallationRollupCount, InstallationCount, '', ''),
+    ]  # type: List[Tuple[Type[BaseCount], Type[BaseCount], str, str]]
+    incremental = stat.additive and not recompute
+
+    for frequency in CountStat.ROLLUP_FREQUENCIES:
+        period_start, period_end = get_rollup_period(first_end_time, frequency)
+        while period_start < end_time:
+            rows_end = min(period_end, end_time)
+            if incremental:
+                # Just the rows at the end_times filled in this period.
+                rows_start = max(period_start, first_end_time - timedelta(hours=1))
+                queries = [increment_query, insert_missing_query]
+            elif stat.additive:
+                rows_start = period_start
+                queries = [rollup_query]
+            else:
+                # Just the rows at rows_end; both hours and days end
+                # more than an hour after the previous end_time.
+                rows_start = rows_end - timedelta(hours=1)
+                queries = [rollup_query]
+            for rollup_table, count_table, id_column, id_match in rollup_tables:
+                if not incremental:
+                    rollup_table.objects.filter(property=stat.property, frequency=frequency,
+                                                end_time=period_end).delete()
+                start = time.time()
+                rowcount = 0
+                for query in queries:
+                    query = query % {'rollup_table': rollup_table._meta.db_table,
+                                     'count_table': count_table._meta.db_table,
+                                     'id_column': id_column,
+                                     'id_match': id_match,
+                                     'property': stat.property,
+                                     'frequency': frequency}
+                    cursor.execute(query, {'period_end': period_end, 'rows_start': rows_start,
+                                           'rows_end': rows_end})
+                    rowcount += cursor.rowcount
+                end = time.time()
+                logger.info("%s %s %s aggregation (%dms/%sr)" % (
+                    stat.property, frequency, rollup_table.__name__,
+                    (end - start) * 1000, rowcount))
+            period_start, period_end = get_rollup_period(period_end + timedelta(hours=1),
+                                                         frequency)
+    cursor.close()
+
 ## Utility functions called from outside counts.py ##
 
+def get_rollup_period(end_time: datetime, frequency: str) -> Tuple[datetime, datetime]:
+    '''
+    Returns the start and end of the week (starting on a Monday) or
+    month containing the hour or day that ends at end_time.
+    '''
+    verify_UTC(end_time)
+    day_start = floor_to_day(end_time - timedelta(hours=1))
+    if frequency == CountStat.WEEK:
+        start = day_start - timedelta(days=day_start.weekday())
+        return start, start + timedelta(weeks=1)
+    elif frequency == CountStat.MONTH:
+        start = day_start.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    else:
+        raise AssertionError("Unknown rollup frequency: %s" % (frequency,))
+
 # called from zerver/lib/actions.py; should not throw any errors
 def do_increment_logging_stat(zerver_object: Union[Realm, UserProfile, Stream], stat: CountStat,
                               subgroup: Optional[Union[str, int, bool]], event_time: datetime,
@@ -225,6 +499,8 @@ def do_drop_all_analytics_tables() -> None:
     StreamCount.objects.all().delete()
     RealmCount.objects.all().delete()
     InstallationCount.objects.all().delete()
+    RealmRollupCount.objects.all().delete()
+    InstallationRollupCount.objects.all().delete()
     FillState.objects.all().delete()
     Anomaly.objects.all().delete()
 
@@ -233,12 +509,15 @@ def do_drop_single_stat(property: str) -> None:
     StreamCount.objects.filter(property=property).delete()
     RealmCount.objects.filter(property=property).delete()
     InstallationCount.objects.filter(property=property).delete()
+    RealmRollupCount.objects.filter(property=property).delete()
+    InstallationRollupCount.objects.filter(property=property).delete()
     FillState.objects.filter(property=property).delete()
 
 ## DataCollector-level operations ##
 
 def do_pull_by_sql_query(property: str, start_time: datetime, end_time: datetime, query: str,
-                         group_by: Optional[Tuple[models.Model, str]]) -> int:
+                         group_by: Optional[Tuple[models.Model, str]],
+                         frequency: Optional[str]=None) -> int:
     if group_by is None:
         subgroup = 'NULL'
         group_by_clause  = ''
@@ -251,7 +530,7 @@ def do_pull_by_sql_query(property: str, start_time: datetime, end_time: datetime
     # We pass in the datetimes as params to cursor.execute so that we don't have to
     # think about how to convert python datetimes to SQL datetimes.
     query_ = query % {'property': property, 'subgroup': subgroup,
-                      'group_by_clause': group_by_clause}
+                      'group_by_clause': group_by_clause, 'frequency': frequency}
     cursor = connection.cursor()
     cursor.execute(query_, {'time_start': start_time, 'time_end': end_time})
     rowcount = cursor.rowcount
@@ -259,10 +538,20 @@ def do_pull_by_sql_query(property: str, start_time: datetime, end_time: datetime
     return rowcount
 
 def sql_data_collector(output_table: Type[BaseCount], query: str,
-                       group_by: Optional[Tuple[models.Model, str]]) -> DataCollector:
+                       group_by: Optional[Tuple[models.Model, str]],
+                       range_query: Optional[str]=None) -> DataCollector:
     def pull_function(property: str, start_time: datetime, end_time: datetime) -> int:
         return do_pull_by_sql_query(property, start_time, end_time, query, group_by)
-    return DataCollector(output_table, pull_function)
+
+    def range_pull_function(property: str, start_time: datetime, end_time: datetime,
+                            frequency: str) -> int:
+        assert range_query is not None
+        return do_pull_by_sql_query(property, start_time, end_time, range_query, group_by,
+                                    frequency=frequency)
+
+    if range_query is None:
+        return DataCollector(output_table, pull_function)
+    return DataCollector(output_table, pull_function, range_pull_function)
 
 def do_pull_minutes_active(property: str, start_time: datetime, end_time: datetime) -> int:
     user_activity_intervals = UserActivityInterval.objects.filter(
@@ -301,6 +590,32 @@ count_message_by_user_query = """
     GROUP BY zerver_userprofile.id %(group_by_clause)s
 """
 
+# The *_range_query variants of the queries below fill every
+# %(frequency)s ending in (time_start, time_end] at once, by grouping
+# the messages by the end of the %(frequency)s they were sent in.
+# Postgres connections use UTC, so date_trunc agrees with
+# ceiling_to_hour and ceiling_to_day.
+count_message_by_user_range_query = """
+    INSERT INTO analytics_usercount
+        (user_id, realm_id, value, property, subgroup, end_time)
+    SELECT
+        zerver_userprofile.id, zerver_userprofile.realm_id, count(*),
+        '%(property)s', %(subgroup)s,
+        date_trunc('%(frequency)s', zerver_message.pub_date) + interval '1 %(frequency)s'
+    FROM zerver_userprofile
+    JOIN zerver_message
+    ON
+        zerver_userprofile.id = zerver_message.sender_id
+    WHERE
+        zerver_userprofile.date_joined <
+            date_trunc('%(frequency)s', zerver_message.pub_date) + interval '1 %(frequency)s' AND
+        zerver_message.pub_date >= %%(time_start)s AND
+        zerver_message.pub_date < %%(time_end)s
+    GROUP BY zerver_userprofile.id,
+        date_trunc('%(frequency)s', zerver_message.pub_date) + interval '1 %(frequency)s'
+        %(group_by_clause)s
+"""
+
 # Note: ignores the group_by / group_by_clause.
 count_message_type_by_user_query = """
     INSERT INTO analytics_usercount
@@ -338,6 +653,45 @@ count_message_type_by_user_query = """
     GROUP BY realm_id, id, message_type
 """
 
+count_message_type_by_user_range_query = """
+    INSERT INTO analytics_usercount
+            (realm_id, user_id, value, property, subgroup, end_time)
+    SELECT realm_id, id, SUM(count) AS value, '%(property)s', message_type, bucket_end_time
+    FROM
+    (
+        SELECT zerver_userprofile.realm_id, zerver_userprofile.id, count(*),
+        CASE WHEN
+                  zerver_recipient.type = 1 THEN 'private_message'
+             WHEN
+                  zerver_recipient.type = 3 THEN 'huddle_message'
+             WHEN
+                  zerver_stream.invite_only = TRUE THEN 'private_stream'
+             ELSE 'public_stream'
+        END
+        message_type,
+        date_trunc('%(frequency)s', zerver_message.pub_date) + interval '1 %(frequency)s'
+        bucket_end_time
+
+        FROM zerver_userprofile
+        JOIN zerver_message
+        ON
+            zerver_userprofile.id = zerver_message.sender_id AND
+            zerver_message.pub_date >= %%(time_start)s AND
+            zerver_message.pub_date < %%(time_end)s
+        JOIN zerver_recipient
+        ON
+            zerver_message.recipient_id = zerver_recipient.id
+        LEFT JOIN zerver_stream
+        ON
+            zerver_recipient.type_id = zerver_stream.id
+        GROUP BY
+            zerver_userprofile.realm_id, zerver_userprofile.id,
+            zerver_recipient.type, zerver_stream.invite_only,
+            date_trunc('%(frequency)s', zerver_message.pub_date) + interval '1 %(frequency)s'
+    ) AS subquery
+    GROUP BY realm_id, id, message_type, bucket_end_time
+"""
+
 # This query joins to the UserProfile table since all current queries that
 # use this also subgroup on UserProfile.is_bot. If in the future there is a
 # stat that counts messages by stream and doesn't need the UserProfile
@@ -365,6 +719,33 @@ count_message_by_stream_query = """
     GROUP BY zerver_stream.id %(group_by_clause)s
 """
 
+count_message_by_stream_range_query = """
+    INSERT INTO analytics_streamcount
+        (stream_id, realm_id, value, property, subgroup, end_time)
+    SELECT
+        zerver_stream.id, zerver_stream.realm_id, count(*), '%(property)s', %(subgroup)s,
+        date_trunc('%(frequency)s', zerver_message.pub_date) + interval '1 %(frequency)s'
+    FROM zerver_stream
+    JOIN zerver_recipient
+    ON
+        zerver_stream.id = zerver_recipient.type_id
+    JOIN zerver_message
+    ON
+        zerver_recipient.id = zerver_message.recipient_id
+    JOIN zerver_userprofile
+    ON
+        zerver_message.sender_id = zerver_userprofile.id
+    WHERE
+        zerver_stream.date_created <
+            date_trunc('%(frequency)s', zerver_message.pub_date) + interval '1 %(frequency)s' AND
+        zerver_recipient.type = 2 AND
+        zerver_message.pub_date >= %%(time_start)s AND
+        zerver_message.pub_date < %%(time_end)s
+    GROUP BY zerver_stream.id,
+        date_trunc('%(frequency)s', zerver_message.pub_date) + interval '1 %(frequency)s'
+        %(group_by_clause)s
+"""
+
 # Hardcodes the query needed by active_users:is_bot:day, since that is
 # currently the only stat that uses this.
 count_user_by_realm_query = """
@@ -477,15 +858,20 @@ count_stats_ = [
     # These are also the set of stats that read from the Message table.
 
     CountStat('messages_sent:is_bot:hour',
-              sql_data_collector(UserCount, count_message_by_user_query, (UserProfile, 'is_bot')),
+              sql_data_collector(UserCount, count_message_by_user_query, (UserProfile, 'is_bot'),
+                                 range_query=count_message_by_user_range_query),
               CountStat.HOUR),
     CountStat('messages_sent:message_type:day',
-              sql_data_collector(UserCount, count_message_type_by_user_query, None), CountStat.DAY),
+              sql_data_collector(UserCount, count_message_type_by_user_query, None,
+                                 range_query=count_message_type_by_user_range_query),
+              CountStat.DAY),
     CountStat('messages_sent:client:day',
-              sql_data_collector(UserCount, count_message_by_user_query, (Message, 'sending_client_id')),
+              sql_data_collector(UserCount, count_message_by_user_query, (Message, 'sending_client_id'),
+                                 range_query=count_message_by_user_range_query),
               CountStat.DAY),
     CountStat('messages_in_stream:is_bot:day',
-              sql_data_collector(StreamCount, count_message_by_stream_query, (UserProfile, 'is_bot')),
+              sql_data_collector(StreamCount, count_message_by_stream_query, (UserProfile, 'is_bot'),
+                                 range_query=count_message_by_stream_range_query),
               CountStat.DAY),
 
     # Number of Users stats
@@ -496,7 +882,7 @@ count_stats_ = [
     # Important that this stay a daily stat, so that 'realm_active_humans::day' works as expected.
     CountStat('active_users_audit:is_bot:day',
               sql_data_collector(UserCount, check_realmauditlog_by_user_query, (UserProfile, 'is_bot')),
-              CountStat.DAY),
+              CountStat.DAY, additive=False),
     # Sanity check on 'active_users_audit:is_bot:day', and a archetype for future LoggingCountStats.
     # In RealmCount, 'active_users_audit:is_bot:day' should be the partial
     # sum sequence of 'active_users_log:is_bot:day', for any realm that
@@ -508,17 +894,19 @@ count_stats_ = [
     # simplest of the three to inspect by hand.
     CountStat('active_users:is_bot:day',
               sql_data_collector(RealmCount, count_user_by_realm_query, (UserProfile, 'is_bot')),
-              CountStat.DAY, interval=TIMEDELTA_MAX),
+              CountStat.DAY, interval=TIMEDELTA_MAX, additive=False),
 
     # User Activity stats
     # Stats that measure user activity in the UserActivityInterval sense.
 
     CountStat('1day_actives::day',
               sql_data_collector(UserCount, check_useractivityinterval_by_user_query, None),
-              CountStat.DAY, interval=timedelta(days=1)-UserActivityInterval.MIN_INTERVAL_LENGTH),
+              CountStat.DAY, interval=timedelta(days=1)-UserActivityInterval.MIN_INTERVAL_LENGTH,
+              additive=False),
     CountStat('15day_actives::day',
               sql_data_collector(UserCount, check_useractivityinterval_by_user_query, None),
-              CountStat.DAY, interval=timedelta(days=15)-UserActivityInterval.MIN_INTERVAL_LENGTH),
+              CountStat.DAY, interval=timedelta(days=15)-UserActivityInterval.MIN_INTERVAL_LENGTH,
+              additive=False),
     CountStat('minutes_active::day', DataCollector(UserCount, do_pull_minutes_active), CountStat.DAY),
 
     # Rate limiting stats
@@ -532,7 +920,7 @@ count_stats_ = [
     # Canonical account of the number of active humans in a realm on each day.
     DependentCountStat('realm_active_humans::day',
                        sql_data_collector(RealmCount, count_realm_active_humans_query, None),
-                       CountStat.DAY,
+                       CountStat.DAY, additive=False,
                        dependencies=['active_users_audit:is_bot:day', '15day_actives::day'])
 ]
 
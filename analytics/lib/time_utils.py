@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta
 from typing import List, Optional
 
-from analytics.lib.counts import CountStat
+from analytics.lib.counts import CountStat, get_rollup_period
 from zerver.lib.timestamp import floor_to_day, floor_to_hour, verify_UTC
 
 # If min_length is None, returns end_times from ceiling(start) to floor(end), inclusive.
 # If min_length is greater than 0, pads the list to the left.
 # So informally, time_range(Sep 20, Sep 22, day, None) returns [Sep 20, Sep 21, Sep 22],
 # and time_range(Sep 20, Sep 22, day, 5) returns [Sep 18, Sep 19, Sep 20, Sep 21, Sep 22]
+# For the rollup frequencies (week and month), the last end_time is instead the
+# end of the week or month containing end, which may be after end.
 def time_range(start: datetime, end: datetime, frequency: str,
                min_length: Optional[int]) -> List[datetime]:
     verify_UTC(start)
@@ -18,6 +20,14 @@ def time_range(start: datetime, end: datetime, frequency: str,
     elif frequency == CountStat.DAY:
         end = floor_to_day(end)
         step = timedelta(days=1)
+    elif frequency in CountStat.ROLLUP_FREQUENCIES:
+        # Weeks and months don't have a fixed step.
+        times = []
+        current = get_rollup_period(end, frequency)[1]
+        while current >= start or (min_length is not None and len(times) < min_length):
+            times.append(current)
+            current = get_rollup_period(current, frequency)[0]
+        return list(reversed(times))
     else:
         raise AssertionError("Unknown frequency: %s" % (frequency,))
 
@@ -6,7 +6,7 @@ from django.core.management.base import BaseCommand
 from django.utils.timezone import now as timezone_now
 
 from analytics.lib.counts import COUNT_STATS, \
-    CountStat, do_drop_all_analytics_tables
+    CountStat, do_aggregate_to_rollup_tables, do_drop_all_analytics_tables
 from analytics.lib.fixtures import generate_time_series_data
 from analytics.lib.time_utils import time_range
 from analytics.models import BaseCount, FillState, RealmCount, UserCount, \
@@ -213,3 +213,8 @@ class Command(BaseCommand):
         insert_fixture_data(stat, stream_data, StreamCount)
         FillState.objects.create(property=stat.property, end_time=last_end_time,
                                  state=FillState.DONE)
+
+        # The fixture data was inserted directly, so roll it up here.
+        for property in FillState.objects.values_list('property', flat=True):
+            do_aggregate_to_rollup_tables(COUNT_STATS[property], last_end_time,
+                                          first_end_time=installation_time)
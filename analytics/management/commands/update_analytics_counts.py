@@ -4,12 +4,13 @@ from argparse import ArgumentParser
 from typing import Any, Dict
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils.dateparse import parse_datetime
 from django.utils.timezone import now as timezone_now
 from django.utils.timezone import utc as timezone_utc
 
-from analytics.lib.counts import COUNT_STATS, logger, process_count_stat
+from analytics.lib.counts import COUNT_STATS, logger, process_count_stat, \
+    process_count_stats
 from scripts.lib.zulip_tools import ENDC, WARNING
 from zerver.lib.timestamp import floor_to_hour
 from zerver.models import Realm
@@ -32,6 +33,11 @@ class Command(BaseCommand):
         parser.add_argument('--stat', '-s',
                             type=str,
                             help="CountStat to process. If omitted, all stats are processed.")
+        parser.add_argument('--processes',
+                            type=int,
+                            help="Number of stats to process concurrently, each in its "
+                                 "own process.",
+                            default=1)
         parser.add_argument('--verbose',
                             action='store_true',
                             help="Print timing information to stdout.",
@@ -74,11 +80,17 @@ class Command(BaseCommand):
             start = time.time()
             last = start
 
-        for stat in stats:
-            process_count_stat(stat, fill_to_time)
-            if options['verbose']:
-                print("Updated %s in %.3fs" % (stat.property, time.time() - last))
-                last = time.time()
+        if options['processes'] > 1 and len(stats) > 1:
+            failed = process_count_stats(stats, fill_to_time, processes=options['processes'])
+            if failed:
+                raise CommandError("Failed to update %s; see %s" % (
+                    ', '.join(failed), settings.ANALYTICS_LOG_PATH))
+        else:
+            for stat in stats:
+                process_count_stat(stat, fill_to_time)
+                if options['verbose']:
+                    print("Updated %s in %.3fs" % (stat.property, time.time() - last))
+                    last = time.time()
 
         if options['verbose']:
             print("Finished updating analytics counts through %s in %.3fs" %
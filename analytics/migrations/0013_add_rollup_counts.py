@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0191_realm_seat_limit'),
+        ('analytics', '0012_add_on_delete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstallationRollupCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('property', models.CharField(max_length=32)),
+                ('subgroup', models.CharField(max_length=16, null=True)),
+                ('end_time', models.DateTimeField()),
+                ('value', models.BigIntegerField()),
+                ('frequency', models.CharField(max_length=8)),
+                ('anomaly', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='analytics.Anomaly')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RealmRollupCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('property', models.CharField(max_length=32)),
+                ('subgroup', models.CharField(max_length=16, null=True)),
+                ('end_time', models.DateTimeField()),
+                ('value', models.BigIntegerField()),
+                ('frequency', models.CharField(max_length=8)),
+                ('anomaly', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='analytics.Anomaly')),
+                ('realm', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='zerver.Realm')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='installationrollupcount',
+            unique_together=set([('property', 'subgroup', 'frequency', 'end_time')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='realmrollupcount',
+            unique_together=set([('realm', 'property', 'subgroup', 'frequency', 'end_time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='realmrollupcount',
+            index_together=set([('property', 'frequency', 'end_time')]),
+        ),
+    ]
@@ -98,3 +98,33 @@ class StreamCount(BaseCount):
     def __str__(self) -> str:
         return "<StreamCount: %s %s %s %s %s>" % (
             self.stream, self.property, self.subgroup, self.value, self.id)
+
+# Weekly and monthly rollups of the RealmCount and InstallationCount
+# rows of each stat, maintained by do_aggregate_to_summary_table, so
+# that charts over long ranges don't have to read every hourly or
+# daily row.  end_time is the end of the week (a Monday, UTC) or
+# month; the rollup of a week or month that isn't over yet covers the
+# end_times filled so far.
+class InstallationRollupCount(BaseCount):
+    # One of CountStat.ROLLUP_FREQUENCIES
+    frequency = models.CharField(max_length=8)  # type: str
+
+    class Meta:
+        unique_together = ("property", "subgroup", "frequency", "end_time")
+
+    def __str__(self) -> str:
+        return "<InstallationRollupCount: %s %s %s %s>" % (
+            self.property, self.subgroup, self.frequency, self.value)
+
+class RealmRollupCount(BaseCount):
+    realm = models.ForeignKey(Realm, on_delete=models.CASCADE)
+    # One of CountStat.ROLLUP_FREQUENCIES
+    frequency = models.CharField(max_length=8)  # type: str
+
+    class Meta:
+        unique_together = ("realm", "property", "subgroup", "frequency", "end_time")
+        index_together = ["property", "frequency", "end_time"]
+
+    def __str__(self) -> str:
+        return "<RealmRollupCount: %s %s %s %s %s>" % (
+            self.realm, self.property, self.subgroup, self.frequency, self.value)
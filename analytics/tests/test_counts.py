@@ -1,7 +1,8 @@
 
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple, Type, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
 
+import mock
 import ujson
 from django.apps import apps
 from django.db import models
@@ -12,12 +13,14 @@ from django.utils.timezone import utc as timezone_utc
 
 from analytics.lib.counts import COUNT_STATS, CountStat, DataCollector, \
     DependentCountStat, LoggingCountStat, do_aggregate_to_summary_table, \
-    do_drop_all_analytics_tables, do_drop_single_stat, \
-    do_fill_count_stat_at_hour, do_increment_logging_stat, \
-    process_count_stat, sql_data_collector
+    do_delete_counts_at_hour, do_drop_all_analytics_tables, do_drop_single_stat, \
+    do_fill_count_stat_at_hour, do_fill_count_stat_for_range, \
+    do_increment_logging_stat, get_fill_waves, get_rollup_period, \
+    process_count_stat, process_count_stats, sql_data_collector
 from analytics.models import Anomaly, BaseCount, \
-    FillState, InstallationCount, RealmCount, StreamCount, \
-    UserCount, installation_epoch, last_successful_fill
+    FillState, InstallationCount, InstallationRollupCount, RealmCount, \
+    RealmRollupCount, StreamCount, UserCount, installation_epoch, \
+    last_successful_fill
 from zerver.lib.actions import do_activate_user, do_create_user, \
     do_deactivate_user, do_reactivate_user, update_user_activity_interval, \
     do_invite_users, do_revoke_user_invite, do_resend_user_invite_email, \
@@ -98,7 +101,7 @@ class AnalyticsTestCase(TestCase):
         if property is None:
             property = self.current_property
         queryset = table.objects.filter(property=property, end_time=end_time).filter(**kwargs)
-        if table is not InstallationCount:
+        if table not in (InstallationCount, InstallationRollupCount):
             if realm is None:
                 realm = self.default_realm
             queryset = queryset.filter(realm=realm)
@@ -140,7 +143,7 @@ class AnalyticsTestCase(TestCase):
                 kwargs[arg_keys[i]] = values[i]
             for key, value in defaults.items():
                 kwargs[key] = kwargs.get(key, value)
-            if table is not InstallationCount:
+            if table not in (InstallationCount, InstallationRollupCount):
                 if 'realm' not in kwargs:
                     if 'user' in kwargs:
                         kwargs['realm'] = kwargs['user'].realm
@@ -299,6 +302,88 @@ class TestProcessCountStat(AnalyticsTestCase):
         self.assertEqual(InstallationCount.objects.filter(property='stat4').count(), 1)
         self.assertFillStateEquals(stat4, hour24)
 
+    def test_process_stat_range(self) -> None:
+        stat = COUNT_STATS['messages_sent:is_bot:hour']
+        self.current_property = stat.property
+        FillState.objects.create(property=stat.property, end_time=self.TIME_ZERO - 4*self.HOUR,
+                                 state=FillState.DONE)
+        user = self.create_user(date_joined=self.TIME_ZERO - self.DAY)
+        recipient = self.create_stream_with_recipient()[1]
+        for hours_ago in [3.5, 3.2, 1.5, 0.5]:
+            self.create_message(user, recipient, pub_date=self.TIME_ZERO - hours_ago*self.HOUR)
+
+        data_collector = stat.data_collector
+        with mock.patch.object(data_collector, 'range_pull_function',
+                               wraps=data_collector.range_pull_function) as range_mock, \
+                mock.patch.object(data_collector, 'pull_function') as pull_mock:
+            process_count_stat(stat, self.TIME_ZERO)
+        range_mock.assert_called_once_with(stat.property, self.TIME_ZERO - 4*self.HOUR,
+                                           self.TIME_ZERO, CountStat.HOUR)
+        pull_mock.assert_not_called()
+
+        self.assertFillStateEquals(stat, self.TIME_ZERO)
+        self.assertTableState(UserCount, ['value', 'subgroup', 'user', 'end_time'],
+                              [[2, 'false', user, self.TIME_ZERO - 3*self.HOUR],
+                               [1, 'false', user, self.TIME_ZERO - self.HOUR],
+                               [1, 'false', user, self.TIME_ZERO]])
+        self.assertTableState(InstallationCount, ['value', 'subgroup', 'end_time'],
+                              [[2, 'false', self.TIME_ZERO - 3*self.HOUR],
+                               [1, 'false', self.TIME_ZERO - self.HOUR],
+                               [1, 'false', self.TIME_ZERO]])
+
+        # A single hour left to fill is filled as before.
+        with mock.patch.object(data_collector, 'range_pull_function') as range_mock:
+            process_count_stat(stat, self.TIME_ZERO + self.HOUR)
+        range_mock.assert_not_called()
+        self.assertFillStateEquals(stat, self.TIME_ZERO + self.HOUR)
+
+    def test_get_fill_waves(self) -> None:
+        waves = get_fill_waves(list(COUNT_STATS.values()))
+        self.assertEqual([[stat.property for stat in wave] for wave in waves[1:]],
+                         [['realm_active_humans::day']])
+        self.assertEqual(sum(len(wave) for wave in waves), len(COUNT_STATS))
+
+        # Dependencies that aren't being processed don't matter.
+        stat = COUNT_STATS['realm_active_humans::day']
+        self.assertEqual(get_fill_waves([stat]), [[stat]])
+
+        stat1 = DependentCountStat('stat1', DataCollector(RealmCount, None), CountStat.DAY,
+                                   dependencies=['stat2'])
+        stat2 = DependentCountStat('stat2', DataCollector(RealmCount, None), CountStat.DAY,
+                                   dependencies=['stat1'])
+        with self.assertRaises(AssertionError):
+            get_fill_waves([stat1, stat2])
+
+    def test_process_count_stats_failure(self) -> None:
+        stat1 = CountStat('stat1', DataCollector(RealmCount, None), CountStat.DAY)
+        stat2 = CountStat('stat2', DataCollector(RealmCount, None), CountStat.DAY)
+        stat3 = DependentCountStat('stat3', DataCollector(RealmCount, None), CountStat.DAY,
+                                   dependencies=['stat1'])
+        stat4 = DependentCountStat('stat4', DataCollector(RealmCount, None), CountStat.DAY,
+                                   dependencies=['stat2'])
+        processed = []  # type: List[str]
+
+        def process(stat: CountStat, fill_to_time: datetime) -> None:
+            if stat.property == 'stat1':
+                raise Exception("failed")
+            processed.append(stat.property)
+
+        def run_in_process(job: Any, data: List[CountStat], threads: int,
+                           stop_on_error: bool) -> Any:
+            for item in data:
+                yield (job(item), item)
+
+        # A failure doesn't stop the rest of its wave, and only skips
+        # the stats that depend on it.
+        with mock.patch('analytics.lib.counts.process_count_stat', side_effect=process), \
+                mock.patch('analytics.lib.counts.run_parallel', side_effect=run_in_process), \
+                mock.patch('analytics.lib.counts.connection'), \
+                mock.patch('analytics.lib.counts.logger'):
+            failed = process_count_stats([stat1, stat2, stat3, stat4], self.TIME_ZERO,
+                                         processes=2)
+        self.assertEqual(failed, ['stat1', 'stat3'])
+        self.assertEqual(processed, ['stat2', 'stat4'])
+
 class TestCountStats(AnalyticsTestCase):
     def setUp(self) -> None:
         super().setUp()
@@ -669,6 +754,45 @@ class TestCountStats(AnalyticsTestCase):
         self.assertTableState(InstallationCount, ['value'], [[61 + 121 + 24*60 + 1]])
         self.assertTableState(StreamCount, [], [])
 
+    def get_count_rows(self) -> Set[Tuple[str, Tuple[Tuple[str, Any], ...]]]:
+        rows = set()  # type: Set[Tuple[str, Tuple[Tuple[str, Any], ...]]]
+        for table in [UserCount, StreamCount, RealmCount, InstallationCount]:
+            for row in table.objects.values():
+                del row['id']
+                rows.add((table.__name__, tuple(sorted(row.items()))))
+        return rows
+
+    def test_range_queries(self) -> None:
+        user = self.create_user()
+        bot = self.create_user(is_bot=True)
+        stream_recipient = self.create_stream_with_recipient()[1]
+        private_stream_recipient = self.create_stream_with_recipient(invite_only=True)[1]
+        huddle_recipient = self.create_huddle_with_recipient()[1]
+        for hours_ago in [0.5, 1.5, 1.6, 25, 30]:
+            pub_date = self.TIME_ZERO - hours_ago*self.HOUR
+            self.create_message(user, stream_recipient, pub_date=pub_date)
+            self.create_message(user, private_stream_recipient, pub_date=pub_date)
+            self.create_message(bot, huddle_recipient, pub_date=pub_date,
+                                sending_client=get_client("API"))
+
+        # Filling a range of hours or days at once gives the same
+        # rows as filling them one at a time.
+        for stat in COUNT_STATS.values():
+            if stat.data_collector.range_pull_function is None:
+                continue
+            step = self.HOUR if stat.frequency == CountStat.HOUR else self.DAY
+            end_times = [self.TIME_ZERO - i*step for i in [2, 1, 0]]
+
+            do_fill_count_stat_for_range(stat, end_times[0], end_times[-1])
+            range_rows = self.get_count_rows()
+            do_drop_all_analytics_tables()
+
+            for end_time in end_times:
+                do_fill_count_stat_at_hour(stat, end_time)
+            self.assertTrue(range_rows)
+            self.assertEqual(self.get_count_rows(), range_rows)
+            do_drop_all_analytics_tables()
+
 class TestDoAggregateToSummaryTable(AnalyticsTestCase):
     # do_aggregate_to_summary_table is mostly tested by the end to end
     # nature of the tests in TestCountStats. But want to highlight one
@@ -680,6 +804,97 @@ class TestDoAggregateToSummaryTable(AnalyticsTestCase):
         do_aggregate_to_summary_table(stat, self.TIME_ZERO)
         self.assertFalse(RealmCount.objects.exists())
         self.assertFalse(InstallationCount.objects.exists())
+        self.assertFalse(RealmRollupCount.objects.exists())
+        self.assertFalse(InstallationRollupCount.objects.exists())
+
+class TestRollups(AnalyticsTestCase):
+    def test_get_rollup_period(self) -> None:
+        # TIME_ZERO is Monday, March 14
+        monday = self.TIME_ZERO
+        self.assertEqual(get_rollup_period(monday, CountStat.WEEK),
+                         (monday - 7*self.DAY, monday))
+        self.assertEqual(get_rollup_period(monday + self.HOUR, CountStat.WEEK),
+                         (monday, monday + 7*self.DAY))
+        self.assertEqual(get_rollup_period(monday + 7*self.DAY, CountStat.WEEK),
+                         (monday, monday + 7*self.DAY))
+        march = datetime(1988, 3, 1).replace(tzinfo=timezone_utc)
+        april = datetime(1988, 4, 1).replace(tzinfo=timezone_utc)
+        self.assertEqual(get_rollup_period(monday, CountStat.MONTH), (march, april))
+        self.assertEqual(get_rollup_period(april, CountStat.MONTH), (march, april))
+        self.assertEqual(get_rollup_period(april + self.DAY, CountStat.MONTH),
+                         (april, datetime(1988, 5, 1).replace(tzinfo=timezone_utc)))
+        with self.assertRaises(AssertionError):
+            get_rollup_period(monday, CountStat.DAY)
+
+    def insert_realm_counts(self, property: str, values: List[int]) -> None:
+        # One daily row per value, with end_times from the Sunday before
+        # TIME_ZERO on, skipping zeros.
+        RealmCount.objects.bulk_create([
+            RealmCount(realm=self.default_realm, property=property, value=value,
+                       end_time=self.TIME_ZERO + (i - 1)*self.DAY)
+            for i, value in enumerate(values) if value != 0])
+
+    def test_additive_stat(self) -> None:
+        stat = LoggingCountStat('test stat', RealmCount, CountStat.DAY)
+        self.current_property = stat.property
+        self.insert_realm_counts(stat.property, [1, 2, 4])
+        do_aggregate_to_summary_table(stat, self.TIME_ZERO + self.DAY,
+                                      first_end_time=self.TIME_ZERO - self.DAY)
+
+        april = datetime(1988, 4, 1).replace(tzinfo=timezone_utc)
+        # The rows ending on the Sunday and the Monday are the last two
+        # days of the week ending at TIME_ZERO.
+        expected = [[CountStat.WEEK, self.TIME_ZERO, 3],
+                    [CountStat.WEEK, self.TIME_ZERO + 7*self.DAY, 4],
+                    [CountStat.MONTH, april, 7]]
+        self.assertTableState(RealmRollupCount, ['frequency', 'end_time', 'value'], expected)
+        self.assertTableState(InstallationRollupCount, ['frequency', 'end_time', 'value'],
+                              expected)
+
+        # Filling another day adds its rows to the rollups of its week
+        # and month, without recomputing them from the earlier rows.
+        self.insert_realm_counts(stat.property, [0, 0, 0, 8])
+        RealmCount.objects.filter(property=stat.property,
+                                  end_time=self.TIME_ZERO).update(value=100)
+        InstallationCount.objects.filter(property=stat.property,
+                                         end_time=self.TIME_ZERO).update(value=100)
+        do_aggregate_to_summary_table(stat, self.TIME_ZERO + 2*self.DAY)
+        expected = [[CountStat.WEEK, self.TIME_ZERO, 3],
+                    [CountStat.WEEK, self.TIME_ZERO + 7*self.DAY, 12],
+                    [CountStat.MONTH, april, 15]]
+        self.assertTableState(RealmRollupCount, ['frequency', 'end_time', 'value'], expected)
+        self.assertTableState(InstallationRollupCount, ['frequency', 'end_time', 'value'],
+                              expected)
+
+        # Undoing a fill recomputes the rollups containing it from the
+        # rows that are left.
+        do_delete_counts_at_hour(stat, self.TIME_ZERO + 2*self.DAY)
+        expected = [[CountStat.WEEK, self.TIME_ZERO, 3],
+                    [CountStat.WEEK, self.TIME_ZERO + 7*self.DAY, 4],
+                    [CountStat.MONTH, april, 105]]
+        self.assertTableState(RealmRollupCount, ['frequency', 'end_time', 'value'], expected)
+        self.assertTableState(InstallationRollupCount, ['frequency', 'end_time', 'value'],
+                              expected)
+
+    def test_non_additive_stat(self) -> None:
+        stat = CountStat('test stat', DataCollector(RealmCount, None), CountStat.DAY,
+                         additive=False)
+        self.current_property = stat.property
+        self.insert_realm_counts(stat.property, [1, 2, 4])
+        do_aggregate_to_summary_table(stat, self.TIME_ZERO + self.DAY,
+                                      first_end_time=self.TIME_ZERO - self.DAY)
+
+        # The value at the last end_time filled in each week or month
+        april = datetime(1988, 4, 1).replace(tzinfo=timezone_utc)
+        self.assertTableState(RealmRollupCount, ['frequency', 'end_time', 'value'],
+                              [[CountStat.WEEK, self.TIME_ZERO, 2],
+                               [CountStat.WEEK, self.TIME_ZERO + 7*self.DAY, 4],
+                               [CountStat.MONTH, april, 4]])
+
+        # A value of 0 at the last end_time means a rollup of 0.
+        do_aggregate_to_summary_table(stat, self.TIME_ZERO + 2*self.DAY)
+        self.assertTableState(RealmRollupCount, ['frequency', 'end_time', 'value'],
+                              [[CountStat.WEEK, self.TIME_ZERO, 2]])
 
 class TestDoIncrementLoggingStat(AnalyticsTestCase):
     def test_table_and_id_args(self) -> None:
@@ -842,6 +1057,8 @@ class TestDeleteStats(AnalyticsTestCase):
         StreamCount.objects.create(stream=stream, realm=stream.realm, **count_args)
         RealmCount.objects.create(realm=user.realm, **count_args)
         InstallationCount.objects.create(**count_args)
+        RealmRollupCount.objects.create(realm=user.realm, frequency=CountStat.WEEK, **count_args)
+        InstallationRollupCount.objects.create(frequency=CountStat.WEEK, **count_args)
         FillState.objects.create(property='test', end_time=self.TIME_ZERO, state=FillState.DONE)
         Anomaly.objects.create(info='test anomaly')
 
@@ -864,6 +1081,9 @@ class TestDeleteStats(AnalyticsTestCase):
             StreamCount.objects.create(stream=stream, realm=stream.realm, **count_args)
             RealmCount.objects.create(realm=user.realm, **count_args)
             InstallationCount.objects.create(**count_args)
+            RealmRollupCount.objects.create(realm=user.realm, frequency=CountStat.WEEK,
+                                            **count_args)
+            InstallationRollupCount.objects.create(frequency=CountStat.WEEK, **count_args)
         FillState.objects.create(property='to_delete', end_time=self.TIME_ZERO, state=FillState.DONE)
         FillState.objects.create(property='to_save', end_time=self.TIME_ZERO, state=FillState.DONE)
         Anomaly.objects.create(info='test anomaly')
@@ -4,7 +4,8 @@ from typing import Dict, List, Optional
 import mock
 from django.utils.timezone import utc
 
-from analytics.lib.counts import COUNT_STATS, CountStat
+from analytics.lib.counts import COUNT_STATS, CountStat, \
+    do_aggregate_to_rollup_tables, get_rollup_period
 from analytics.lib.time_utils import time_range
 from analytics.models import FillState, \
     RealmCount, UserCount, last_successful_fill
@@ -274,6 +275,66 @@ class TestGetChartData(ZulipTestCase):
         self.assertEqual(data['end_times'], [datetime_to_timestamp(dt) for dt in end_times])
         self.assertEqual(data['everyone'], {'_1day': [0]+self.data(100), '_15day': [0]+self.data(100), 'all_time': [0]+self.data(100)})
 
+    def test_max_length(self) -> None:
+        stat = COUNT_STATS['messages_sent:is_bot:hour']
+        self.insert_data(stat, ['true', 'false'], ['false'])
+        do_aggregate_to_rollup_tables(stat, self.end_times_hour[-1],
+                                      first_end_time=self.end_times_hour[0])
+
+        # max_length is long enough for the hourly data
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time',
+                                  'max_length': 4})
+        self.assert_json_success(result)
+        data = result.json()
+        self.assertEqual(data['frequency'], CountStat.HOUR)
+        self.assertEqual(data['end_times'], [datetime_to_timestamp(dt) for dt in self.end_times_hour])
+
+        # Otherwise, the data is rolled up by week
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time',
+                                  'max_length': 3})
+        self.assert_json_success(result)
+        data = result.json()
+        end_times = time_range(self.realm.date_created, self.end_times_hour[-1],
+                               CountStat.WEEK, None)
+        week_end = get_rollup_period(self.end_times_hour[2], CountStat.WEEK)[1]
+
+        def week_data(i: int) -> List[int]:
+            return [i if end_time == week_end else 0 for end_time in end_times]
+
+        self.assertEqual(data['frequency'], CountStat.WEEK)
+        self.assertEqual(data['end_times'], [datetime_to_timestamp(dt) for dt in end_times])
+        self.assertEqual(data['everyone'], {'bot': week_data(100), 'human': week_data(101)})
+        self.assertEqual(data['user'], {'bot': week_data(0), 'human': week_data(200)})
+
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time',
+                                  'min_length': 4, 'max_length': 3})
+        self.assert_json_error(result, 'min_length is larger than max_length')
+
+    def test_chart_data_cache(self) -> None:
+        stat = COUNT_STATS['messages_sent:is_bot:hour']
+        self.insert_data(stat, ['true', 'false'], ['false'])
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assert_json_success(result)
+        self.assertEqual(result.json()['everyone'], {'bot': self.data(100), 'human': self.data(101)})
+
+        # Until the FillState changes, the cached data is returned.
+        RealmCount.objects.filter(property=stat.property).delete()
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assert_json_success(result)
+        self.assertEqual(result.json()['everyone'], {'bot': self.data(100), 'human': self.data(101)})
+
+        FillState.objects.filter(property=stat.property).update(
+            end_time=self.end_times_hour[-1] + timedelta(hours=1))
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assert_json_success(result)
+        self.assertEqual(result.json()['everyone'], {'bot': [0] * 5, 'human': [0] * 5})
+
     def test_non_existent_chart(self) -> None:
         result = self.client_get('/json/analytics/chart_data',
                                  {'chart_name': 'does_not_exist'})
@@ -376,6 +437,13 @@ class TestTimeRange(ZulipTestCase):
                          [floor_hour-2*HOUR, floor_hour-HOUR, floor_hour, floor_hour+HOUR])
         self.assertEqual(time_range(floor_day, floor_day+DAY, CountStat.DAY, 4),
                          [floor_day-2*DAY, floor_day-DAY, floor_day, floor_day+DAY])
+        # test the rollup frequencies, whose last end_time is the end of
+        # the week or month containing end (floor_day is a Monday)
+        self.assertEqual(time_range(a_time, a_time, CountStat.WEEK, None), [floor_day+7*DAY])
+        self.assertEqual(time_range(floor_day-7*DAY, a_time, CountStat.WEEK, None),
+                         [floor_day-7*DAY, floor_day, floor_day+7*DAY])
+        self.assertEqual(time_range(a_time, a_time, CountStat.MONTH, 3),
+                         [datetime(2016, month, 1).replace(tzinfo=utc) for month in [2, 3, 4]])
 
 class TestMapArrays(ZulipTestCase):
     def test_map_arrays(self) -> None:
@@ -19,22 +19,26 @@ from django.http import HttpRequest, HttpResponse, HttpResponseNotFound
 from django.shortcuts import render
 from django.template import RequestContext, loader
 from django.utils.timezone import now as timezone_now, utc as timezone_utc
-from django.utils.translation import ugettext as _
+from django.utils.translation import get_language, ugettext as _
 from jinja2 import Markup as mark_safe
 import stripe
 
-from analytics.lib.counts import COUNT_STATS, CountStat, process_count_stat
+from analytics.lib.counts import COUNT_STATS, CountStat, get_rollup_period, \
+    process_count_stat
 from analytics.lib.time_utils import time_range
-from analytics.models import BaseCount, InstallationCount, \
-    RealmCount, StreamCount, UserCount, last_successful_fill, installation_epoch
+from analytics.models import BaseCount, InstallationCount, InstallationRollupCount, \
+    RealmCount, RealmRollupCount, StreamCount, UserCount, last_successful_fill, \
+    installation_epoch
 from zerver.decorator import require_server_admin, require_server_admin_api, \
     to_non_negative_int, to_utc_datetime, zulip_login_required, require_non_guest_user
+from zerver.lib.cache import cache_get, cache_set
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.json_encoder_for_html import JSONEncoderForHTML
 from zerver.lib.request import REQ, has_request_variables
 from zerver.lib.response import json_success
 from zerver.lib.timestamp import ceiling_to_day, \
     ceiling_to_hour, convert_to_UTC, timestamp_to_datetime
+from zerver.lib.utils import make_safe_digest
 from zerver.models import Client, get_realm, Realm, \
     UserActivity, UserActivityInterval, UserProfile
 from zproject.settings import get_secret
@@ -89,10 +93,28 @@ def get_chart_data_for_installation(request: HttpRequest, user_profile: UserProf
                                     chart_name: str=REQ(), **kwargs: Any) -> HttpResponse:
     return get_chart_data(request=request, user_profile=user_profile, for_installation=True, **kwargs)
 
+# Chart data is cached under a key including the FillState of each of
+# the chart's stats, so it's never served after update_analytics_counts
+# has changed them.  Bump the version when changing the format of the
+# cached data.
+CHART_DATA_CACHE_VERSION = 1
+CHART_DATA_CACHE_TIMEOUT = 24 * 60 * 60
+
+def chart_data_cache_key(chart_name: str, realm: Realm, user_profile: Optional[UserProfile],
+                         for_installation: bool, start: datetime, end: datetime,
+                         min_length: Optional[int], max_length: Optional[int],
+                         fill_times: List[Optional[datetime]]) -> str:
+    key_parts = [CHART_DATA_CACHE_VERSION, chart_name, realm.id,
+                 user_profile.id if user_profile is not None else None,
+                 for_installation, str(start), str(end), min_length, max_length,
+                 [str(fill_time) for fill_time in fill_times], get_language()]
+    return 'chart_data:%s' % (make_safe_digest(json.dumps(key_parts)),)
+
 @require_non_guest_user
 @has_request_variables
 def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name: str=REQ(),
                    min_length: Optional[int]=REQ(converter=to_non_negative_int, default=None),
+                   max_length: Optional[int]=REQ(converter=to_non_negative_int, default=None),
                    start: Optional[datetime]=REQ(converter=to_utc_datetime, default=None),
                    end: Optional[datetime]=REQ(converter=to_utc_datetime, default=None),
                    realm: Optional[Realm]=None, for_installation: bool=False) -> HttpResponse:
@@ -147,6 +169,8 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
     if start is not None and end is not None and start > end:
         raise JsonableError(_("Start time is later than end time. Start: %(start)s, End: %(end)s") %
                             {'start': start, 'end': end})
+    if min_length is not None and max_length is not None and min_length > max_length:
+        raise JsonableError(_("min_length is larger than max_length"))
 
     if realm is None:
         realm = user_profile.realm
@@ -155,9 +179,10 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
             start = installation_epoch()
         else:
             start = realm.date_created
+    fill_times = [last_successful_fill(stat.property) for stat in stats]
     if end is None:
-        end = max(last_successful_fill(stat.property) or
-                  datetime.min.replace(tzinfo=timezone_utc) for stat in stats)
+        end = max(fill_time or datetime.min.replace(tzinfo=timezone_utc)
+                  for fill_time in fill_times)
     if end is None or start > end:
         logging.warning("User from realm %s attempted to access /stats, but the computed "
                         "start time: %s (creation of realm or installation) is later than the computed "
@@ -165,9 +190,23 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
                         "analytics cron job running?" % (realm.string_id, start, end))
         raise JsonableError(_("No analytics data available. Please contact your server administrator."))
 
+    cache_key = chart_data_cache_key(chart_name, realm,
+                                     user_profile if UserCount in tables else None,
+                                     for_installation, start, end, min_length, max_length,
+                                     fill_times)
+    cached_data = cache_get(cache_key)
+    if cached_data is not None:
+        return json_success(data=cached_data[0])
+
     assert len(set([stat.frequency for stat in stats])) == 1
-    end_times = time_range(start, end, stats[0].frequency, min_length)
-    data = {'end_times': end_times, 'frequency': stats[0].frequency}  # type: Dict[str, Any]
+    # With max_length, use the finest of the stats' frequency and the
+    # rollup frequencies that needs at most max_length end_times (or
+    # the coarsest, if none does).
+    for frequency in [stats[0].frequency] + CountStat.ROLLUP_FREQUENCIES:
+        end_times = time_range(start, end, frequency, min_length)
+        if max_length is None or len(end_times) <= max_length:
+            break
+    data = {'end_times': end_times, 'frequency': frequency}  # type: Dict[str, Any]
 
     aggregation_level = {InstallationCount: 'everyone', RealmCount: 'everyone', UserCount: 'user'}
     # -1 is a placeholder value, since there is no relevant filtering on InstallationCount
@@ -176,12 +215,14 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
         data[aggregation_level[table]] = {}
         for stat in stats:
             data[aggregation_level[table]].update(get_time_series_by_subgroup(
-                stat, table, id_value[table], end_times, subgroup_to_label[stat], include_empty_subgroups))
+                stat, table, id_value[table], end_times, subgroup_to_label[stat],
+                include_empty_subgroups, frequency=frequency))
 
     if labels_sort_function is not None:
         data['display_order'] = labels_sort_function(data)
     else:
         data['display_order'] = None
+    cache_set(cache_key, data, timeout=CHART_DATA_CACHE_TIMEOUT)
     return json_success(data=data)
 
 def sort_by_totals(value_arrays: Dict[str, List[int]]) -> List[str]:
@@ -209,6 +250,10 @@ def sort_client_labels(data: Dict[str, Dict[str, List[int]]]) -> List[str]:
 def table_filtered_to_id(table: Type[BaseCount], key_id: int) -> QuerySet:
     if table == RealmCount:
         return RealmCount.objects.filter(realm_id=key_id)
+    elif table == RealmRollupCount:
+        return RealmRollupCount.objects.filter(realm_id=key_id)
+    elif table == InstallationRollupCount:
+        return InstallationRollupCount.objects.all()
     elif table == UserCount:
         return UserCount.objects.filter(user_id=key_id)
     elif table == StreamCount:
@@ -248,17 +293,45 @@ def rewrite_client_arrays(value_arrays: Dict[str, List[int]]) -> Dict[str, List[
             mapped_arrays[mapped_label] = [value_arrays[label][i] for i in range(0, len(array))]
     return mapped_arrays
 
+ROLLUP_TABLES = {
+    RealmCount: RealmRollupCount,
+    InstallationCount: InstallationRollupCount,
+}  # type: Dict[Type[BaseCount], Type[BaseCount]]
+
 def get_time_series_by_subgroup(stat: CountStat,
                                 table: Type[BaseCount],
                                 key_id: int,
                                 end_times: List[datetime],
                                 subgroup_to_label: Dict[Optional[str], str],
-                                include_empty_subgroups: bool) -> Dict[str, List[int]]:
-    queryset = table_filtered_to_id(table, key_id).filter(property=stat.property) \
-                                                  .values_list('subgroup', 'end_time', 'value')
+                                include_empty_subgroups: bool,
+                                frequency: Optional[str]=None) -> Dict[str, List[int]]:
+    # frequency is stat.frequency (the default) or one of
+    # CountStat.ROLLUP_FREQUENCIES.
     value_dicts = defaultdict(lambda: defaultdict(int))  # type: Dict[Optional[str], Dict[datetime, int]]
-    for subgroup, end_time, value in queryset:
-        value_dicts[subgroup][end_time] = value
+    if frequency is None or frequency == stat.frequency:
+        queryset = table_filtered_to_id(table, key_id).filter(property=stat.property) \
+                                                      .values_list('subgroup', 'end_time', 'value')
+        for subgroup, end_time, value in queryset:
+            value_dicts[subgroup][end_time] = value
+    elif table in ROLLUP_TABLES:
+        queryset = table_filtered_to_id(ROLLUP_TABLES[table], key_id).filter(
+            property=stat.property, frequency=frequency,
+            end_time__gte=end_times[0], end_time__lte=end_times[-1],
+        ).values_list('subgroup', 'end_time', 'value')
+        for subgroup, end_time, value in queryset:
+            value_dicts[subgroup][end_time] = value
+    else:
+        # A single user's rows are few enough to roll up here.  None of
+        # the charts show a user's value of a non-additive stat, which
+        # would need the end_time each rollup was sampled at.
+        assert stat.additive
+        queryset = table_filtered_to_id(table, key_id).filter(
+            property=stat.property,
+            end_time__gt=get_rollup_period(end_times[0], frequency)[0],
+            end_time__lte=end_times[-1],
+        ).values_list('subgroup', 'end_time', 'value')
+        for subgroup, end_time, value in queryset:
+            value_dicts[subgroup][get_rollup_period(end_time, frequency)[1]] += value
     value_arrays = {}
     for subgroup, label in subgroup_to_label.items():
         if (subgroup in value_dicts) or include_empty_subgroups:
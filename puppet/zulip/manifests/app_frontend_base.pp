@@ -63,6 +63,14 @@ class zulip::app_frontend_base {
   } else {
     $tornado_multiprocess = false
   }
+  file { '/etc/nginx/zulip-include/tornado-upstreams':
+    require => Package['nginx-full'],
+    owner   => 'root',
+    group   => 'root',
+    mode    => '0644',
+    content => template('zulip/nginx/tornado-upstreams.conf.template.erb'),
+    notify  => Service['nginx'],
+  }
 
   # This determines whether we run queue processors multithreaded or
   # multiprocess.  Multiprocess scales much better, but requires more
@@ -26,8 +26,7 @@ from zerver.lib.exceptions import RateLimited, JsonableError, ErrorCode, \
     InvalidJSONError
 from zerver.lib.types import ViewFuncT
 
-from zerver.lib.rate_limiter import incr_ratelimit, is_ratelimited, \
-    api_calls_left, RateLimitedUser
+from zerver.lib.rate_limiter import rate_limit_entity, RateLimitedUser
 from zerver.lib.request import REQ, has_request_variables, JsonableError, RequestVariableMissingError
 from django.core.handlers import base
 
@@ -764,7 +763,8 @@ def rate_limit_user(request: HttpRequest, user: UserProfile, domain: str) -> Non
     the rate limit information"""
 
     entity = RateLimitedUser(user, domain=domain)
-    ratelimited, time = is_ratelimited(entity)
+    # This checks the limits and records the request in one Redis call.
+    ratelimited, time, calls_remaining = rate_limit_entity(entity)
     request._ratelimit_applied_limits = True
     request._ratelimit_secs_to_freedom = time
     request._ratelimit_over_limit = ratelimited
@@ -773,11 +773,7 @@ def rate_limit_user(request: HttpRequest, user: UserProfile, domain: str) -> Non
         statsd.incr("ratelimiter.limited.%s.%s" % (type(user), user.id))
         raise RateLimited()
 
-    incr_ratelimit(entity)
-    calls_remaining, time_reset = api_calls_left(entity)
-
     request._ratelimit_remaining = calls_remaining
-    request._ratelimit_secs_to_freedom = time_reset
 
 def rate_limit(domain: str='all') -> Callable[[ViewFuncT], ViewFuncT]:
     """Rate-limits a view. Takes an optional 'domain' param if you wish to
@@ -1,6 +1,6 @@
 from typing import (
-    AbstractSet, Any, AnyStr, Callable, Dict, Iterable, List, Mapping, MutableMapping,
-    Optional, Sequence, Set, Tuple, TypeVar, Union, cast
+    AbstractSet, Any, AnyStr, Callable, Dict, FrozenSet, Iterable, Iterator, List, Mapping,
+    MutableMapping, Optional, Sequence, Set, Tuple, TypeVar, Union, cast
 )
 from mypy_extensions import TypedDict
 
@@ -70,6 +70,15 @@ from zerver.lib.topic_mutes import (
     add_topic_mute,
     remove_topic_mute,
 )
+from zerver.lib.presence import get_status_dict_from_snapshot, update_presence_snapshot
+from zerver.lib.unread_summary import (
+    add_new_messages_to_unread_summaries,
+    clear_unread_summary,
+    drop_unread_summaries,
+    drop_unread_summaries_for_messages,
+    mark_unread_in_summary,
+    remove_messages_from_unread_summaries,
+)
 from zerver.lib.users import (
     bulk_get_users,
     check_bot_name_available,
@@ -109,6 +118,7 @@ from zerver.lib.widget import do_widget_post_save_actions
 
 from django.db import transaction, IntegrityError, connection
 from django.db.models import F, Q, Max, Sum
+from django.db.models.functions import Greatest
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError
 from django.utils.timezone import now as timezone_now
@@ -152,7 +162,9 @@ import os
 import platform
 import logging
 import itertools
-from collections import defaultdict
+import io
+from array import array
+from collections import defaultdict, OrderedDict
 from operator import itemgetter
 
 # This will be used to type annotate parameters in a function if the function
@@ -1046,6 +1058,24 @@ def get_recipient_info(recipient: Recipient,
     )  # type: RecipientInfoResult
     return info
 
+def copy_recipient_info(info: RecipientInfoResult) -> RecipientInfoResult:
+    '''
+    do_send_messages shares get_recipient_info results between
+    messages with the same recipient, and then mutates the sets
+    for each message (e.g. adding mentioned bots), so every
+    message needs its own copy of the containers.
+    '''
+    return dict(
+        active_user_ids=set(info['active_user_ids']),
+        push_notify_user_ids=set(info['push_notify_user_ids']),
+        stream_push_user_ids=set(info['stream_push_user_ids']),
+        stream_email_user_ids=set(info['stream_email_user_ids']),
+        um_eligible_user_ids=set(info['um_eligible_user_ids']),
+        long_term_idle_user_ids=set(info['long_term_idle_user_ids']),
+        default_bot_user_ids=set(info['default_bot_user_ids']),
+        service_bot_tuples=list(info['service_bot_tuples']),
+    )
+
 def get_service_bot_events(sender: UserProfile, service_bot_tuples: List[Tuple[int, int]],
                            mentioned_user_ids: Set[int], active_user_ids: Set[int],
                            recipient_type: int) -> Dict[str, List[Dict[str, Any]]]:
@@ -1146,6 +1176,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
     messages = new_messages
 
     links_for_embed = set()  # type: Set[str]
+    recipient_info_cache = {}  # type: Dict[Tuple[int, int, Optional[str], FrozenSet[int]], RecipientInfoResult]
     # For consistency, changes to the default values for these gets should also be applied
     # to the default args in do_send_message
     for message in messages:
@@ -1170,12 +1201,25 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         else:
             stream_topic = None
 
-        info = get_recipient_info(
-            recipient=message['message'].recipient,
-            sender_id=message['message'].sender_id,
-            stream_topic=stream_topic,
-            possibly_mentioned_user_ids=mention_data.get_user_ids(),
+        possibly_mentioned_user_ids = mention_data.get_user_ids()
+
+        # Bursts of messages (e.g. from an integration bot) usually go
+        # to the same recipient, so we only fetch subscription, muted
+        # topic and user rows once per group of equivalent messages.
+        info_key = (
+            message['message'].recipient.id,
+            message['message'].sender_id,
+            stream_topic.topic_name.lower() if stream_topic is not None else None,
+            frozenset(possibly_mentioned_user_ids),
         )
+        if info_key not in recipient_info_cache:
+            recipient_info_cache[info_key] = get_recipient_info(
+                recipient=message['message'].recipient,
+                sender_id=message['message'].sender_id,
+                stream_topic=stream_topic,
+                possibly_mentioned_user_ids=possibly_mentioned_user_ids,
+            )
+        info = copy_recipient_info(recipient_info_cache[info_key])
 
         message['active_user_ids'] = info['active_user_ids']
         message['push_notify_user_ids'] = info['push_notify_user_ids']
@@ -1225,12 +1269,12 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
     user_message_flags = defaultdict(dict)  # type: Dict[int, Dict[int, List[str]]]
     with transaction.atomic():
         Message.objects.bulk_create([message['message'] for message in messages])
-        ums = []  # type: List[UserMessageLite]
+        fanouts = []  # type: List[UserMessageFanout]
         for message in messages:
             # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
             # they will be processed later.
             mentioned_user_ids = message['message'].mentions_user_ids
-            user_messages = create_user_messages(
+            fanout = create_user_messages(
                 message=message['message'],
                 um_eligible_user_ids=message['um_eligible_user_ids'],
                 long_term_idle_user_ids=message['long_term_idle_user_ids'],
@@ -1239,10 +1283,8 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
                 mentioned_user_ids=mentioned_user_ids,
             )
 
-            for um in user_messages:
-                user_message_flags[message['message'].id][um.user_profile_id] = um.flags_list()
-
-            ums.extend(user_messages)
+            user_message_flags[message['message'].id] = fanout.flags_dict()
+            fanouts.append(fanout)
 
             message['message'].service_queue_events = get_service_bot_events(
                 sender=message['message'].sender,
@@ -1252,7 +1294,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
                 recipient_type=message['message'].recipient.type,
             )
 
-        bulk_insert_ums(ums)
+        bulk_insert_fanouts(fanouts)
 
         # Claim attachments in message
         for message in messages:
@@ -1262,6 +1304,31 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         for message in messages:
             do_widget_post_save_actions(message)
 
+    add_new_messages_to_unread_summaries(
+        [message['message'] for message in messages],
+        itertools.chain.from_iterable(fanout.rows() for fanout in fanouts),
+    )
+
+    # Check presence for every user who might need a notification
+    # about any of these messages with a single UserPresence query.
+    presence_idle_candidates = {}  # type: Dict[int, Set[int]]
+    for message in messages:
+        sender = message['message'].sender
+        if message['message'].is_stream_message():
+            message_type = 'stream'
+        else:
+            message_type = 'private'
+        presence_idle_candidates[message['message'].id] = get_presence_idle_candidate_user_ids(
+            realm=sender.realm,
+            sender_id=sender.id,
+            message_type=message_type,
+            active_user_ids=message['active_user_ids'],
+            user_flags=user_message_flags.get(message['message'].id, {}),
+        )
+    all_presence_idle_user_ids = set(filter_presence_idle_user_ids(
+        set().union(*presence_idle_candidates.values())))
+
+    stream_cache = {}  # type: Dict[int, Stream]
     for message in messages:
         # Deliver events to the real-time push system, as well as
         # enqueuing any additional processing triggered by the message.
@@ -1269,15 +1336,9 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
 
         user_flags = user_message_flags.get(message['message'].id, {})
         sender = message['message'].sender
-        message_type = wide_message_dict['type']
 
-        presence_idle_user_ids = get_active_presence_idle_user_ids(
-            realm=sender.realm,
-            sender_id=sender.id,
-            message_type=message_type,
-            active_user_ids=message['active_user_ids'],
-            user_flags=user_flags,
-        )
+        presence_idle_user_ids = sorted(
+            presence_idle_candidates[message['message'].id] & all_presence_idle_user_ids)
 
         event = dict(
             type='message',
@@ -1319,7 +1380,9 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
             # messages are only associated to their subscribed users.
             if message['stream'] is None:
                 stream_id = message['message'].recipient.type_id
-                message['stream'] = Stream.objects.select_related("realm").get(id=stream_id)
+                if stream_id not in stream_cache:
+                    stream_cache[stream_id] = Stream.objects.select_related("realm").get(id=stream_id)
+                message['stream'] = stream_cache[stream_id]
             assert message['stream'] is not None  # assert needed because stubs for django are missing
             if message['stream'].is_public():
                 event['realm_id'] = message['stream'].realm_id
@@ -1387,38 +1450,69 @@ class UserMessageLite:
     def flags_list(self) -> List[str]:
         return UserMessage.flags_list_for_flags(self.flags)
 
+UserMessageRow = Tuple[int, int, int]
+
+class UserMessageFanout:
+    '''
+    A columnar version of a list of UserMessageLite objects for a
+    single message: parallel arrays of user ids and flags.  Sending a
+    message to a stream with tens of thousands of subscribers would
+    otherwise allocate (and loop over) one Python object per
+    recipient.
+    '''
+    def __init__(self, message_id: int, user_profile_ids: List[int], flags: List[int]) -> None:
+        assert len(user_profile_ids) == len(flags)
+        self.message_id = message_id
+        self.user_profile_ids = array('q', user_profile_ids)
+        self.flags = array('l', flags)
+
+    def __len__(self) -> int:
+        return len(self.user_profile_ids)
+
+    def rows(self) -> Iterator[UserMessageRow]:
+        message_id = self.message_id
+        for user_profile_id, flags in zip(self.user_profile_ids, self.flags):
+            yield (user_profile_id, message_id, flags)
+
+    def flags_dict(self) -> Dict[int, List[str]]:
+        '''
+        Nearly every recipient has one of a handful of flag values, so
+        we decode each distinct value once; note that the returned
+        lists are shared between users, and must not be mutated.
+        '''
+        flags_lists = {}  # type: Dict[int, List[str]]
+        result = {}  # type: Dict[int, List[str]]
+        for user_profile_id, flags in zip(self.user_profile_ids, self.flags):
+            if flags not in flags_lists:
+                flags_lists[flags] = UserMessage.flags_list_for_flags(flags)
+            result[user_profile_id] = flags_lists[flags]
+        return result
+
 def create_user_messages(message: Message,
                          um_eligible_user_ids: Set[int],
                          long_term_idle_user_ids: Set[int],
                          stream_push_user_ids: Set[int],
                          stream_email_user_ids: Set[int],
-                         mentioned_user_ids: Set[int]) -> List[UserMessageLite]:
-    ums_to_create = []
-    for user_profile_id in um_eligible_user_ids:
-        um = UserMessageLite(
-            user_profile_id=user_profile_id,
-            message_id=message.id,
-            flags=0,
-        )
-        ums_to_create.append(um)
-
+                         mentioned_user_ids: Set[int]) -> UserMessageFanout:
+    # Flags that every recipient of the message gets.
+    base_flags = 0
+    if message.recipient.type in [Recipient.HUDDLE, Recipient.PERSONAL]:
+        base_flags |= UserMessage.flags.is_private
     # These properties on the Message are set via
     # render_markdown by code in the bugdown inline patterns
-    wildcard = message.mentions_wildcard
-    ids_with_alert_words = message.user_ids_with_alert_words
-
-    for um in ums_to_create:
-        if um.user_profile_id == message.sender.id and \
-                message.sent_by_human():
-            um.flags |= UserMessage.flags.read
-        if wildcard:
-            um.flags |= UserMessage.flags.wildcard_mentioned
-        if um.user_profile_id in mentioned_user_ids:
-            um.flags |= UserMessage.flags.mentioned
-        if um.user_profile_id in ids_with_alert_words:
-            um.flags |= UserMessage.flags.has_alert_word
-        if message.recipient.type in [Recipient.HUDDLE, Recipient.PERSONAL]:
-            um.flags |= UserMessage.flags.is_private
+    if message.mentions_wildcard:
+        base_flags |= UserMessage.flags.wildcard_mentioned
+
+    # Flags that only a few recipients get; we compute these from
+    # the (small) sets of affected users, rather than checking every
+    # recipient against every set.
+    extra_flags = defaultdict(int)  # type: Dict[int, int]
+    for user_profile_id in mentioned_user_ids & um_eligible_user_ids:
+        extra_flags[user_profile_id] |= UserMessage.flags.mentioned
+    for user_profile_id in message.user_ids_with_alert_words & um_eligible_user_ids:
+        extra_flags[user_profile_id] |= UserMessage.flags.has_alert_word
+    if message.sender.id in um_eligible_user_ids and message.sent_by_human():
+        extra_flags[message.sender.id] |= UserMessage.flags.read
 
     # For long_term_idle (aka soft-deactivated) users, we are allowed
     # to optimize by lazily not creating UserMessage rows that would
@@ -1436,31 +1530,56 @@ def create_user_messages(message: Message,
     #   case the notifications code will call `access_message` on the
     #   message to re-verify permissions, and for private streams,
     #   will get an error if the UserMessage row doesn't exist yet.
-    user_messages = []
-    for um in ums_to_create:
-        if (um.user_profile_id in long_term_idle_user_ids and
-                um.user_profile_id not in stream_push_user_ids and
-                um.user_profile_id not in stream_email_user_ids and
-                message.is_stream_message() and
-                int(um.flags) == 0):
-            continue
-        user_messages.append(um)
+    if message.is_stream_message() and base_flags == 0:
+        lazy_user_ids = (long_term_idle_user_ids -
+                         stream_push_user_ids -
+                         stream_email_user_ids -
+                         set(extra_flags.keys()))
+    else:
+        lazy_user_ids = set()
+
+    user_profile_ids = list(um_eligible_user_ids - lazy_user_ids)
+    if extra_flags:
+        flags = [base_flags | extra_flags.get(user_profile_id, 0)
+                 for user_profile_id in user_profile_ids]
+    else:
+        flags = [base_flags] * len(user_profile_ids)
 
-    return user_messages
+    return UserMessageFanout(
+        message_id=message.id,
+        user_profile_ids=user_profile_ids,
+        flags=flags,
+    )
 
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
+    insert_user_message_rows(
+        ((um.user_profile_id, um.message_id, um.flags) for um in ums),
+        num_rows=len(ums),
+    )
+
+def bulk_insert_fanouts(fanouts: List[UserMessageFanout]) -> None:
+    insert_user_message_rows(
+        itertools.chain.from_iterable(fanout.rows() for fanout in fanouts),
+        num_rows=sum(len(fanout) for fanout in fanouts),
+    )
+
+def insert_user_message_rows(rows: Iterable[UserMessageRow], num_rows: int) -> None:
     '''
     Doing bulk inserts this way is much faster than using Django,
     since we don't have any ORM overhead.  Profiling with 1000
     users shows a speedup of 0.436 -> 0.027 seconds, so we're
     talking about a 15x speedup.
     '''
-    if not ums:
+    if not num_rows:
+        return
+
+    if num_rows >= settings.BULK_INSERT_UMS_COPY_THRESHOLD:
+        copy_insert_user_message_rows(rows)
         return
 
     vals = ','.join([
-        '(%d, %d, %d)' % (um.user_profile_id, um.message_id, um.flags)
-        for um in ums
+        '(%d, %d, %d)' % row
+        for row in rows
     ])
     query = '''
         INSERT into
@@ -1471,6 +1590,28 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     with connection.cursor() as cursor:
         cursor.execute(query)
 
+def copy_insert_user_message_rows(rows: Iterable[UserMessageRow]) -> None:
+    '''
+    For very large fan-outs (e.g. announcement streams with tens
+    of thousands of subscribers), the giant INSERT statement built
+    by insert_user_message_rows costs a lot of time to build and for
+    PostgreSQL to parse.  Streaming the rows through COPY FROM
+    STDIN avoids both; it has a small fixed overhead, so
+    insert_user_message_rows only uses it above
+    settings.BULK_INSERT_UMS_COPY_THRESHOLD rows.
+    '''
+    data = io.StringIO(''.join([
+        '%d\t%d\t%d\n' % row
+        for row in rows
+    ]))
+
+    with connection.cursor() as cursor:
+        cursor.copy_from(
+            data,
+            'zerver_usermessage',
+            columns=('user_profile_id', 'message_id', 'flags'),
+        )
+
 def do_add_submessage(realm: Realm,
                       sender_id: int,
                       message_id: int,
@@ -3463,45 +3604,151 @@ def streams_to_dicts_sorted(streams: List[Stream]) -> List[Dict[str, Any]]:
 def default_stream_groups_to_dicts_sorted(groups: List[DefaultStreamGroup]) -> List[Dict[str, Any]]:
     return sorted([group.to_dict() for group in groups], key=lambda elt: elt["name"])
 
+def bulk_update_rows(objs: Sequence[Any], fields: List[str]) -> None:
+    '''
+    Saves the given fields of model objects (all of the same model) in
+    a single UPDATE statement, since Django 1.11 has no bulk_update.
+    Like QuerySet.update, this doesn't send any signals.
+    '''
+    if not objs:
+        return
+
+    meta = objs[0]._meta
+    quote_name = connection.ops.quote_name
+    attnames = [meta.get_field(field).attname for field in fields]
+    columns = [quote_name(meta.get_field(field).column) for field in fields]
+    params = []  # type: List[Any]
+    for obj in objs:
+        params.append(obj.id)
+        params.extend(getattr(obj, attname) for attname in attnames)
+
+    row_template = '(' + ', '.join(['%s'] * (len(fields) + 1)) + ')'
+    query = '''
+        UPDATE {table}
+        SET {assignments}
+        FROM (VALUES {rows}) AS new_values (id, {columns})
+        WHERE {table}.id = new_values.id
+    '''.format(
+        table=quote_name(meta.db_table),
+        assignments=', '.join('{column} = new_values.{column}'.format(column=column)
+                              for column in columns),
+        rows=', '.join([row_template] * len(objs)),
+        columns=', '.join(columns),
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+
+def do_update_user_activity_intervals(activity: List[Tuple[int, datetime.datetime]]) -> None:
+    '''
+    Records the (user_profile_id, log_time) pairs of user input, e.g. a
+    batch from the user_activity_interval queue, with one query to
+    fetch each user's most recent UserActivityInterval and at most one
+    each to update and create intervals.
+    '''
+    log_times = defaultdict(list)  # type: Dict[int, List[datetime.datetime]]
+    for user_profile_id, log_time in activity:
+        log_times[user_profile_id].append(log_time)
+
+    last_intervals = {
+        interval.user_profile_id: interval
+        for interval in UserActivityInterval.objects.filter(
+            user_profile_id__in=list(log_times)
+        ).order_by('user_profile_id', '-end').distinct('user_profile_id')
+    }
+
+    to_update = {}  # type: Dict[int, UserActivityInterval]
+    to_create = []  # type: List[UserActivityInterval]
+    for user_profile_id, user_log_times in log_times.items():
+        last = last_intervals.get(user_profile_id)
+        for log_time in sorted(user_log_times):
+            effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
+            # This code isn't perfect, because with various races we might end
+            # up creating two overlapping intervals, but that shouldn't happen
+            # often, and can be corrected for in post-processing
+            #
+            # There are two ways our intervals could overlap:
+            # (1) The start of the new interval could be inside the old interval
+            # (2) The end of the new interval could be inside the old interval
+            # In either case, we just extend the old interval to include the new interval.
+            if last is not None and (
+                    (log_time <= last.end and log_time >= last.start) or
+                    (effective_end <= last.end and effective_end >= last.start)):
+                last.end = max(last.end, effective_end)
+                last.start = min(last.start, log_time)
+                if last.id is not None:
+                    to_update[last.id] = last
+                continue
+
+            # Otherwise, the intervals don't overlap, so we should make a new one
+            last = UserActivityInterval(user_profile_id=user_profile_id, start=log_time,
+                                        end=effective_end)
+            to_create.append(last)
+
+    bulk_update_rows(list(to_update.values()), ['start', 'end'])
+    UserActivityInterval.objects.bulk_create(to_create)
+
 def do_update_user_activity_interval(user_profile: UserProfile,
                                      log_time: datetime.datetime) -> None:
-    effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
-    # This code isn't perfect, because with various races we might end
-    # up creating two overlapping intervals, but that shouldn't happen
-    # often, and can be corrected for in post-processing
-    try:
-        last = UserActivityInterval.objects.filter(user_profile=user_profile).order_by("-end")[0]
-        # There are two ways our intervals could overlap:
-        # (1) The start of the new interval could be inside the old interval
-        # (2) The end of the new interval could be inside the old interval
-        # In either case, we just extend the old interval to include the new interval.
-        if ((log_time <= last.end and log_time >= last.start) or
-                (effective_end <= last.end and effective_end >= last.start)):
-            last.end = max(last.end, effective_end)
-            last.start = min(last.start, log_time)
-            last.save(update_fields=["start", "end"])
-            return
-    except IndexError:
-        pass
+    do_update_user_activity_intervals([(user_profile.id, log_time)])
 
-    # Otherwise, the intervals don't overlap, so we should make a new one
-    UserActivityInterval.objects.create(user_profile=user_profile, start=log_time,
-                                        end=effective_end)
+def do_update_user_activities(activity: List[Tuple[int, int, str, datetime.datetime]]) -> None:
+    '''
+    Records the (user_profile_id, client_id, query, log_time) of API
+    requests, e.g. a batch from the user_activity queue, with one query
+    to fetch the affected UserActivity rows and at most one each to
+    update and create rows.
+    '''
+    counts = defaultdict(int)  # type: Dict[Tuple[int, int, str], int]
+    last_visits = {}  # type: Dict[Tuple[int, int, str], datetime.datetime]
+    for user_profile_id, client_id, query, log_time in activity:
+        key = (user_profile_id, client_id, query)
+        counts[key] += 1
+        last_visits[key] = max(log_time, last_visits.get(key, log_time))
+
+    to_update = []  # type: List[UserActivity]
+    for user_activity in UserActivity.objects.filter(
+            user_profile_id__in={key[0] for key in counts},
+            client_id__in={key[1] for key in counts},
+            query__in={key[2] for key in counts}):
+        key = (user_activity.user_profile_id, user_activity.client_id, user_activity.query)
+        if key not in counts:
+            continue
+        user_activity.count += counts.pop(key)
+        user_activity.last_visit = max(user_activity.last_visit, last_visits[key])
+        to_update.append(user_activity)
+
+    bulk_update_rows(to_update, ['count', 'last_visit'])
+    to_create = [
+        UserActivity(user_profile_id=user_profile_id, client_id=client_id, query=query,
+                     count=count, last_visit=last_visits[(user_profile_id, client_id, query)])
+        for (user_profile_id, client_id, query), count in counts.items()
+    ]
+    try:
+        with transaction.atomic():
+            UserActivity.objects.bulk_create(to_create)
+    except IntegrityError:
+        # Another process created some of these rows after we fetched
+        # the existing ones; create them one at a time, adding to the
+        # rows that exist by now instead.
+        for user_activity in to_create:
+            try:
+                with transaction.atomic():
+                    user_activity.save(force_insert=True)
+            except IntegrityError:
+                UserActivity.objects.filter(
+                    user_profile_id=user_activity.user_profile_id,
+                    client_id=user_activity.client_id,
+                    query=user_activity.query,
+                ).update(count=F('count') + user_activity.count,
+                         last_visit=Greatest('last_visit', user_activity.last_visit))
+    statsd.incr('user_activity', len(activity))
 
-@statsd_increment('user_activity')
 def do_update_user_activity(user_profile: UserProfile,
                             client: Client,
                             query: str,
                             log_time: datetime.datetime) -> None:
-    (activity, created) = UserActivity.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        query = query,
-        defaults={'last_visit': log_time, 'count': 0})
-
-    activity.count += 1
-    activity.last_visit = log_time
-    activity.save(update_fields=["last_visit", "count"])
+    do_update_user_activities([(user_profile.id, client.id, query, log_time)])
 
 def send_presence_changed(user_profile: UserProfile, presence: UserPresence) -> None:
     presence_dict = presence.to_dict()
@@ -3522,42 +3769,115 @@ def consolidate_client(client: Client) -> Client:
     else:
         return client
 
-@statsd_increment('user_presence')
-def do_update_user_presence(user_profile: UserProfile,
-                            client: Client,
-                            log_time: datetime.datetime,
-                            status: int) -> None:
-    client = consolidate_client(client)
-    (presence, created) = UserPresence.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        defaults = {'timestamp': log_time,
-                    'status': status})
-
+def apply_user_presence_update(presence: UserPresence, log_time: datetime.datetime,
+                               status: int) -> bool:
+    '''
+    Applies an update from the presence's client to it in memory;
+    returns whether the user became online on that client.
+    '''
     stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
     was_idle = presence.status == UserPresence.IDLE
     became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
 
-    # If an object was created, it has already been saved.
-    #
     # We suppress changes from ACTIVE to IDLE before stale_status is reached;
     # this protects us from the user having two clients open: one active, the
     # other idle. Without this check, we would constantly toggle their status
     # between the two states.
-    if not created and stale_status or was_idle or status == presence.status:
-        # The following block attempts to only update the "status"
-        # field in the event that it actually changed.  This is
-        # important to avoid flushing the UserPresence cache when the
-        # data it would return to a client hasn't actually changed
-        # (see the UserPresence post_save hook for details).
+    if stale_status or was_idle or status == presence.status:
         presence.timestamp = log_time
-        update_fields = ["timestamp"]
-        if presence.status != status:
-            presence.status = status
-            update_fields.append("status")
-        presence.save(update_fields=update_fields)
+        presence.status = status
+    return became_online
 
-    if not user_profile.realm.presence_disabled and (created or became_online):
+def create_user_presences(
+        to_create: List[UserPresence],
+        updates_by_key: Dict[Tuple[int, int], List[Tuple[datetime.datetime, int]]]
+) -> List[UserPresence]:
+    '''
+    Saves the new UserPresence rows built by do_update_user_presences,
+    returning the rows as saved.  If another process has created some
+    of them since we fetched the existing rows, we apply the batch's
+    updates for those to the existing rows instead.
+    '''
+    try:
+        with transaction.atomic():
+            UserPresence.objects.bulk_create(to_create)
+        return to_create
+    except IntegrityError:
+        pass
+
+    saved = []  # type: List[UserPresence]
+    for presence in to_create:
+        try:
+            with transaction.atomic():
+                presence.save(force_insert=True)
+        except IntegrityError:
+            key = (presence.user_profile_id, presence.client_id)
+            existing = UserPresence.objects.get(user_profile_id=key[0], client_id=key[1])
+            existing.user_profile = presence.user_profile
+            existing.client = presence.client
+            for log_time, status in updates_by_key[key]:
+                apply_user_presence_update(existing, log_time, status)
+            existing.save(update_fields=['timestamp', 'status'])
+            presence = existing
+        saved.append(presence)
+    return saved
+
+def do_update_user_presences(
+        updates: List[Tuple[UserProfile, Client, datetime.datetime, int]]) -> None:
+    '''
+    Applies (user_profile, client, log_time, status) presence updates,
+    e.g. a batch from the user_presence queue, with one query to fetch
+    the affected UserPresence rows and at most one each to update and
+    create rows.  Successive updates from the same client are applied
+    in order, and we send a presence event if any of them would have
+    sent one on its own.
+    '''
+    user_profiles = {}  # type: Dict[int, UserProfile]
+    clients = {}  # type: Dict[int, Client]
+    updates_by_key = OrderedDict()  # type: Dict[Tuple[int, int], List[Tuple[datetime.datetime, int]]]
+    for user_profile, client, log_time, status in updates:
+        client = consolidate_client(client)
+        user_profiles[user_profile.id] = user_profile
+        clients[client.id] = client
+        updates_by_key.setdefault((user_profile.id, client.id), []).append((log_time, status))
+
+    presences = {
+        (presence.user_profile_id, presence.client_id): presence
+        for presence in UserPresence.objects.filter(user_profile_id__in=list(user_profiles),
+                                                    client_id__in=list(clients))
+    }
+
+    to_update = []  # type: List[UserPresence]
+    to_create = []  # type: List[UserPresence]
+    to_notify = []  # type: List[UserPresence]
+    for (user_profile_id, client_id), client_updates in updates_by_key.items():
+        user_profile = user_profiles[user_profile_id]
+        presence = presences.get((user_profile_id, client_id))
+        created = presence is None
+        if presence is None:
+            (log_time, status) = client_updates[0]
+            presence = UserPresence(user_profile=user_profile, client=clients[client_id],
+                                    timestamp=log_time, status=status)
+            to_create.append(presence)
+        else:
+            presence.user_profile = user_profile
+            presence.client = clients[client_id]
+
+        old_state = (presence.timestamp, presence.status)
+        became_online = False
+        for log_time, status in client_updates:
+            if apply_user_presence_update(presence, log_time, status):
+                became_online = True
+        if not created and (presence.timestamp, presence.status) != old_state:
+            to_update.append(presence)
+
+        if not user_profile.realm.presence_disabled and (created or became_online):
+            to_notify.append(presence)
+
+    bulk_update_rows(to_update, ['timestamp', 'status'])
+    update_presence_snapshot(to_update + create_user_presences(to_create, updates_by_key))
+
+    for presence in to_notify:
         # Push event to all users in the realm so they see the new user
         # appear in the presence list immediately, or the newly online
         # user without delay.  Note that we won't send an update here for a
@@ -3568,7 +3888,14 @@ def do_update_user_presence(user_profile: UserProfile,
         # sending timestamp updates, we could eliminate the ping responses, but
         # that's not a high priority for now, considering that most of our non-MIT
         # realms are pretty small.
-        send_presence_changed(user_profile, presence)
+        send_presence_changed(presence.user_profile, presence)
+    statsd.incr('user_presence', len(updates))
+
+def do_update_user_presence(user_profile: UserProfile,
+                            client: Client,
+                            log_time: datetime.datetime,
+                            status: int) -> None:
+    do_update_user_presences([(user_profile, client, log_time, status)])
 
 def update_user_activity_interval(user_profile: UserProfile, log_time: datetime.datetime) -> None:
     event = {'user_profile_id': user_profile.id,
@@ -3611,6 +3938,7 @@ def do_update_pointer(user_profile: UserProfile, client: Client,
                                    message__id__gt=prev_pointer,
                                    message__id__lte=pointer).extra(where=[UserMessage.where_unread()]) \
                            .update(flags=F('flags').bitor(UserMessage.flags.read))
+        drop_unread_summaries([user_profile.id])
         do_clear_mobile_push_notifications_for_ids(user_profile, app_message_ids)
 
     event = dict(type='pointer', pointer=pointer)
@@ -3628,6 +3956,7 @@ def do_mark_all_as_read(user_profile: UserProfile, client: Client) -> int:
     count = msgs.update(
         flags=F('flags').bitor(UserMessage.flags.read)
     )
+    clear_unread_summary(user_profile)
 
     event = dict(
         type='update_message_flags',
@@ -3677,6 +4006,7 @@ def do_mark_stream_messages_as_read(user_profile: UserProfile,
     count = msgs.update(
         flags=F('flags').bitor(UserMessage.flags.read)
     )
+    remove_messages_from_unread_summaries([user_profile.id], message_ids)
 
     event = dict(
         type='update_message_flags',
@@ -3741,6 +4071,12 @@ def do_update_message_flags(user_profile: UserProfile,
     else:
         raise AssertionError("Invalid message flags operation")
 
+    if flag == "read":
+        if operation == "add":
+            remove_messages_from_unread_summaries([user_profile.id], messages)
+        else:
+            mark_unread_in_summary(user_profile, messages)
+
     event = {'type': 'update_message_flags',
              'operation': operation,
              'flag': flag,
@@ -4000,6 +4336,18 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
 
     event['message_ids'] = update_to_dict_cache(changed_messages)
 
+    # The unread summaries store each message's topic and whether
+    # the user was mentioned; rather than patching them, we drop
+    # them for the affected users.  This must wait until we commit,
+    # since otherwise a concurrent /register could rebuild them from
+    # the old topic and mentions.
+    if topic_name is not None:
+        message_ids = event['message_ids']
+        transaction.on_commit(lambda: drop_unread_summaries_for_messages(message_ids))
+    elif content is not None:
+        mentioned_user_ids = prior_mention_user_ids | mention_user_ids
+        transaction.on_commit(lambda: drop_unread_summaries(mentioned_user_ids))
+
     def user_info(um: UserMessage) -> Dict[str, Any]:
         return {
             'id': um.user_profile_id,
@@ -4028,6 +4376,7 @@ def do_delete_message(user_profile: UserProfile, message: Message) -> None:
     ums = [{'id': um.user_profile_id} for um in
            UserMessage.objects.filter(message=message.id)]
     move_messages_to_archive([message.id])
+    remove_messages_from_unread_summaries([um['id'] for um in ums], [message.id])
     send_event(user_profile.realm, event, ums)
 
 def do_delete_messages(user: UserProfile) -> None:
@@ -4331,8 +4680,27 @@ def get_active_presence_idle_user_ids(realm: Realm,
           UserPresence table.
     '''
 
+    user_ids = get_presence_idle_candidate_user_ids(
+        realm=realm,
+        sender_id=sender_id,
+        message_type=message_type,
+        active_user_ids=active_user_ids,
+        user_flags=user_flags,
+    )
+    return filter_presence_idle_user_ids(user_ids)
+
+def get_presence_idle_candidate_user_ids(realm: Realm,
+                                         sender_id: int,
+                                         message_type: str,
+                                         active_user_ids: Set[int],
+                                         user_flags: Dict[int, List[str]]) -> Set[int]:
+    '''
+    The users from active_user_ids who would need a notification if
+    they turn out to be idle; this doesn't touch the database, so
+    do_send_messages can check presence for a whole batch at once.
+    '''
     if realm.presence_disabled:
-        return []
+        return set()
 
     is_pm = message_type == 'private'
 
@@ -4344,7 +4712,7 @@ def get_active_presence_idle_user_ids(realm: Realm,
         if mentioned or private_message:
             user_ids.add(user_id)
 
-    return filter_presence_idle_user_ids(user_ids)
+    return user_ids
 
 def filter_presence_idle_user_ids(user_ids: Set[int]) -> List[int]:
     if not user_ids:
@@ -4361,11 +4729,25 @@ def filter_presence_idle_user_ids(user_ids: Set[int]) -> List[int]:
     idle_user_ids = user_ids - active_user_ids
     return sorted(list(idle_user_ids))
 
-def get_status_dict(requesting_user_profile: UserProfile) -> Dict[str, Dict[str, Dict[str, Any]]]:
+def get_status_dict(requesting_user_profile: UserProfile,
+                    since: Optional[float]=None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    '''
+    If `since` is passed and the presence snapshot is enabled, only
+    includes the users whose presence may have changed since that
+    time; users who should no longer be included (deactivated, or with
+    no presence from the last two weeks) are not reported, so clients
+    using `since` need to refresh the full data periodically.
+    '''
     if requesting_user_profile.realm.presence_disabled:
         # Return an empty dict if presence is disabled in this realm
         return defaultdict(dict)
 
+    if settings.PRESENCE_SNAPSHOT_ENABLED:
+        return get_status_dict_from_snapshot(requesting_user_profile.realm_id, since)
+
+    # Without the snapshot, we don't know when rows were stored (a
+    # client can report a timestamp from before `since` after it), so
+    # we ignore `since` and return the full data.
     return UserPresence.get_status_dict_by_realm(requesting_user_profile.realm_id)
 
 def get_cross_realm_dicts() -> List[Dict[str, Any]]:
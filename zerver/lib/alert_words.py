@@ -3,7 +3,7 @@ from django.db.models import Q
 from zerver.models import UserProfile, Realm
 from zerver.lib.cache import cache_with_key, realm_alert_words_cache_key
 import ujson
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Set, Tuple
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
@@ -37,3 +37,110 @@ def remove_user_alert_words(user_profile: UserProfile, alert_words: Iterable[str
 def set_user_alert_words(user_profile: UserProfile, alert_words: List[str]) -> None:
     user_profile.alert_words = ujson.dumps(alert_words)
     user_profile.save(update_fields=['alert_words'])
+
+# Characters allowed immediately before and after an alert word, in
+# addition to whitespace and the start/end of the message.
+ALERT_WORD_BEFORE_PUNCTUATION = frozenset('(".,\';[*`>')
+ALERT_WORD_AFTER_PUNCTUATION = frozenset(')"?:.,\';]!*`')
+
+class AlertWordMatcher:
+    '''
+    An Aho-Corasick automaton over a set of alert words, which finds
+    every alert word in a message in a single pass over the content,
+    rather than searching the content once per word.  Matching is
+    case-insensitive, and a match only counts if it is surrounded by
+    whitespace or punctuation (see ALERT_WORD_*_PUNCTUATION).
+    '''
+
+    def __init__(self, words: Iterable[str]) -> None:
+        self.words = frozenset(words)
+
+        # The trie: goto[node] maps a character to the next node, and
+        # node 0 is the root.  outputs[node] lists the words (with
+        # their lowercased length) that end at that node.
+        self.goto = [{}]  # type: List[Dict[str, int]]
+        self.outputs = [[]]  # type: List[List[Tuple[str, int]]]
+        for word in self.words:
+            pattern = word.lower()
+            if not pattern:
+                continue
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.outputs.append([])
+                node = next_node
+            self.outputs[node].append((word, len(pattern)))
+
+        # Failure links, computed breadth-first: fail[node] is the node
+        # for the longest proper suffix of node's string that is also
+        # in the trie.  output_link[node] is the nearest node along the
+        # failure links that has outputs, or 0 if there is none.
+        self.fail = [0] * len(self.goto)
+        self.output_link = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                suffix = self.fail[child]
+                self.output_link[child] = suffix if self.outputs[suffix] else self.output_link[suffix]
+                queue.append(child)
+
+    def find_words(self, content: str) -> Set[str]:
+        content = content.lower()
+        content_length = len(content)
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        output_link = self.output_link
+
+        found = set()  # type: Set[str]
+        node = 0
+        for end, char in enumerate(content, start=1):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            match_node = node if outputs[node] else output_link[node]
+            while match_node:
+                for word, length in outputs[match_node]:
+                    if word in found:
+                        continue
+                    start = end - length
+                    if start > 0:
+                        before = content[start - 1]
+                        if not (before.isspace() or before in ALERT_WORD_BEFORE_PUNCTUATION):
+                            continue
+                    if end < content_length:
+                        after = content[end]
+                        if not (after.isspace() or after in ALERT_WORD_AFTER_PUNCTUATION):
+                            continue
+                    found.add(word)
+                match_node = output_link[match_node]
+        return found
+
+# Compiled matchers for all the alert words in a realm, by realm id.
+# These are per-process; get_alert_word_matcher rebuilds a realm's
+# matcher whenever the realm's set of alert words has changed.
+alert_word_matchers = {}  # type: Dict[int, AlertWordMatcher]
+
+def get_alert_word_matcher(realm: Realm,
+                           realm_alert_words: Dict[int, List[str]]) -> AlertWordMatcher:
+    '''
+    realm_alert_words should come from alert_words_in_realm, whose cache
+    is flushed whenever a user's alert words change; that's what
+    invalidates the matcher here.
+    '''
+    words = frozenset(word for user_words in realm_alert_words.values()
+                      for word in user_words)
+    matcher = alert_word_matchers.get(realm.id)
+    if matcher is None or matcher.words != words:
+        matcher = AlertWordMatcher(words)
+        alert_word_matchers[realm.id] = matcher
+    return matcher
@@ -15,11 +15,12 @@ import html
 import platform
 import time
 import functools
+import hashlib
 import ujson
 import xml.etree.cElementTree as etree
 from xml.etree.cElementTree import Element, SubElement
 
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
 
 import requests
 
@@ -30,6 +31,7 @@ from django.db.models import Q
 from markdown.extensions import codehilite, nl2br, tables
 from zerver.lib.bugdown import fenced_code
 from zerver.lib.bugdown.fenced_code import FENCE_RE
+from zerver.lib.alert_words import AlertWordMatcher
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import translate_emoticons, emoticon_regex
 from zerver.lib.mention import possible_mentions, \
@@ -590,6 +592,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
                     is_album):
                 return None
 
+            self.mark_uncacheable()
             # Try to retrieve open graph protocol info for a preview
             # This might be redundant right now for shared links for images.
             # However, we might want to make use of title and description
@@ -921,6 +924,13 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
     def is_absolute_url(self, url: str) -> bool:
         return bool(urllib.parse.urlparse(url).netloc)
 
+    def mark_uncacheable(self) -> None:
+        # Previews that depend on fetching other websites can't be
+        # stored in the render cache.
+        db_data = self.markdown.zulip_db_data
+        if db_data is not None:
+            db_data['render_cacheable'] = False
+
     def run(self, root: Element) -> None:
         # Get all URLs from the blob
         found_urls = walk_tree_with_family(root, self.get_url_data)
@@ -957,6 +967,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
                 if rendered_tweet_count >= self.TWITTER_MAX_TO_PREVIEW:
                     # Only render at most one tweet per message
                     continue
+                self.mark_uncacheable()
                 twitter_data = self.twitter_link(url)
                 if twitter_data is None:
                     # This link is not actually a tweet known to twitter
@@ -982,6 +993,9 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
                                                        self.markdown.zulip_realm):
                 continue
 
+            # The embed is added by re-rendering the message once
+            # the embed_links worker has fetched the preview.
+            self.mark_uncacheable()
             try:
                 extracted_data = link_preview.link_embed_data_from_cache(url)
             except NotFoundInCache:
@@ -1565,23 +1579,29 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
             # don't do any special rendering; we just append the alert words
             # we find to the set self.markdown.zulip_message.alert_words.
 
-            realm_words = db_data['possible_words']
+            content = '\n'.join(lines)
+            # Saved so that renders from the render cache can find
+            # alert words for a different set of possible_words.
+            db_data['alert_word_content'] = content
+            find_alert_words(self.markdown.zulip_message, db_data, content)
 
-            content = '\n'.join(lines).lower()
+        return lines
 
-            allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
-            allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+def find_alert_words(message: Message, db_data: DbData, content: str) -> None:
+    realm_words = db_data['possible_words']
+    if not realm_words:
+        return
 
-            for word in realm_words:
-                escaped = re.escape(word.lower())
-                match_re = re.compile('(?:%s)%s(?:%s)' %
-                                      (allowed_before_punctuation,
-                                       escaped,
-                                       allowed_after_punctuation))
-                if re.search(match_re, content):
-                    self.markdown.zulip_message.alert_words.add(word)
+    matcher = db_data['alert_word_matcher']
+    if matcher is None:
+        matcher = AlertWordMatcher(realm_words)
 
-        return lines
+    for word in matcher.find_words(content):
+        # The matcher may have been built from all of the realm's
+        # alert words, not just the possible_words of users who can
+        # see this message.
+        if word in realm_words:
+            message.alert_words.add(word)
 
 # This prevents realm_filters from running on the content of a
 # Markdown link, breaking up the link.  This is a monkey-patch, but it
@@ -1770,6 +1790,7 @@ def make_md_engine(realm_filters_key: int, email_gateway: bool) -> None:
     md_engine_key = (realm_filters_key, email_gateway)
     if md_engine_key in md_engines:
         del md_engines[md_engine_key]
+    clear_render_cache()
 
     realm_filters = realm_filter_data[realm_filters_key]
     md_engines[md_engine_key] = build_engine(
@@ -2004,7 +2025,8 @@ def do_convert(content: str,
                sent_by_bot: Optional[bool]=False,
                translate_emoticons: Optional[bool]=False,
                mention_data: Optional[MentionData]=None,
-               email_gateway: Optional[bool]=False) -> str:
+               email_gateway: Optional[bool]=False,
+               alert_word_matcher: Optional[AlertWordMatcher]=None) -> str:
     """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
@@ -2043,6 +2065,8 @@ def do_convert(content: str,
     _md_engine.zulip_realm = message_realm
     _md_engine.zulip_db_data = None  # for now
 
+    cache_key = None  # type: Optional[str]
+
     # Pre-fetch data from the DB that is used in the bugdown thread
     if message is not None:
         assert message_realm is not None  # ensured above if message is not None
@@ -2069,8 +2093,20 @@ def do_convert(content: str,
         else:
             active_realm_emoji = dict()
 
+        # Only content without syntax that refers to users, streams
+        # or custom emoji can be rendered from the render cache.
+        if (not emails and not stream_names and
+                not content_has_emoji_syntax(content) and
+                not possible_mentions(content) and
+                not possible_user_group_mentions(content)):
+            cache_key = render_cache_key(content, realm_filters_key, message_realm,
+                                         email_gateway, sent_by_bot,
+                                         translate_emoticons)
+
         _md_engine.zulip_db_data = {
             'possible_words': possible_words,
+            'alert_word_matcher': alert_word_matcher,
+            'render_cacheable': cache_key is not None,
             'email_info': email_info,
             'mention_data': mention_data,
             'active_realm_emoji': active_realm_emoji,
@@ -2081,6 +2117,14 @@ def do_convert(content: str,
         }
 
     try:
+        if cache_key is not None and cache_key in render_cache:
+            assert message is not None and _md_engine.zulip_db_data is not None
+            rendered_content, alert_word_content = render_cache[cache_key]
+            render_cache.move_to_end(cache_key)
+            bugdown_stats_cache_hit()
+            find_alert_words(message, _md_engine.zulip_db_data, alert_word_content)
+            return rendered_content
+
         # Spend at most 5 seconds rendering; this protects the backend
         # from being overloaded by bugs (e.g. markdown logic that is
         # extremely inefficient in corner cases) as well as user
@@ -2094,6 +2138,13 @@ def do_convert(content: str,
         if len(rendered_content) > MAX_MESSAGE_LENGTH * 10:
             raise BugdownRenderingException('Rendered content exceeds %s characters' %
                                             (MAX_MESSAGE_LENGTH * 10,))
+
+        if cache_key is not None:
+            bugdown_stats_cache_miss()
+            db_data = _md_engine.zulip_db_data
+            if db_data['render_cacheable']:
+                save_in_render_cache(cache_key, rendered_content,
+                                     db_data.get('alert_word_content', ''))
         return rendered_content
     except Exception:
         cleaned = privacy_clean_markdown(content)
@@ -2113,9 +2164,40 @@ def do_convert(content: str,
         _md_engine.zulip_realm = None
         _md_engine.zulip_db_data = None
 
+# A bounded LRU cache of rendered content, for content whose rendering
+# doesn't depend on anything but the content and the settings in
+# render_cache_key (e.g. repeated bot and integration messages, or
+# previews of the same draft).  Values are (rendered_content, text
+# seen by AlertWordsNotificationProcessor).  It is cleared whenever a
+# markdown engine is rebuilt, e.g. because a realm's filters changed.
+RENDER_CACHE_SIZE = 1000
+render_cache = OrderedDict()  # type: OrderedDict[str, Tuple[str, str]]
+
+def render_cache_key(content: str, realm_filters_key: int, message_realm: Realm,
+                     email_gateway: Optional[bool], sent_by_bot: Optional[bool],
+                     translate_emoticons: Optional[bool]) -> str:
+    context = (realm_filters_key, version, bool(email_gateway), bool(sent_by_bot),
+               bool(translate_emoticons), message_realm.uri,
+               image_preview_enabled_for_realm(realm=message_realm),
+               url_embed_preview_enabled_for_realm(realm=message_realm),
+               is_thumbor_enabled(), settings.CAMO_URI)
+    content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    return '%s:%r' % (content_hash, context)
+
+def save_in_render_cache(cache_key: str, rendered_content: str,
+                         alert_word_content: str) -> None:
+    render_cache[cache_key] = (rendered_content, alert_word_content)
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        render_cache.popitem(last=False)
+
+def clear_render_cache() -> None:
+    render_cache.clear()
+
 bugdown_time_start = 0.0
 bugdown_total_time = 0.0
 bugdown_total_requests = 0
+bugdown_render_cache_hits = 0
+bugdown_render_cache_misses = 0
 
 def get_bugdown_time() -> float:
     return bugdown_total_time
@@ -2123,6 +2205,12 @@ def get_bugdown_time() -> float:
 def get_bugdown_requests() -> int:
     return bugdown_total_requests
 
+def get_bugdown_render_cache_hits() -> int:
+    return bugdown_render_cache_hits
+
+def get_bugdown_render_cache_misses() -> int:
+    return bugdown_render_cache_misses
+
 def bugdown_stats_start() -> None:
     global bugdown_time_start
     bugdown_time_start = time.time()
@@ -2134,6 +2222,14 @@ def bugdown_stats_finish() -> None:
     bugdown_total_requests += 1
     bugdown_total_time += (time.time() - bugdown_time_start)
 
+def bugdown_stats_cache_hit() -> None:
+    global bugdown_render_cache_hits
+    bugdown_render_cache_hits += 1
+
+def bugdown_stats_cache_miss() -> None:
+    global bugdown_render_cache_misses
+    bugdown_render_cache_misses += 1
+
 def convert(content: str,
             message: Optional[Message]=None,
             message_realm: Optional[Realm]=None,
@@ -2141,10 +2237,11 @@ def convert(content: str,
             sent_by_bot: Optional[bool]=False,
             translate_emoticons: Optional[bool]=False,
             mention_data: Optional[MentionData]=None,
-            email_gateway: Optional[bool]=False) -> str:
+            email_gateway: Optional[bool]=False,
+            alert_word_matcher: Optional[AlertWordMatcher]=None) -> str:
     bugdown_stats_start()
     ret = do_convert(content, message, message_realm,
                      possible_words, sent_by_bot, translate_emoticons,
-                     mention_data, email_gateway)
+                     mention_data, email_gateway, alert_word_matcher)
     bugdown_stats_finish()
     return ret
@@ -11,12 +11,17 @@ from django.core.cache.backends.base import BaseCache
 from typing import cast, Any, Callable, Dict, Iterable, List, Optional, Union, Set, TypeVar, Tuple
 
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
+from collections import OrderedDict
+import logging
+import pickle
+import threading
 import time
 import base64
 import random
 import sys
 import os
 import hashlib
+import ujson
 
 if False:
     from zerver.models import UserProfile, Realm, Message
@@ -50,6 +55,179 @@ def remote_cache_stats_finish() -> None:
     remote_cache_total_requests += 1
     remote_cache_total_time += (time.time() - remote_cache_time_start)
 
+l1_cache_hits = 0
+l1_cache_misses = 0
+
+def get_l1_cache_hits() -> int:
+    return l1_cache_hits
+
+def get_l1_cache_misses() -> int:
+    return l1_cache_misses
+
+L1_CACHE_INVALIDATION_CHANNEL = 'remote_cache_l1_invalidation'
+
+class L1Cache:
+    """A per-process LRU cache in front of memcached.
+
+    Entries are stored pickled, like in memcached, so that callers can't
+    modify the cached value through the objects they get back; this
+    also gives us each entry's size for the byte limit.  Entries expire
+    after a TTL.
+
+    Whenever a process changes or deletes a key in memcached (e.g. in
+    flush_message, flush_user_profile, flush_stream or
+    update_to_dict_cache, which all use cache_set*/cache_delete*), it
+    publishes the key on a Redis channel; every process runs a thread
+    that evicts the published keys from its own L1 cache.  If that
+    thread loses its Redis connection, it clears the cache, since it
+    may have missed invalidations.  The TTL bounds the damage from any
+    invalidation that is delayed or lost anyway.
+
+    An invalidation can arrive while a process is reading the old value
+    from memcached (or the database); storing that value afterwards
+    would keep it around until the TTL.  So every invalidation bumps a
+    generation counter and records the generation for its keys, and a
+    fill passes the fill_token() taken before the read: keys
+    invalidated since then aren't stored.
+    """
+
+    # How many recent invalidations we remember for checking fills;
+    # fills older than the forgotten ones are dropped entirely.
+    MAX_INVALIDATIONS = 10000
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key => (expiry time, pickled value)
+        self.entries = OrderedDict()  # type: OrderedDict[str, Tuple[float, bytes]]
+        self.num_bytes = 0
+        self.generation = 0
+        # key => generation of its last invalidation
+        self.invalidations = OrderedDict()  # type: OrderedDict[str, int]
+        # Fills with tokens before this generation are dropped.
+        self.min_fill_generation = 0
+
+    def fill_token(self) -> int:
+        with self.lock:
+            return self.generation
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        now = time.time()
+        found = {}  # type: Dict[str, bytes]
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    self._delete(key)
+                    continue
+                self.entries.move_to_end(key)
+                found[key] = entry[1]
+        return {key: pickle.loads(data) for key, data in found.items()}
+
+    def set_many(self, items: Dict[str, Any], token: Optional[int]=None) -> None:
+        """Stores the items; with a fill_token(), skips the items
+        invalidated since the token was taken."""
+        expiry = time.time() + self.ttl
+        pickled = {key: pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                   for key, value in items.items()}
+        with self.lock:
+            if token is not None and token < self.min_fill_generation:
+                return
+            for key, data in pickled.items():
+                if len(data) > self.max_bytes:
+                    continue
+                if token is not None and self.invalidations.get(key, -1) > token:
+                    continue
+                self._delete(key)
+                self.entries[key] = (expiry, data)
+                self.num_bytes += len(data)
+            while self.num_bytes > self.max_bytes:
+                key, (expiry, data) = self.entries.popitem(last=False)
+                self.num_bytes -= len(data)
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self._delete(key)
+                self.invalidations.pop(key, None)
+                self.invalidations[key] = self.generation
+            while len(self.invalidations) > self.MAX_INVALIDATIONS:
+                key, generation = self.invalidations.popitem(last=False)
+                self.min_fill_generation = max(self.min_fill_generation, generation)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+            self.generation += 1
+            self.invalidations.clear()
+            self.min_fill_generation = self.generation
+
+    def _delete(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= len(entry[1])
+
+l1_cache = None  # type: Optional[L1Cache]
+l1_cache_pid = None  # type: Optional[int]
+l1_redis_client = None  # type: Any
+
+def get_l1_cache(cache_name: Optional[str]) -> Optional[L1Cache]:
+    global l1_cache, l1_cache_pid, l1_redis_client
+    if cache_name is not None or not settings.REMOTE_CACHE_L1_ENABLED:
+        return None
+    if l1_cache is None or l1_cache_pid != os.getpid():
+        # The invalidation thread doesn't survive a fork, so each
+        # process sets up its own cache.
+        l1_cache = L1Cache(settings.REMOTE_CACHE_L1_MAX_BYTES,
+                           settings.REMOTE_CACHE_L1_TTL_SECONDS)
+        l1_cache_pid = os.getpid()
+        from zerver.lib.redis_utils import get_redis_client
+        l1_redis_client = get_redis_client()
+        thread = threading.Thread(target=listen_for_l1_invalidations, args=(l1_cache,))
+        thread.daemon = True
+        thread.start()
+    return l1_cache
+
+def listen_for_l1_invalidations(cache: L1Cache) -> None:  # nocoverage
+    from zerver.lib.redis_utils import get_redis_client
+    while True:
+        try:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(L1_CACHE_INVALIDATION_CHANNEL)
+            # Anything cached before we subscribed may have missed an
+            # invalidation.
+            cache.clear()
+            for message in pubsub.listen():
+                cache.delete_many(ujson.loads(message['data']))
+        except Exception:
+            logging.exception("Error listening for L1 cache invalidations")
+            cache.clear()
+            time.sleep(1)
+
+def invalidate_l1_cache(cache: L1Cache, keys: List[str]) -> None:
+    cache.delete_many(keys)
+    l1_redis_client.publish(L1_CACHE_INVALIDATION_CHANNEL, ujson.dumps(keys))
+
+def get_l1_fill_token(cache_name: Optional[str]=None) -> Optional[int]:
+    """To be taken before computing a value to store with cache_set*'s
+    l1_fill_token; see L1Cache."""
+    l1 = get_l1_cache(cache_name)
+    if l1 is None:
+        return None
+    return l1.fill_token()
+
+def l1_cache_lookup(cache: L1Cache, keys: List[str]) -> Dict[str, Any]:
+    global l1_cache_hits, l1_cache_misses
+    found = cache.get_many(keys)
+    l1_cache_hits += len(found)
+    l1_cache_misses += len(keys) - len(found)
+    return found
+
 def get_or_create_key_prefix() -> str:
     if settings.CASPER_TESTS:
         # This sets the prefix for the benefit of the Casper tests.
@@ -106,6 +284,18 @@ def get_cache_backend(cache_name: Optional[str]) -> BaseCache:
         return djcache
     return caches[cache_name]
 
+def disconnect_remote_caches() -> None:
+    '''
+    Closes this process's memcached connections, so that processes
+    forked from it afterwards (e.g. by multiprocessing.Pool) don't share
+    them with it; every process reconnects on its next request.
+    '''
+    for cache in caches.all():
+        # The pylibmc backend's close() leaves the connections open.
+        client = getattr(cache, '_cache', None)
+        if hasattr(client, 'disconnect_all'):
+            client.disconnect_all()
+
 def get_cache_with_key(
         keyfunc: Callable[..., str],
         cache_name: Optional[str]=None
@@ -144,6 +334,7 @@ def cache_with_key(
         def func_with_caching(*args: Any, **kwargs: Any) -> ReturnT:
             key = keyfunc(*args, **kwargs)
 
+            l1_fill_token = get_l1_fill_token(cache_name)
             val = cache_get(key, cache_name=cache_name)
 
             extra = ""
@@ -165,7 +356,8 @@ def cache_with_key(
 
             val = func(*args, **kwargs)
 
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            cache_set(key, val, cache_name=cache_name, timeout=timeout,
+                      l1_fill_token=l1_fill_token)
 
             return val
 
@@ -173,28 +365,63 @@ def cache_with_key(
 
     return decorator
 
-def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optional[int]=None) -> None:
+# With the L1 cache enabled, cache_set and cache_set_many invalidate the
+# keys in every process's L1 cache, since they're used to update values
+# that may be cached elsewhere.  When instead just storing a value that
+# was computed after a cache miss, pass the get_l1_fill_token() taken
+# before the lookup as l1_fill_token.
+def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optional[int]=None,
+              l1_fill_token: Optional[int]=None) -> None:
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
 
+    l1 = get_l1_cache(cache_name)
+    if l1 is not None:
+        if l1_fill_token is not None:
+            l1.set_many({KEY_PREFIX + key: (val,)}, l1_fill_token)
+        else:
+            invalidate_l1_cache(l1, [KEY_PREFIX + key])
+
 def cache_get(key: str, cache_name: Optional[str]=None) -> Any:
+    l1 = get_l1_cache(cache_name)
+    if l1 is not None:
+        found = l1_cache_lookup(l1, [KEY_PREFIX + key])
+        if found:
+            return found[KEY_PREFIX + key]
+        token = l1.fill_token()
+
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(KEY_PREFIX + key)
     remote_cache_stats_finish()
+
+    if l1 is not None and ret is not None:
+        l1.set_many({KEY_PREFIX + key: ret}, token)
     return ret
 
 def cache_get_many(keys: List[str], cache_name: Optional[str]=None) -> Dict[str, Any]:
     keys = [KEY_PREFIX + key for key in keys]
-    remote_cache_stats_start()
-    ret = get_cache_backend(cache_name).get_many(keys)
-    remote_cache_stats_finish()
+    l1 = get_l1_cache(cache_name)
+    if l1 is not None:
+        ret = l1_cache_lookup(l1, keys)
+        keys = [key for key in keys if key not in ret]
+        token = l1.fill_token()
+    else:
+        ret = {}
+
+    if l1 is None or keys:
+        remote_cache_stats_start()
+        remote_ret = get_cache_backend(cache_name).get_many(keys)
+        remote_cache_stats_finish()
+        if l1 is not None:
+            l1.set_many(remote_ret, token)
+        ret.update(remote_ret)
     return dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
 
 def cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
-                   timeout: Optional[int]=None) -> None:
+                   timeout: Optional[int]=None, l1_fill_token: Optional[int]=None) -> None:
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
@@ -203,17 +430,32 @@ def cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
     get_cache_backend(cache_name).set_many(items, timeout=timeout)
     remote_cache_stats_finish()
 
+    l1 = get_l1_cache(cache_name)
+    if l1 is not None:
+        if l1_fill_token is not None:
+            l1.set_many(items, l1_fill_token)
+        else:
+            invalidate_l1_cache(l1, list(items.keys()))
+
 def cache_delete(key: str, cache_name: Optional[str]=None) -> None:
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
 
+    l1 = get_l1_cache(cache_name)
+    if l1 is not None:
+        invalidate_l1_cache(l1, [KEY_PREFIX + key])
+
 def cache_delete_many(items: Iterable[str], cache_name: Optional[str]=None) -> None:
+    keys = [KEY_PREFIX + item for item in items]
     remote_cache_stats_start()
-    get_cache_backend(cache_name).delete_many(
-        KEY_PREFIX + item for item in items)
+    get_cache_backend(cache_name).delete_many(keys)
     remote_cache_stats_finish()
 
+    l1 = get_l1_cache(cache_name)
+    if l1 is not None:
+        invalidate_l1_cache(l1, keys)
+
 # Generic_bulk_cached fetch and its helpers
 ObjKT = TypeVar('ObjKT')
 ItemT = TypeVar('ItemT')
@@ -257,6 +499,7 @@ def generic_bulk_cached_fetch(
     cache_keys = {}  # type: Dict[ObjKT, str]
     for object_id in object_ids:
         cache_keys[object_id] = cache_key_function(object_id)
+    l1_fill_token = get_l1_fill_token()
     cached_objects_compressed = cache_get_many([cache_keys[object_id]
                                                 for object_id in object_ids])  # type: Dict[str, Tuple[CompressedItemT]]
     cached_objects = {}  # type: Dict[str, ItemT]
@@ -273,7 +516,7 @@ def generic_bulk_cached_fetch(
         items_for_remote_cache[key] = (setter(item),)
         cached_objects[key] = item
     if len(items_for_remote_cache) > 0:
-        cache_set_many(items_for_remote_cache)
+        cache_set_many(items_for_remote_cache, l1_fill_token=l1_fill_token)
     return dict((object_id, cached_objects[cache_keys[object_id]]) for object_id in object_ids
                 if cache_keys[object_id] in cached_objects)
 
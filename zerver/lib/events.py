@@ -2,11 +2,16 @@
 # high-level documentation on how this system works.
 
 import copy
+import logging
+import os
+import time
 import ujson
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from django.utils.translation import ugettext as _
 from django.conf import settings
+from django.db import close_old_connections
 from importlib import import_module
 from typing import (
     cast, Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
@@ -18,6 +23,7 @@ from zerver.lib.alert_words import user_alert_words
 from zerver.lib.attachments import user_attachments
 from zerver.lib.avatar import avatar_url, get_avatar_field
 from zerver.lib.bot_config import load_bot_config_template
+from zerver.lib.db import reset_queries
 from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.integrations import EMBEDDED_BOTS
 from zerver.lib.message import (
@@ -33,6 +39,7 @@ from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.request import JsonableError
 from zerver.lib.topic import TOPIC_NAME
 from zerver.lib.topic_mutes import get_topic_mutes
+from zerver.lib.unread_summary import get_raw_unread_data_from_summary
 from zerver.lib.actions import (
     validate_user_access_to_subscribers_helper,
     do_get_streams, get_default_streams_for_realm,
@@ -42,6 +49,7 @@ from zerver.lib.actions import (
     get_owned_bot_dicts,
 )
 from zerver.lib.user_groups import user_groups_in_realm_serialized
+from zerver.lib.utils import format_timedelta, statsd, timedelta_ms
 from zerver.tornado.event_queue import request_event_queue, get_user_events
 from zerver.models import Client, Message, Realm, UserPresence, UserProfile, CustomProfileFieldValue, \
     get_user_profile_by_id, \
@@ -51,6 +59,11 @@ from zerver.models import Client, Message, Realm, UserPresence, UserProfile, Cus
 from zproject.backends import email_auth_enabled, password_auth_enabled
 from version import ZULIP_VERSION
 
+logger = logging.getLogger('zulip.register')
+
+# fetch_initial_state_data logs a breakdown of the time spent in each
+# section when it takes at least this long.
+SLOW_REGISTER_LOG_THRESHOLD_SECONDS = 1.0
 
 def get_raw_user_data(realm_id: int, client_gravatar: bool) -> Dict[int, Dict[str, str]]:
     user_dicts = get_realm_user_dicts(realm_id)
@@ -108,16 +121,353 @@ def always_want(msg_type: str) -> bool:
     '''
     return True
 
+class InitialStateContext:
+    def __init__(self, user_profile: UserProfile, client_gravatar: bool,
+                 include_subscribers: bool) -> None:
+        self.user_profile = user_profile
+        self.realm = user_profile.realm
+        self.client_gravatar = client_gravatar
+        self.include_subscribers = include_subscribers
+        # The state computed by each section that has finished, by
+        # section name; a section can look at the results of the
+        # sections it depends on.
+        self.results = {}  # type: Dict[str, Dict[str, Any]]
+
+InitialStateFetcher = Callable[[InitialStateContext], Dict[str, Any]]
+
+class InitialStateSection:
+    '''
+    A part of the state returned by fetch_initial_state_data.  The
+    section is computed if the client wants all of its event_types;
+    sections listed in depends_on are computed (even if not wanted)
+    and finish before it starts.
+    '''
+    def __init__(self, name: str, fetch: InitialStateFetcher,
+                 event_types: List[str], depends_on: List[str]) -> None:
+        self.name = name
+        self.fetch = fetch
+        self.event_types = event_types
+        self.depends_on = depends_on
+
+initial_state_sections = OrderedDict()  # type: OrderedDict[str, InitialStateSection]
+
+def initial_state_section(name: str, event_types: Optional[List[str]]=None,
+                          depends_on: Optional[List[str]]=None
+                          ) -> Callable[[InitialStateFetcher], InitialStateFetcher]:
+    '''
+    Registers a function computing a section of the initial state.
+    By default, the section is wanted for the event type with the
+    same name.  Whenever you add a new section, you should also add
+    corresponding events for changes in the data structures and new
+    code to apply_events (and add a test in EventsRegisterTest).
+    '''
+    def wrapper(fetch: InitialStateFetcher) -> InitialStateFetcher:
+        for dependency in depends_on or []:
+            # This keeps the registration order a valid order to
+            # compute sections in.
+            assert dependency in initial_state_sections
+        initial_state_sections[name] = InitialStateSection(
+            name=name,
+            fetch=fetch,
+            event_types=event_types if event_types is not None else [name],
+            depends_on=depends_on or [],
+        )
+        return fetch
+    return wrapper
+
+@initial_state_section('alert_words')
+def fetch_alert_words(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(alert_words=user_alert_words(context.user_profile))
+
+@initial_state_section('custom_profile_fields')
+def fetch_custom_profile_fields(context: InitialStateContext) -> Dict[str, Any]:
+    fields = custom_profile_fields_for_realm(context.realm.id)
+    return dict(
+        custom_profile_fields=[f.as_dict() for f in fields],
+        custom_profile_field_types=CustomProfileField.FIELD_TYPE_CHOICES_DICT,
+    )
+
+@initial_state_section('hotspots')
+def fetch_hotspots(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(hotspots=get_next_hotspots(context.user_profile))
+
+@initial_state_section('message')
+def fetch_max_message_id(context: InitialStateContext) -> Dict[str, Any]:
+    # The client should use get_messages() to fetch messages
+    # starting with the max_message_id.  They will get messages
+    # newer than that ID via get_events()
+    messages = Message.objects.filter(
+        usermessage__user_profile=context.user_profile).order_by('-id')[:1]
+    if messages:
+        return dict(max_message_id=messages[0].id)
+    return dict(max_message_id=-1)
+
+@initial_state_section('muted_topics')
+def fetch_muted_topics(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(muted_topics=get_topic_mutes(context.user_profile))
+
+@initial_state_section('pointer')
+def fetch_pointer(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(pointer=context.user_profile.pointer)
+
+@initial_state_section('presence')
+def fetch_presences(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(presences=get_status_dict(context.user_profile))
+
+@initial_state_section('realm')
+def fetch_realm(context: InitialStateContext) -> Dict[str, Any]:
+    realm = context.realm
+    state = {}  # type: Dict[str, Any]
+    for property_name in Realm.property_types:
+        state['realm_' + property_name] = getattr(realm, property_name)
+
+    # Most state is handled via the property_types framework;
+    # these manual entries are for those realm settings that don't
+    # fit into that framework.
+    state['realm_authentication_methods'] = realm.authentication_methods_dict()
+    state['realm_allow_message_editing'] = realm.allow_message_editing
+    state['realm_allow_community_topic_editing'] = realm.allow_community_topic_editing
+    state['realm_allow_message_deleting'] = realm.allow_message_deleting
+    state['realm_message_content_edit_limit_seconds'] = realm.message_content_edit_limit_seconds
+    state['realm_message_content_delete_limit_seconds'] = realm.message_content_delete_limit_seconds
+    state['realm_icon_url'] = realm_icon_url(realm)
+    state['realm_icon_source'] = realm.icon_source
+    state['max_icon_file_size'] = settings.MAX_ICON_FILE_SIZE
+    state['realm_bot_domain'] = realm.get_bot_domain()
+    state['realm_uri'] = realm.uri
+    state['realm_available_video_chat_providers'] = realm.VIDEO_CHAT_PROVIDERS
+    state['realm_presence_disabled'] = realm.presence_disabled
+    state['realm_digest_emails_enabled'] = realm.digest_emails_enabled and settings.SEND_DIGEST_EMAILS
+    state['realm_is_zephyr_mirror_realm'] = realm.is_zephyr_mirror_realm
+    state['realm_email_auth_enabled'] = email_auth_enabled(realm)
+    state['realm_password_auth_enabled'] = password_auth_enabled(realm)
+    state['realm_push_notifications_enabled'] = push_notifications_enabled()
+    if realm.notifications_stream and not realm.notifications_stream.deactivated:
+        notifications_stream = realm.notifications_stream
+        state['realm_notifications_stream_id'] = notifications_stream.id
+    else:
+        state['realm_notifications_stream_id'] = -1
+
+    signup_notifications_stream = realm.get_signup_notifications_stream()
+    if signup_notifications_stream:
+        state['realm_signup_notifications_stream_id'] = signup_notifications_stream.id
+    else:
+        state['realm_signup_notifications_stream_id'] = -1
+    return state
+
+@initial_state_section('realm_domains')
+def fetch_realm_domains(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(realm_domains=get_realm_domains(context.realm))
+
+@initial_state_section('realm_emoji')
+def fetch_realm_emoji(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(realm_emoji=context.realm.get_emoji())
+
+@initial_state_section('realm_filters')
+def fetch_realm_filters(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(realm_filters=realm_filters_for_realm(context.realm.id))
+
+@initial_state_section('realm_user_groups')
+def fetch_realm_user_groups(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(realm_user_groups=user_groups_in_realm_serialized(context.realm))
+
+@initial_state_section('realm_user')
+def fetch_realm_user(context: InitialStateContext) -> Dict[str, Any]:
+    user_profile = context.user_profile
+    state = {}  # type: Dict[str, Any]
+    state['raw_users'] = get_raw_user_data(
+        realm_id=context.realm.id,
+        client_gravatar=context.client_gravatar,
+    )
+
+    # For the user's own avatar URL, we force
+    # client_gravatar=False, since that saves some unnecessary
+    # client-side code for handing medium-size avatars.  See #8253
+    # for details.
+    state['avatar_source'] = user_profile.avatar_source
+    state['avatar_url_medium'] = avatar_url(
+        user_profile,
+        medium=True,
+        client_gravatar=False,
+    )
+    state['avatar_url'] = avatar_url(
+        user_profile,
+        medium=False,
+        client_gravatar=False,
+    )
+
+    state['can_create_streams'] = user_profile.can_create_streams()
+    state['can_subscribe_other_users'] = user_profile.can_subscribe_other_users()
+    state['cross_realm_bots'] = list(get_cross_realm_dicts())
+    state['is_admin'] = user_profile.is_realm_admin
+    state['is_guest'] = user_profile.is_guest
+    state['user_id'] = user_profile.id
+    state['enter_sends'] = user_profile.enter_sends
+    state['email'] = user_profile.email
+    state['delivery_email'] = user_profile.delivery_email
+    state['full_name'] = user_profile.full_name
+    return state
+
+@initial_state_section('realm_bot')
+def fetch_realm_bots(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(realm_bots=get_owned_bot_dicts(context.user_profile))
+
+# This does not yet have an apply_event counterpart, since currently,
+# new entries for EMBEDDED_BOTS can only be added directly in the codebase.
+@initial_state_section('realm_embedded_bots')
+def fetch_realm_embedded_bots(context: InitialStateContext) -> Dict[str, Any]:
+    realm_embedded_bots = []
+    for bot in EMBEDDED_BOTS:
+        realm_embedded_bots.append({'name': bot.name,
+                                    'config': load_bot_config_template(bot.name)})
+    return dict(realm_embedded_bots=realm_embedded_bots)
+
+@initial_state_section('subscription')
+def fetch_subscriptions(context: InitialStateContext) -> Dict[str, Any]:
+    subscriptions, unsubscribed, never_subscribed = gather_subscriptions_helper(
+        context.user_profile, include_subscribers=context.include_subscribers)
+    return dict(
+        subscriptions=subscriptions,
+        unsubscribed=unsubscribed,
+        never_subscribed=never_subscribed,
+    )
+
+# Keeping unread_msgs updated requires both message flag updates and
+# message updates. This is due to the fact that new messages will not
+# generate a flag update so we need to use the flags field in the
+# message event.
+@initial_state_section('raw_unread_msgs', event_types=['update_message_flags', 'message'])
+def fetch_raw_unread_msgs(context: InitialStateContext) -> Dict[str, Any]:
+    if settings.UNREAD_SUMMARY_ENABLED:
+        return dict(raw_unread_msgs=get_raw_unread_data_from_summary(context.user_profile))
+    return dict(raw_unread_msgs=get_raw_unread_data(context.user_profile))
+
+@initial_state_section('starred_messages')
+def fetch_starred_messages(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(starred_messages=get_starred_message_ids(context.user_profile))
+
+@initial_state_section('stream')
+def fetch_streams(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(
+        streams=do_get_streams(context.user_profile),
+        stream_name_max_length=Stream.MAX_NAME_LENGTH,
+        stream_description_max_length=Stream.MAX_DESCRIPTION_LENGTH,
+    )
+
+@initial_state_section('default_streams')
+def fetch_default_streams(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(realm_default_streams=streams_to_dicts_sorted(
+        get_default_streams_for_realm(context.realm.id)))
+
+@initial_state_section('default_stream_groups')
+def fetch_default_stream_groups(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(realm_default_stream_groups=default_stream_groups_to_dicts_sorted(
+        get_default_stream_groups(context.realm)))
+
+@initial_state_section('update_display_settings')
+def fetch_display_settings(context: InitialStateContext) -> Dict[str, Any]:
+    user_profile = context.user_profile
+    state = {}  # type: Dict[str, Any]
+    for prop in UserProfile.property_types:
+        state[prop] = getattr(user_profile, prop)
+    state['emojiset_choices'] = user_profile.emojiset_choices()
+    return state
+
+@initial_state_section('update_global_notifications')
+def fetch_global_notifications(context: InitialStateContext) -> Dict[str, Any]:
+    state = {}  # type: Dict[str, Any]
+    for notification in UserProfile.notification_setting_types:
+        state[notification] = getattr(context.user_profile, notification)
+    return state
+
+@initial_state_section('zulip_version')
+def fetch_zulip_version(context: InitialStateContext) -> Dict[str, Any]:
+    return dict(zulip_version=ZULIP_VERSION)
+
+class InitialStateExecutor:
+    '''
+    A bounded pool of threads for computing independent sections of
+    the initial state concurrently, with settings.INITIAL_STATE_FETCH_THREADS
+    threads.  Each thread uses its own database connection, which it
+    keeps between sections (subject to CONN_MAX_AGE).
+    '''
+    def __init__(self) -> None:
+        self.executor = None  # type: Optional[ThreadPoolExecutor]
+        self.pid = None  # type: Optional[int]
+
+    def get_executor(self) -> Optional[ThreadPoolExecutor]:
+        if settings.INITIAL_STATE_FETCH_THREADS <= 1:
+            return None
+        if self.pid != os.getpid():
+            # Threads don't survive a fork, so a child process
+            # needs its own pool.
+            self.executor = ThreadPoolExecutor(max_workers=settings.INITIAL_STATE_FETCH_THREADS)
+            self.pid = os.getpid()
+        return self.executor
+
+initial_state_executor = InitialStateExecutor()
+
+def compute_section(section: InitialStateSection,
+                    context: InitialStateContext) -> Tuple[Dict[str, Any], float]:
+    start = time.time()
+    result = section.fetch(context)
+    return (result, time.time() - start)
+
+def compute_section_in_thread(section: InitialStateSection,
+                              context: InitialStateContext) -> Tuple[Dict[str, Any], float]:
+    # Like a request would, drop a connection that has gone bad or
+    # is past CONN_MAX_AGE, and don't accumulate query logs.
+    close_old_connections()
+    reset_queries()
+    return compute_section(section, context)
+
+def compute_sections(sections: List[InitialStateSection],
+                     context: InitialStateContext) -> Dict[str, float]:
+    '''
+    Computes the sections, in rounds of sections whose dependencies
+    have all been computed; the sections of a round are computed
+    concurrently if we have a thread pool.  Returns how long each
+    section took.
+    '''
+    executor = initial_state_executor.get_executor()
+    timings = {}  # type: Dict[str, float]
+    remaining = sections
+    while remaining:
+        ready = [section for section in remaining
+                 if all(dependency in context.results for dependency in section.depends_on)]
+        remaining = [section for section in remaining if section not in ready]
+
+        if executor is None or len(ready) == 1:
+            for section in ready:
+                context.results[section.name], timings[section.name] = compute_section(
+                    section, context)
+            continue
+
+        futures = [(section, executor.submit(compute_section_in_thread, section, context))
+                   for section in ready]
+        for section, future in futures:
+            context.results[section.name], timings[section.name] = future.result()
+    return timings
+
+def log_section_timings(user_profile: UserProfile, timings: Dict[str, float],
+                        total: float) -> None:
+    for name, delay in timings.items():
+        statsd.timing("register.section.%s" % (name,), timedelta_ms(delay))
+    if total >= SLOW_REGISTER_LOG_THRESHOLD_SECONDS:
+        breakdown = ' '.join('%s=%s' % (name, format_timedelta(delay)) for name, delay in
+                             sorted(timings.items(), key=lambda item: -item[1]))
+        logger.info('slow register for %s: %s total; %s' % (
+            user_profile.email, format_timedelta(total), breakdown))
+
 # Fetch initial data.  When event_types is not specified, clients want
-# all event types.  Whenever you add new code to this function, you
-# should also add corresponding events for changes in the data
-# structures and new code to apply_events (and add a test in EventsRegisterTest).
+# all event types.  The state is put together from the sections
+# registered with initial_state_section above.
 def fetch_initial_state_data(user_profile: UserProfile,
                              event_types: Optional[Iterable[str]],
                              queue_id: str, client_gravatar: bool,
                              include_subscribers: bool = True) -> Dict[str, Any]:
+    start = time.time()
     state = {'queue_id': queue_id}  # type: Dict[str, Any]
-    realm = user_profile.realm
 
     if event_types is None:
         # return True always
@@ -125,170 +475,29 @@ def fetch_initial_state_data(user_profile: UserProfile,
     else:
         want = set(event_types).__contains__
 
-    if want('alert_words'):
-        state['alert_words'] = user_alert_words(user_profile)
-
-    if want('custom_profile_fields'):
-        fields = custom_profile_fields_for_realm(realm.id)
-        state['custom_profile_fields'] = [f.as_dict() for f in fields]
-        state['custom_profile_field_types'] = CustomProfileField.FIELD_TYPE_CHOICES_DICT
-
-    if want('hotspots'):
-        state['hotspots'] = get_next_hotspots(user_profile)
-
-    if want('message'):
-        # The client should use get_messages() to fetch messages
-        # starting with the max_message_id.  They will get messages
-        # newer than that ID via get_events()
-        messages = Message.objects.filter(usermessage__user_profile=user_profile).order_by('-id')[:1]
-        if messages:
-            state['max_message_id'] = messages[0].id
-        else:
-            state['max_message_id'] = -1
-
-    if want('muted_topics'):
-        state['muted_topics'] = get_topic_mutes(user_profile)
-
-    if want('pointer'):
-        state['pointer'] = user_profile.pointer
-
-    if want('presence'):
-        state['presences'] = get_status_dict(user_profile)
-
-    if want('realm'):
-        for property_name in Realm.property_types:
-            state['realm_' + property_name] = getattr(realm, property_name)
-
-        # Most state is handled via the property_types framework;
-        # these manual entries are for those realm settings that don't
-        # fit into that framework.
-        state['realm_authentication_methods'] = realm.authentication_methods_dict()
-        state['realm_allow_message_editing'] = realm.allow_message_editing
-        state['realm_allow_community_topic_editing'] = realm.allow_community_topic_editing
-        state['realm_allow_message_deleting'] = realm.allow_message_deleting
-        state['realm_message_content_edit_limit_seconds'] = realm.message_content_edit_limit_seconds
-        state['realm_message_content_delete_limit_seconds'] = realm.message_content_delete_limit_seconds
-        state['realm_icon_url'] = realm_icon_url(realm)
-        state['realm_icon_source'] = realm.icon_source
-        state['max_icon_file_size'] = settings.MAX_ICON_FILE_SIZE
-        state['realm_bot_domain'] = realm.get_bot_domain()
-        state['realm_uri'] = realm.uri
-        state['realm_available_video_chat_providers'] = realm.VIDEO_CHAT_PROVIDERS
-        state['realm_presence_disabled'] = realm.presence_disabled
-        state['realm_digest_emails_enabled'] = realm.digest_emails_enabled and settings.SEND_DIGEST_EMAILS
-        state['realm_is_zephyr_mirror_realm'] = realm.is_zephyr_mirror_realm
-        state['realm_email_auth_enabled'] = email_auth_enabled(realm)
-        state['realm_password_auth_enabled'] = password_auth_enabled(realm)
-        state['realm_push_notifications_enabled'] = push_notifications_enabled()
-        if realm.notifications_stream and not realm.notifications_stream.deactivated:
-            notifications_stream = realm.notifications_stream
-            state['realm_notifications_stream_id'] = notifications_stream.id
-        else:
-            state['realm_notifications_stream_id'] = -1
-
-        signup_notifications_stream = realm.get_signup_notifications_stream()
-        if signup_notifications_stream:
-            state['realm_signup_notifications_stream_id'] = signup_notifications_stream.id
-        else:
-            state['realm_signup_notifications_stream_id'] = -1
-
-    if want('realm_domains'):
-        state['realm_domains'] = get_realm_domains(realm)
-
-    if want('realm_emoji'):
-        state['realm_emoji'] = realm.get_emoji()
-
-    if want('realm_filters'):
-        state['realm_filters'] = realm_filters_for_realm(realm.id)
-
-    if want('realm_user_groups'):
-        state['realm_user_groups'] = user_groups_in_realm_serialized(realm)
-
-    if want('realm_user'):
-        state['raw_users'] = get_raw_user_data(
-            realm_id=realm.id,
-            client_gravatar=client_gravatar,
-        )
-
-        # For the user's own avatar URL, we force
-        # client_gravatar=False, since that saves some unnecessary
-        # client-side code for handing medium-size avatars.  See #8253
-        # for details.
-        state['avatar_source'] = user_profile.avatar_source
-        state['avatar_url_medium'] = avatar_url(
-            user_profile,
-            medium=True,
-            client_gravatar=False,
-        )
-        state['avatar_url'] = avatar_url(
-            user_profile,
-            medium=False,
-            client_gravatar=False,
-        )
-
-        state['can_create_streams'] = user_profile.can_create_streams()
-        state['can_subscribe_other_users'] = user_profile.can_subscribe_other_users()
-        state['cross_realm_bots'] = list(get_cross_realm_dicts())
-        state['is_admin'] = user_profile.is_realm_admin
-        state['is_guest'] = user_profile.is_guest
-        state['user_id'] = user_profile.id
-        state['enter_sends'] = user_profile.enter_sends
-        state['email'] = user_profile.email
-        state['delivery_email'] = user_profile.delivery_email
-        state['full_name'] = user_profile.full_name
-
-    if want('realm_bot'):
-        state['realm_bots'] = get_owned_bot_dicts(user_profile)
-
-    # This does not yet have an apply_event counterpart, since currently,
-    # new entries for EMBEDDED_BOTS can only be added directly in the codebase.
-    if want('realm_embedded_bots'):
-        realm_embedded_bots = []
-        for bot in EMBEDDED_BOTS:
-            realm_embedded_bots.append({'name': bot.name,
-                                        'config': load_bot_config_template(bot.name)})
-        state['realm_embedded_bots'] = realm_embedded_bots
-
-    if want('subscription'):
-        subscriptions, unsubscribed, never_subscribed = gather_subscriptions_helper(
-            user_profile, include_subscribers=include_subscribers)
-        state['subscriptions'] = subscriptions
-        state['unsubscribed'] = unsubscribed
-        state['never_subscribed'] = never_subscribed
-
-    if want('update_message_flags') and want('message'):
-        # Keeping unread_msgs updated requires both message flag updates and
-        # message updates. This is due to the fact that new messages will not
-        # generate a flag update so we need to use the flags field in the
-        # message event.
-        state['raw_unread_msgs'] = get_raw_unread_data(user_profile)
-
-    if want('starred_messages'):
-        state['starred_messages'] = get_starred_message_ids(user_profile)
-
-    if want('stream'):
-        state['streams'] = do_get_streams(user_profile)
-        state['stream_name_max_length'] = Stream.MAX_NAME_LENGTH
-        state['stream_description_max_length'] = Stream.MAX_DESCRIPTION_LENGTH
-    if want('default_streams'):
-        state['realm_default_streams'] = streams_to_dicts_sorted(
-            get_default_streams_for_realm(realm.id))
-    if want('default_stream_groups'):
-        state['realm_default_stream_groups'] = default_stream_groups_to_dicts_sorted(
-            get_default_stream_groups(realm))
-
-    if want('update_display_settings'):
-        for prop in UserProfile.property_types:
-            state[prop] = getattr(user_profile, prop)
-        state['emojiset_choices'] = user_profile.emojiset_choices()
-
-    if want('update_global_notifications'):
-        for notification in UserProfile.notification_setting_types:
-            state[notification] = getattr(user_profile, notification)
-
-    if want('zulip_version'):
-        state['zulip_version'] = ZULIP_VERSION
-
+    wanted = [section for section in initial_state_sections.values()
+              if all(want(event_type) for event_type in section.event_types)]
+
+    # Add the dependencies of the wanted sections; the registration
+    # order is a valid order to compute them in.
+    needed_names = {section.name for section in wanted}
+    for name in reversed(list(initial_state_sections)):
+        if name in needed_names:
+            needed_names.update(initial_state_sections[name].depends_on)
+    needed = [section for name, section in initial_state_sections.items()
+              if name in needed_names]
+
+    context = InitialStateContext(
+        user_profile=user_profile,
+        client_gravatar=client_gravatar,
+        include_subscribers=include_subscribers,
+    )
+    timings = compute_sections(needed, context)
+
+    for section in wanted:
+        state.update(context.results[section.name])
+
+    log_section_timings(user_profile, timings, time.time() - start)
     return state
 
 
@@ -1,4 +1,5 @@
 import datetime
+from collections import defaultdict
 from boto.s3.connection import S3Connection
 from django.apps import apps
 from django.conf import settings
@@ -9,10 +10,12 @@ from django.utils.timezone import utc as timezone_utc
 from django.utils.timezone import is_naive as timezone_is_naive
 import glob
 import logging
+import multiprocessing
 import os
 import ujson
 import subprocess
 import tempfile
+import time
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.models import UserProfile, Realm, Client, Huddle, Stream, \
     UserMessage, Subscription, Message, RealmEmoji, RealmFilter, Reaction, \
@@ -21,7 +24,6 @@ from zerver.models import UserProfile, Realm, Client, Huddle, Stream, \
     CustomProfileFieldValue, get_display_recipient, Attachment, get_system_bot, \
     RealmAuditLog, UserHotspot, MutedTopic, Service, UserGroup, \
     UserGroupMembership, BotStorageData, BotConfigData
-from zerver.lib.parallel import run_parallel
 from typing import Any, Callable, Dict, List, Optional, Set, Tuple, \
     Iterable, Union
 
@@ -52,6 +54,10 @@ MessageOutput = Dict[str, Union[List[Record], List[int], int]]
 
 MESSAGE_BATCH_CHUNK_SIZE = 1000
 
+# How many rows of a table a streaming export (see RealmJsonWriter)
+# fetches and holds in memory at once.
+EXPORT_TABLE_CHUNK_SIZE = 1000
+
 realm_tables = [("zerver_defaultstream", DefaultStream, "defaultstream"),
                 ("zerver_realmemoji", RealmEmoji, "realmemoji"),
                 ("zerver_realmdomain", RealmDomain, "realmdomain"),
@@ -62,7 +68,9 @@ ALL_ZULIP_TABLES = {
     'analytics_anomaly',
     'analytics_fillstate',
     'analytics_installationcount',
+    'analytics_installationrollupcount',
     'analytics_realmcount',
+    'analytics_realmrollupcount',
     'analytics_streamcount',
     'analytics_usercount',
     'otp_static_staticdevice',
@@ -168,15 +176,18 @@ NON_EXPORTED_TABLES = {
     'social_auth_partial',
     'social_auth_usersocialauth',
 
-    # We will likely never want to migrate this table, since it's a
-    # total of all the realmcount values on the server.  Might need to
-    # recompute it after a fillstate import.
+    # We will likely never want to migrate these tables, since they're
+    # totals of all the realmcount values on the server.  Might need to
+    # recompute them after a fillstate import.
     'analytics_installationcount',
+    'analytics_installationrollupcount',
 
     # These analytics tables, however, should ideally be in the export.
     'analytics_realmcount',
     'analytics_streamcount',
     'analytics_usercount',
+    # Rollups are recomputed from RealmCount, once that is exported.
+    'analytics_realmrollupcount',
     # Fillstate will require some cleverness to do the right partial export.
     'analytics_fillstate',
     # This table isn't yet used for anything.
@@ -221,7 +232,13 @@ DATE_FIELDS = {
     'zerver_userhotspot': ['timestamp'],
 }  # type: Dict[TableName, List[Field]]
 
-def sanity_check_output(data: TableData) -> None:
+def sanity_check_output(data: TableData,
+                        row_counts: Optional[Dict[TableName, int]]=None) -> None:
+    # row_counts has the tables that a streaming export has already
+    # written to realm.json, rather than kept in data.
+    if row_counts is None:
+        row_counts = {}
+
     # First, we verify that the export tool has a declared
     # configuration for every table.
     target_models = (
@@ -256,7 +273,7 @@ def sanity_check_output(data: TableData) -> None:
     tables -= ATTACHMENT_TABLES
 
     for table in tables:
-        if table not in data:
+        if table not in data and table not in row_counts:
             logging.warning('??? NO DATA EXPORTED FOR TABLE %s!!!' % (table,))
 
 def write_data_to_file(output_file: Path, data: Any) -> None:
@@ -299,6 +316,56 @@ def floatify_datetime_fields(data: TableData, table: TableName) -> None:
             utc_naive  = dt.replace(tzinfo=None) - dt.utcoffset()
             item[field] = (utc_naive - datetime.datetime(1970, 1, 1)).total_seconds()
 
+class RealmJsonWriter:
+    '''
+    Writes realm.json one table at a time, and the rows of tables
+    fetched with write_query one chunk at a time, so that a streaming
+    export never holds all the rows of the largest tables (e.g.
+    zerver_useractivity or zerver_realmauditlog) in memory.  The file
+    parses to the same data as write_data_to_file would have written.
+    '''
+
+    def __init__(self, output_file: Path) -> None:
+        self.output = open(output_file, "w")
+        self.output.write('{')
+        self.row_counts = {}  # type: Dict[TableName, int]
+
+    def write_table(self, table: TableName, chunks: Iterable[List[Record]]) -> None:
+        assert table not in self.row_counts
+        if self.row_counts:
+            self.output.write(',')
+        self.output.write('\n    %s: [' % (ujson.dumps(table),))
+        count = 0
+        for chunk in chunks:
+            for record in chunk:
+                if count > 0:
+                    self.output.write(',')
+                self.output.write('\n        ' + ujson.dumps(record))
+                count += 1
+        self.output.write('\n    ]')
+        self.row_counts[table] = count
+        logging.info('Wrote %d rows of %s' % (count, table))
+
+    def write_query(self, table: TableName, query: Any,
+                    exclude: Optional[List[Field]]=None) -> None:
+        def fetch_chunks() -> Iterable[List[Record]]:
+            min_id = -1
+            while True:
+                rows = list(query.filter(id__gt=min_id).order_by('id')[0:EXPORT_TABLE_CHUNK_SIZE])
+                if len(rows) == 0:
+                    break
+                data = {table: make_raw(rows, exclude=exclude)}
+                if table in DATE_FIELDS:
+                    floatify_datetime_fields(data, table)
+                yield data[table]
+                min_id = rows[-1].id
+
+        self.write_table(table, fetch_chunks())
+
+    def close(self) -> None:
+        self.output.write('\n}\n')
+        self.output.close()
+
 class Config:
     '''
     A Config object configures a single table for exporting (and,
@@ -387,8 +454,23 @@ class Config:
                     self.virtual_parent.table))
 
 
+def can_stream_config(config: Config) -> bool:
+    # The rows of a table are only read again by its children, its
+    # post_process_data, or (for temporary "_" tables) the config that
+    # concatenates them; do_export_realm itself only reads tables with
+    # children or custom fetches.  So tables without any of those can
+    # be written out as soon as they're fetched.
+    return (not config.children and config.post_process_data is None and
+            config.table is not None and not config.table.startswith('_'))
+
 def export_from_config(response: TableData, config: Config, seed_object: Optional[Any]=None,
-                       context: Optional[Context]=None) -> None:
+                       context: Optional[Context]=None,
+                       writer: Optional[RealmJsonWriter]=None) -> None:
+    '''
+    With a writer, the tables that can_stream_config allows are
+    written with it, a chunk at a time, instead of being added to
+    response.
+    '''
     table = config.table
     parent = config.parent
     model = config.model
@@ -409,6 +491,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
         logging.info('Exporting via export_from_config:  %s' % (t,))
 
     rows = None
+    query = None  # type: Any
     if config.is_seeded:
         rows = [seed_object]
 
@@ -438,7 +521,6 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
     elif config.use_all:
         assert model is not None
         query = model.objects.all()
-        rows = list(query)
 
     elif config.normal_parent:
         # In this mode, our current model is figuratively Article,
@@ -455,7 +537,6 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
             filter_parms.update(config.filter_args)
         assert model is not None
         query = model.objects.filter(**filter_parms)
-        rows = list(query)
 
     elif config.id_source:
         # In this mode, we are the figurative Blog, and we now
@@ -473,7 +554,13 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
         if config.filter_args:
             filter_parms.update(config.filter_args)
         query = model.objects.filter(**filter_parms)
-        rows = list(query)
+
+    if query is not None:
+        assert table is not None  # Hint for mypy
+        if writer is not None and can_stream_config(config):
+            writer.write_query(table, query, exclude=config.exclude)
+        else:
+            rows = list(query)
 
     # Post-process rows (which won't apply to custom fetches/concats)
     if rows is not None:
@@ -496,6 +583,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
             response=response,
             config=child_config,
             context=context,
+            writer=writer,
         )
 
 def get_realm_config() -> Config:
@@ -889,11 +977,14 @@ def fetch_usermessages(realm: Realm,
     logging.info("Fetched UserMessages for %s" % (message_filename,))
     return user_message_chunk
 
-def export_usermessages_batch(input_path: Path, output_path: Path) -> None:
+def export_usermessages_batch(input_path: Path, output_path: Path) -> int:
     """As part of the system for doing parallel exports, this runs on one
     batch of Message objects and adds the corresponding UserMessage
-    objects. (This is called by the export_usermessage_batch
-    management command)."""
+    objects, returning how many. (This is called by the worker
+    processes of export_usermessages_batches).
+
+    The output file is only ever complete: it's written under a
+    temporary name and then renamed, before the input is removed."""
     with open(input_path, "r") as input_file:
         output = ujson.loads(input_file.read())
     message_ids = [item['id'] for item in output['zerver_message']]
@@ -902,8 +993,67 @@ def export_usermessages_batch(input_path: Path, output_path: Path) -> None:
     realm = Realm.objects.get(id=output['realm_id'])
     del output['realm_id']
     output['zerver_usermessage'] = fetch_usermessages(realm, set(message_ids), user_profile_ids, output_path)
-    write_message_export(output_path, output)
+    write_message_export(output_path + '.tmp', output)
+    os.rename(output_path + '.tmp', output_path)
     os.unlink(input_path)
+    return len(output['zerver_usermessage'])
+
+def export_usermessages_batch_job(input_path: Path) -> Tuple[Path, int, float, int]:
+    start = time.time()
+    output_path = input_path.replace('.json.partial', '.json')
+    rows = export_usermessages_batch(input_path, output_path)
+    return (input_path, rows, time.time() - start, os.getpid())
+
+def get_usermessage_batch_paths(output_dir: Path) -> List[Path]:
+    """Returns the messages-*.json.partial files still waiting for their
+    UserMessage rows.  Batches whose output was written, but whose
+    .partial file an interrupted export didn't get to remove, are
+    complete, so we remove the .partial file here."""
+    input_paths = []
+    for input_path in sorted(glob.glob(os.path.join(output_dir, 'messages-*.json.partial'))):
+        if os.path.exists(input_path.replace('.json.partial', '.json')):
+            os.unlink(input_path)
+        else:
+            input_paths.append(input_path)
+    return input_paths
+
+def export_usermessages_batches(output_dir: Path, processes: int) -> None:
+    """Adds the UserMessage rows to every messages-*.json.partial file
+    in output_dir, using a pool of worker processes that each take the
+    next batch as soon as they finish one.  The workers are forked
+    from this process, so Django is already set up in them.
+
+    Completed batches are skipped, so this can be rerun (e.g. via the
+    export_usermessage_batch management command) to finish an
+    interrupted export."""
+    input_paths = get_usermessage_batch_paths(output_dir)
+    logging.info('Exporting UserMessage rows for %d batches with %d processes' % (
+        len(input_paths), processes))
+    if not input_paths:
+        return
+
+    # The workers must each open their own database connection.
+    connection.close()
+
+    start = time.time()
+    rows_by_worker = defaultdict(int)  # type: Dict[int, int]
+    seconds_by_worker = defaultdict(float)  # type: Dict[int, float]
+    with multiprocessing.Pool(processes=processes) as pool:
+        results = pool.imap_unordered(export_usermessages_batch_job, input_paths)
+        for done, (input_path, rows, seconds, worker) in enumerate(results, start=1):
+            rows_by_worker[worker] += rows
+            seconds_by_worker[worker] += seconds
+            elapsed = time.time() - start
+            logging.info('Worker %d exported %d UserMessage rows for %s in %.1fs '
+                         '(%.0f rows/sec for this worker); %d of %d batches done, ETA %ds' % (
+                             worker, rows, os.path.basename(input_path), seconds,
+                             rows_by_worker[worker] / max(seconds_by_worker[worker], 0.001),
+                             done, len(input_paths),
+                             elapsed / done * (len(input_paths) - done)))
+
+    total_rows = sum(rows_by_worker.values())
+    logging.info('Exported %d UserMessage rows in %ds (%.0f rows/sec)' % (
+        total_rows, time.time() - start, total_rows / max(time.time() - start, 0.001)))
 
 def write_message_export(message_filename: Path, output: MessageOutput) -> None:
     write_data_to_file(output_file=message_filename, data=output)
@@ -1278,7 +1428,8 @@ def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
             f.write('\n')
 
 def do_export_realm(realm: Realm, output_dir: Path, threads: int,
-                    exportable_user_ids: Optional[Set[int]]=None) -> None:
+                    exportable_user_ids: Optional[Set[int]]=None,
+                    streaming: bool=False) -> None:
     response = {}  # type: TableData
 
     # We need at least one thread running to export
@@ -1287,22 +1438,28 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     if not settings.TEST_SUITE:
         assert threads >= 1
 
-    assert os.path.exists("./manage.py")
-
     realm_config = get_realm_config()
 
     create_soft_link(source=output_dir, in_progress=True)
 
+    export_file = os.path.join(output_dir, "realm.json")
+    writer = None  # type: Optional[RealmJsonWriter]
+    if streaming:
+        # Tables that nothing else in the export reads are written to
+        # realm.json as they're fetched; the rest at the end, as usual.
+        writer = RealmJsonWriter(export_file)
+
     logging.info("Exporting data from get_realm_config()...")
     export_from_config(
         response=response,
         config=realm_config,
         seed_object=realm,
-        context=dict(realm=realm, exportable_user_ids=exportable_user_ids)
+        context=dict(realm=realm, exportable_user_ids=exportable_user_ids),
+        writer=writer,
     )
     logging.info('...DONE with get_realm_config() data')
 
-    sanity_check_output(response)
+    sanity_check_output(response, writer.row_counts if writer is not None else None)
 
     logging.info("Exporting uploaded files and avatars")
     export_uploads_and_avatars(realm, output_dir)
@@ -1322,15 +1479,20 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     response.update(zerver_reaction)
 
     # Write realm data
-    export_file = os.path.join(output_dir, "realm.json")
-    write_data_to_file(output_file=export_file, data=response)
+    if writer is not None:
+        for table, rows in response.items():
+            writer.write_table(table, [rows])
+        writer.close()
+    else:
+        write_data_to_file(output_file=export_file, data=response)
     logging.info('Writing realm data to %s' % (export_file,))
 
     # zerver_attachment
     export_attachment_table(realm=realm, output_dir=output_dir, message_ids=message_ids)
 
     # Start parallel jobs to export the UserMessage objects.
-    launch_user_message_subprocesses(threads=threads, output_dir=output_dir)
+    if threads > 0:
+        export_usermessages_batches(output_dir, processes=threads)
 
     logging.info("Finished exporting %s" % (realm.string_id))
     create_soft_link(source=output_dir, in_progress=False)
@@ -1358,19 +1520,6 @@ def create_soft_link(source: Path, in_progress: bool=True) -> None:
         logging.info('See %s for output files' % (new_target,))
 
 
-def launch_user_message_subprocesses(threads: int, output_dir: Path) -> None:
-    logging.info('Launching %d PARALLEL subprocesses to export UserMessage rows' % (threads,))
-
-    def run_job(shard: str) -> int:
-        subprocess.call(["./manage.py", 'export_usermessage_batch', '--path',
-                         str(output_dir), '--thread', shard])
-        return 0
-
-    for (status, job) in run_parallel(run_job,
-                                      [str(x) for x in range(0, threads)],
-                                      threads=threads):
-        print("Shard %s finished, status %s" % (job, status))
-
 def do_export_user(user_profile: UserProfile, output_dir: Path) -> None:
     response = {}  # type: TableData
 
@@ -1,6 +1,9 @@
 import datetime
+import io
 import logging
+import multiprocessing
 import os
+import time
 import ujson
 import shutil
 
@@ -16,6 +19,7 @@ from typing import Any, Dict, List, Optional, Set, Tuple, \
 from zerver.lib.actions import UserMessageLite, bulk_insert_ums
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bulk_create import bulk_create_users
+from zerver.lib.cache import disconnect_remote_caches
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.export import DATE_FIELDS, realm_tables, \
     Record, TableData, TableName, Field, Path
@@ -387,6 +391,25 @@ def re_map_foreign_keys_internal(data_table: List[Record],
             else:
                 item[field_name] = new_id
 
+def re_map_foreign_keys_bulk(data_table: List[Record],
+                             fields: List[Tuple[Field, TableName]]) -> None:
+    """
+    Equivalent to calling re_map_foreign_keys_internal for each
+    (field_name, related_table) pair, for plain foreign keys only,
+    but does a single pass over the rows with one dict lookup per
+    field.  We use it for the tables with a row per message, where
+    the per-row overhead of re_map_foreign_keys_internal adds up.
+    """
+    # See comments in bulk_import_user_message_data.
+    assert(all('usermessage' not in related_table for _, related_table in fields))
+
+    lookups = [(field_name, field_name + '_id', ID_MAP[related_table])
+               for field_name, related_table in fields]
+    for item in data_table:
+        for field_name, id_field_name, lookup_table in lookups:
+            old_id = item.pop(field_name)
+            item[id_field_name] = lookup_table.get(old_id, old_id)
+
 def re_map_foreign_keys_many_to_many(data: TableData,
                                      table: TableName,
                                      field_name: Field,
@@ -504,6 +527,48 @@ def bulk_import_model(data: TableData, model: Any, dump_file_id: Optional[str]=N
     else:
         logging.info("Successfully imported %s from %s[%s]." % (model, table, dump_file_id))
 
+def copy_value(value: Any) -> str:
+    """Formats a value for PostgreSQL's COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_import_model(data: TableData, model: Any, dump_file_id: Optional[int]=None) -> None:
+    """
+    Like bulk_import_model, but loads the rows with PostgreSQL's COPY
+    FROM STDIN, which is much faster than the multi-row INSERTs done
+    by bulk_create; we use it for our largest tables.  Like
+    bulk_create, this doesn't send any signals.  The rows must
+    already have their ids (see update_model_ids).
+    """
+    table = get_db_table(model)
+    start = time.time()
+    fields = model._meta.concrete_fields
+    rows = io.StringIO()
+    for item in data[table]:
+        obj = model(**item)
+        rows.write('\t'.join(
+            copy_value(field.get_db_prep_save(field.pre_save(obj, True), connection=connection))
+            for field in fields
+        ))
+        rows.write('\n')
+    rows.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.copy_from(rows, table, columns=[field.column for field in fields])
+
+    seconds = time.time() - start
+    rate = len(data[table]) / seconds if seconds else 0
+    if dump_file_id is None:
+        logging.info("Successfully imported %s from %s (%d rows, %.0f rows/s)." % (
+            model, table, len(data[table]), rate))
+    else:
+        logging.info("Successfully imported %s from %s[%s] (%d rows, %.0f rows/s)." % (
+            model, table, dump_file_id, len(data[table]), rate))
+
 # Client is a table shared by multiple realms, so in order to
 # correctly import multiple realms into the same server, we need to
 # check if a Client object already exists, and so we need to support
@@ -695,7 +760,7 @@ def import_uploads(import_dir: Path, processing_avatars: bool=False,
 # Because the Python object => JSON conversion process is not fully
 # faithful, we have to use a set of fixers (e.g. on DateTime objects
 # and Foreign Keys) to do the import correctly.
-def do_import_realm(import_dir: Path, subdomain: str) -> Realm:
+def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm:
     logging.info("Importing realm dump %s" % (import_dir,))
     if not os.path.exists(import_dir):
         raise Exception("Missing import directory!")
@@ -933,14 +998,15 @@ def do_import_realm(import_dir: Path, subdomain: str) -> Realm:
     }
 
     # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
+    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir,
+                        processes=processes)
 
-    re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
-    re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
+    re_map_foreign_keys_bulk(data['zerver_reaction'], [('message', 'message'),
+                                                       ('user_profile', 'user_profile')])
     re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji", id_field=True,
                         reaction_field=True)
     update_model_ids(Reaction, data, 'reaction')
-    bulk_import_model(data, Reaction)
+    copy_import_model(data, Reaction)
 
     # Do attachments AFTER message data is loaded.
     # TODO: de-dup how we read these json files.
@@ -1054,57 +1120,128 @@ def get_incoming_message_ids(import_dir: Path,
 
     return message_ids
 
-def import_message_data(realm: Realm,
-                        sender_map: Dict[int, Record],
-                        import_dir: Path) -> None:
-    dump_file_id = 1
-    while True:
-        message_filename = os.path.join(import_dir, "messages-%06d.json" % (dump_file_id,))
-        if not os.path.exists(message_filename):
-            break
+# The realm and sender_map for import_message_file, set up in each
+# process importing message dump files by init_message_import.
+message_import_state = {}  # type: Dict[str, Any]
 
-        with open(message_filename) as f:
-            data = ujson.load(f)
+def init_message_import(realm: Realm, sender_map: Dict[int, Record]) -> None:
+    message_import_state['realm'] = realm
+    message_import_state['sender_map'] = sender_map
 
-        logging.info("Importing message dump %s" % (message_filename,))
-        re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
-        re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
-        re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
-        fix_datetime_fields(data, 'zerver_message')
-        # Parser to update message content with the updated attachment urls
-        fix_upload_links(data, 'zerver_message')
-
-        # We already create mappings for zerver_message ids
-        # in update_message_foreign_keys(), so here we simply
-        # apply them.
-        message_id_map = ID_MAP['message']
-        for row in data['zerver_message']:
-            row['id'] = message_id_map[row['id']]
+def import_message_file(dump_file: Tuple[int, Path]) -> Tuple[Path, int, int, float]:
+    """
+    Imports the Message and UserMessage rows of one message dump
+    file, returning the filename, the numbers of Message and
+    UserMessage rows, and how long it took.  The message ids were
+    already allocated by update_message_foreign_keys, so the files
+    can be imported in any order, or at the same time.
+    """
+    dump_file_id, message_filename = dump_file
+    start = time.time()
+    with open(message_filename) as f:
+        data = ujson.load(f)
 
-        for row in data['zerver_usermessage']:
-            assert(row['message'] in message_id_map)
+    logging.info("Importing message dump %s" % (message_filename,))
+    re_map_foreign_keys_bulk(data['zerver_message'], [('sender', 'user_profile'),
+                                                      ('recipient', 'recipient'),
+                                                      ('sending_client', 'client')])
+    fix_datetime_fields(data, 'zerver_message')
+    # Parser to update message content with the updated attachment urls
+    fix_upload_links(data, 'zerver_message')
+
+    # We already create mappings for zerver_message ids
+    # in update_message_foreign_keys(), so here we simply
+    # apply them.
+    message_id_map = ID_MAP['message']
+    for row in data['zerver_message']:
+        row['id'] = message_id_map[row['id']]
+
+    for row in data['zerver_usermessage']:
+        assert(row['message'] in message_id_map)
+
+    fix_message_rendered_content(
+        realm=message_import_state['realm'],
+        sender_map=message_import_state['sender_map'],
+        messages=data['zerver_message'],
+    )
+    logging.info("Successfully rendered markdown for message batch")
 
-        fix_message_rendered_content(
-            realm=realm,
-            sender_map=sender_map,
-            messages=data['zerver_message'],
-        )
-        logging.info("Successfully rendered markdown for message batch")
+    # A LOT HAPPENS HERE.
+    # This is where we actually import the message data.
+    copy_import_model(data, Message, dump_file_id)
 
-        # A LOT HAPPENS HERE.
-        # This is where we actually import the message data.
-        bulk_import_model(data, Message)
+    # Due to the structure of these message chunks, we're
+    # guaranteed to have already imported all the Message objects
+    # for this batch of UserMessage objects.
+    re_map_foreign_keys_bulk(data['zerver_usermessage'], [('message', 'message'),
+                                                          ('user_profile', 'user_profile')])
+    fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
 
-        # Due to the structure of these message chunks, we're
-        # guaranteed to have already imported all the Message objects
-        # for this batch of UserMessage objects.
-        re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
-        re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
-        fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
+    bulk_import_user_message_data(data, dump_file_id)
+    return (message_filename, len(data['zerver_message']),
+            len(data['zerver_usermessage']), time.time() - start)
 
-        bulk_import_user_message_data(data, dump_file_id)
+def import_message_data(realm: Realm,
+                        sender_map: Dict[int, Record],
+                        import_dir: Path,
+                        processes: int=1) -> None:
+    """
+    Imports the message dump files, using a pool of `processes`
+    worker processes if processes > 1.  The workers are forked from
+    this process, so they share ID_MAP with it; each takes the next
+    file as soon as it finishes one.
+    """
+    dump_files = []  # type: List[Tuple[int, Path]]
+    dump_file_id = 1
+    while True:
+        message_filename = os.path.join(import_dir, "messages-%06d.json" % (dump_file_id,))
+        if not os.path.exists(message_filename):
+            break
+        dump_files.append((dump_file_id, message_filename))
         dump_file_id += 1
 
+    start = time.time()
+    pool = None  # type: Optional[Any]
+    if processes > 1 and len(dump_files) > 1:
+        # Close our database and memcached connections, so that the
+        # forked workers open their own.
+        connection.close()
+        disconnect_remote_caches()
+        pool = multiprocessing.Pool(processes, initializer=init_message_import,
+                                    initargs=(realm, sender_map))
+        results = pool.imap_unordered(
+            import_message_file, dump_files)  # type: Iterable[Tuple[Path, int, int, float]]
+    else:
+        init_message_import(realm, sender_map)
+        results = map(import_message_file, dump_files)
+
+    total_messages = 0
+    total_usermessages = 0
+    try:
+        for i, (message_filename, messages, usermessages, seconds) in enumerate(results, 1):
+            total_messages += messages
+            total_usermessages += usermessages
+            logging.info("Imported %s (%d/%d): %d messages and %d usermessages "
+                         "in %.1fs (%.0f rows/s)" % (
+                             message_filename, i, len(dump_files), messages, usermessages,
+                             seconds, (messages + usermessages) / seconds if seconds else 0))
+    except BaseException:
+        # Stop the other workers, rather than letting them import the
+        # remaining files after the import has failed.
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    seconds = time.time() - start
+    for table, rows in [('zerver_message', total_messages),
+                        ('zerver_usermessage', total_usermessages)]:
+        logging.info("Imported %d rows into %s in %.1fs (%.0f rows/s)" % (
+            rows, table, seconds, rows / seconds if seconds else 0))
+
 def import_attachments(data: TableData) -> None:
 
     # Clean up the data in zerver_attachment that is not
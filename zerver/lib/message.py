@@ -3,12 +3,15 @@ import datetime
 import ujson
 import zlib
 
+from collections import OrderedDict
+
 from django.utils.translation import ugettext as _
 from django.utils.timezone import now as timezone_now
 from django.db.models import Sum
 
 from analytics.lib.counts import COUNT_STATS, RealmCount
 
+from zerver.lib.alert_words import AlertWordMatcher, get_alert_word_matcher
 from zerver.lib.avatar import get_avatar_field
 import zerver.lib.bugdown as bugdown
 from zerver.lib.cache import (
@@ -114,6 +117,66 @@ def messages_for_ids(message_ids: List[int],
 
     return message_list
 
+def messages_for_ids_json(message_ids: List[int],
+                          user_message_flags: Dict[int, List[str]],
+                          search_fields: Dict[int, Dict[str, str]],
+                          apply_markdown: bool,
+                          client_gravatar: bool,
+                          allow_edit_history: bool) -> List[str]:
+    '''
+    Like messages_for_ids, but returns each message already serialized
+    as JSON, for use with json_success_with_fragments.  This avoids
+    decoding the cached message dicts and building a new dict for each
+    message; instead, we splice per-request JSON (flags, sender details,
+    search highlights) between pieces of JSON that were serialized once
+    per cached message (see MessageFragments).
+    '''
+    fetched = generic_bulk_cached_fetch(to_dict_cache_key_id,
+                                        MessageDict.get_raw_db_rows,
+                                        message_ids,
+                                        id_fetcher=lambda row: row['id'],
+                                        cache_transformer=MessageDict.build_dict_from_raw_db_row,
+                                        extractor=get_message_fragments,
+                                        setter=stringify_message_dict)  # type: Dict[int, Any]
+
+    message_fragments = {}  # type: Dict[int, MessageFragments]
+    for message_id, value in fetched.items():
+        if isinstance(value, dict):
+            # Cache misses come back as the dicts we just stored.
+            value = MessageFragments(value)
+        message_fragments[message_id] = value
+
+    sender_info = MessageDict.bulk_get_sender_info(
+        {fragments.sender_id for fragments in message_fragments.values()})
+    sender_json = {}  # type: Dict[int, str]
+    flags_json = {}  # type: Dict[Tuple[str, ...], str]
+
+    message_list = []  # type: List[str]
+    for message_id in message_ids:
+        fragments = message_fragments[message_id]
+        sender_id = fragments.sender_id
+        if sender_id not in sender_json:
+            sender_json[sender_id] = fragments.sender_json(sender_info[sender_id],
+                                                           client_gravatar)
+
+        flags = tuple(user_message_flags[message_id])
+        if flags not in flags_json:
+            flags_json[flags] = ujson.dumps(flags)
+
+        parts = ['{', fragments.static_json,
+                 fragments.rendered_content_json if apply_markdown else fragments.raw_content_json,
+                 sender_json[sender_id],
+                 fragments.display_recipient_json(sender_info[sender_id]),
+                 ',"flags":', flags_json[flags]]
+        if allow_edit_history:
+            parts.append(fragments.edit_history_json)
+        if message_id in search_fields:
+            parts.append(',' + ujson.dumps(search_fields[message_id])[1:-1])
+        parts.append('}')
+        message_list.append(''.join(parts))
+
+    return message_list
+
 def sew_messages_and_reactions(messages: List[Dict[str, Any]],
                                reactions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Given a iterable of messages and reactions stitch reactions
@@ -153,6 +216,102 @@ def extract_message_dict(message_bytes: bytes) -> Dict[str, Any]:
 def stringify_message_dict(message_dict: Dict[str, Any]) -> bytes:
     return zlib.compress(ujson.dumps(message_dict).encode())
 
+class MessageFragments:
+    '''
+    The parts of a cached message dict (see MessageDict) that don't
+    depend on who is fetching it, pre-serialized as the JSON that
+    finalize_payload and hydrate_recipient_info would produce, plus the
+    few fields needed to fill in the rest.  See messages_for_ids_json.
+    '''
+    __slots__ = ('sender_id', 'sender_realm_id', 'recipient_type',
+                 'raw_display_recipient', 'static_json', 'rendered_content_json',
+                 'raw_content_json', 'edit_history_json', 'stream_recipient_json')
+
+    # Fields that aren't sent to clients as-is.
+    special_fields = {'content', 'rendered_content', 'edit_history', 'sender_realm_id',
+                      'raw_display_recipient', 'recipient_type', 'recipient_type_id'}
+
+    def __init__(self, obj: Dict[str, Any]) -> None:
+        self.sender_id = obj['sender_id']  # type: int
+        self.sender_realm_id = obj['sender_realm_id']  # type: int
+        self.recipient_type = obj['recipient_type']  # type: int
+        self.raw_display_recipient = obj['raw_display_recipient']  # type: Any
+
+        static = {key: value for key, value in obj.items()
+                  if key not in self.special_fields}
+        self.static_json = ujson.dumps(static)[1:-1]
+        self.rendered_content_json = ',"content":%s,"content_type":"text/html"' % (
+            ujson.dumps(obj['rendered_content']),)
+        self.raw_content_json = ',"content":%s,"content_type":"text/x-markdown"' % (
+            ujson.dumps(obj['content']),)
+        if 'edit_history' in obj:
+            self.edit_history_json = ',"edit_history":' + ujson.dumps(obj['edit_history'])
+        else:
+            self.edit_history_json = ''
+
+        if self.recipient_type == Recipient.STREAM:
+            self.stream_recipient_json = ',' + ujson.dumps(dict(
+                type='stream',
+                stream_id=obj['recipient_type_id'],
+                display_recipient=self.raw_display_recipient,
+            ))[1:-1]  # type: Optional[str]
+        else:
+            self.stream_recipient_json = None
+
+    def sender_json(self, sender_row: Dict[str, Any], client_gravatar: bool) -> str:
+        return ',' + ujson.dumps(dict(
+            sender_full_name=sender_row['full_name'],
+            sender_short_name=sender_row['short_name'],
+            sender_email=sender_row['email'],
+            sender_realm_str=sender_row['realm__string_id'],
+            avatar_url=get_avatar_field(
+                user_id=self.sender_id,
+                realm_id=self.sender_realm_id,
+                email=sender_row['email'],
+                avatar_source=sender_row['avatar_source'],
+                avatar_version=sender_row['avatar_version'],
+                medium=False,
+                client_gravatar=client_gravatar,
+            ),
+        ))[1:-1]
+
+    def display_recipient_json(self, sender_row: Dict[str, Any]) -> str:
+        if self.stream_recipient_json is not None:
+            return self.stream_recipient_json
+
+        # Private messages include the sender in display_recipient.
+        obj = dict(
+            raw_display_recipient=self.raw_display_recipient,
+            recipient_type=self.recipient_type,
+            recipient_type_id=None,
+            sender_is_mirror_dummy=sender_row['is_mirror_dummy'],
+            sender_email=sender_row['email'],
+            sender_full_name=sender_row['full_name'],
+            sender_short_name=sender_row['short_name'],
+            sender_id=self.sender_id,
+        )
+        MessageDict.hydrate_recipient_info(obj)
+        return ',' + ujson.dumps(dict(type=obj['type'],
+                                      display_recipient=obj['display_recipient']))[1:-1]
+
+# A per-process LRU of MessageFragments, keyed by the compressed
+# message dict from the message cache; since a changed message is
+# cached as different bytes, this needs no invalidation of its own.
+MESSAGE_FRAGMENTS_CACHE_SIZE = 10000
+message_fragments_cache = OrderedDict()  # type: OrderedDict[bytes, MessageFragments]
+
+def get_message_fragments(message_bytes: bytes) -> MessageFragments:
+    fragments = message_fragments_cache.get(message_bytes)
+    if fragments is not None:
+        message_fragments_cache.move_to_end(message_bytes)
+        return fragments
+
+    fragments = MessageFragments(extract_message_dict(message_bytes))
+    message_fragments_cache[message_bytes] = fragments
+    if len(message_fragments_cache) > MESSAGE_FRAGMENTS_CACHE_SIZE:
+        message_fragments_cache.popitem(last=False)
+    return fragments
+
 @cache_with_key(to_dict_cache_key, timeout=3600*24)
 def message_to_dict_json(message: Message) -> bytes:
     return MessageDict.to_dict_uncached(message)
@@ -381,14 +540,32 @@ class MessageDict:
     @staticmethod
     def bulk_hydrate_sender_info(objs: List[Dict[str, Any]]) -> None:
 
-        sender_ids = list({
+        sender_ids = {
             obj['sender_id']
             for obj in objs
-        })
+        }
 
         if not sender_ids:
             return
 
+        sender_dict = MessageDict.bulk_get_sender_info(sender_ids)
+
+        for obj in objs:
+            sender_id = obj['sender_id']
+            user_row = sender_dict[sender_id]
+            obj['sender_full_name'] = user_row['full_name']
+            obj['sender_short_name'] = user_row['short_name']
+            obj['sender_email'] = user_row['email']
+            obj['sender_realm_str'] = user_row['realm__string_id']
+            obj['sender_avatar_source'] = user_row['avatar_source']
+            obj['sender_avatar_version'] = user_row['avatar_version']
+            obj['sender_is_mirror_dummy'] = user_row['is_mirror_dummy']
+
+    @staticmethod
+    def bulk_get_sender_info(sender_ids: Set[int]) -> Dict[int, Dict[str, Any]]:
+        if not sender_ids:
+            return {}
+
         query = UserProfile.objects.values(
             'id',
             'full_name',
@@ -400,24 +577,13 @@ class MessageDict:
             'is_mirror_dummy',
         )
 
-        rows = query_for_ids(query, sender_ids, 'zerver_userprofile.id')
+        rows = query_for_ids(query, list(sender_ids), 'zerver_userprofile.id')
 
-        sender_dict = {
+        return {
             row['id']: row
             for row in rows
         }
 
-        for obj in objs:
-            sender_id = obj['sender_id']
-            user_row = sender_dict[sender_id]
-            obj['sender_full_name'] = user_row['full_name']
-            obj['sender_short_name'] = user_row['short_name']
-            obj['sender_email'] = user_row['email']
-            obj['sender_realm_str'] = user_row['realm__string_id']
-            obj['sender_avatar_source'] = user_row['avatar_source']
-            obj['sender_avatar_version'] = user_row['avatar_version']
-            obj['sender_is_mirror_dummy'] = user_row['is_mirror_dummy']
-
     @staticmethod
     def hydrate_recipient_info(obj: Dict[str, Any]) -> None:
         '''
@@ -623,6 +789,12 @@ def do_render_markdown(message: Message,
         if user_id in message_user_ids:
             possible_words.update(set(words))
 
+    if possible_words:
+        alert_word_matcher = get_alert_word_matcher(
+            realm, realm_alert_words)  # type: Optional[AlertWordMatcher]
+    else:
+        alert_word_matcher = None
+
     # DO MAIN WORK HERE -- call bugdown to convert
     rendered_content = bugdown.convert(
         content,
@@ -632,7 +804,8 @@ def do_render_markdown(message: Message,
         sent_by_bot=sent_by_bot,
         translate_emoticons=translate_emoticons,
         mention_data=mention_data,
-        email_gateway=email_gateway
+        email_gateway=email_gateway,
+        alert_word_matcher=alert_word_matcher,
     )
 
     message.user_ids_with_alert_words = set()
@@ -774,6 +947,18 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
     user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
 
     rows = list(reversed(user_msgs))
+    return extract_unread_data_from_um_rows(rows, user_profile)
+
+def extract_unread_data_from_um_rows(
+        rows: List[Dict[str, Any]],
+        user_profile: UserProfile,
+        known_huddle_users: Optional[Dict[int, str]]=None) -> RawUnreadMessagesResult:
+    '''
+    Builds the raw unread data from UserMessage rows (as fetched in
+    get_raw_unread_data), in increasing message id order.  Callers
+    that already know the user_ids_string of some huddles can pass
+    them in known_huddle_users, keyed by recipient id.
+    '''
 
     muted_stream_ids = get_muted_stream_ids(user_profile)
 
@@ -789,6 +974,8 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
         return False
 
     huddle_cache = {}  # type: Dict[int, str]
+    if known_huddle_users is not None:
+        huddle_cache.update(known_huddle_users)
 
     def get_huddle_users(recipient_id: int) -> str:
         if recipient_id in huddle_cache:
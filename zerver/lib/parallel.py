@@ -9,7 +9,8 @@ JobData = TypeVar('JobData')
 
 def run_parallel(job: Callable[[JobData], int],
                  data: Iterable[JobData],
-                 threads: int=6) -> Iterator[Tuple[int, JobData]]:
+                 threads: int=6,
+                 stop_on_error: bool=True) -> Iterator[Tuple[int, JobData]]:
     pids = {}  # type: Dict[int, JobData]
 
     def wait_for_one() -> Tuple[int, JobData]:
@@ -39,7 +40,7 @@ def run_parallel(job: Callable[[JobData], int],
             (status, item) = wait_for_one()
             threads += 1
             yield (status, item)
-            if status != 0:
+            if status != 0 and stop_on_error:
                 # Stop if any error occurred
                 break
 
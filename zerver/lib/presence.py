@@ -0,0 +1,231 @@
+'''
+A realm-wide snapshot of users' presence, maintained in Redis.
+
+Every presence poll from every client returns the presence of the
+whole realm, which UserPresence.get_status_dict_by_realm computes by
+querying the realm's active users, their UserPresence rows from the
+last two weeks and their PushDeviceToken rows.  With
+settings.PRESENCE_SNAPSHOT_ENABLED, we instead keep, for each realm, a
+Redis hash mapping each user's id to the latest status from each of
+their clients, which do_update_user_presences updates whenever it
+saves UserPresence rows.  The snapshot is built from the database the
+first time it's needed, and rebuilt after it expires
+(PRESENCE_SNAPSHOT_TTL_SECONDS), which bounds the damage from
+changes made to UserPresence rows by other code paths.
+
+Next to the hash, a sorted set records when each user's entry was
+last stored, so that clients can ask for only the users whose
+presence changed since the server_timestamp of their previous
+response.  Both the times in the sorted set and that server_timestamp
+come from Redis's clock, since the clocks of our hosts may disagree;
+and since a writer reads the time before its script runs, readers
+look back PRESENCE_SINCE_MARGIN_SECONDS further than `since`.  Such a response doesn't report users who have since been
+deactivated or whose presence has aged past PRESENCE_MAX_AGE; clients
+handle those themselves and periodically refetch the full data (see
+docs/subsystems/presence.md).
+
+Which users are active non-bot users, and their current email
+addresses, are applied when the snapshot is read, from the cached
+get_realm_user_dicts.  Whether a user is pushable is as of the last
+update from that client.
+'''
+import datetime
+import os
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set
+
+import ujson
+from django.conf import settings
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.models import PushDeviceToken, UserPresence, get_realm_user_dicts
+
+client = get_redis_client()
+
+KEY_PREFIX = ''
+
+PRESENCE_SNAPSHOT_TTL_SECONDS = 24 * 60 * 60
+PRESENCE_MAX_AGE = datetime.timedelta(weeks=2)
+PRESENCE_SINCE_MARGIN_SECONDS = 10
+
+READY_FIELD = 'ready'
+
+# A user's entry is a JSON object mapping client names to
+# [status, timestamp, push_enabled, has_push_devices], with the
+# timestamp in integer milliseconds (Lua's cjson rounds floats to 14
+# significant digits, which isn't enough for seconds); an update from
+# a client only replaces that client's status if it is more recent,
+# since presence events can be processed out of order, and a build
+# can race with updates.
+#
+# KEYS: snapshot, changes
+# ARGV: ttl, stored_at, ready, then (user_id, client, row) triples
+store_script = client.register_script('''
+for i = 4, #ARGV, 3 do
+    local row = cjson.decode(ARGV[i + 2])
+    local old = redis.call('hget', KEYS[1], ARGV[i])
+    local clients = {}
+    if old then
+        clients = cjson.decode(old)
+    end
+    local current = clients[ARGV[i + 1]]
+    if not current or current[2] < row[2] then
+        clients[ARGV[i + 1]] = row
+        redis.call('hset', KEYS[1], ARGV[i], cjson.encode(clients))
+        redis.call('zadd', KEYS[2], ARGV[2], ARGV[i])
+    end
+end
+if ARGV[3] == '1' then
+    redis.call('hset', KEYS[1], 'ready', '1')
+    redis.call('expire', KEYS[1], ARGV[1])
+    redis.call('expire', KEYS[2], ARGV[1])
+elseif redis.call('ttl', KEYS[1]) < 0 then
+    redis.call('expire', KEYS[1], ARGV[1])
+    redis.call('expire', KEYS[2], ARGV[1])
+end
+''')
+
+def bounce_presence_key_prefix_for_testing(test_name: str) -> None:
+    global KEY_PREFIX
+    KEY_PREFIX = test_name + ':' + str(os.getpid()) + ':'
+
+def presence_snapshot_keys(realm_id: int) -> List[str]:
+    return ["{}presence:{}:{}".format(KEY_PREFIX, realm_id, keytype)
+            for keytype in ['snapshot', 'changes']]
+
+def presence_snapshot_row(status: int, timestamp: datetime.datetime,
+                          push_enabled: bool, has_push_devices: bool) -> str:
+    return ujson.dumps([status, int(timestamp.timestamp() * 1000),
+                        push_enabled, has_push_devices])
+
+def get_presence_snapshot_time() -> float:
+    # The script can't read the time itself: before Redis 3.2, a
+    # script may not write after calling TIME.
+    seconds, microseconds = client.time()
+    return seconds + microseconds / 1000000
+
+def store_presence_rows(realm_id: int, args: List[Any], ready: bool) -> None:
+    store_script(keys=presence_snapshot_keys(realm_id),
+                 args=[PRESENCE_SNAPSHOT_TTL_SECONDS, get_presence_snapshot_time(),
+                       '1' if ready else '0'] + args)
+
+def build_presence_snapshot(realm_id: int) -> None:
+    query = UserPresence.objects.filter(
+        user_profile__realm_id=realm_id,
+        timestamp__gte=timezone_now() - PRESENCE_MAX_AGE,
+    ).values(
+        'client__name',
+        'status',
+        'timestamp',
+        'user_profile_id',
+        'user_profile__enable_offline_push_notifications',
+    )
+    mobile_user_ids = set(PushDeviceToken.objects.filter(
+        user__realm_id=realm_id,
+    ).distinct('user_id').values_list('user_id', flat=True))
+
+    args = []  # type: List[Any]
+    for row in query:
+        args += [row['user_profile_id'], row['client__name'], presence_snapshot_row(
+            status=row['status'],
+            timestamp=row['timestamp'],
+            push_enabled=row['user_profile__enable_offline_push_notifications'],
+            has_push_devices=row['user_profile_id'] in mobile_user_ids,
+        )]
+    store_presence_rows(realm_id, args, ready=True)
+
+def update_presence_snapshot(presences: List[UserPresence]) -> None:
+    '''
+    Stores the UserPresence rows (with their user_profile and client
+    loaded) that do_update_user_presences has just saved.
+    '''
+    if not settings.PRESENCE_SNAPSHOT_ENABLED or not presences:
+        return
+    # has_push_devices only matters for users with push notifications
+    # enabled, so don't query for the others.
+    push_enabled_user_ids = {presence.user_profile_id for presence in presences
+                             if presence.user_profile.enable_offline_push_notifications}
+    mobile_user_ids = set()  # type: Set[int]
+    if push_enabled_user_ids:
+        mobile_user_ids = set(PushDeviceToken.objects.filter(
+            user_id__in=push_enabled_user_ids,
+        ).distinct('user_id').values_list('user_id', flat=True))
+
+    args_by_realm = defaultdict(list)  # type: Dict[int, List[Any]]
+    for presence in presences:
+        user_profile = presence.user_profile
+        args_by_realm[user_profile.realm_id] += [
+            user_profile.id, presence.client.name, presence_snapshot_row(
+                status=presence.status,
+                timestamp=presence.timestamp,
+                push_enabled=user_profile.enable_offline_push_notifications,
+                has_push_devices=user_profile.id in mobile_user_ids,
+            )]
+    for realm_id, args in args_by_realm.items():
+        store_presence_rows(realm_id, args, ready=False)
+
+def fetch_presence_snapshot(realm_id: int, since: Optional[float]=None) -> Dict[int, Any]:
+    '''
+    Returns the entries of the realm's snapshot, building it if needed:
+    all of them, or if `since` is passed, those of the users whose
+    presence was stored after that time (as returned by
+    get_presence_snapshot_time), or shortly before it.
+    '''
+    keys = presence_snapshot_keys(realm_id)
+    for i in range(2):
+        if since is None:
+            entries = client.hgetall(keys[0])
+        else:
+            pipeline = client.pipeline()
+            pipeline.hget(keys[0], READY_FIELD)
+            pipeline.zrangebyscore(keys[1], '(%r' % (since - PRESENCE_SINCE_MARGIN_SECONDS,),
+                                   '+inf')
+            ready, user_ids = pipeline.execute()
+            entries = {}  # type: Dict[bytes, Optional[bytes]]
+            if ready is not None:
+                entries[READY_FIELD.encode()] = ready
+                if user_ids:
+                    entries.update(zip(user_ids, client.hmget(keys[0], user_ids)))
+        if READY_FIELD.encode() in entries:
+            break
+        build_presence_snapshot(realm_id)
+
+    return {int(user_id): ujson.loads(value)
+            for user_id, value in entries.items()
+            if user_id != READY_FIELD.encode() and value is not None}
+
+def get_status_dict_from_snapshot(realm_id: int,
+                                  since: Optional[float]=None) -> Dict[str, Dict[str, Any]]:
+    '''
+    The equivalent of UserPresence.get_status_dict_by_realm, served
+    from the snapshot.
+    '''
+    emails = {row['id']: row['email'] for row in get_realm_user_dicts(realm_id)
+              if row['is_active'] and not row['is_bot']}
+    cutoff = (timezone_now() - PRESENCE_MAX_AGE).timestamp() * 1000
+
+    presence_rows = []  # type: List[Dict[str, Any]]
+    mobile_user_ids = set()  # type: Set[int]
+    for user_id, clients in fetch_presence_snapshot(realm_id, since).items():
+        if user_id not in emails:
+            continue
+        for client_name, (status, timestamp, push_enabled, has_push_devices) in clients.items():
+            if timestamp < cutoff:
+                continue
+            if has_push_devices:
+                mobile_user_ids.add(user_id)
+            presence_rows.append({
+                'client__name': client_name,
+                'status': status,
+                'timestamp': timestamp_to_datetime(timestamp / 1000),
+                'user_profile__email': emails[user_id],
+                'user_profile__id': user_id,
+                'user_profile__enable_offline_push_notifications': push_enabled,
+            })
+
+    return UserPresence.get_status_dicts_for_rows(presence_rows, mobile_user_ids)
+
+def drop_presence_snapshot(realm_id: int) -> None:
+    client.delete(*presence_snapshot_keys(realm_id))
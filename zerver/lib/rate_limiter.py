@@ -1,16 +1,14 @@
 
 import os
 
-from typing import Any, Iterator, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from django.conf import settings
 from zerver.lib.redis_utils import get_redis_client
 
 from zerver.models import UserProfile
 
-import redis
 import time
-import logging
 
 # Implement a rate-limiting scheme inspired by the one described here, but heavily modified
 # http://blog.domaintools.com/2013/04/rate-limiting-with-redis/
@@ -20,6 +18,58 @@ rules = settings.RATE_LIMITING_RULES  # type: List[Tuple[int, int]]
 
 KEY_PREFIX = ''
 
+# The check done by is_ratelimited, followed if the entity isn't
+# limited by recording the request (the newest timestamps in a list
+# capped at the highest limit's number of requests, and all of them in
+# a sorted set for counting), as one atomic operation; this replaced a
+# WATCH/MULTI transaction that would retry under contention, and the
+# several round-trips around it.
+#
+# Lua numbers are converted to integers on their way back to Redis, so
+# fractional times are returned as strings (with 14 significant
+# digits, which is plenty for durations).
+#
+# KEYS: list, zset, block
+# ARGV: now, then (range_seconds, num_requests) pairs, in increasing
+#       order of range_seconds
+# Returns: {1, seconds until free, 0} if rate limited, or
+#          {0, seconds until the highest limit resets, calls remaining}
+rate_limit_script = client.register_script('''
+if redis.call('exists', KEYS[3]) == 1 then
+    return {1, tostring(redis.call('ttl', KEYS[3])), 0}
+end
+
+local now = tonumber(ARGV[1])
+local max_window = 0
+local max_calls = 0
+for i = 2, #ARGV, 2 do
+    local range_seconds = tonumber(ARGV[i])
+    local num_requests = tonumber(ARGV[i + 1])
+    local timestamp = redis.call('lindex', KEYS[1], num_requests - 1)
+    if timestamp then
+        local boundary = tonumber(timestamp) + range_seconds
+        if boundary > now then
+            return {1, tostring(boundary - now), 0}
+        end
+    end
+    max_window = range_seconds
+    max_calls = num_requests
+end
+
+local trimmed = redis.call('lindex', KEYS[1], max_calls - 1)
+redis.call('lpush', KEYS[1], ARGV[1])
+redis.call('ltrim', KEYS[1], 0, max_calls - 1)
+redis.call('zadd', KEYS[2], ARGV[1], ARGV[1])
+if trimmed then
+    redis.call('zrem', KEYS[2], trimmed)
+end
+redis.call('expire', KEYS[1], max_window)
+redis.call('expire', KEYS[2], max_window)
+
+local count = redis.call('zcount', KEYS[2], now - max_window, ARGV[1])
+return {0, tostring(max_window), max_calls - count}
+''')
+
 class RateLimitedObject:
     def get_keys(self) -> List[str]:
         key_fragment = self.key_fragment()
@@ -49,6 +99,66 @@ class RateLimitedUser(RateLimitedObject):
             return result
         return rules
 
+# With settings.RATE_LIMITING_LOCAL_PRECHECK, each process keeps a
+# LocalRateLimitState per key, so that a client hammering us can be
+# turned away without a Redis round-trip:
+#
+# * When Redis says an entity is rate limited, we remember until when,
+#   since nothing other than block/unblock commands can free it sooner.
+#
+# * A token bucket for each rule (holding up to num_requests tokens,
+#   refilled at num_requests per range_seconds) is charged for each
+#   request Redis allowed.  A bucket with less than one token means
+#   this process alone has allowed num_requests requests within
+#   range_seconds, so Redis would refuse the request too.
+#
+# Requests that pass these checks still go to Redis, which counts
+# requests across all processes.
+local_rate_limit_states = {}  # type: Dict[str, LocalRateLimitState]
+LOCAL_RATE_LIMIT_MAX_KEYS = 10000
+
+class LocalRateLimitState:
+    def __init__(self, rules: List[Tuple[int, int]], now: float) -> None:
+        self.rules = list(rules)
+        self.tokens = [float(num_requests) for _, num_requests in rules]
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def refill(self, now: float) -> None:
+        elapsed = max(now - self.updated, 0)
+        for i, (range_seconds, num_requests) in enumerate(self.rules):
+            self.tokens[i] = min(float(num_requests),
+                                 self.tokens[i] + elapsed * num_requests / range_seconds)
+        self.updated = max(now, self.updated)
+
+    def time_till_free(self, now: float) -> float:
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        self.refill(now)
+        free = 0.0
+        for tokens, (range_seconds, num_requests) in zip(self.tokens, self.rules):
+            if tokens < 1:
+                free = max(free, (1 - tokens) * range_seconds / num_requests)
+        return free
+
+    def record(self, now: float, rate_limited: bool, time_till_free: float) -> None:
+        if rate_limited:
+            self.blocked_until = now + time_till_free
+            return
+        self.refill(now)
+        self.tokens = [tokens - 1 for tokens in self.tokens]
+
+def get_local_rate_limit_state(entity: RateLimitedObject, rules: List[Tuple[int, int]],
+                               now: float) -> LocalRateLimitState:
+    key = entity.key_fragment()
+    state = local_rate_limit_states.get(key)
+    if state is None or state.rules != rules:
+        if len(local_rate_limit_states) >= LOCAL_RATE_LIMIT_MAX_KEYS:
+            local_rate_limit_states.clear()
+        state = LocalRateLimitState(rules, now)
+        local_rate_limit_states[key] = state
+    return state
+
 def bounce_redis_key_prefix_for_testing(test_name: str) -> None:
     global KEY_PREFIX
     KEY_PREFIX = test_name + ':' + str(os.getpid()) + ':'
@@ -91,6 +201,7 @@ def clear_history(entity: RateLimitedObject) -> None:
     '''
     for key in entity.get_keys():
         client.delete(key)
+    local_rate_limit_states.pop(entity.key_fragment(), None)
 
 def _get_api_calls_left(entity: RateLimitedObject, range_seconds: int, max_calls: int) -> Tuple[int, float]:
     list_key, set_key, _ = entity.get_keys()
@@ -175,61 +286,29 @@ def is_ratelimited(entity: RateLimitedObject) -> Tuple[bool, float]:
     # No api calls recorded yet
     return False, 0.0
 
-def incr_ratelimit(entity: RateLimitedObject) -> None:
-    """Increases the rate-limit for the specified entity"""
-    list_key, set_key, _ = entity.get_keys()
-    now = time.time()
-
-    # If we have no rules, we don't store anything
+def rate_limit_entity(entity: RateLimitedObject) -> Tuple[bool, float, int]:
+    """Atomically checks whether the entity is over any of its limits
+    and, if it isn't, records this request.  Returns a tuple of
+    (rate_limited, time_till_free, calls_remaining); time_till_free is
+    until the highest limit resets to 0 when the request was allowed."""
+    rules = entity.rules()
     if len(rules) == 0:
-        return
+        return False, 0.0, 0
 
-    # Start redis transaction
-    with client.pipeline() as pipe:
-        count = 0
-        while True:
-            try:
-                # To avoid a race condition between getting the element we might trim from our list
-                # and removing it from our associated set, we abort this whole transaction if
-                # another agent manages to change our list out from under us
-                # When watching a value, the pipeline is set to Immediate mode
-                pipe.watch(list_key)
-
-                # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                last_val = pipe.lindex(list_key, max_api_calls(entity) - 1)
-
-                # Restart buffered execution
-                pipe.multi()
-
-                # Add this timestamp to our list
-                pipe.lpush(list_key, now)
-
-                # Trim our list to the oldest rule we have
-                pipe.ltrim(list_key, 0, max_api_calls(entity) - 1)
-
-                # Add our new value to the sorted set that we keep
-                # We need to put the score and val both as timestamp,
-                # as we sort by score but remove by value
-                pipe.zadd(set_key, now, now)
-
-                # Remove the trimmed value from our sorted set, if there was one
-                if last_val is not None:
-                    pipe.zrem(set_key, last_val)
-
-                # Set the TTL for our keys as well
-                api_window = max_api_window(entity)
-                pipe.expire(list_key, api_window)
-                pipe.expire(set_key, api_window)
-
-                pipe.execute()
-
-                # If no exception was raised in the execution, there were no transaction conflicts
-                break
-            except redis.WatchError:
-                if count > 10:
-                    logging.error("Failed to complete incr_ratelimit transaction without "
-                                  "interference 10 times in a row! Aborting rate-limit increment")
-                    break
-                count += 1
-
-                continue
+    now = time.time()
+    if settings.RATE_LIMITING_LOCAL_PRECHECK:
+        local_state = get_local_rate_limit_state(entity, rules, now)
+        time_till_free = local_state.time_till_free(now)
+        if time_till_free > 0:
+            return True, time_till_free, 0
+
+    list_key, set_key, blocking_key = entity.get_keys()
+    args = [now]  # type: List[Any]
+    for range_seconds, num_requests in rules:
+        args += [range_seconds, num_requests]
+    rate_limited, seconds, calls_remaining = rate_limit_script(
+        keys=[list_key, set_key, blocking_key], args=args)
+
+    if settings.RATE_LIMITING_LOCAL_PRECHECK:
+        local_state.record(now, bool(rate_limited), float(seconds))
+    return bool(rate_limited), float(seconds), int(calls_remaining)
@@ -43,6 +43,20 @@ def json_response(res_type: str="success",
 def json_success(data: Optional[Dict[str, Any]]=None) -> HttpResponse:
     return json_response(data=data)
 
+def json_success_with_fragments(data: Dict[str, Any], key: str,
+                                fragments: List[str]) -> HttpResponse:
+    '''
+    Like json_success, but with data[key] given as a list of
+    already-serialized JSON values, which are spliced into the
+    response as-is.
+    '''
+    content = {"result": "success", "msg": ""}
+    content.update(data)
+    serialized = ujson.dumps(content)
+    assert serialized.endswith('}')
+    return HttpResponse(content='%s,"%s":[%s]}\n' % (serialized[:-1], key, ','.join(fragments)),
+                        content_type='application/json', status=200)
+
 def json_response_from_error(exception: JsonableError) -> HttpResponse:
     '''
     This should only be needed in middleware; in app code, just raise.
@@ -1,5 +1,6 @@
 
 from zerver.lib.logging_util import log_to_file
+from zerver.lib.unread_summary import drop_unread_summaries
 from collections import defaultdict
 import logging
 from django.db import transaction
@@ -159,6 +160,7 @@ def add_missing_messages(user_profile: UserProfile) -> None:
     # Doing a bulk create for all the UserMessage objects stored for creation.
     if len(user_messages_to_insert) > 0:
         UserMessage.objects.bulk_create(user_messages_to_insert)
+        drop_unread_summaries([user_profile.id])
 
 def do_soft_deactivate_user(user_profile: UserProfile) -> None:
     user_profile.last_active_message_id = UserMessage.objects.filter(
@@ -18,6 +18,7 @@ from django.db.utils import IntegrityError
 from django.http import HttpRequest
 
 from two_factor.models import PhoneDevice
+from zerver.lib.bugdown import clear_render_cache
 from zerver.lib.initial_password import initial_password
 from zerver.lib.utils import is_remote_server
 from zerver.lib.users import get_api_key
@@ -67,6 +68,7 @@ API_KEYS = {}  # type: Dict[str, str]
 def flush_caches_for_testing() -> None:
     global API_KEYS
     API_KEYS = {}
+    clear_render_cache()
 
 class UploadSerializeMixin(SerializeMixin):
     """
@@ -1,12 +1,15 @@
 from types import TracebackType
-from typing import Any, Callable, Optional, Tuple, Type, TypeVar
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
 
+import os
 import six
 import sys
 import time
 import ctypes
 import threading
 
+from six.moves import queue
+
 # Based on http://code.activestate.com/recipes/483752/
 
 class TimeoutExpired(Exception):
@@ -17,6 +20,134 @@ class TimeoutExpired(Exception):
 
 ResultT = TypeVar('ResultT')
 
+class TimeoutTask:
+    def __init__(self, func: Callable[..., Any], args: Tuple[Any, ...],
+                 kwargs: Dict[str, Any]) -> None:
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None  # type: Any
+        self.exc_info = None  # type: Optional[Tuple[Optional[Type[BaseException]], Optional[BaseException], Optional[TracebackType]]]
+        # Both of these are only changed while holding the pool's lock.
+        self.finished = False
+        self.timed_out = False
+        self.done = threading.Event()
+
+    def execute(self) -> None:
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+
+class TimeoutWorker(threading.Thread):
+    def __init__(self, pool: 'TimeoutWorkerPool') -> None:
+        threading.Thread.__init__(self)
+        self.pool = pool
+        self.inbox = queue.Queue()  # type: queue.Queue
+        # Don't block the whole program from exiting
+        # if this is the only thread left.
+        self.daemon = True
+
+    def run(self) -> None:
+        while True:
+            try:
+                task = self.inbox.get()
+                task.execute()
+            except TimeoutExpired:
+                # The timeout can arrive just after the function
+                # returned, outside of task.execute().
+                pass
+
+            # pool.finish() stops any further timeout exceptions from
+            # being sent to this thread, but one may land before it
+            # gets that far; just try again.
+            while True:
+                try:
+                    self.pool.finish(self, task)
+                    break
+                except TimeoutExpired:
+                    pass
+
+    def raise_async_timeout(self) -> None:
+        # Called from another thread.
+        # Attempt to raise a TimeoutExpired in the thread represented by 'self'.
+        assert self.ident is not None  # Thread should be running; c_long expects int
+        tid = ctypes.c_long(self.ident)
+        result = ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            tid, ctypes.py_object(TimeoutExpired))
+        if result > 1:
+            # "if it returns a number greater than one, you're in trouble,
+            # and you should call it again with exc=NULL to revert the effect"
+            #
+            # I was unable to find the actual source of this quote, but it
+            # appears in the many projects across the Internet that have
+            # copy-pasted this recipe.
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, None)
+
+    def clear_async_timeout(self) -> None:
+        # Called from this thread, to drop a TimeoutExpired that was
+        # sent but hasn't been raised yet.
+        assert self.ident is not None
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.ident), None)
+
+class TimeoutWorkerPool:
+    '''Long-lived threads for running functions under timeout().
+
+    Starting a thread for every call is a significant part of the cost
+    of rendering a short message, so idle workers are kept around and
+    reused.  A new worker is only started when every existing one is
+    busy, which includes workers stuck in a call that has already timed
+    out and that we failed to interrupt.'''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.idle_workers = []  # type: List[TimeoutWorker]
+        self.pid = os.getpid()
+
+    def run(self, timeout: float, task: TimeoutTask) -> None:
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads don't survive a fork, so a child process
+                # needs its own workers.
+                self.idle_workers = []
+                self.pid = os.getpid()
+            if self.idle_workers:
+                worker = self.idle_workers.pop()
+            else:
+                worker = TimeoutWorker(self)
+                worker.start()
+        worker.inbox.put(task)
+
+        if task.done.wait(timeout):
+            return
+
+        # Gamely try to kill the call, following the dodgy approach from
+        # http://stackoverflow.com/a/325528/90777
+        #
+        # We need to retry, because an async exception received while the
+        # thread is in a system call is simply ignored.
+        for i in range(10):
+            with self.lock:
+                if task.finished:
+                    if not task.timed_out:
+                        # It finished just in time.
+                        return
+                    break
+                task.timed_out = True
+                worker.raise_async_timeout()
+            time.sleep(0.1)
+        raise TimeoutExpired
+
+    def finish(self, worker: TimeoutWorker, task: TimeoutTask) -> None:
+        with self.lock:
+            if task.timed_out:
+                worker.clear_async_timeout()
+            task.finished = True
+            self.idle_workers.append(worker)
+        task.done.set()
+
+worker_pool = TimeoutWorkerPool()
+
 def timeout(timeout: float, func: Callable[..., ResultT], *args: Any, **kwargs: Any) -> ResultT:
     '''Call the function in a separate thread.
        Return its return value, or raise an exception,
@@ -31,60 +162,17 @@ def timeout(timeout: float, func: Callable[..., ResultT], *args: Any, **kwargs:
 
        This may also fail to interrupt functions which are
        stuck in a long-running primitive interpreter
-       operation.'''
-
-    class TimeoutThread(threading.Thread):
-        def __init__(self) -> None:
-            threading.Thread.__init__(self)
-            self.result = None  # type: Optional[ResultT]
-            self.exc_info = None  # type: Optional[Tuple[Optional[Type[BaseException]], Optional[BaseException], Optional[TracebackType]]]
+       operation.
 
-            # Don't block the whole program from exiting
-            # if this is the only thread left.
-            self.daemon = True
+       The threads are reused between calls; see
+       TimeoutWorkerPool.'''
 
-        def run(self) -> None:
-            try:
-                self.result = func(*args, **kwargs)
-            except BaseException:
-                self.exc_info = sys.exc_info()
-
-        def raise_async_timeout(self) -> None:
-            # Called from another thread.
-            # Attempt to raise a TimeoutExpired in the thread represented by 'self'.
-            assert self.ident is not None  # Thread should be running; c_long expects int
-            tid = ctypes.c_long(self.ident)
-            result = ctypes.pythonapi.PyThreadState_SetAsyncExc(
-                tid, ctypes.py_object(TimeoutExpired))
-            if result > 1:
-                # "if it returns a number greater than one, you're in trouble,
-                # and you should call it again with exc=NULL to revert the effect"
-                #
-                # I was unable to find the actual source of this quote, but it
-                # appears in the many projects across the Internet that have
-                # copy-pasted this recipe.
-                ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, None)
-
-    thread = TimeoutThread()
-    thread.start()
-    thread.join(timeout)
-
-    if thread.is_alive():
-        # Gamely try to kill the thread, following the dodgy approach from
-        # http://stackoverflow.com/a/325528/90777
-        #
-        # We need to retry, because an async exception received while the
-        # thread is in a system call is simply ignored.
-        for i in range(10):
-            thread.raise_async_timeout()
-            time.sleep(0.1)
-            if not thread.is_alive():
-                break
-        raise TimeoutExpired
+    task = TimeoutTask(func, args, kwargs)
+    worker_pool.run(timeout, task)
 
-    if thread.exc_info:
+    if task.exc_info:
         # Raise the original stack trace so our error messages are more useful.
         # from http://stackoverflow.com/a/4785766/90777
-        six.reraise(thread.exc_info[0], thread.exc_info[1], thread.exc_info[2])
-    assert thread.result is not None  # assured if above did not reraise
-    return thread.result
+        six.reraise(task.exc_info[0], task.exc_info[1], task.exc_info[2])
+    assert task.result is not None  # assured if above did not reraise
+    return task.result
@@ -0,0 +1,373 @@
+'''
+Per-user summaries of unread messages, maintained in Redis.
+
+Computing the unread data for /register with get_raw_unread_data
+means scanning up to MAX_UNREAD_MESSAGES UserMessage rows joined with
+Message and Recipient, which is slow for users with tens of thousands
+of unread messages.  With settings.UNREAD_SUMMARY_ENABLED, we instead
+keep, for each user who has registered recently, a Redis hash mapping
+the id of each of their unread messages to the fields of that row we
+need (recipient, stream, topic, sender, whether they were mentioned
+and, for huddles, the user_ids_string).
+
+The summary is built from the database the first time it's needed,
+and is then updated incrementally by the code paths that create
+UserMessage rows or change the read flag (do_send_messages,
+do_update_message_flags, do_mark_stream_messages_as_read and
+do_mark_all_as_read).  Code paths where an incremental update isn't
+worth it (editing topics or mentions, catching up soft-deactivated
+users, moving the pointer) just drop the affected summaries, which
+are then rebuilt on the next /register.  Summaries also expire after
+UNREAD_SUMMARY_TTL_SECONDS, which bounds the damage from any change
+that was missed; check_unread_summaries compares them against the
+database.
+
+Everything that depends on the user's settings rather than on the
+messages themselves (muted streams and topics, and which streams they
+are still subscribed to) is applied when the summary is read, just as
+get_raw_unread_data does, so those changes don't need to touch it.
+
+Building a summary races with concurrent updates: a message sent
+after we've queried the database but before we've stored the result
+would be missing.  To avoid that, while a summary is being built,
+updates for that user are appended to a log that is replayed (in a
+single Lua script) when the built summary is stored.
+'''
+import os
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import ujson
+from django.conf import settings
+
+from zerver.lib.message import (
+    MAX_UNREAD_MESSAGES,
+    RawUnreadMessagesResult,
+    extract_unread_data_from_um_rows,
+    get_raw_unread_data,
+    huddle_users,
+)
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.stream_subscription import get_inactive_recipient_ids
+from zerver.lib.topic import MESSAGE__TOPIC
+from zerver.models import Message, Recipient, UserMessage, UserProfile
+
+client = get_redis_client()
+
+KEY_PREFIX = ''
+
+# Users with more unread messages than this don't get a summary; we
+# fall back to get_raw_unread_data for them.
+UNREAD_SUMMARY_MAX_MESSAGES = 2 * MAX_UNREAD_MESSAGES
+UNREAD_SUMMARY_TTL_SECONDS = 24 * 60 * 60
+# How long a build (querying the database for the user's unread
+# messages) may take before its log of concurrent updates expires.
+UNREAD_SUMMARY_BUILD_SECONDS = 60
+
+# Fields of the summary hash other than message ids.
+READY_FIELD = 'ready'
+OVERFLOW_FIELD = 'overflow'
+
+# An update is a JSON list: ["add", message_id, row, message_id, row, ...],
+# ["remove", message_id, ...] or ["clear"].
+APPLY_UPDATE_LUA = '''
+local function apply_update(key, update)
+    if update[1] == 'clear' then
+        redis.call('del', key)
+        redis.call('hset', key, 'ready', '1')
+        redis.call('expire', key, ARGV[1])
+    elseif redis.call('hexists', key, 'overflow') == 1 then
+        return
+    elseif update[1] == 'add' then
+        for i = 2, #update, 2 do
+            redis.call('hset', key, update[i], update[i + 1])
+        end
+    elseif update[1] == 'remove' then
+        for i = 2, #update do
+            redis.call('hdel', key, update[i])
+        end
+    end
+end
+'''
+
+# KEYS: summary, build token, build log
+# ARGV: ttl, update
+update_script = client.register_script(APPLY_UPDATE_LUA + '''
+if redis.call('exists', KEYS[1]) == 1 then
+    apply_update(KEYS[1], cjson.decode(ARGV[2]))
+end
+-- A build replaces the whole summary, so it needs to replay this
+-- update even if we've just applied it to the current summary.
+if redis.call('exists', KEYS[2]) == 1 then
+    redis.call('rpush', KEYS[3], ARGV[2])
+    redis.call('expire', KEYS[3], redis.call('ttl', KEYS[2]))
+end
+''')
+
+# KEYS: summary, build token, build log
+# ARGV: ttl, token, overflow, message_id, row, message_id, row, ...
+finish_build_script = client.register_script(APPLY_UPDATE_LUA + '''
+if redis.call('get', KEYS[2]) ~= ARGV[2] then
+    return 0
+end
+redis.call('del', KEYS[1])
+redis.call('hset', KEYS[1], 'ready', '1')
+if ARGV[3] == '1' then
+    redis.call('hset', KEYS[1], 'overflow', '1')
+end
+for i = 4, #ARGV, 2 do
+    redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+for _, update in ipairs(redis.call('lrange', KEYS[3], 0, -1)) do
+    apply_update(KEYS[1], cjson.decode(update))
+end
+redis.call('del', KEYS[2], KEYS[3])
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+''')
+
+def bounce_unread_summary_key_prefix_for_testing(test_name: str) -> None:
+    global KEY_PREFIX
+    KEY_PREFIX = test_name + ':' + str(os.getpid()) + ':'
+
+def unread_summary_keys(user_profile_id: int) -> List[str]:
+    return ["{}unread_summary:{}:{}".format(KEY_PREFIX, user_profile_id, keytype)
+            for keytype in ['summary', 'build', 'log']]
+
+def unread_summary_row(recipient_id: int, recipient_type: int, recipient_type_id: int,
+                       sender_id: int, topic: str, mentioned: bool,
+                       huddle_cache: Dict[int, str]) -> str:
+    user_ids_string = None  # type: Optional[str]
+    if recipient_type == Recipient.HUDDLE:
+        if recipient_id not in huddle_cache:
+            huddle_cache[recipient_id] = huddle_users(recipient_id)
+        user_ids_string = huddle_cache[recipient_id]
+    return ujson.dumps([recipient_id, recipient_type, recipient_type_id, sender_id,
+                        topic, mentioned, user_ids_string])
+
+def fetch_unread_summary_rows(user_profile: UserProfile,
+                              message_ids: Optional[List[int]]=None,
+                              limit: Optional[int]=None) -> Dict[str, str]:
+    user_msgs = UserMessage.objects.filter(
+        user_profile=user_profile
+    ).extra(
+        where=[UserMessage.where_unread()]
+    ).values(
+        'message_id',
+        'message__sender_id',
+        MESSAGE__TOPIC,
+        'message__recipient_id',
+        'message__recipient__type',
+        'message__recipient__type_id',
+        'flags',
+    ).order_by("-message_id")
+    if message_ids is not None:
+        user_msgs = user_msgs.filter(message_id__in=message_ids)
+    if limit is not None:
+        user_msgs = user_msgs[:limit]
+
+    huddle_cache = {}  # type: Dict[int, str]
+    return {
+        str(row['message_id']): unread_summary_row(
+            recipient_id=row['message__recipient_id'],
+            recipient_type=row['message__recipient__type'],
+            recipient_type_id=row['message__recipient__type_id'],
+            sender_id=row['message__sender_id'],
+            topic=row[MESSAGE__TOPIC],
+            mentioned=(row['flags'] & UserMessage.flags.mentioned) != 0,
+            huddle_cache=huddle_cache,
+        )
+        for row in user_msgs
+    }
+
+def build_unread_summary(user_profile: UserProfile) -> Optional[Dict[str, str]]:
+    '''
+    Builds and stores the summary for the user from the database.
+    Returns the summary rows, or None if the user has too many unread
+    messages to be worth summarizing.
+    '''
+    keys = unread_summary_keys(user_profile.id)
+    token = os.urandom(8).hex()
+    client.delete(keys[2])
+    client.set(keys[1], token, ex=UNREAD_SUMMARY_BUILD_SECONDS)
+
+    rows = fetch_unread_summary_rows(user_profile, limit=UNREAD_SUMMARY_MAX_MESSAGES + 1)
+    overflow = len(rows) > UNREAD_SUMMARY_MAX_MESSAGES
+
+    args = [UNREAD_SUMMARY_TTL_SECONDS, token, '1' if overflow else '0']  # type: List[Any]
+    if not overflow:
+        for message_id, row in rows.items():
+            args += [message_id, row]
+    # If this fails, another build started in the meantime, or the
+    # summary was dropped; either way, the next /register will use
+    # what's in Redis then.
+    finish_build_script(keys=keys, args=args)
+
+    if overflow:
+        return None
+    return rows
+
+def get_unread_summary(user_profile: UserProfile) -> Optional[Dict[str, str]]:
+    '''
+    Returns the user's summary rows, building the summary if needed,
+    or None if the user has too many unread messages to summarize.
+    '''
+    rows = {key.decode('utf-8'): value.decode('utf-8')
+            for key, value in client.hgetall(unread_summary_keys(user_profile.id)[0]).items()}
+    if READY_FIELD not in rows:
+        return build_unread_summary(user_profile)
+    if OVERFLOW_FIELD in rows:
+        return None
+    del rows[READY_FIELD]
+    return rows
+
+def get_raw_unread_data_from_summary(user_profile: UserProfile) -> RawUnreadMessagesResult:
+    summary = get_unread_summary(user_profile)
+    if summary is None:
+        return get_raw_unread_data(user_profile)
+
+    excluded_recipient_ids = set(get_inactive_recipient_ids(user_profile))
+    um_rows = []  # type: List[Dict[str, Any]]
+    known_huddle_users = {}  # type: Dict[int, str]
+    # Like get_raw_unread_data, only consider the most recent
+    # MAX_UNREAD_MESSAGES messages.
+    for message_id in sorted((int(message_id) for message_id in summary), reverse=True):
+        (recipient_id, recipient_type, recipient_type_id, sender_id,
+         topic, mentioned, user_ids_string) = ujson.loads(summary[str(message_id)])
+        if recipient_id in excluded_recipient_ids:
+            continue
+        if user_ids_string is not None:
+            known_huddle_users[recipient_id] = user_ids_string
+        um_rows.append({
+            'message_id': message_id,
+            'message__sender_id': sender_id,
+            MESSAGE__TOPIC: topic,
+            'message__recipient_id': recipient_id,
+            'message__recipient__type': recipient_type,
+            'message__recipient__type_id': recipient_type_id,
+            'flags': int(UserMessage.flags.mentioned) if mentioned else 0,
+        })
+        if len(um_rows) == MAX_UNREAD_MESSAGES:
+            break
+
+    um_rows.reverse()
+    return extract_unread_data_from_um_rows(um_rows, user_profile, known_huddle_users)
+
+def send_unread_summary_updates(updates: Dict[int, List[Any]]) -> None:
+    if not settings.UNREAD_SUMMARY_ENABLED or not updates:
+        return
+    pipeline = client.pipeline()
+    for user_profile_id, update in updates.items():
+        update_script(keys=unread_summary_keys(user_profile_id),
+                      args=[UNREAD_SUMMARY_TTL_SECONDS, ujson.dumps(update)],
+                      client=pipeline)
+    pipeline.execute()
+
+def get_users_with_unread_summaries(user_profile_ids: Set[int]) -> Set[int]:
+    '''
+    Returns those of the users who have a summary, or one being built,
+    with one round trip to Redis.  do_send_messages calls
+    add_new_messages_to_unread_summaries after committing the
+    UserMessage rows, so a build starting after this check will find
+    them in the database.
+    '''
+    user_profile_ids_list = list(user_profile_ids)
+    pipeline = client.pipeline()
+    for user_profile_id in user_profile_ids_list:
+        keys = unread_summary_keys(user_profile_id)
+        pipeline.exists(keys[0])
+        pipeline.exists(keys[1])
+    results = pipeline.execute()
+    return {user_profile_id
+            for i, user_profile_id in enumerate(user_profile_ids_list)
+            if results[2 * i] or results[2 * i + 1]}
+
+def add_new_messages_to_unread_summaries(messages: Iterable[Message],
+                                         user_message_rows: Iterable[Tuple[int, int, int]]) -> None:
+    '''
+    user_message_rows are the (user_profile_id, message_id, flags)
+    of the UserMessage rows created for the messages.
+    '''
+    if not settings.UNREAD_SUMMARY_ENABLED:
+        return
+
+    unread_rows = [row for row in user_message_rows
+                   if not row[2] & UserMessage.flags.read]
+    # Most recipients of a message to a big stream haven't registered
+    # recently, so don't have a summary to update.
+    summarized_user_ids = get_users_with_unread_summaries({row[0] for row in unread_rows})
+
+    messages_by_id = {message.id: message for message in messages}
+    rows = {}  # type: Dict[Tuple[int, bool], str]
+    huddle_cache = {}  # type: Dict[int, str]
+    updates = {}  # type: Dict[int, List[Any]]
+    for user_profile_id, message_id, flags in unread_rows:
+        if user_profile_id not in summarized_user_ids:
+            continue
+        mentioned = (flags & UserMessage.flags.mentioned) != 0
+        if (message_id, mentioned) not in rows:
+            message = messages_by_id[message_id]
+            rows[(message_id, mentioned)] = unread_summary_row(
+                recipient_id=message.recipient_id,
+                recipient_type=message.recipient.type,
+                recipient_type_id=message.recipient.type_id,
+                sender_id=message.sender_id,
+                topic=message.topic_name(),
+                mentioned=mentioned,
+                huddle_cache=huddle_cache,
+            )
+        updates.setdefault(user_profile_id, ['add']).extend(
+            [str(message_id), rows[(message_id, mentioned)]])
+    send_unread_summary_updates(updates)
+
+def mark_unread_in_summary(user_profile: UserProfile, message_ids: List[int]) -> None:
+    if not settings.UNREAD_SUMMARY_ENABLED:
+        return
+    update = ['add']  # type: List[Any]
+    for message_id, row in fetch_unread_summary_rows(user_profile, message_ids).items():
+        update += [message_id, row]
+    send_unread_summary_updates({user_profile.id: update})
+
+def remove_messages_from_unread_summaries(user_profile_ids: Iterable[int],
+                                          message_ids: List[int]) -> None:
+    if not message_ids:
+        return
+    update = ['remove'] + [str(message_id) for message_id in message_ids]  # type: List[Any]
+    send_unread_summary_updates({user_profile_id: update
+                                 for user_profile_id in user_profile_ids})
+
+def clear_unread_summary(user_profile: UserProfile) -> None:
+    send_unread_summary_updates({user_profile.id: ['clear']})
+
+def drop_unread_summaries(user_profile_ids: Iterable[int]) -> None:
+    if not settings.UNREAD_SUMMARY_ENABLED:
+        return
+    keys = []  # type: List[str]
+    for user_profile_id in user_profile_ids:
+        keys += unread_summary_keys(user_profile_id)
+    if keys:
+        client.delete(*keys)
+
+def drop_unread_summaries_for_messages(message_ids: List[int]) -> None:
+    if not settings.UNREAD_SUMMARY_ENABLED:
+        return
+    user_profile_ids = UserMessage.objects.filter(
+        message_id__in=message_ids
+    ).extra(
+        where=[UserMessage.where_unread()]
+    ).values_list('user_profile_id', flat=True).distinct()
+    drop_unread_summaries(user_profile_ids)
+
+def has_unread_summary(user_profile: UserProfile) -> bool:
+    return client.hexists(unread_summary_keys(user_profile.id)[0], READY_FIELD)
+
+def check_unread_summary(user_profile: UserProfile) -> Set[str]:
+    '''
+    Compares the user's summary with the database, returning the names
+    of the fields of the raw unread data that differ.  Concurrent
+    changes to the user's unread messages can cause false positives.
+    '''
+    if not has_unread_summary(user_profile):
+        return set()
+    expected = dict(get_raw_unread_data(user_profile))  # type: Dict[str, Any]
+    actual = dict(get_raw_unread_data_from_summary(user_profile))  # type: Dict[str, Any]
+    return {field for field in expected if expected[field] != actual[field]}
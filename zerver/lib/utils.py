@@ -110,6 +110,14 @@ def log_statsd_event(name: str) -> None:
     event_name = "events.%s" % (name,)
     statsd.incr(event_name)
 
+def timedelta_ms(timedelta: float) -> float:
+    return timedelta * 1000
+
+def format_timedelta(timedelta: float) -> str:
+    if (timedelta >= 1):
+        return "%.1fs" % (timedelta)
+    return "%.0fms" % (timedelta_ms(timedelta),)
+
 def generate_random_token(length: int) -> str:
     return str(base64.b16encode(os.urandom(length // 2)).decode('utf-8').lower())
 
@@ -0,0 +1,44 @@
+from argparse import ArgumentParser
+from typing import Any
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.unread_summary import check_unread_summary, drop_unread_summaries
+from zerver.models import UserProfile
+
+class Command(ZulipBaseCommand):
+    help = """Check users' unread message summaries (see zerver/lib/unread_summary.py)
+against the UserMessage table.
+
+Users without a summary are skipped.  Messages being sent or read while
+this runs can be reported as false positives; rerun to confirm.
+
+Usage: ./manage.py check_unread_summaries -r zulip [--fix] [<email> ...]"""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument('emails', metavar='<email>', type=str, nargs='*',
+                            help='email addresses of users to check (default: all users)')
+        parser.add_argument('--fix', dest='fix', action='store_true', default=False,
+                            help='drop inconsistent summaries, so that they are rebuilt')
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+
+        if options['emails']:
+            user_profiles = [self.get_user(email, realm) for email in options['emails']]
+        else:
+            user_profiles = list(UserProfile.objects.filter(realm=realm, is_active=True))
+
+        inconsistent = 0
+        for user_profile in user_profiles:
+            fields = check_unread_summary(user_profile)
+            if not fields:
+                continue
+            inconsistent += 1
+            print('%s: %s differ' % (user_profile.email, ', '.join(sorted(fields))))
+            if options['fix']:
+                drop_unread_summaries([user_profile.id])
+
+        print('%d of %d users have inconsistent unread summaries' % (
+            inconsistent, len(user_profiles)))
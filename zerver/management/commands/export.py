@@ -97,6 +97,12 @@ class Command(ZulipBaseCommand):
                             action="store",
                             default=6,
                             help='Threads to use in exporting UserMessage objects in parallel')
+        parser.add_argument('--streaming',
+                            dest='streaming',
+                            action="store_true",
+                            default=False,
+                            help='Write the largest tables to realm.json as they are fetched, '
+                                 'a chunk of rows at a time, to bound memory use')
         self.add_realm_args(parser, True)
 
     def handle(self, *args: Any, **options: Any) -> None:
@@ -116,7 +122,8 @@ class Command(ZulipBaseCommand):
         if num_threads < 1:
             raise CommandError('You must have at least one thread.')
 
-        do_export_realm(realm, output_dir, threads=num_threads)
+        do_export_realm(realm, output_dir, threads=num_threads,
+                        streaming=options['streaming'])
         print("Finished exporting to %s; tarring" % (output_dir,))
 
         do_write_stats_file_for_realm_export(output_dir)
@@ -1,17 +1,18 @@
-
-import glob
-import logging
-import os
-import shutil
 from argparse import ArgumentParser
 from typing import Any
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from zerver.lib.export import export_usermessages_batch
+from zerver.lib.export import export_usermessages_batches
 
 class Command(BaseCommand):
-    help = """UserMessage fetching helper for export.py"""
+    help = """Export the UserMessage rows for the messages-*.json.partial files of a realm export.
+
+`./manage.py export` does this itself; use this command to finish an
+export that was interrupted while exporting UserMessage rows.  Batches
+that were already exported are skipped.
+
+Usage: ./manage.py export_usermessage_batch --path /tmp/zulip-export-zcmpxfm6 --threads 6"""
 
     def add_arguments(self, parser: ArgumentParser) -> None:
         parser.add_argument('--path',
@@ -19,27 +20,16 @@ class Command(BaseCommand):
                             action="store",
                             default=None,
                             help='Path to find messages.json archives')
-        parser.add_argument('--thread',
-                            dest='thread',
+        parser.add_argument('--threads',
+                            dest='threads',
                             action="store",
-                            default=None,
-                            help='Thread ID')
+                            default=6,
+                            help='Number of processes to export UserMessage rows with')
 
     def handle(self, *args: Any, **options: Any) -> None:
-        logging.info("Starting UserMessage batch thread %s" % (options['thread'],))
-        files = set(glob.glob(os.path.join(options['path'], 'messages-*.json.partial')))
-        for partial_path in files:
-            locked_path = partial_path.replace(".json.partial", ".json.locked")
-            output_path = partial_path.replace(".json.partial", ".json")
-            try:
-                shutil.move(partial_path, locked_path)
-            except Exception:
-                # Already claimed by another process
-                continue
-            logging.info("Thread %s processing %s" % (options['thread'], output_path))
-            try:
-                export_usermessages_batch(locked_path, output_path)
-            except Exception:
-                # Put the item back in the free pool when we fail
-                shutil.move(locked_path, partial_path)
-                raise
+        if options['path'] is None:
+            raise CommandError('You must specify --path.')
+        num_threads = int(options['threads'])
+        if num_threads < 1:
+            raise CommandError('You must have at least one thread.')
+        export_usermessages_batches(options['path'], processes=num_threads)
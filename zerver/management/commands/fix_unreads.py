@@ -9,6 +9,7 @@ from django.db import connection
 
 from zerver.lib.fix_unreads import fix
 from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.unread_summary import drop_unread_summaries
 from zerver.models import Realm, UserProfile
 
 logging.getLogger('zulip.fix_unreads').setLevel(logging.INFO)
@@ -37,6 +38,7 @@ class Command(ZulipBaseCommand):
         for user_profile in user_profiles:
             fix(user_profile)
             connection.commit()
+            drop_unread_summaries([user_profile.id])
 
     def fix_emails(self, realm: Optional[Realm], emails: List[str]) -> None:
 
@@ -49,6 +51,7 @@ class Command(ZulipBaseCommand):
 
             fix(user_profile)
             connection.commit()
+            drop_unread_summaries([user_profile.id])
 
     def handle(self, *args: Any, **options: Any) -> None:
         realm = self.get_realm(options)
@@ -7,7 +7,7 @@ from typing import Any
 
 from django.conf import settings
 from django.core.management import call_command
-from django.core.management.base import BaseCommand, CommandParser
+from django.core.management.base import BaseCommand, CommandError, CommandParser
 
 from zerver.lib.import_realm import do_import_realm, do_import_system_bots
 from zerver.forms import check_subdomain_available
@@ -31,6 +31,12 @@ import a database dump from one or more JSON files."""
                             action="store_true",
                             help='Import into an existing nonempty database.')
 
+        parser.add_argument('--processes',
+                            dest='processes',
+                            action="store",
+                            default=1,
+                            help='Number of processes to import message dump files with')
+
         parser.add_argument('subdomain', metavar='<subdomain>',
                             type=str, help="Subdomain")
 
@@ -53,6 +59,10 @@ import a database dump from one or more JSON files."""
         elif options["import_into_nonempty"]:
             print("NOTE: The argument 'import_into_nonempty' is now the default behavior.")
 
+        num_processes = int(options['processes'])
+        if num_processes < 1:
+            raise CommandError('You must have at least one process.')
+
         check_subdomain_available(subdomain, from_management_command=True)
 
         paths = []
@@ -68,6 +78,6 @@ import a database dump from one or more JSON files."""
 
         for path in paths:
             print("Processing dump: %s ..." % (path,))
-            realm = do_import_realm(path, subdomain)
+            realm = do_import_realm(path, subdomain, processes=num_processes)
             print("Checking the system bots.")
             do_import_system_bots(realm)
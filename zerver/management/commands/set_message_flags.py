@@ -8,6 +8,7 @@ from django.db import models
 
 from zerver.lib import utils
 from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.unread_summary import drop_unread_summaries
 from zerver.models import UserMessage
 
 class Command(ZulipBaseCommand):
@@ -80,4 +81,5 @@ class Command(ZulipBaseCommand):
             exit(1)
 
         utils.run_in_batches(mids, 400, do_update, sleep_time=3)
+        drop_unread_summaries([user_profile.id])
         exit(0)
@@ -19,7 +19,8 @@ from django.utils.http import cookie_date
 from django.utils.translation import ugettext as _
 from django.views.csrf import csrf_failure as html_csrf_failure
 
-from zerver.lib.bugdown import get_bugdown_requests, get_bugdown_time
+from zerver.lib.bugdown import get_bugdown_render_cache_hits, \
+    get_bugdown_render_cache_misses, get_bugdown_requests, get_bugdown_time
 from zerver.lib.cache import get_remote_cache_requests, get_remote_cache_time
 from zerver.lib.debug import maybe_tracemalloc_listen
 from zerver.lib.db import reset_queries
@@ -27,7 +28,7 @@ from zerver.lib.exceptions import ErrorCode, JsonableError, RateLimited
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.response import json_error, json_response_from_error
 from zerver.lib.subdomains import get_subdomain
-from zerver.lib.utils import statsd
+from zerver.lib.utils import format_timedelta, statsd, timedelta_ms
 from zerver.lib.types import ViewFuncT
 from zerver.models import Realm, flush_per_request_caches, get_realm
 
@@ -39,6 +40,8 @@ def record_request_stop_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['remote_cache_requests_stopped'] = get_remote_cache_requests()
     log_data['bugdown_time_stopped'] = get_bugdown_time()
     log_data['bugdown_requests_stopped'] = get_bugdown_requests()
+    log_data['bugdown_cache_hits_stopped'] = get_bugdown_render_cache_hits()
+    log_data['bugdown_cache_misses_stopped'] = get_bugdown_render_cache_misses()
     if settings.PROFILE_ALL_REQUESTS:
         log_data["prof"].disable()
 
@@ -53,6 +56,8 @@ def record_request_restart_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['remote_cache_requests_restarted'] = get_remote_cache_requests()
     log_data['bugdown_time_restarted'] = get_bugdown_time()
     log_data['bugdown_requests_restarted'] = get_bugdown_requests()
+    log_data['bugdown_cache_hits_restarted'] = get_bugdown_render_cache_hits()
+    log_data['bugdown_cache_misses_restarted'] = get_bugdown_render_cache_misses()
 
 def async_request_timer_restart(request: HttpRequest) -> None:
     if "time_restarted" in request._log_data:
@@ -72,14 +77,8 @@ def record_request_start_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['remote_cache_requests_start'] = get_remote_cache_requests()
     log_data['bugdown_time_start'] = get_bugdown_time()
     log_data['bugdown_requests_start'] = get_bugdown_requests()
-
-def timedelta_ms(timedelta: float) -> float:
-    return timedelta * 1000
-
-def format_timedelta(timedelta: float) -> str:
-    if (timedelta >= 1):
-        return "%.1fs" % (timedelta)
-    return "%.0fms" % (timedelta_ms(timedelta),)
+    log_data['bugdown_cache_hits_start'] = get_bugdown_render_cache_hits()
+    log_data['bugdown_cache_misses_start'] = get_bugdown_render_cache_misses()
 
 def is_slow_query(time_delta: float, path: str) -> bool:
     if time_delta < 1.2:
@@ -156,12 +155,20 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
     if 'bugdown_time_start' in log_data:
         bugdown_time_delta = get_bugdown_time() - log_data['bugdown_time_start']
         bugdown_count_delta = get_bugdown_requests() - log_data['bugdown_requests_start']
+        bugdown_cache_hits_delta = (get_bugdown_render_cache_hits() -
+                                    log_data['bugdown_cache_hits_start'])
+        bugdown_cache_misses_delta = (get_bugdown_render_cache_misses() -
+                                      log_data['bugdown_cache_misses_start'])
         if 'bugdown_requests_stopped' in log_data:
             # (now - restarted) + (stopped - start) = (now - start) + (stopped - restarted)
             bugdown_time_delta += (log_data['bugdown_time_stopped'] -
                                    log_data['bugdown_time_restarted'])
             bugdown_count_delta += (log_data['bugdown_requests_stopped'] -
                                     log_data['bugdown_requests_restarted'])
+            bugdown_cache_hits_delta += (log_data['bugdown_cache_hits_stopped'] -
+                                         log_data['bugdown_cache_hits_restarted'])
+            bugdown_cache_misses_delta += (log_data['bugdown_cache_misses_stopped'] -
+                                           log_data['bugdown_cache_misses_restarted'])
 
         if (bugdown_time_delta > 0.005):
             bugdown_output = " (md: %s/%s)" % (format_timedelta(bugdown_time_delta),
@@ -171,6 +178,16 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
                 statsd.timing("%s.markdown.time" % (statsd_path,), timedelta_ms(bugdown_time_delta))
                 statsd.incr("%s.markdown.count" % (statsd_path,), bugdown_count_delta)
 
+        # Lookups in the cache of rendered content, as hits/lookups.
+        bugdown_cache_lookups = bugdown_cache_hits_delta + bugdown_cache_misses_delta
+        if bugdown_cache_lookups > 0:
+            bugdown_output += " (md cache: %s/%s)" % (bugdown_cache_hits_delta,
+                                                      bugdown_cache_lookups)
+
+            if not suppress_statsd:
+                statsd.incr("%s.markdown.cache_hits" % (statsd_path,), bugdown_cache_hits_delta)
+                statsd.incr("%s.markdown.cache_misses" % (statsd_path,), bugdown_cache_misses_delta)
+
     # Get the amount of time spent doing database queries
     db_time_output = ""
     queries = connection.connection.queries if connection.connection is not None else []
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from zerver.lib.alert_words import (
+    AlertWordMatcher,
     add_user_alert_words,
     alert_words_in_realm,
+    get_alert_word_matcher,
     remove_user_alert_words,
     user_alert_words,
 )
@@ -165,6 +167,27 @@ class AlertWordTests(ZulipTestCase):
         self.assertFalse(self.message_does_alert(user_profile_hamlet, "Don't alert on http://t.co/one/ urls"))
         self.assertFalse(self.message_does_alert(user_profile_hamlet, "Don't alert on http://t.co/one urls"))
 
+    def test_alert_word_matcher(self) -> None:
+        matcher = AlertWordMatcher(['one', 'One', 'two three', 'hers', 'she', u'☃', 'one-two'])
+        self.assertEqual(matcher.find_words('nothing here'), set())
+        self.assertEqual(matcher.find_words('ONE'), {'one', 'One'})
+        self.assertEqual(matcher.find_words('(one-two) and Two  three'), {'one-two'})
+        self.assertEqual(matcher.find_words('(one-two) and two three!'),
+                         {'one-two', 'two three'})
+        # Overlapping words are all found, as long as each one has a
+        # valid boundary on both sides.
+        self.assertEqual(matcher.find_words('ushers'), set())
+        self.assertEqual(matcher.find_words('she hers'), {'she', 'hers'})
+        self.assertEqual(matcher.find_words(u'snow: ☃.'), {u'☃'})
+        self.assertEqual(matcher.find_words('someone'), set())
+
+        realm = self.example_user('hamlet').realm
+        matcher = get_alert_word_matcher(realm, {1: ['one'], 2: ['two']})
+        self.assertEqual(matcher.words, {'one', 'two'})
+        self.assertIs(get_alert_word_matcher(realm, {2: ['two'], 3: ['one']}), matcher)
+        new_matcher = get_alert_word_matcher(realm, {2: ['two'], 3: ['three']})
+        self.assertEqual(new_matcher.find_words('one two three'), {'two', 'three'})
+
     def test_update_alert_words(self) -> None:
         user_profile = self.example_user('hamlet')
         me_email = user_profile.email
@@ -862,6 +862,41 @@ class BugdownTest(ZulipTestCase):
         self.assertEqual(render(msg, content), "<p>We have a NOTHINGWORD day today!</p>")
         self.assertEqual(msg.user_ids_with_alert_words, set())
 
+    def test_render_cache(self) -> None:
+        user_profile = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+        do_set_alert_words(user_profile, ["ALERTWORD"])
+        realm_alert_words = alert_words_in_realm(user_profile.realm)
+
+        def render(content: str, user_ids: Set[int]) -> Message:
+            msg = Message(sender=user_profile, sending_client=get_client("test"))
+            render_markdown(msg, content, realm_alert_words=realm_alert_words,
+                            user_ids=user_ids)
+            return msg
+
+        hits = bugdown.get_bugdown_render_cache_hits()
+        misses = bugdown.get_bugdown_render_cache_misses()
+        content = "An ALERTWORD in **bold**"
+        msg = render(content, {hamlet.id})
+        self.assertEqual(msg.user_ids_with_alert_words, set())
+        self.assertEqual(bugdown.get_bugdown_render_cache_misses(), misses + 1)
+
+        # The second render comes from the cache, but still finds
+        # alert words for its own recipients.
+        msg = render(content, {hamlet.id, user_profile.id})
+        self.assertEqual(msg.user_ids_with_alert_words, {user_profile.id})
+        self.assertEqual(bugdown.get_bugdown_render_cache_hits(), hits + 1)
+
+        # Content that mentions users or links to tweets isn't cached;
+        # only the latter counts as a miss, since it was a candidate.
+        for content in ["@**King Hamlet** hi",
+                        "http://twitter.com/wdaher/status/287977969287315456"]:
+            with mock.patch('zerver.lib.bugdown.fetch_tweet_data', return_value=None):
+                render(content, set())
+                render(content, set())
+        self.assertEqual(bugdown.get_bugdown_render_cache_hits(), hits + 1)
+        self.assertEqual(bugdown.get_bugdown_render_cache_misses(), misses + 3)
+
     def test_mention_wildcard(self) -> None:
         user_profile = self.example_user('othello')
         msg = Message(sender=user_profile, sending_client=get_client("test"))
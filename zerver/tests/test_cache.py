@@ -1,6 +1,12 @@
+import time
+import ujson
 from mock import Mock, patch
+from typing import Any, Dict
 
 from zerver.apps import flush_cache
+from zerver.lib import cache
+from zerver.lib.cache import L1Cache, cache_set, disconnect_remote_caches, \
+    generic_bulk_cached_fetch, get_l1_cache_hits
 from zerver.lib.test_classes import ZulipTestCase
 
 class AppsTest(ZulipTestCase):
@@ -11,3 +17,81 @@ class AppsTest(ZulipTestCase):
                 flush_cache(Mock())
                 mock.assert_called_once()
             mock_logging.assert_called_once()
+
+class DisconnectRemoteCachesTest(ZulipTestCase):
+    def test_disconnect_remote_caches(self) -> None:
+        memcached = Mock()
+        database_cache = Mock(spec=[])
+        with patch('zerver.lib.cache.caches.all', return_value=[memcached, database_cache]):
+            disconnect_remote_caches()
+        memcached._cache.disconnect_all.assert_called_once_with()
+
+class L1CacheTest(ZulipTestCase):
+    def test_lru_and_ttl(self) -> None:
+        l1 = L1Cache(max_bytes=800, ttl=60)
+        l1.set_many({'a': 'x' * 300, 'b': 'y' * 300})
+        self.assertEqual(l1.get_many(['a', 'b', 'c']), {'a': 'x' * 300, 'b': 'y' * 300})
+
+        # 'a' was used more recently than 'b', so 'b' gets evicted.
+        l1.get_many(['a'])
+        l1.set_many({'c': 'z' * 300, 'd': 'w' * 2000})
+        self.assertEqual(set(l1.get_many(['a', 'b', 'c', 'd'])), {'a', 'c'})
+        self.assertLessEqual(l1.num_bytes, 800)
+
+        # Callers get their own copy of the value.
+        l1.set_many({'e': [1, 2]})
+        l1.get_many(['e'])['e'].append(3)
+        self.assertEqual(l1.get_many(['e'])['e'], [1, 2])
+
+        with patch('zerver.lib.cache.time.time', return_value=time.time() + 61):
+            self.assertEqual(l1.get_many(['a', 'c', 'e']), {})
+        self.assertEqual(l1.num_bytes, 0)
+
+    def test_fill_after_invalidation(self) -> None:
+        l1 = L1Cache(max_bytes=10000, ttl=60)
+
+        # An invalidation that arrives while the old values are being
+        # read from memcached keeps them out of the cache.
+        token = l1.fill_token()
+        l1.delete_many(['a'])
+        l1.set_many({'a': 'old', 'b': 'value'}, token)
+        self.assertEqual(l1.get_many(['a', 'b']), {'b': 'value'})
+        l1.set_many({'a': 'new'}, l1.fill_token())
+        self.assertEqual(l1.get_many(['a']), {'a': 'new'})
+
+        # So does clearing the cache, or forgetting the invalidations.
+        token = l1.fill_token()
+        l1.clear()
+        l1.set_many({'c': 'value'}, token)
+        token = l1.fill_token()
+        with patch.object(L1Cache, 'MAX_INVALIDATIONS', 2):
+            l1.delete_many(['x', 'y', 'z'])
+        l1.set_many({'c': 'value'}, token)
+        self.assertEqual(l1.get_many(['c']), {})
+
+    def test_remote_cache_with_l1(self) -> None:
+        l1 = L1Cache(max_bytes=10000, ttl=60)
+        redis_client = Mock()
+        with patch('zerver.lib.cache.get_l1_cache', return_value=l1), \
+                patch('zerver.lib.cache.l1_redis_client', redis_client):
+            query = Mock(side_effect=lambda ids: [Mock(id=object_id) for object_id in ids])
+
+            def fetch() -> Dict[int, Any]:
+                return generic_bulk_cached_fetch(
+                    lambda object_id: 'l1_test:%d' % (object_id,),
+                    query, [1, 2],
+                    cache_transformer=lambda obj: obj.id * 10)
+
+            hits = get_l1_cache_hits()
+            self.assertEqual(fetch(), {1: 10, 2: 20})
+            self.assertEqual(fetch(), {1: 10, 2: 20})
+            self.assertEqual(query.call_count, 1)
+            self.assertEqual(get_l1_cache_hits(), hits + 2)
+            redis_client.publish.assert_not_called()
+
+            # Changing a value in memcached invalidates it everywhere.
+            cache_set('l1_test:1', 11)
+            self.assertEqual(ujson.loads(redis_client.publish.call_args[0][1]),
+                             [cache.KEY_PREFIX + 'l1_test:1'])
+            self.assertEqual(fetch(), {1: 11, 2: 20})
+            self.assertEqual(get_l1_cache_hits(), hits + 3)
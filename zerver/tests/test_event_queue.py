@@ -1,4 +1,6 @@
 import mock
+import os
+import tempfile
 import time
 import ujson
 
@@ -10,8 +12,14 @@ from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import POSTRequestMock
 from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
 from zerver.tornado.event_queue import maybe_enqueue_notifications, \
-    allocate_client_descriptor, process_message_event, \
-    get_client_descriptor, missedmessage_hook, persistent_queue_filename
+    allocate_client_descriptor, process_message_event, process_notification, \
+    get_client_descriptor, missedmessage_hook, persistent_queue_filename, \
+    checkpoint_event_queues, clear_client_event_queues_for_testing, \
+    do_gc_event_queues, dump_event_queues, load_event_queues, \
+    persistent_queue_log_filename, gc_event_queues, queue_expiry_heap, \
+    IDLE_EVENT_QUEUE_TIMEOUT_SECS
+from zerver.tornado.sharding import get_tornado_port, get_tornado_port_for_queue_id, \
+    make_queue_id
 from zerver.tornado.views import get_events
 
 class MissedMessageNotificationsTest(ZulipTestCase):
@@ -333,3 +341,167 @@ class FileReloadLogicTest(ZulipTestCase):
                              "/var/tmp/event_queues.9993.json")
             self.assertEqual(persistent_queue_filename(9993, last=True),
                              "/var/tmp/event_queues.9993.last.json")
+
+    def test_incremental_persistence(self) -> None:
+        hamlet = self.example_user('hamlet')
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+
+        tmp_dir = tempfile.mkdtemp()
+        with self.settings(JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmp_dir, "queues%s.json"),
+                           INCREMENTAL_EVENT_QUEUE_PERSISTENCE=True), \
+                mock.patch('zerver.tornado.event_queue.event_queue_log', None):
+            clear_client_event_queues_for_testing()
+            client1 = allocate_client_descriptor(dict(queue_data))
+            client2 = allocate_client_descriptor(dict(queue_data))
+            checkpoint_event_queues(9993)
+
+            # Only the changes since the checkpoint get appended, with
+            # just the new events for queues already in the log.
+            client1.add_event(dict(type='unknown'))
+            do_gc_event_queues({client2.event_queue.id}, {hamlet.id}, {hamlet.realm_id})
+            checkpoint_event_queues(9993)
+            client1.event_queue.prune(0)
+            client1.add_event(dict(type='unknown'))
+            dump_event_queues(9993)
+            with open(persistent_queue_log_filename(9993)) as f:
+                records = [ujson.loads(line) for line in f]
+            self.assertEqual([record[0] for record in records],
+                             ['put', 'put', 'update', 'delete', 'update', 'shutdown'])
+            self.assertEqual(records[4][2]['event_queue']['new_events'],
+                             [dict(type='unknown', id=1)])
+
+            clear_client_event_queues_for_testing()
+            load_event_queues(9993)
+            loaded = get_client_descriptor(client1.event_queue.id)
+            self.assertEqual(loaded.event_queue.contents(), [dict(type='unknown', id=1)])
+            self.assertIsNone(get_client_descriptor(client2.event_queue.id))
+
+            # A log that wasn't closed by a clean shutdown is discarded.
+            clear_client_event_queues_for_testing()
+            load_event_queues(9993)
+            self.assertIsNone(get_client_descriptor(client1.event_queue.id))
+            self.assertFalse(os.path.exists(persistent_queue_log_filename(9993)))
+            clear_client_event_queues_for_testing()
+
+class GarbageCollectionTest(ZulipTestCase):
+    def test_gc_event_queues(self) -> None:
+        hamlet = self.example_user('hamlet')
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+        clear_client_event_queues_for_testing()
+        client1 = allocate_client_descriptor(dict(queue_data))
+        client2 = allocate_client_descriptor(dict(queue_data))
+        self.assert_length(queue_expiry_heap, 2)
+
+        # client2 has polled more recently.
+        start = client1.last_connection_time
+        client2.last_connection_time = start + 300
+
+        with mock.patch('zerver.tornado.event_queue.time.time',
+                        return_value=start + IDLE_EVENT_QUEUE_TIMEOUT_SECS + 1):
+            gc_event_queues(9993)
+        self.assertIsNone(get_client_descriptor(client1.event_queue.id))
+        self.assertEqual(get_client_descriptor(client2.event_queue.id), client2)
+        self.assertEqual(queue_expiry_heap,
+                         [(start + 300 + IDLE_EVENT_QUEUE_TIMEOUT_SECS, client2.event_queue.id)])
+
+        with mock.patch('zerver.tornado.event_queue.time.time',
+                        return_value=start + IDLE_EVENT_QUEUE_TIMEOUT_SECS + 301):
+            gc_event_queues(9993)
+        self.assertIsNone(get_client_descriptor(client2.event_queue.id))
+        self.assertEqual(queue_expiry_heap, [])
+
+class ShardingTest(ZulipTestCase):
+    def test_realm_sharding(self) -> None:
+        zulip = self.example_user('hamlet').realm
+        with self.settings(TORNADO_SERVER='http://127.0.0.1:9993', TORNADO_PROCESSES=1):
+            self.assertEqual(get_tornado_port(zulip), 9993)
+            queue_id = make_queue_id(9993, 12)
+            self.assertEqual(queue_id.split(':')[-1], '12')
+            self.assertIsNone(get_tornado_port_for_queue_id(queue_id))
+
+        with self.settings(TORNADO_SERVER='http://127.0.0.1:9993', TORNADO_PROCESSES=4):
+            port = get_tornado_port(zulip)
+            self.assertEqual(port, 9800 + zulip.id % 4)
+            queue_id = make_queue_id(port, 12)
+            self.assertEqual(get_tornado_port_for_queue_id(queue_id), port)
+
+    def test_queue_created_in_wrong_process(self) -> None:
+        hamlet = self.example_user('hamlet')
+        request_data = {
+            "event_types": ujson.dumps(["message"]),
+            "user_client": "website",
+            "dont_block": ujson.dumps(True),
+        }
+        with self.settings(TORNADO_SERVER='http://127.0.0.1:9993', TORNADO_PROCESSES=4):
+            port = get_tornado_port(hamlet.realm)
+            # A get_events request without a queue_id reaching a process
+            # that doesn't own the realm can't create a queue there.
+            other_port = 9800 + (port - 9800 + 1) % 4
+            with mock.patch('zerver.tornado.event_queue.tornado_port', other_port):
+                result = get_events(POSTRequestMock(request_data, hamlet), hamlet)
+            self.assert_json_error(result, "Create an event queue with /register first.")
+
+            with mock.patch('zerver.tornado.event_queue.tornado_port', port):
+                result = get_events(POSTRequestMock(request_data, hamlet), hamlet)
+            self.assert_json_success(result)
+            queue_id = ujson.loads(result.content)['queue_id']
+            self.assertEqual(get_tornado_port_for_queue_id(queue_id), port)
+
+    def test_forwarded_queue_cleanup(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.login(hamlet.email)
+        with self.settings(TORNADO_SERVER='http://127.0.0.1:9993', TORNADO_PROCESSES=4), \
+                mock.patch('zerver.tornado.event_queue.tornado_port', 9800):
+            # A queue owned by another process is deleted there.
+            queue_id = make_queue_id(9801, 12)
+            with mock.patch('zerver.tornado.event_queue.queue_json_publish') as mock_publish:
+                result = self.client_delete('/json/events', {'queue_id': queue_id})
+            self.assert_json_success(result)
+            self.assertEqual(mock_publish.call_args[0][:2], (
+                'notify_tornado_port_9801',
+                dict(event=dict(type='cleanup_queue', queue_id=queue_id), users=[hamlet.id])))
+
+            # An unknown queue that would be ours is an error, as before.
+            result = self.client_delete('/json/events', {'queue_id': make_queue_id(9800, 12)})
+            self.assert_json_error(result, 'Bad event queue id: %s' % (make_queue_id(9800, 12),))
+
+            clear_client_event_queues_for_testing()
+            client = allocate_client_descriptor(dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name='website',
+                event_types=None,
+                last_connection_time=time.time(),
+                queue_timeout=0,
+                realm_id=hamlet.realm_id,
+                user_profile_id=hamlet.id,
+            ))
+            queue_id = client.event_queue.id
+            notice = dict(event=dict(type='cleanup_queue', queue_id=queue_id))
+
+            # The owning process only deletes the queue for its owner.
+            process_notification(dict(notice, users=[self.example_user('cordelia').id]))
+            self.assertIsNotNone(get_client_descriptor(queue_id))
+            process_notification(dict(notice, users=[hamlet.id]))
+            self.assertIsNone(get_client_descriptor(queue_id))
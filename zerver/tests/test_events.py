@@ -98,6 +98,8 @@ from zerver.lib.actions import (
 from zerver.lib.events import (
     apply_events,
     fetch_initial_state_data,
+    initial_state_section,
+    InitialStateContext,
 )
 from zerver.lib.message import (
     aggregate_unread_data,
@@ -134,6 +136,7 @@ from zerver.tornado.event_queue import (
     get_client_info_for_message_event,
     process_message_event,
     EventQueue,
+    MessageEvent,
 )
 from zerver.tornado.views import get_events
 
@@ -2758,6 +2761,37 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+    def test_shared_message_events(self) -> None:
+        payload = dict(id=5, content='hello')
+        queue1 = EventQueue("1")
+        queue2 = EventQueue("2")
+        queue1.push({"type": "unknown"})
+        queue1.push(MessageEvent(payload, ['mentioned'], dict(stream_push_notify=True)))
+        queue2.push(MessageEvent(payload, []))
+
+        # Both queues reference the same payload until they are fetched.
+        self.assertIs(queue1.queue[1].message, queue2.queue[0].message)
+        self.assertEqual(queue1.queue[1]['id'], 1)
+        self.assertEqual(queue1.contents(),
+                         [{"type": "unknown",
+                           "id": 0},
+                          {"type": "message",
+                           "id": 1,
+                           "message": payload,
+                           "flags": ['mentioned'],
+                           "stream_push_notify": True}])
+        self.assertIsInstance(queue1.queue[1], MessageEvent)
+        self.assertEqual(queue2.to_dict()['queue'],
+                         [{"type": "message",
+                           "id": 0,
+                           "message": payload,
+                           "flags": []}])
+
+        queue1.prune(0)
+        self.assertEqual(len(queue1.contents()), 1)
+        queue1.prune(1)
+        self.assertTrue(queue1.empty())
+
 class ClientDescriptorsTest(ZulipTestCase):
     def test_get_client_info_for_all_public_streams(self) -> None:
         hamlet = self.example_user('hamlet')
@@ -3110,6 +3144,46 @@ class FetchQueriesTest(ZulipTestCase):
             self.assert_length(queries, count)
 
 
+class InitialStateSectionsTest(ZulipTestCase):
+    def test_sections(self) -> None:
+        user = self.example_user('hamlet')
+        sections = OrderedDict()  # type: OrderedDict[str, Any]
+        with mock.patch('zerver.lib.events.initial_state_sections', sections):
+            @initial_state_section('a')
+            def fetch_a(context: InitialStateContext) -> Dict[str, Any]:
+                return dict(a=1)
+
+            @initial_state_section('b')
+            def fetch_b(context: InitialStateContext) -> Dict[str, Any]:
+                return dict(b=2)
+
+            @initial_state_section('c', depends_on=['a', 'b'])
+            def fetch_c(context: InitialStateContext) -> Dict[str, Any]:
+                return dict(c=context.results['a']['a'] + context.results['b']['b'])
+
+            @initial_state_section('d', event_types=['d', 'e'])
+            def fetch_d(context: InitialStateContext) -> Dict[str, Any]:
+                return dict(d=4)
+
+            with self.assertRaises(AssertionError):
+                @initial_state_section('f', depends_on=['g'])
+                def fetch_f(context: InitialStateContext) -> Dict[str, Any]:
+                    raise AssertionError("Never called")  # nocoverage
+
+            for threads in [0, 2]:
+                with self.settings(INITIAL_STATE_FETCH_THREADS=threads), \
+                        mock.patch('zerver.lib.events.SLOW_REGISTER_LOG_THRESHOLD_SECONDS', 0), \
+                        mock.patch('zerver.lib.events.logger') as mock_logger:
+                    state = fetch_initial_state_data(user, ['b', 'c', 'd'], 'x',
+                                                     client_gravatar=False)
+                # 'a' is computed for 'c', but not returned, and 'd'
+                # also needs 'e'.
+                self.assertEqual(state, dict(queue_id='x', b=2, c=3))
+                log_line = mock_logger.info.call_args[0][0]
+                self.assertTrue(log_line.startswith('slow register for %s: ' % (user.email,)))
+                for name in ['a', 'b', 'c']:
+                    self.assertIn(' %s=' % (name,), log_line)
+
 class TestEventsRegisterAllPublicStreamsDefaults(ZulipTestCase):
     def setUp(self) -> None:
         self.user_profile = self.example_user('hamlet')
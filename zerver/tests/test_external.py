@@ -2,12 +2,17 @@
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse
+from django.test import override_settings
 
 from zerver.forms import email_is_not_mit_mailing_list
 
 from zerver.lib.rate_limiter import (
     add_ratelimit_rule,
+    api_calls_left,
+    block_access,
     clear_history,
+    rate_limit_entity,
+    rate_limit_script,
     remove_ratelimit_rule,
     RateLimitedUser,
 )
@@ -109,3 +114,54 @@ class RateLimitTests(ZulipTestCase):
             result = self.send_api_message(email, "Good message")
 
             self.assert_json_success(result)
+
+    def test_rate_limit_entity(self) -> None:
+        entity = RateLimitedUser(self.example_user('hamlet'))
+        clear_history(entity)
+
+        # The rules are now (1, 5) and (60, 200).
+        start_time = time.time()
+        for i in range(5):
+            with mock.patch('time.time', return_value=(start_time + i * 0.1)):
+                self.assertEqual(rate_limit_entity(entity), (False, 60.0, 200 - i - 1))
+
+        with mock.patch('time.time', return_value=(start_time + 0.5)):
+            rate_limited, time_till_free, calls_remaining = rate_limit_entity(entity)
+            self.assertTrue(rate_limited)
+            self.assertAlmostEqual(time_till_free, 0.5)
+            # Requests that are turned away aren't counted.
+            self.assertEqual(api_calls_left(entity)[0], 195)
+
+        block_access(entity, 10)
+        self.assertEqual(rate_limit_entity(entity), (True, 10.0, 0))
+        clear_history(entity)
+
+    @override_settings(RATE_LIMITING_LOCAL_PRECHECK=True)
+    def test_rate_limit_entity_local_precheck(self) -> None:
+        entity = RateLimitedUser(self.example_user('hamlet'))
+        clear_history(entity)
+
+        def check(now: float, rate_limited: bool, time_till_free: float, uses_redis: bool) -> None:
+            with mock.patch('time.time', return_value=now), \
+                    mock.patch('zerver.lib.rate_limiter.rate_limit_script',
+                               wraps=rate_limit_script) as script_mock:
+                result = rate_limit_entity(entity)
+            self.assertEqual(result[0], rate_limited)
+            self.assertAlmostEqual(result[1], time_till_free)
+            self.assertEqual(script_mock.called, uses_redis)
+
+        # The rules are now (1, 5) and (60, 200).
+        start_time = time.time()
+        for i in range(5):
+            check(start_time, False, 60.0, True)
+
+        # This process's bucket for the (1, 5) rule is empty.
+        check(start_time, True, 0.2, False)
+
+        # The bucket has refilled halfway, but Redis still has 5
+        # requests in the last second; we remember that until then.
+        check(start_time + 0.5, True, 0.5, True)
+        check(start_time + 0.6, True, 0.4, False)
+
+        check(start_time + 1.1, False, 60.0, True)
+        clear_history(entity)
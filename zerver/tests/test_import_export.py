@@ -18,8 +18,11 @@ from zerver.lib.export import (
     export_files_from_s3,
     export_usermessages_batch,
     do_export_user,
+    get_usermessage_batch_paths,
 )
 from zerver.lib.import_realm import (
+    allocate_ids,
+    copy_import_model,
     do_import_realm,
     get_incoming_message_ids,
 )
@@ -232,7 +235,8 @@ class ImportExportTest(ZulipTestCase):
         os.makedirs(output_dir, exist_ok=True)
         return output_dir
 
-    def _export_realm(self, realm: Realm, exportable_user_ids: Optional[Set[int]]=None) -> Dict[str, Any]:
+    def _export_realm(self, realm: Realm, exportable_user_ids: Optional[Set[int]]=None,
+                      streaming: bool=False) -> Dict[str, Any]:
         output_dir = self._make_output_dir()
         with patch('logging.info'), patch('zerver.lib.export.create_soft_link'):
             do_export_realm(
@@ -240,6 +244,7 @@ class ImportExportTest(ZulipTestCase):
                 output_dir=output_dir,
                 threads=0,
                 exportable_user_ids=exportable_user_ids,
+                streaming=streaming,
             )
             # TODO: Process the second partial file, which can be created
             #       for certain edge cases.
@@ -451,6 +456,40 @@ class ImportExportTest(ZulipTestCase):
         self.assertIn(self.example_email('iago'), dummy_user_emails)
         self.assertNotIn(self.example_email('cordelia'), dummy_user_emails)
 
+    def test_streaming_export(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        realm_emoji = RealmEmoji.objects.get(realm=realm)
+        realm_emoji.delete()
+        data = self._export_realm(realm)['realm']
+        # Small chunks, so that the larger tables take several.
+        with patch('zerver.lib.export.EXPORT_TABLE_CHUNK_SIZE', 5):
+            streamed_data = self._export_realm(realm, streaming=True)['realm']
+        realm_emoji.save()
+
+        def sort_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            return sorted(rows, key=lambda row: ujson.dumps(row, sort_keys=True))
+
+        self.assertEqual(set(streamed_data), set(data))
+        for table in data:
+            self.assertEqual(sort_rows(streamed_data[table]), sort_rows(data[table]))
+        self.assertGreater(len(data['zerver_client']), 5)
+
+    def test_get_usermessage_batch_paths(self) -> None:
+        output_dir = self._make_output_dir()
+        for fn in ['messages-000001.json.partial', 'messages-000001.json',
+                   'messages-000002.json.partial', 'messages-000003.json.partial',
+                   'messages-000003.json.tmp']:
+            with open(os.path.join(output_dir, fn), 'w') as f:
+                f.write('{}')
+
+        # The first batch was completed by an interrupted export.
+        self.assertEqual(get_usermessage_batch_paths(output_dir), [
+            os.path.join(output_dir, 'messages-000002.json.partial'),
+            os.path.join(output_dir, 'messages-000003.json.partial'),
+        ])
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'messages-000001.json.partial')))
+        self.assertTrue(os.path.exists(os.path.join(output_dir, 'messages-000001.json')))
+
     def test_export_single_user(self) -> None:
         output_dir = self._make_output_dir()
         cordelia = self.example_user('cordelia')
@@ -733,6 +772,31 @@ class ImportExportTest(ZulipTestCase):
 
         assert_realm_values(get_usermessages_user)
 
+    def test_copy_import_model(self) -> None:
+        message = Message.objects.last()
+        item = dict(
+            id=allocate_ids(Message, 1)[0],
+            sender_id=message.sender_id,
+            recipient_id=message.recipient_id,
+            sending_client_id=message.sending_client_id,
+            subject='',
+            content='tab\there\nnewline\r\nand a \\N backslash',
+            rendered_content=None,
+            pub_date=message.pub_date,
+            has_link=True,
+        )
+        with patch('logging.info'):
+            copy_import_model({'zerver_message': [item]}, Message)
+
+        imported = Message.objects.get(id=item['id'])
+        self.assertEqual(imported.content, item['content'])
+        self.assertEqual(imported.subject, '')
+        self.assertIsNone(imported.rendered_content)
+        self.assertIsNone(imported.last_edit_time)
+        self.assertEqual(imported.pub_date, message.pub_date)
+        self.assertTrue(imported.has_link)
+        self.assertFalse(imported.has_image)
+
     def test_import_files_from_local(self) -> None:
 
         realm = Realm.objects.get(string_id='zulip')
@@ -10,15 +10,17 @@ from django.utils.timezone import utc as timezone_utc
 from zerver.lib import bugdown
 from zerver.decorator import JsonableError
 from zerver.lib.test_runner import slow
-from zerver.lib.cache import get_stream_cache_key, cache_delete
+from zerver.lib.cache import get_stream_cache_key, cache_delete, to_dict_cache_key_id
 from zerver.lib.message import estimate_recent_messages
 
 from zerver.lib.addressee import Addressee
+from zerver.lib.response import json_success_with_fragments
 
 from zerver.lib.actions import (
     check_message,
     check_send_stream_message,
     create_mirror_user_if_needed,
+    create_user_messages,
     do_add_alert_words,
     do_change_stream_invite_only,
     do_create_user,
@@ -50,6 +52,7 @@ from zerver.lib.message import (
     get_raw_unread_data,
     maybe_update_first_visible_message_id,
     messages_for_ids,
+    messages_for_ids_json,
     sew_messages_and_reactions,
     update_first_visible_message_id,
 )
@@ -774,6 +777,93 @@ class StreamMessagesTest(ZulipTestCase):
         num_active_users = num_extra_users / 2
         self.assertTrue(ums_created > (num_active_users * num_messages))
 
+    def test_batched_recipient_info(self) -> None:
+        sender = self.example_user('cordelia')
+        realm = sender.realm
+        stream = get_stream('Denmark', realm)
+        recipient = get_stream_recipient(stream.id)
+        sending_client = make_client(name="test suite")
+
+        def make_message(topic_name: str) -> Dict[str, Any]:
+            message = Message(
+                sender=sender,
+                recipient=recipient,
+                content='whatever',
+                pub_date=timezone_now(),
+                sending_client=sending_client,
+            )
+            message.set_topic_name(topic_name)
+            return dict(message=message)
+
+        messages = [make_message('lunch') for i in range(5)]
+        messages.append(make_message('LUNCH'))
+        messages.append(make_message('dinner'))
+
+        from zerver.lib.actions import get_recipient_info
+        with mock.patch('zerver.lib.actions.get_recipient_info',
+                        wraps=get_recipient_info) as m:
+            message_ids = do_send_messages(messages)
+        self.assertEqual(m.call_count, 2)
+        self.assert_length(message_ids, 7)
+
+        # Each message must still get its own copy of the recipient data.
+        self.assertEqual(messages[0]['active_user_ids'], messages[1]['active_user_ids'])
+        self.assertIsNot(messages[0]['active_user_ids'], messages[1]['active_user_ids'])
+        for message_id in message_ids:
+            self.assertEqual(
+                UserMessage.objects.filter(message_id=message_id).count(),
+                UserMessage.objects.filter(message_id=message_ids[0]).count())
+
+    def test_create_user_messages(self) -> None:
+        sender = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        cordelia = self.example_user('cordelia')
+        iago = self.example_user('iago')
+        stream = get_stream('Denmark', sender.realm)
+        message = Message(
+            sender=sender,
+            recipient=get_stream_recipient(stream.id),
+            content='whatever',
+            pub_date=timezone_now(),
+            sending_client=make_client(name="test suite"),
+        )
+        message.id = 1
+        message.mentions_wildcard = False
+        message.user_ids_with_alert_words = {cordelia.id}
+
+        fanout = create_user_messages(
+            message=message,
+            um_eligible_user_ids={sender.id, othello.id, cordelia.id, iago.id},
+            long_term_idle_user_ids={cordelia.id, iago.id},
+            stream_push_user_ids=set(),
+            stream_email_user_ids=set(),
+            mentioned_user_ids={othello.id},
+        )
+        self.assertEqual(list(fanout.rows()), [
+            (user_id, 1, int(flags))
+            for user_id, flags in zip(fanout.user_profile_ids, fanout.flags)
+        ])
+        # iago is soft-deactivated and has no flags, so gets no row.
+        self.assertEqual(fanout.flags_dict(), {
+            sender.id: [],
+            othello.id: ['mentioned'],
+            cordelia.id: ['has_alert_word'],
+        })
+
+    def test_copy_insert_ums(self) -> None:
+        sender = self.example_user('hamlet')
+        with override_settings(BULK_INSERT_UMS_COPY_THRESHOLD=1):
+            message_id = self.send_stream_message(sender.email, "Denmark",
+                                                  content="whatever", topic_name="copy")
+
+        subscribers = self.users_subscribed_to_stream("Denmark", sender.realm)
+        user_messages = UserMessage.objects.filter(message_id=message_id)
+        self.assertEqual(
+            {um.user_profile_id for um in user_messages},
+            {user.id for user in subscribers
+             if user.bot_type not in UserProfile.SERVICE_BOT_TYPES},
+        )
+
     def test_not_too_many_queries(self) -> None:
         recipient_list  = [self.example_user("hamlet"), self.example_user("iago"),
                            self.example_user("cordelia"), self.example_user("othello")]
@@ -3811,6 +3901,48 @@ class MessageHydrationTest(ZulipTestCase):
         self.assertIn('class="user-mention"', new_message['content'])
         self.assertEqual(new_message['flags'], ['mentioned'])
 
+    def test_messages_for_ids_json(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        stream_message_id = self.send_stream_message(cordelia.email, 'Verona', content='**foo**')
+        pm_id = self.send_personal_message(cordelia.email, hamlet.email, content='bar')
+        huddle_id = self.send_huddle_message(hamlet.email, [cordelia.email, self.example_email('iago')],
+                                             content='baz')
+        self.login(cordelia.email)
+        result = self.client_patch('/json/messages/' + str(stream_message_id),
+                                   {'content': 'edited'})
+        self.assert_json_success(result)
+
+        message_ids = [stream_message_id, pm_id, huddle_id]
+        user_message_flags = {
+            stream_message_id: ['read'],
+            pm_id: [],
+            huddle_id: ['read', 'starred'],
+        }
+        search_fields = {pm_id: dict(match_content='<p><span class="highlight">bar</span></p>',
+                                     match_subject='')}
+
+        # Both with the message cache cold and warm.
+        for i in range(2):
+            for apply_markdown in [True, False]:
+                for allow_edit_history in [True, False]:
+                    kwargs = dict(
+                        message_ids=message_ids,
+                        user_message_flags=user_message_flags,
+                        search_fields=search_fields,
+                        apply_markdown=apply_markdown,
+                        client_gravatar=False,
+                        allow_edit_history=allow_edit_history,
+                    )  # type: Dict[str, Any]
+                    actual = [ujson.loads(message) for message in messages_for_ids_json(**kwargs)]
+                    expected = messages_for_ids(**kwargs)
+                    self.assertEqual(actual, expected)
+            cache_delete(to_dict_cache_key_id(pm_id))
+
+        response = json_success_with_fragments(dict(anchor=5), 'messages', ['{"id":1}'])
+        self.assertEqual(ujson.loads(response.content),
+                         dict(result='success', msg='', anchor=5, messages=[dict(id=1)]))
+
 class MessageVisibilityTest(ZulipTestCase):
     def test_update_first_visible_message_id(self) -> None:
         Message.objects.all().delete()
@@ -12,6 +12,8 @@ class SlowQueryTest(ZulipTestCase):
                 'time_started': 0,
                 'bugdown_requests_start': 0,
                 'bugdown_time_start': 0,
+                'bugdown_cache_hits_start': 0,
+                'bugdown_cache_misses_start': 0,
                 'remote_cache_time_start': 0,
                 'remote_cache_requests_start': 0}
 
@@ -49,3 +51,15 @@ class SlowQueryTest(ZulipTestCase):
         write_log_line(self.log_data, path='/socket/open', method='SOCKET',
                        remote_ip='123.456.789.012', email='unknown', client_name='?')
         mock_internal_send_message.assert_not_called()
+
+    @patch('zerver.middleware.get_bugdown_render_cache_misses', return_value=1)
+    @patch('zerver.middleware.get_bugdown_render_cache_hits', return_value=3)
+    def test_bugdown_render_cache_log(self, mock_hits: Mock, mock_misses: Mock) -> None:
+        log_data = dict(self.log_data, time_started=time.time())
+        with patch('zerver.middleware.logger') as mock_logger, \
+                patch('zerver.middleware.statsd') as mock_statsd:
+            write_log_line(log_data, path='/json/messages', method='GET',
+                           remote_ip='123.456.789.012', email='unknown', client_name='?')
+        self.assertIn(' (md cache: 3/4) ', mock_logger.info.call_args[0][0])
+        mock_statsd.incr.assert_any_call('webreq.json.messages.markdown.cache_hits', 3)
+        mock_statsd.incr.assert_any_call('webreq.json.messages.markdown.cache_misses', 1)
@@ -13,6 +13,7 @@ from zerver.models import (
     get_display_recipient, get_personal_recipient, get_realm, get_stream, get_user,
     Reaction, UserMessage, get_stream_recipient, Message
 )
+from zerver.lib.actions import do_delete_message
 from zerver.lib.message import (
     MessageDict,
     get_first_visible_message_id,
@@ -1236,6 +1237,53 @@ class GetOldMessagesTest(ZulipTestCase):
         self.assertEqual(old_message['flags'], ['read', 'historical'])
         self.assertEqual(new_message['flags'], ['mentioned'])
 
+    def test_export_messages(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+
+        stream_name = 'export stream'
+        self.subscribe(cordelia, stream_name)
+        old_message_id = self.send_stream_message(cordelia.email, stream_name, content='foo')
+        self.subscribe(hamlet, stream_name)
+        message_ids = [old_message_id] + [
+            self.send_stream_message(cordelia.email, stream_name, content='message %d' % (i,))
+            for i in range(4)
+        ]
+
+        self.make_stream('private export stream', invite_only=True)
+        self.subscribe(cordelia, 'private export stream')
+        self.send_stream_message(cordelia.email, 'private export stream', content='secret')
+
+        self.login(hamlet.email)
+
+        def export(narrow: List[Dict[str, str]], after_id: int=0) -> List[Dict[str, Any]]:
+            req = dict(narrow=ujson.dumps(narrow), after_id=after_id)
+            with mock.patch('zerver.views.messages.MESSAGES_PER_EXPORT_BATCH', 2), \
+                    queries_captured() as queries:
+                result = self.client_get('/json/messages/export', req)
+                self.assertEqual(result.status_code, 200)
+                self.assertEqual(result['Content-Type'], 'application/x-ndjson')
+                lines = b''.join(result.streaming_content).decode().splitlines()
+            # Each batch is a separate keyset query on the message id.
+            export_queries = [q for q in queries if '/* export_messages */' in q['sql']]
+            self.assertEqual(len(export_queries), len(lines) // 2 + 1)
+            return [ujson.loads(line) for line in lines]
+
+        narrow = [dict(operator='stream', operand=stream_name)]
+        messages = export(narrow)
+        self.assertEqual([m['id'] for m in messages], message_ids)
+        self.assertEqual(messages[0]['flags'], ['read', 'historical'])
+        self.assertEqual(messages[0]['content'], '<p>foo</p>')
+
+        # Resuming from the last id received.
+        messages = export(narrow, after_id=message_ids[2])
+        self.assertEqual([m['id'] for m in messages], message_ids[3:])
+
+        # The same access rules as GET /messages: no history for a
+        # private stream hamlet isn't subscribed to.
+        messages = export([dict(operator='stream', operand='private export stream')])
+        self.assertEqual(messages, [])
+
     def test_get_messages_with_narrow_stream(self) -> None:
         """
         A request for old messages with a narrow by stream only returns
@@ -1596,6 +1644,71 @@ class GetOldMessagesTest(ZulipTestCase):
         narrow = [dict(operator='search', operand="Hogwart's")]
         self.message_visibility_test(narrow, message_ids, 2)
 
+    @override_settings(USING_PGROONGA=False, SEARCH_RESULTS_CACHE_SECONDS=60)
+    def test_search_results_cache(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.subscribe(hamlet, 'Scotland')
+        message_ids = [
+            self.send_stream_message(self.example_email("iago"), "Scotland",
+                                     topic_name="caching", content="cacheable result %s" % (i,))
+            for i in range(6)
+        ]
+        self._update_tsvector_index()
+        narrow = ujson.dumps([dict(operator='search', operand='cacheable')])
+
+        def get_page(**params: Any) -> Tuple[List[int], Dict[str, Any], List[Dict[str, Any]]]:
+            params['narrow'] = narrow
+            request = POSTRequestMock(params, hamlet)
+            with queries_captured() as queries:
+                result = ujson.loads(get_messages_backend(request, hamlet).content)
+            self.assertEqual(result['result'], 'success')
+            self.assertIn(' match=', request._log_data['extra'])
+            self.assertIn(' highlight=', request._log_data['extra'])
+            self.assertIn(' hydrate=', request._log_data['extra'])
+            return ([m['id'] for m in result['messages']], result, queries)
+
+        def searched(queries: List[Dict[str, str]]) -> bool:
+            return any("/* get_messages */" in query['sql'] for query in queries)
+
+        def checked(queries: List[Dict[str, str]]) -> bool:
+            return any("/* search_results_check */" in query['sql'] for query in queries)
+
+        # The newest page always runs the search, and caches the results.
+        ids, result, queries = get_page(anchor=LARGER_THAN_MAX_MESSAGE_ID, num_before=2, num_after=0)
+        self.assertEqual(ids, message_ids[-2:])
+        self.assertTrue(searched(queries))
+
+        # Older pages are sliced out of the cache, but still highlighted.
+        ids, result, queries = get_page(anchor=message_ids[-3], num_before=2, num_after=0)
+        self.assertEqual(ids, message_ids[-5:-2])
+        self.assertFalse(searched(queries))
+        self.assertTrue(checked(queries))
+        self.assertTrue(result['found_anchor'])
+        self.assertFalse(result['found_oldest'])
+        self.assertIn('<span class="highlight">cacheable</span>',
+                      result['messages'][0]['match_content'])
+        self.assertEqual(result['messages'][0]['flags'], [])
+
+        # A page with messages that no longer match the narrow, e.g.
+        # because they were deleted, is searched again.
+        do_delete_message(self.example_user('iago'), Message.objects.get(id=message_ids[0]))
+        ids, result, queries = get_page(anchor=message_ids[1], num_before=5, num_after=1)
+        self.assertEqual(ids, message_ids[1:3])
+        self.assertTrue(checked(queries))
+        self.assertTrue(searched(queries))
+        self.assertTrue(result['found_oldest'])
+
+        # ... which refreshes the cache.
+        ids, result, queries = get_page(anchor=message_ids[2], num_before=1, num_after=0)
+        self.assertEqual(ids, message_ids[1:3])
+        self.assertFalse(searched(queries))
+
+        # The newest messages can't be served from the cache, since
+        # there might be new ones.
+        ids, result, queries = get_page(anchor=message_ids[-2], num_before=0, num_after=5)
+        self.assertEqual(ids, message_ids[-2:])
+        self.assertTrue(searched(queries))
+
     @override_settings(USING_PGROONGA=False)
     def test_get_messages_with_search_not_subscribed(self) -> None:
         """Verify support for searching a stream you're not subscribed to"""
@@ -2544,19 +2657,19 @@ class GetOldMessagesTest(ZulipTestCase):
     def test_get_messages_with_search_queries(self) -> None:
         query_ids = self.get_query_ids()
 
-        sql_template = "SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.topic_matches \nFROM (SELECT message_id, flags, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS topic_matches \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"  # type: str
+        sql_template = "SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT message_id, flags \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"  # type: str
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 9,
                                               'narrow': '[["search", "jumping"]]'},
                                              sql)
 
-        sql_template = "SELECT anon_1.message_id, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.topic_matches \nFROM (SELECT id AS message_id, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS topic_matches \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 9,
                                               'narrow': '[["stream", "Scotland"], ["search", "jumping"]]'},
                                              sql)
 
-        sql_template = 'SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.topic_matches \nFROM (SELECT message_id, flags, subject, rendered_content, ts_match_locs_array(\'zulip.english_us_search\', rendered_content, plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS content_matches, ts_match_locs_array(\'zulip.english_us_search\', escape_html(subject), plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS topic_matches \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (content ILIKE \'%jumping%\' OR subject ILIKE \'%jumping%\') AND (search_tsvector @@ plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
+        sql_template = 'SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT message_id, flags \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (content ILIKE \'%jumping%\' OR subject ILIKE \'%jumping%\') AND (search_tsvector @@ plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
         sql = sql_template.format(**query_ids)
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 9,
                                               'narrow': '[["search", "\\"jumping\\" quickly"]]'},
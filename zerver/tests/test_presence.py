@@ -8,6 +8,12 @@ import mock
 
 from typing import Any, Dict
 from zerver.lib.actions import do_deactivate_user
+from zerver.lib.presence import (
+    drop_presence_snapshot,
+    get_presence_snapshot_time,
+    get_status_dict_from_snapshot,
+    update_presence_snapshot,
+)
 from zerver.lib.statistics import seconds_usage_between
 from zerver.lib.test_helpers import (
     make_client,
@@ -505,3 +511,110 @@ class GetRealmStatusesTest(ZulipTestCase):
         self.assert_json_success(result)
         json = result.json()
         self.assertEqual(sorted(json['presences'].keys()), [hamlet_email, othello_email])
+
+@override_settings(PRESENCE_SNAPSHOT_ENABLED=True)
+class PresenceSnapshotTest(ZulipTestCase):
+    def post_presence(self, email: str, status: str, user_agent: str) -> None:
+        result = self.api_post(email, "/api/v1/users/me/presence", {'status': status},
+                               HTTP_USER_AGENT=user_agent)
+        self.assert_json_success(result)
+
+    def test_snapshot_matches_database(self) -> None:
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        hamlet.enable_offline_push_notifications = True
+        hamlet.save()
+        PushDeviceToken.objects.create(user=hamlet, kind=PushDeviceToken.APNS,
+                                       token='abcd')
+
+        # Rows from before the snapshot is built come from the database.
+        self.post_presence(hamlet.email, 'idle', 'ZulipDesktop/1.0')
+        drop_presence_snapshot(realm.id)
+        self.post_presence(hamlet.email, 'active', 'ZulipAndroid/1.0')
+        self.post_presence(othello.email, 'active', 'ZulipAndroid/1.0')
+
+        presences = get_status_dict_from_snapshot(realm.id)
+        self.assertEqual(presences, UserPresence.get_status_dict_by_realm(realm.id))
+        self.assertEqual(presences[hamlet.email]['website']['status'], 'idle')
+        self.assertEqual(presences[hamlet.email]['aggregated']['client'], 'ZulipAndroid')
+        self.assertTrue(presences[hamlet.email]['ZulipAndroid']['pushable'])
+
+        with queries_captured() as queries:
+            get_status_dict_from_snapshot(realm.id)
+        self.assert_length(queries, 0)
+
+        result = self.api_get(othello.email, "/api/v1/realm/presence")
+        self.assert_json_success(result)
+        self.assertEqual(result.json()['presences'], presences)
+
+        do_deactivate_user(othello)
+        presences = get_status_dict_from_snapshot(realm.id)
+        self.assertNotIn(othello.email, presences)
+
+    def test_older_and_expired_rows(self) -> None:
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        self.post_presence(hamlet.email, 'active', 'ZulipAndroid/1.0')
+        presence = UserPresence.objects.get(user_profile=hamlet, client__name='ZulipAndroid')
+
+        # An update processed out of order doesn't replace a newer one.
+        older = UserPresence(user_profile=hamlet, client=presence.client,
+                             status=UserPresence.IDLE,
+                             timestamp=presence.timestamp - timedelta(minutes=1))
+        update_presence_snapshot([older])
+        presences = get_status_dict_from_snapshot(realm.id)
+        self.assertEqual(presences[hamlet.email]['ZulipAndroid']['status'], 'active')
+
+        # Rows older than two weeks are ignored.
+        stale = UserPresence(user_profile=hamlet, client=make_client('ZulipTerminal'),
+                             status=UserPresence.ACTIVE,
+                             timestamp=timezone_now() - timedelta(weeks=3))
+        update_presence_snapshot([stale])
+        presences = get_status_dict_from_snapshot(realm.id)
+        self.assertNotIn('ZulipTerminal', presences[hamlet.email])
+
+    @mock.patch('zerver.lib.presence.PRESENCE_SINCE_MARGIN_SECONDS', 0)
+    def test_since(self) -> None:
+        hamlet_email = self.example_email('hamlet')
+        othello_email = self.example_email('othello')
+        # Building the snapshot marks every user as changed.
+        get_status_dict_from_snapshot(get_realm('zulip').id)
+        self.post_presence(hamlet_email, 'active', 'ZulipAndroid/1.0')
+        result = self.api_get(othello_email, "/api/v1/realm/presence")
+        self.assert_json_success(result)
+        server_timestamp = result.json()['server_timestamp']
+        self.assertIn(hamlet_email, result.json()['presences'])
+
+        self.post_presence(othello_email, 'active', 'ZulipAndroid/1.0')
+        result = self.api_get(hamlet_email, "/api/v1/realm/presence",
+                              {'since': server_timestamp})
+        self.assert_json_success(result)
+        self.assertEqual(list(result.json()['presences'].keys()), [othello_email])
+
+        result = self.api_post(hamlet_email, "/api/v1/users/me/presence",
+                               {'status': 'active', 'since': result.json()['server_timestamp']},
+                               HTTP_USER_AGENT='ZulipAndroid/1.0')
+        self.assert_json_success(result)
+        self.assertEqual(list(result.json()['presences'].keys()), [hamlet_email])
+
+        # Without the snapshot, `since` is ignored.
+        with self.settings(PRESENCE_SNAPSHOT_ENABLED=False):
+            result = self.api_get(hamlet_email, "/api/v1/realm/presence",
+                                  {'since': server_timestamp + 3600})
+        self.assert_json_success(result)
+        self.assertEqual(sorted(result.json()['presences'].keys()),
+                         sorted([hamlet_email, othello_email]))
+
+    def test_since_update_stored_after_read(self) -> None:
+        realm = get_realm('zulip')
+        hamlet_email = self.example_email('hamlet')
+        get_status_dict_from_snapshot(realm.id)
+        since = get_presence_snapshot_time()
+        # An update that read the time before that, but whose script
+        # only ran afterwards.
+        with mock.patch('zerver.lib.presence.get_presence_snapshot_time',
+                        return_value=since - 1):
+            self.post_presence(hamlet_email, 'active', 'ZulipAndroid/1.0')
+        presences = get_status_dict_from_snapshot(realm.id, since)
+        self.assertIn('ZulipAndroid', presences[hamlet_email])
@@ -1,4 +1,5 @@
 
+import datetime
 import os
 import time
 import ujson
@@ -7,14 +8,17 @@ import smtplib
 from django.conf import settings
 from django.http import HttpResponse
 from django.test import TestCase, override_settings
+from django.utils.timezone import now as timezone_now
 from mock import patch, MagicMock
 from typing import Any, Callable, Dict, List, Mapping, Tuple
 
+from zerver.lib.actions import do_update_user_presences
 from zerver.lib.send_email import FromAddress
-from zerver.lib.test_helpers import simulated_queue_client
+from zerver.lib.test_helpers import queries_captured, simulated_queue_client
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.models import get_client, UserActivity, PreregistrationUser, \
-    get_system_bot
+from zerver.lib.timestamp import datetime_to_timestamp, timestamp_to_datetime
+from zerver.models import get_client, UserActivity, UserActivityInterval, UserPresence, \
+    PreregistrationUser, get_system_bot
 from zerver.worker import queue_processors
 from zerver.worker.queue_processors import (
     get_active_worker_queues,
@@ -383,25 +387,181 @@ class WorkerTest(ZulipTestCase):
             user_profile = user.id,
             client = get_client('ios')
         ).delete()
+        UserActivity.objects.create(user_profile=user, client=get_client('ios'),
+                                    query='get_events', count=3,
+                                    last_visit=timezone_now() - datetime.timedelta(days=1))
+
+        now = time.time()
+        for query in ['send_message', 'get_events', 'send_message']:
+            data = dict(
+                user_profile_id = user.id,
+                client = 'ios',
+                time = now,
+                query = query
+            )
+            fake_client.queue.append(('user_activity', data))
 
-        data = dict(
-            user_profile_id = user.id,
-            client = 'ios',
-            time = time.time(),
-            query = 'send_message'
-        )
-        fake_client.queue.append(('user_activity', data))
-
-        with simulated_queue_client(lambda: fake_client):
+        with simulated_queue_client(lambda: fake_client), \
+                patch('zerver.worker.queue_processors.time.sleep', side_effect=AbortLoop):
             worker = queue_processors.UserActivityWorker()
             worker.setup()
-            worker.start()
+            with queries_captured() as queries:
+                try:
+                    worker.start()
+                except AbortLoop:
+                    pass
+            # One query to fetch the rows, one to update them and
+            # one to create them.
+            self.assert_length(queries, 3)
             activity_records = UserActivity.objects.filter(
                 user_profile = user.id,
                 client = get_client('ios')
             )
-            self.assertTrue(len(activity_records), 1)
-            self.assertTrue(activity_records[0].count, 1)
+            counts = {record.query: record.count for record in activity_records}
+            self.assertEqual(counts, {'send_message': 2, 'get_events': 4})
+            self.assertEqual(activity_records.get(query='get_events').last_visit,
+                             timestamp_to_datetime(now))
+
+    def test_UserPresenceWorker(self) -> None:
+        fake_client = self.FakeClient()
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        UserPresence.objects.filter(user_profile__in=[hamlet, othello]).delete()
+
+        now = time.time()
+        for user, status, offset in [(hamlet, UserPresence.IDLE, 0),
+                                     (othello, UserPresence.ACTIVE, 0),
+                                     (hamlet, UserPresence.ACTIVE, 5)]:
+            fake_client.queue.append(('user_presence', dict(
+                user_profile_id=user.id,
+                client='website',
+                time=now + offset,
+                status=status,
+            )))
+
+        with simulated_queue_client(lambda: fake_client), \
+                patch('zerver.worker.queue_processors.time.sleep', side_effect=AbortLoop), \
+                patch('zerver.lib.actions.send_event') as send_event_mock:
+            worker = queue_processors.UserPresenceWorker()
+            worker.setup()
+            try:
+                worker.start()
+            except AbortLoop:
+                pass
+
+        # Each user's presence was created, so each gets one event.
+        self.assertEqual(send_event_mock.call_count, 2)
+        presence = UserPresence.objects.get(user_profile=hamlet, client__name='website')
+        self.assertEqual(presence.status, UserPresence.ACTIVE)
+        self.assertEqual(presence.timestamp, timestamp_to_datetime(now + 5))
+        presence = UserPresence.objects.get(user_profile=othello, client__name='website')
+        self.assertEqual(presence.status, UserPresence.ACTIVE)
+
+        # Going idle right after becoming active is suppressed, and
+        # doesn't send an event; coming back after a while does.
+        fake_client.queue.append(('user_presence', dict(
+            user_profile_id=hamlet.id, client='website', time=now + 10,
+            status=UserPresence.IDLE)))
+        fake_client.queue.append(('user_presence', dict(
+            user_profile_id=othello.id, client='website', time=now + 600,
+            status=UserPresence.ACTIVE)))
+        with simulated_queue_client(lambda: fake_client), \
+                patch('zerver.worker.queue_processors.time.sleep', side_effect=AbortLoop), \
+                patch('zerver.lib.actions.send_event') as send_event_mock:
+            try:
+                worker.start()
+            except AbortLoop:
+                pass
+        self.assertEqual(send_event_mock.call_count, 1)
+        self.assertEqual(send_event_mock.call_args[0][1]['email'], othello.email)
+        presence = UserPresence.objects.get(user_profile=hamlet, client__name='website')
+        self.assertEqual(presence.status, UserPresence.ACTIVE)
+        self.assertEqual(presence.timestamp, timestamp_to_datetime(now + 5))
+
+    def test_concurrently_created_presence(self) -> None:
+        hamlet = self.example_user('hamlet')
+        website = get_client('website')
+        UserPresence.objects.filter(user_profile=hamlet).delete()
+        now = timezone_now()
+        UserPresence.objects.create(user_profile=hamlet, client=website,
+                                    timestamp=now - datetime.timedelta(minutes=10),
+                                    status=UserPresence.IDLE)
+
+        # Simulate another process creating the row after we looked
+        # for it; the update is applied to the existing row instead.
+        with patch.object(UserPresence.objects, 'filter', return_value=[]), \
+                patch('zerver.lib.actions.send_event'):
+            do_update_user_presences([(hamlet, website, now, UserPresence.ACTIVE)])
+        presence = UserPresence.objects.get(user_profile=hamlet, client=website)
+        self.assertEqual(presence.status, UserPresence.ACTIVE)
+        self.assertEqual(presence.timestamp, now)
+
+    def test_UserActivityIntervalWorker(self) -> None:
+        fake_client = self.FakeClient()
+        user = self.example_user('hamlet')
+        UserActivityInterval.objects.filter(user_profile=user).delete()
+        start = (timezone_now() - datetime.timedelta(hours=2)).replace(microsecond=0)
+        UserActivityInterval.objects.create(
+            user_profile=user, start=start,
+            end=start + UserActivityInterval.MIN_INTERVAL_LENGTH)
+
+        # The first two events extend the existing interval; the
+        # last two are an hour later, and make a new one.
+        for minutes in [10, 20, 80, 90]:
+            log_time = start + datetime.timedelta(minutes=minutes)
+            fake_client.queue.append(('user_activity_interval', dict(
+                user_profile_id=user.id, time=datetime_to_timestamp(log_time))))
+
+        with simulated_queue_client(lambda: fake_client), \
+                patch('zerver.worker.queue_processors.time.sleep', side_effect=AbortLoop):
+            worker = queue_processors.UserActivityIntervalWorker()
+            worker.setup()
+            try:
+                worker.start()
+            except AbortLoop:
+                pass
+
+        intervals = [(interval.start - start, interval.end - start) for interval in
+                     UserActivityInterval.objects.filter(user_profile=user).order_by('start')]
+        self.assertEqual(intervals, [
+            (datetime.timedelta(minutes=0), datetime.timedelta(minutes=35)),
+            (datetime.timedelta(minutes=80), datetime.timedelta(minutes=105)),
+        ])
+
+    def test_loop_worker_error_handling(self) -> None:
+        fake_client = self.FakeClient()
+        hamlet = self.example_user('hamlet')
+        UserActivityInterval.objects.filter(user_profile=hamlet).delete()
+        fake_client.queue.append(('user_activity_interval', dict(
+            user_profile_id=hamlet.id, time=time.time())))
+        fake_client.queue.append(('user_activity_interval', dict(
+            user_profile_id=hamlet.id, time='not a timestamp')))
+
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, 'user_activity_interval.errors')
+        try:
+            os.remove(fn)
+        except OSError:  # nocoverage # error handling for the directory not existing
+            pass
+
+        with simulated_queue_client(lambda: fake_client), \
+                patch('zerver.worker.queue_processors.time.sleep', side_effect=AbortLoop), \
+                patch('logging.exception') as logging_exception_mock:
+            worker = queue_processors.UserActivityIntervalWorker()
+            worker.setup()
+            try:
+                worker.start()
+            except AbortLoop:
+                pass
+            logging_exception_mock.assert_called_once_with(
+                "Problem handling data on queue user_activity_interval")
+
+        # The batch failed, so the events were retried one at a time,
+        # and only the bad one was logged.
+        lines = open(fn).readlines()
+        self.assert_length(lines, 1)
+        event = ujson.loads(lines[0].strip().split('\t')[1])
+        self.assertEqual(event['time'], 'not a timestamp')
+        self.assertTrue(UserActivityInterval.objects.filter(user_profile=hamlet).exists())
 
     def test_error_handling(self) -> None:
         processed = []
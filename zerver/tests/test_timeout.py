@@ -0,0 +1,32 @@
+import time
+
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.timeout import timeout, TimeoutExpired, worker_pool
+
+class TimeoutTestCase(ZulipTestCase):
+    def test_timeout_returns(self) -> None:
+        self.assertEqual(timeout(1, lambda x, y: x + y, 1, y=2), 3)
+
+        with self.assertRaises(ZeroDivisionError):
+            timeout(1, lambda: 1 / 0)
+
+    def test_workers_reused(self) -> None:
+        timeout(1, len, 'abc')
+        workers = list(worker_pool.idle_workers)
+        for i in range(20):
+            timeout(1, len, 'abc')
+        self.assertEqual(worker_pool.idle_workers, workers)
+
+    def test_timeout_expired(self) -> None:
+        def spin() -> None:
+            while True:
+                pass
+
+        start = time.time()
+        with self.assertRaises(TimeoutExpired):
+            timeout(0.2, spin)
+        self.assertLess(time.time() - start, 2)
+
+        # The interrupted worker goes back in the pool, and doesn't
+        # see a stray timeout in its next call.
+        self.assertEqual(timeout(1, len, 'abc'), 3)
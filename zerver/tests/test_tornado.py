@@ -460,6 +460,8 @@ class TornadoTestCase(WebSocketBaseTestCase):
             request._log_data = {'bugdown_requests_start': 0,
                                  'time_started': 0,
                                  'bugdown_time_start': 0,
+                                 'bugdown_cache_hits_start': 0,
+                                 'bugdown_cache_misses_start': 0,
                                  'remote_cache_time_start': 0,
                                  'remote_cache_requests_start': 0,
                                  'startup_time_delta': 0}
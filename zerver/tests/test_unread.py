@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-AA
 
-from typing import Any, Dict, List, Mapping
+from typing import Any, Callable, Dict, List, Mapping
 
+from django.core.management import call_command
 from django.db import connection
 from django.test import override_settings
 
@@ -22,14 +23,23 @@ from zerver.lib.fix_unreads import (
     fix_pre_pointer,
     fix_unsubscribed,
 )
+from zerver.lib.message import get_raw_unread_data
 from zerver.lib.test_helpers import (
     get_subscription,
+    queries_captured,
     tornado_redirected_to_list,
 )
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
 from zerver.lib.topic_mutes import add_topic_mute
+from zerver.lib import unread_summary
+from zerver.lib.unread_summary import (
+    check_unread_summary,
+    get_raw_unread_data_from_summary,
+    get_unread_summary,
+    has_unread_summary,
+)
 
 import mock
 import ujson
@@ -358,6 +368,148 @@ class UnreadCountTests(ZulipTestCase):
         })
         self.assert_json_error(result, 'No such topic \'abc\'')
 
+@override_settings(UNREAD_SUMMARY_ENABLED=True)
+class UnreadSummaryTest(ZulipTestCase):
+    def assert_summary_consistent(self, user_profile: UserProfile) -> None:
+        self.assertTrue(has_unread_summary(user_profile))
+        self.assertEqual(check_unread_summary(user_profile), set())
+
+    def test_incremental_updates(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.login(hamlet.email)
+        self.subscribe(hamlet, 'Denmark')
+
+        self.assertFalse(has_unread_summary(hamlet))
+        self.assertEqual(get_raw_unread_data_from_summary(hamlet), get_raw_unread_data(hamlet))
+        self.assert_summary_consistent(hamlet)
+
+        stream_message_id = self.send_stream_message(self.example_email('iago'), 'Denmark')
+        mention_message_id = self.send_stream_message(
+            self.example_email('iago'), 'Denmark', content='hi @**King Hamlet**')
+        pm_id = self.send_personal_message(self.example_email('iago'), hamlet.email)
+        huddle_message_id = self.send_huddle_message(
+            self.example_email('iago'), [hamlet.email, self.example_email('cordelia')])
+        self.assert_summary_consistent(hamlet)
+
+        # Only users with a summary get an update.
+        with mock.patch('zerver.lib.unread_summary.update_script',
+                        wraps=unread_summary.update_script) as mock_update:
+            self.send_stream_message(self.example_email('iago'), 'Denmark')
+        self.assertEqual(mock_update.call_count, 1)
+        self.assertEqual(mock_update.call_args[1]['keys'][0],
+                         unread_summary.unread_summary_keys(hamlet.id)[0])
+        self.assertFalse(has_unread_summary(self.example_user('cordelia')))
+
+        # Reading an existing summary doesn't touch UserMessage.
+        with queries_captured() as queries:
+            raw_unread_data = get_raw_unread_data_from_summary(hamlet)
+        self.assertFalse([query for query in queries if 'zerver_usermessage' in query['sql']])
+        self.assertEqual(raw_unread_data['mentions'], {mention_message_id})
+        self.assertIn(pm_id, raw_unread_data['pm_dict'])
+        self.assertIn(huddle_message_id, raw_unread_data['huddle_dict'])
+
+        result = self.client_post('/json/messages/flags', {
+            'messages': ujson.dumps([stream_message_id, pm_id]),
+            'op': 'add',
+            'flag': 'read',
+        })
+        self.assert_json_success(result)
+        self.assert_summary_consistent(hamlet)
+
+        result = self.client_post('/json/messages/flags', {
+            'messages': ujson.dumps([pm_id]),
+            'op': 'remove',
+            'flag': 'read',
+        })
+        self.assert_json_success(result)
+        self.assert_summary_consistent(hamlet)
+
+        # Mutes are applied when reading the summary.
+        add_topic_mute(hamlet, get_stream('Denmark', hamlet.realm).id,
+                       get_stream_recipient(get_stream('Denmark', hamlet.realm).id).id,
+                       'test')
+        self.assert_summary_consistent(hamlet)
+
+        result = self.client_post('/json/mark_stream_as_read', {
+            'stream_id': get_stream('Denmark', hamlet.realm).id,
+        })
+        self.assert_json_success(result)
+        self.assert_summary_consistent(hamlet)
+
+        result = self.client_post('/json/mark_all_as_read', {})
+        self.assert_json_success(result)
+        self.assert_summary_consistent(hamlet)
+        self.assertEqual(get_unread_summary(hamlet), {})
+
+    def test_topic_edit_drops_summary(self) -> None:
+        hamlet = self.example_user('hamlet')
+        message_id = self.send_stream_message(self.example_email('iago'), 'Verona')
+        get_raw_unread_data_from_summary(hamlet)
+        self.assertTrue(has_unread_summary(hamlet))
+
+        self.login(self.example_email('iago'))
+        # Tests run in a transaction that is never committed, so
+        # collect the on_commit callbacks and run them ourselves.
+        on_commit_callbacks = []  # type: List[Callable[[], None]]
+        with mock.patch('django.db.transaction.on_commit',
+                        side_effect=on_commit_callbacks.append):
+            result = self.client_patch('/json/messages/' + str(message_id), {
+                'message_id': message_id,
+                'topic': 'edited',
+            })
+        self.assert_json_success(result)
+        # The summary is only dropped once the edit is committed.
+        self.assertTrue(has_unread_summary(hamlet))
+        for callback in on_commit_callbacks:
+            callback()
+        self.assertFalse(has_unread_summary(hamlet))
+        get_raw_unread_data_from_summary(hamlet)
+        self.assert_summary_consistent(hamlet)
+
+    def test_update_during_build(self) -> None:
+        hamlet = self.example_user('hamlet')
+        fetch_unread_summary_rows = unread_summary.fetch_unread_summary_rows
+        sent_message_ids = []  # type: List[int]
+
+        def fetch_and_send(*args: Any, **kwargs: Any) -> Dict[str, str]:
+            rows = fetch_unread_summary_rows(*args, **kwargs)
+            # A message sent after we've queried the database.
+            sent_message_ids.append(self.send_personal_message(
+                self.example_email('iago'), hamlet.email))
+            return rows
+
+        with mock.patch('zerver.lib.unread_summary.fetch_unread_summary_rows',
+                        side_effect=fetch_and_send):
+            get_raw_unread_data_from_summary(hamlet)
+
+        summary = get_unread_summary(hamlet)
+        assert summary is not None
+        self.assertIn(str(sent_message_ids[0]), summary)
+        self.assert_summary_consistent(hamlet)
+
+    def test_too_many_unread_messages(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.send_personal_message(self.example_email('iago'), hamlet.email)
+        self.send_personal_message(self.example_email('iago'), hamlet.email)
+        with mock.patch('zerver.lib.unread_summary.UNREAD_SUMMARY_MAX_MESSAGES', 1):
+            self.assertEqual(get_raw_unread_data_from_summary(hamlet), get_raw_unread_data(hamlet))
+            self.assertTrue(has_unread_summary(hamlet))
+            self.assertIsNone(get_unread_summary(hamlet))
+
+    def test_check_unread_summaries(self) -> None:
+        hamlet = self.example_user('hamlet')
+        pm_id = self.send_personal_message(self.example_email('iago'), hamlet.email)
+        get_raw_unread_data_from_summary(hamlet)
+
+        # Simulate a missed update.
+        unread_summary.client.hdel(unread_summary.unread_summary_keys(hamlet.id)[0], str(pm_id))
+        self.assertEqual(check_unread_summary(hamlet), {'pm_dict'})
+
+        with mock.patch('builtins.print') as mock_print:
+            call_command('check_unread_summaries', '-r', 'zulip', '--fix', hamlet.email)
+        mock_print.assert_any_call('%s: pm_dict differ' % (hamlet.email,))
+        self.assertFalse(has_unread_summary(hamlet))
+
 class FixUnreadTests(ZulipTestCase):
     def test_fix_unreads(self) -> None:
         user = self.example_user('hamlet')
@@ -1,12 +1,13 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
-from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Union
+from typing import cast, AbstractSet, Any, Callable, Dict, Iterator, List, \
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Tuple, Union
 from mypy_extensions import TypedDict
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from collections import deque
+import heapq
 import os
 import time
 import logging
@@ -30,8 +31,9 @@ from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.queue_log import EventQueueLog
 from zerver.tornado.sharding import get_tornado_uri, get_tornado_port, \
-    notify_tornado_queue_name, tornado_return_queue_name
+    make_queue_id, notify_tornado_queue_name, tornado_return_queue_name
 import copy
 
 requests_client = requests.Session()
@@ -46,6 +48,9 @@ for host in ['127.0.0.1', 'localhost']:
 # due to the accumulation of message data in those queues.
 IDLE_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 5
+# How often queues that changed are appended to the event queue log,
+# with INCREMENTAL_EVENT_QUEUE_PERSISTENCE.
+EVENT_QUEUE_CHECKPOINT_FREQ_MSECS = 1000 * 30
 
 # Capped limit for how long a client can request an event queue
 # to live
@@ -58,6 +63,61 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 # wireless routers that kill "inactive" http connections.
 HEARTBEAT_MIN_FREQ_SECS = 45
 
+class MessageEvent(Mapping[str, Any]):
+    '''
+    A message event in a single client's queue.  A message to a big
+    stream is delivered to thousands of queues, so rather than
+    building a fresh dict for every client, each queue holds one of
+    these, pointing at the message payload shared by every client with
+    the same (apply_markdown, client_gravatar) settings, plus the small
+    amount of per-client data (flags and notification data).  The
+    actual event dict is only built when the client fetches its events.
+
+    The shared payload and flags lists must never be mutated.
+    '''
+    __slots__ = ('id', 'message', 'flags', 'extra')
+
+    def __init__(self, message: Dict[str, Any], flags: Iterable[str],
+                 extra: Optional[Dict[str, Any]]=None) -> None:
+        self.id = None  # type: Optional[int]
+        self.message = message
+        self.flags = flags
+        self.extra = extra
+
+    def to_dict(self) -> Dict[str, Any]:
+        event = dict(type='message', message=self.message, flags=self.flags)  # type: Dict[str, Any]
+        if self.extra is not None:
+            event.update(self.extra)
+        if self.id is not None:
+            event['id'] = self.id
+        return event
+
+    # Read-only dict-style access, so that code inspecting queued
+    # events (narrow filters, pruning, etc.) doesn't need to care.
+    def __getitem__(self, key: str) -> Any:
+        if key == 'type':
+            return 'message'
+        if key == 'message':
+            return self.message
+        if key == 'flags':
+            return self.flags
+        if key == 'id' and self.id is not None:
+            return self.id
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.to_dict())
+
+    def __len__(self) -> int:
+        return len(self.to_dict())
+
+def materialize_event(event: Union[Dict[str, Any], MessageEvent]) -> Dict[str, Any]:
+    if isinstance(event, MessageEvent):
+        return event.to_dict()
+    return event
+
 class ClientDescriptor:
     def __init__(self,
                  user_profile_id: int,
@@ -112,6 +172,12 @@ class ClientDescriptor:
                     narrow=self.narrow,
                     client_type_name=self.client_type_name)
 
+    def to_delta(self) -> Dict[str, Any]:
+        # The changes since this queue's last record in the event
+        # queue log; see zerver/tornado/queue_log.py.
+        return dict(last_connection_time=self.last_connection_time,
+                    event_queue=self.event_queue.to_delta())
+
     def __repr__(self) -> str:
         return "ClientDescriptor<%s>" % (self.event_queue.id,)
 
@@ -148,12 +214,13 @@ class ClientDescriptor:
         self.current_handler_id = None
         self._timeout_handle = None
 
-    def add_event(self, event: Dict[str, Any]) -> None:
+    def add_event(self, event: Union[Dict[str, Any], MessageEvent]) -> None:
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_timer_restart(handler._request)
 
         self.event_queue.push(event)
+        mark_queue_changed(self.event_queue.id)
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
@@ -192,6 +259,7 @@ class ClientDescriptor:
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        mark_queue_changed(self.event_queue.id)
 
         def timeout_callback() -> None:
             self._timeout_handle = None
@@ -242,6 +310,10 @@ class EventQueue:
         self.next_event_id = 0  # type: int
         self.id = id  # type: str
         self.virtual_events = {}  # type: Dict[str, Dict[str, Any]]
+        # The next_event_id as of this queue's last record in the
+        # event queue log, or None if the next record needs to be a
+        # full "put" (see checkpoint_event_queues).
+        self.checkpointed_next_event_id = None  # type: Optional[int]
 
     def to_dict(self) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
@@ -249,7 +321,21 @@ class EventQueue:
         # loading event queues that lack that key.
         return dict(id=self.id,
                     next_event_id=self.next_event_id,
-                    queue=list(self.queue),
+                    queue=[materialize_event(event) for event in self.queue],
+                    virtual_events=self.virtual_events)
+
+    def to_delta(self) -> Dict[str, Any]:
+        assert self.checkpointed_next_event_id is not None
+        # Events are queued in order of id, so the new ones are at the end.
+        new_events = []  # type: List[Dict[str, Any]]
+        for event in reversed(self.queue):
+            if event['id'] < self.checkpointed_next_event_id:
+                break
+            new_events.append(materialize_event(event))
+        new_events.reverse()
+        return dict(first_event_id=self.queue[0]['id'] if self.queue else self.next_event_id,
+                    new_events=new_events,
+                    next_event_id=self.next_event_id,
                     virtual_events=self.virtual_events)
 
     @classmethod
@@ -260,7 +346,14 @@ class EventQueue:
         ret.virtual_events = d.get("virtual_events", {})
         return ret
 
-    def push(self, event: Dict[str, Any]) -> None:
+    def push(self, event: Union[Dict[str, Any], MessageEvent]) -> None:
+        if isinstance(event, MessageEvent):
+            # Message events are never collapsed into virtual events.
+            event.id = self.next_event_id
+            self.next_event_id += 1
+            self.queue.append(event)
+            return
+
         event['id'] = self.next_event_id
         self.next_event_id += 1
         full_event_type = compute_full_event_type(event)
@@ -286,7 +379,7 @@ class EventQueue:
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
-    def pop(self) -> Dict[str, Any]:
+    def pop(self) -> Union[Dict[str, Any], MessageEvent]:
         return self.queue.popleft()
 
     def empty(self) -> bool:
@@ -298,12 +391,18 @@ class EventQueue:
             self.pop()
 
     def contents(self) -> List[Dict[str, Any]]:
-        contents = []  # type: List[Dict[str, Any]]
+        contents = []  # type: List[Union[Dict[str, Any], MessageEvent]]
         virtual_id_map = {}  # type: Dict[str, Dict[str, Any]]
         for event_type in self.virtual_events:
             virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
         virtual_ids = sorted(list(virtual_id_map.keys()))
 
+        if virtual_ids and self.checkpointed_next_event_id is not None and \
+                virtual_ids[0] < self.checkpointed_next_event_id:
+            # This moves already logged virtual events into the middle
+            # of the queue, which a delta can't express.
+            self.checkpointed_next_event_id = None
+
         # Merge the virtual events into their final place in the queue
         index = 0
         length = len(virtual_ids)
@@ -318,7 +417,7 @@ class EventQueue:
 
         self.virtual_events = {}
         self.queue = deque(contents)
-        return contents
+        return [materialize_event(event) for event in contents]
 
 # maps queue ids to client descriptors
 clients = {}  # type: Dict[str, ClientDescriptor]
@@ -327,6 +426,28 @@ user_clients = {}  # type: Dict[int, List[ClientDescriptor]]
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
 
+# Heap of (expiry time, queue id), with one entry per queue, so that
+# gc_event_queues only needs to look at queues that may have expired.
+#
+# The expiry time in an entry is a lower bound: connecting a handler
+# only moves a queue's last_connection_time forward, so rather than
+# updating the heap on every connect/disconnect, gc_event_queues
+# reschedules entries that turn out not to have expired yet.  Entries
+# for queues deleted by other means are skipped when popped.
+queue_expiry_heap = []  # type: List[Tuple[float, str]]
+
+def schedule_queue_expiry(client: ClientDescriptor, expiry: Optional[float]=None) -> None:
+    if expiry is None:
+        expiry = client.last_connection_time + client.queue_timeout
+    heapq.heappush(queue_expiry_heap, (expiry, client.event_queue.id))
+
+# ids of queues changed (or deleted) since the last checkpoint to the
+# event queue log; only used with INCREMENTAL_EVENT_QUEUE_PERSISTENCE.
+changed_queue_ids = set()  # type: Set[str]
+
+def mark_queue_changed(queue_id: str) -> None:
+    changed_queue_ids.add(queue_id)
+
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
 # last_for_client that is true if this is the last queue pertaining
@@ -335,12 +456,16 @@ realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
 gc_hooks = []  # type: List[Callable[[int, ClientDescriptor, bool], None]]
 
 next_queue_id = 0
+# The port this Tornado process is listening on; set by setup_event_queue.
+tornado_port = 9993
 
 def clear_client_event_queues_for_testing() -> None:
     assert(settings.TEST_SUITE)
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    del queue_expiry_heap[:]
+    changed_queue_ids.clear()
     gc_hooks.clear()
     global next_queue_id
     next_queue_id = 0
@@ -364,12 +489,14 @@ def add_to_client_dicts(client: ClientDescriptor) -> None:
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
-    queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    queue_id = make_queue_id(tornado_port, next_queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    schedule_queue_expiry(client)
+    mark_queue_changed(queue_id)
     return client
 
 def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[int],
@@ -394,17 +521,34 @@ def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
+        mark_queue_changed(id)
 
 def gc_event_queues(port: int) -> None:
     start = time.time()
     to_remove = set()  # type: Set[str]
     affected_users = set()  # type: Set[int]
     affected_realms = set()  # type: Set[int]
-    for (id, client) in clients.items():
+    to_reschedule = []  # type: List[ClientDescriptor]
+    while queue_expiry_heap and queue_expiry_heap[0][0] <= start:
+        (expiry, id) = heapq.heappop(queue_expiry_heap)
+        client = clients.get(id)
+        if client is None:
+            # Already deleted, e.g. via cleanup().
+            continue
         if client.idle(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        else:
+            to_reschedule.append(client)
+
+    for client in to_reschedule:
+        expiry = client.last_connection_time + client.queue_timeout
+        if expiry <= start:
+            # The client has a handler connected right now; check
+            # again after its next heartbeat.
+            expiry = start + HEARTBEAT_MIN_FREQ_SECS
+        schedule_queue_expiry(client, expiry)
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle and thus
@@ -429,7 +573,52 @@ def persistent_queue_filename(port: int, last: bool=False) -> str:
         return "/var/tmp/event_queues.%d.last.json" % (port,)
     return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port),)
 
+def persistent_queue_log_filename(port: int) -> str:
+    return persistent_queue_filename(port) + ".log"
+
+event_queue_log = None  # type: Optional[EventQueueLog]
+
+def get_event_queue_log(port: int) -> EventQueueLog:
+    global event_queue_log
+    if event_queue_log is None:
+        event_queue_log = EventQueueLog(persistent_queue_log_filename(port))
+    return event_queue_log
+
+def checkpoint_event_queues(port: int, shutdown: bool=False) -> None:
+    start = time.time()
+    log = get_event_queue_log(port)
+
+    # Once most of the log is superseded records, write a fresh log
+    # with just the live queues instead.
+    if log.needs_compaction():
+        log.compact(dict((qid, client.to_dict()) for (qid, client) in clients.items()),
+                    shutdown=shutdown)
+        for client in clients.values():
+            client.event_queue.checkpointed_next_event_id = client.event_queue.next_event_id
+        logging.info('Tornado %d compacted event queue log with %d event queues in %.3fs'
+                     % (port, len(clients), time.time() - start))
+    else:
+        records = []  # type: List[List[Any]]
+        for qid in changed_queue_ids:
+            client = clients.get(qid)
+            if client is None:
+                records.append(["delete", qid])
+                continue
+            if client.event_queue.checkpointed_next_event_id is None:
+                records.append(["put", qid, client.to_dict()])
+            else:
+                records.append(["update", qid, client.to_delta()])
+            client.event_queue.checkpointed_next_event_id = client.event_queue.next_event_id
+        log.append(records, shutdown=shutdown)
+        logging.info('Tornado %d checkpointed %d of %d event queues in %.3fs'
+                     % (port, len(records), len(clients), time.time() - start))
+    changed_queue_ids.clear()
+
 def dump_event_queues(port: int) -> None:
+    if settings.INCREMENTAL_EVENT_QUEUE_PERSISTENCE:
+        checkpoint_event_queues(port, shutdown=True)
+        return
+
     start = time.time()
 
     with open(persistent_queue_filename(port), "w") as stored_queues:
@@ -439,29 +628,66 @@ def dump_event_queues(port: int) -> None:
     logging.info('Tornado %d dumped %d event queues in %.3fs'
                  % (port, len(clients), time.time() - start))
 
+def load_event_queues_from_log(port: int) -> bool:
+    global clients
+    log = get_event_queue_log(port)
+    try:
+        queues = log.load()
+    except Exception:
+        logging.exception("Tornado %d could not deserialize event queue log" % (port,))
+        queues = None
+
+    if queues is None:
+        log.discard()
+        return False
+
+    try:
+        clients = dict((qid, ClientDescriptor.from_dict(client))
+                       for (qid, client) in queues.items())
+    except Exception:
+        logging.exception("Tornado %d could not deserialize event queues" % (port,))
+        log.discard()
+        return False
+    for client in clients.values():
+        client.event_queue.checkpointed_next_event_id = client.event_queue.next_event_id
+    return True
+
 def load_event_queues(port: int) -> None:
     global clients
     start = time.time()
 
-    # ujson chokes on bad input pretty easily.  We separate out the actual
-    # file reading from the loading so that we don't silently fail if we get
-    # bad input.
-    try:
-        with open(persistent_queue_filename(port), "r") as stored_queues:
-            json_data = stored_queues.read()
+    if not (settings.INCREMENTAL_EVENT_QUEUE_PERSISTENCE and
+            load_event_queues_from_log(port)):
+        # ujson chokes on bad input pretty easily.  We separate out the actual
+        # file reading from the loading so that we don't silently fail if we get
+        # bad input.
         try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
-        except Exception:
-            logging.exception("Tornado %d could not deserialize event queues" % (port,))
-    except (IOError, EOFError):
-        pass
+            with open(persistent_queue_filename(port), "r") as stored_queues:
+                json_data = stored_queues.read()
+            try:
+                clients = dict((qid, ClientDescriptor.from_dict(client))
+                               for (qid, client) in ujson.loads(json_data))
+            except Exception:
+                logging.exception("Tornado %d could not deserialize event queues" % (port,))
+        except (IOError, EOFError):
+            pass
+
+        if settings.INCREMENTAL_EVENT_QUEUE_PERSISTENCE:
+            # Queues loaded from the legacy file need to be written
+            # to the log at the first checkpoint.
+            changed_queue_ids.update(clients.keys())
 
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
 
         add_to_client_dicts(client)
 
+    queue_expiry_heap[:] = [
+        (client.last_connection_time + client.queue_timeout, qid)
+        for (qid, client) in clients.items()
+    ]
+    heapq.heapify(queue_expiry_heap)
+
     logging.info('Tornado %d loaded %d event queues in %.3fs'
                  % (port, len(clients), time.time() - start))
 
@@ -474,6 +700,9 @@ def send_restart_events(immediate: bool=False) -> None:
             client.add_event(event.copy())
 
 def setup_event_queue(port: int) -> None:
+    global tornado_port
+    tornado_port = port
+
     if not settings.TEST_SUITE:
         load_event_queues(port)
         atexit.register(dump_event_queues, port)
@@ -492,6 +721,12 @@ def setup_event_queue(port: int) -> None:
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
+    if settings.INCREMENTAL_EVENT_QUEUE_PERSISTENCE and not settings.TEST_SUITE:
+        checkpoint_callback = tornado.ioloop.PeriodicCallback(
+            lambda: checkpoint_event_queues(port),
+            EVENT_QUEUE_CHECKPOINT_FREQ_MSECS, ioloop)
+        checkpoint_callback.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
@@ -523,6 +758,7 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
             client.event_queue.prune(last_event_id)
+            mark_queue_changed(queue_id)
             was_connected = client.finish_current_handler()
 
         if not client.event_queue.empty() or dont_block:
@@ -847,14 +1083,17 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
             message_dict = message_dict.copy()
             message_dict["invite_only_stream"] = True
 
-        user_event = dict(type='message', message=message_dict, flags=flags)  # type: Dict[str, Any]
+        extra = None  # type: Optional[Dict[str, Any]]
         if extra_data is not None:
-            user_event.update(extra_data)
+            extra = dict(extra_data)
 
         if is_sender:
             local_message_id = event_template.get('local_id', None)
             if local_message_id is not None:
-                user_event["local_message_id"] = local_message_id
+                extra = extra or {}
+                extra["local_message_id"] = local_message_id
+
+        user_event = MessageEvent(message_dict, flags, extra)
 
         if not client.accepts_event(user_event):
             continue
@@ -972,11 +1211,37 @@ def maybe_enqueue_notifications_for_message_update(user_profile_id: UserProfile,
         already_notified={},
     )
 
+def forward_cleanup_event_queue(port: int, queue_id: str, user_profile_id: int) -> None:
+    '''
+    Asks the Tornado process on `port`, which owns the queue, to
+    delete it.  Clients send the queue_id of DELETE /json/events in
+    the request body, which nginx can't route on, so these requests
+    reach the default Tornado process.
+    '''
+    def send_http(notice: Mapping[str, Any]) -> None:
+        requests_client.post('http://127.0.0.1:%d/notify_tornado' % (port,), data=dict(
+            data   = ujson.dumps(notice),
+            secret = settings.SHARED_SECRET))
+
+    queue_json_publish(notify_tornado_queue_name(port),
+                       dict(event=dict(type='cleanup_queue', queue_id=queue_id),
+                            users=[user_profile_id]),
+                       send_http)
+
+def cleanup_forwarded_event_queue(queue_id: str, user_profile_id: int) -> None:
+    client = get_client_descriptor(queue_id)
+    if client is None or client.user_profile_id != user_profile_id:
+        logging.info("Ignoring forwarded cleanup of event queue %s" % (queue_id,))
+        return
+    client.cleanup()
+
 def process_notification(notice: Mapping[str, Any]) -> None:
     event = notice['event']  # type: Mapping[str, Any]
     users = notice['users']  # type: Union[List[int], List[Mapping[str, Any]]]
     start_time = time.time()
-    if event['type'] == "message":
+    if event['type'] == "cleanup_queue":
+        cleanup_forwarded_event_queue(event['queue_id'], cast(List[int], users)[0])
+    elif event['type'] == "message":
         process_message_event(event, cast(Iterable[Mapping[str, Any]], users))
     elif event['type'] == "update_message":
         process_message_update_event(event, cast(Iterable[Mapping[str, Any]], users))
@@ -0,0 +1,126 @@
+import logging
+import os
+from typing import Any, Dict, IO, Iterable, List, Mapping, Optional
+
+import ujson
+
+# Incremental persistence for Tornado's event queues.
+#
+# Rather than serializing every event queue into one JSON file at
+# shutdown (which blocks Tornado for many seconds on a server with
+# tens of thousands of queues), we keep an append-only log with one
+# JSON record per line:
+#
+#   ["put", queue_id, client_descriptor_dict]
+#   ["update", queue_id, client_descriptor_delta]
+#   ["delete", queue_id]
+#   ["shutdown"]
+#
+# While running, Tornado periodically appends records for just the
+# queues that changed since the last checkpoint.  A queue already in
+# the log gets an "update" record (see ClientDescriptor.to_delta)
+# with only the events added since its last record, where its queue
+# now starts, and its small remaining state, so that a checkpoint
+# costs about as much as the events that arrived since the previous
+# one, and shutdown only needs to write the last few seconds of
+# changes.  Replaying the log in order reconstructs the queues.  The
+# log is only trusted if it ends with a "shutdown" record, since
+# otherwise (e.g. after a crash) it is missing the most recent
+# events; this matches the legacy behavior of discarding the queues
+# file once it has been loaded.
+#
+# When the log grows to several times the size it had after it was
+# last written from scratch, it is compacted by writing a fresh log
+# containing one "put" per queue.
+
+# The log is compacted once it is larger than this many times its
+# size after the last compaction, plus COMPACTION_MIN_BYTES.
+COMPACTION_FACTOR = 3
+COMPACTION_MIN_BYTES = 16 * 1024 * 1024
+
+class EventQueueLog:
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.size = 0
+        self.compacted_size = 0
+
+    def load(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        '''
+        Returns the queues recorded in the log, or None if there is no
+        log or it wasn't written by a clean shutdown.  On success, the
+        shutdown record is removed, so that later checkpoints can keep
+        appending to the log.
+        '''
+        try:
+            with open(self.filename, "rb") as log_file:
+                data = log_file.read()
+        except (IOError, EOFError):
+            return None
+
+        lines = data.splitlines()
+        if not lines or ujson.loads(lines[-1]) != ["shutdown"]:
+            logging.warning("Event queue log %s was not cleanly shut down; ignoring it"
+                            % (self.filename,))
+            return None
+
+        queues = {}  # type: Dict[str, Dict[str, Any]]
+        for line in lines[:-1]:
+            record = ujson.loads(line)
+            if record[0] == "put":
+                queues[record[1]] = record[2]
+            elif record[0] == "update":
+                apply_update(queues[record[1]], record[2])
+            elif record[0] == "delete":
+                queues.pop(record[1], None)
+
+        self.size = len(data) - len(data.splitlines(True)[-1])
+        with open(self.filename, "r+b") as log_file:
+            log_file.truncate(self.size)
+        self.compacted_size = self.size
+        return queues
+
+    def needs_compaction(self) -> bool:
+        return self.size > COMPACTION_FACTOR * self.compacted_size + COMPACTION_MIN_BYTES
+
+    def append(self, records: Iterable[List[Any]], shutdown: bool=False) -> None:
+        with open(self.filename, "a") as log_file:
+            self.size += write_records(log_file, records, shutdown)
+
+    def compact(self, queues: Mapping[str, Dict[str, Any]], shutdown: bool=False) -> None:
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as log_file:
+            self.size = write_records(log_file, (["put", queue_id, client_dict]
+                                                 for (queue_id, client_dict) in queues.items()),
+                                      shutdown)
+        os.rename(tmp_filename, self.filename)
+        self.compacted_size = self.size
+
+    def discard(self) -> None:
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+        self.size = 0
+        self.compacted_size = 0
+
+def write_records(log_file: IO[str], records: Iterable[List[Any]], shutdown: bool) -> int:
+    """Writes the records, returning the number of bytes written."""
+    size = 0
+    for record in records:
+        line = ujson.dumps(record) + "\n"
+        log_file.write(line)
+        size += len(line)
+    if shutdown:
+        log_file.write(ujson.dumps(["shutdown"]) + "\n")
+    return size
+
+def apply_update(client_dict: Dict[str, Any], delta: Dict[str, Any]) -> None:
+    """Applies an "update" record (see ClientDescriptor.to_delta) to
+    the client_dict of the queue's previous records."""
+    client_dict['last_connection_time'] = delta['last_connection_time']
+    queue = client_dict['event_queue']
+    queue_delta = delta['event_queue']
+    queue['queue'] = [event for event in queue['queue']
+                      if event['id'] >= queue_delta['first_event_id']] + queue_delta['new_events']
+    queue['next_event_id'] = queue_delta['next_event_id']
+    queue['virtual_events'] = queue_delta['virtual_events']
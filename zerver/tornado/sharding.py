@@ -1,13 +1,22 @@
+import re
+from typing import Optional
+
 from django.conf import settings
 
 from zerver.models import Realm
 
+# When running multiple Tornado processes, they listen on consecutive
+# ports starting here (see puppet/zulip/manifests/app_frontend_base.pp).
+TORNADO_SHARD_BASE_PORT = 9800
+
 def get_tornado_port(realm: Realm) -> int:
     if settings.TORNADO_SERVER is None:
         return 9993
     if settings.TORNADO_PROCESSES == 1:
         return int(settings.TORNADO_SERVER.split(":")[-1])
-    return 9993
+    # Every realm lives on exactly one Tornado process, so that all of
+    # its event queues and the events for them end up in one place.
+    return TORNADO_SHARD_BASE_PORT + realm.id % settings.TORNADO_PROCESSES
 
 def get_tornado_uri(realm: Realm) -> str:
     if settings.TORNADO_PROCESSES == 1:
@@ -16,6 +25,23 @@ def get_tornado_uri(realm: Realm) -> str:
     port = get_tornado_port(realm)
     return "http://127.0.0.1:%d" % (port,)
 
+def make_queue_id(port: int, queue_number: int) -> str:
+    '''
+    With multiple Tornado processes, event queue ids include the port
+    of the process that owns the queue, so that nginx can route a
+    client's get_events requests to the right process based on the
+    queue_id parameter alone.
+    '''
+    if settings.TORNADO_PROCESSES == 1:
+        return "%s:%d" % (settings.SERVER_GENERATION, queue_number)
+    return "%s:%d:%d" % (settings.SERVER_GENERATION, port, queue_number)
+
+def get_tornado_port_for_queue_id(queue_id: str) -> Optional[int]:
+    m = re.match(r'^\d+:(\d+):\d+$', queue_id)
+    if m is None:
+        return None
+    return int(m.group(1))
+
 def notify_tornado_queue_name(port: int) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return "notify_tornado"
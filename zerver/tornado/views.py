@@ -3,6 +3,7 @@ import time
 from typing import Iterable, List, Optional, Sequence, Union
 
 import ujson
+from django.conf import settings
 from django.core.handlers.base import BaseHandler
 from django.http import HttpRequest, HttpResponse
 from django.utils.translation import ugettext as _
@@ -13,9 +14,11 @@ from zerver.decorator import REQ, RespondAsynchronously, \
 from zerver.lib.response import json_error, json_success
 from zerver.lib.validator import check_bool, check_list, check_string
 from zerver.models import Client, UserProfile, get_client, get_user_profile_by_id
-from zerver.tornado.event_queue import fetch_events, \
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import fetch_events, forward_cleanup_event_queue, \
     get_client_descriptor, process_notification
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.sharding import get_tornado_port, get_tornado_port_for_queue_id
 
 @internal_notify_view(True)
 def notify(request: HttpRequest) -> HttpResponse:
@@ -27,7 +30,14 @@ def cleanup_event_queue(request: HttpRequest, user_profile: UserProfile,
                         queue_id: str=REQ()) -> HttpResponse:
     client = get_client_descriptor(str(queue_id))
     if client is None:
-        raise BadEventQueueIdError(queue_id)
+        port = get_tornado_port_for_queue_id(str(queue_id))
+        if port is None or port == event_queue.tornado_port:
+            raise BadEventQueueIdError(queue_id)
+        # The queue lives in another Tornado process; we check there
+        # that it exists and belongs to this user.
+        forward_cleanup_event_queue(port, str(queue_id), user_profile.id)
+        request._log_data['extra'] = "[%s forwarded]" % (queue_id,)
+        return json_success()
     if user_profile.id != client.user_profile_id:
         return json_error(_("You are not authorized to access this queue"))
     request._log_data['extra'] = "[%s]" % (queue_id,)
@@ -81,6 +91,13 @@ def get_events_backend(request: HttpRequest, user_profile: UserProfile, handler:
         handler_id = handler.handler_id)
 
     if queue_id is None:
+        if (settings.TORNADO_PROCESSES > 1 and
+                get_tornado_port(user_profile.realm) != event_queue.tornado_port):
+            # nginx routes requests without a queue_id to the first
+            # Tornado process, but a queue must live in the process
+            # its realm is sharded to, or it won't receive any events.
+            # /register creates the queue in the right process.
+            return json_error(_("Create an event queue with /register first."))
         events_query['new_queue_data'] = dict(
             user_profile_id = user_profile.id,
             realm_id = user_profile.realm_id,
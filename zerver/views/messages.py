@@ -4,8 +4,8 @@ from django.conf import settings
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.db import connection
-from django.http import HttpRequest, HttpResponse
-from typing import Dict, List, Set, Any, Callable, Iterable, \
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from typing import Dict, List, Set, Any, Callable, Iterable, Iterator, \
     Optional, Tuple, Union, Sequence
 from zerver.lib.exceptions import JsonableError, ErrorCode
 from zerver.lib.html_diff import highlight_html_differences
@@ -21,14 +21,15 @@ from zerver.lib.actions import recipient_for_emails, do_update_message_flags, \
     do_mark_all_as_read, do_mark_stream_messages_as_read, \
     get_user_info_for_message_updates, check_schedule_message
 from zerver.lib.addressee import raw_pm_with_emails
+from zerver.lib.cache import cache_delete, cache_get, cache_set
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.message import (
     access_message,
-    messages_for_ids,
+    messages_for_ids_json,
     render_markdown,
     get_first_visible_message_id,
 )
-from zerver.lib.response import json_success, json_error
+from zerver.lib.response import json_success, json_error, json_success_with_fragments
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import access_stream_by_id, can_access_stream_history_by_name
 from zerver.lib.timestamp import datetime_to_timestamp, convert_to_UTC
@@ -43,7 +44,7 @@ from zerver.lib.topic import (
     REQ_topic,
 )
 from zerver.lib.topic_mutes import exclude_topic_mutes
-from zerver.lib.utils import statsd
+from zerver.lib.utils import format_timedelta, make_safe_digest, statsd, timedelta_ms
 from zerver.lib.validator import \
     check_list, check_int, check_dict, check_string, check_bool
 from zerver.lib.zephyr import compute_mit_user_fullname
@@ -58,11 +59,14 @@ from sqlalchemy.sql import select, join, column, literal_column, literal, and_,
 
 from dateutil.parser import parse as dateparser
 import re
+import time
 import ujson
 import datetime
 
 LARGER_THAN_MAX_MESSAGE_ID = 10000000000000000
 MAX_MESSAGES_PER_FETCH = 5000
+MESSAGES_PER_EXPORT_BATCH = 1000
+SEARCH_RESULTS_CACHE_PREFETCH = 1000
 
 class BadNarrowOperator(JsonableError):
     code = ErrorCode.BAD_NARROW
@@ -377,28 +381,13 @@ class NarrowBuilder:
 
     def _by_search_pgroonga(self, query: Query, operand: str,
                             maybe_negate: ConditionTransform) -> Query:
-        match_positions_character = func.pgroonga_match_positions_character
-        query_extract_keywords = func.pgroonga_query_extract_keywords
         operand_escaped = func.escape_html(operand)
-        keywords = query_extract_keywords(operand_escaped)
-        query = query.column(match_positions_character(column("rendered_content"),
-                                                       keywords).label("content_matches"))
-        query = query.column(match_positions_character(func.escape_html(topic_column_sa()),
-                                                       keywords).label("topic_matches"))
         condition = column("search_pgroonga").op("&@~")(operand_escaped)
         return query.where(maybe_negate(condition))
 
     def _by_search_tsearch(self, query: Query, operand: str,
                            maybe_negate: ConditionTransform) -> Query:
         tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
-        ts_locs_array = func.ts_match_locs_array
-        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
-                                           column("rendered_content"),
-                                           tsquery).label("content_matches"))
-        # We HTML-escape the topic in Postgres to avoid doing a server round-trip
-        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
-                                           func.escape_html(topic_column_sa()),
-                                           tsquery).label("topic_matches"))
 
         # Do quoted string matching.  We really want phrase
         # search here so we can ignore punctuation and do
@@ -415,6 +404,34 @@ class NarrowBuilder:
         cond = column("search_tsvector").op("@@")(tsquery)
         return query.where(maybe_negate(cond))
 
+def add_search_match_columns(query: Query, operand: str) -> Query:
+    '''
+    Adds the content_matches and topic_matches columns, the positions
+    of the search's matches in rendered_content and the topic, which
+    get_search_fields uses to highlight them.  These are expensive, so
+    we only compute them for the messages we're returning; see
+    get_search_fields_for_ids.
+    '''
+    if settings.USING_PGROONGA:
+        match_positions_character = func.pgroonga_match_positions_character
+        query_extract_keywords = func.pgroonga_query_extract_keywords
+        keywords = query_extract_keywords(func.escape_html(operand))
+        query = query.column(match_positions_character(column("rendered_content"),
+                                                       keywords).label("content_matches"))
+        query = query.column(match_positions_character(func.escape_html(topic_column_sa()),
+                                                       keywords).label("topic_matches"))
+    else:
+        tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
+        ts_locs_array = func.ts_match_locs_array
+        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
+                                           column("rendered_content"),
+                                           tsquery).label("content_matches"))
+        # We HTML-escape the topic in Postgres to avoid doing a server round-trip
+        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
+                                           func.escape_html(topic_column_sa()),
+                                           tsquery).label("topic_matches"))
+    return query
+
 # The offsets we get from PGroonga are counted in characters
 # whereas the offsets from tsearch_extras are in bytes, so we
 # have to account for both cases in the logic below.
@@ -474,6 +491,36 @@ def get_search_fields(rendered_content: str, topic_name: str, content_matches: I
         MATCH_TOPIC: highlight_string(escape_html(topic_name), topic_matches),
     }
 
+def get_search_fields_for_ids(message_ids: List[int], operand: str,
+                              narrow: Optional[List[Dict[str, Any]]]) -> Dict[int, Dict[str, str]]:
+    '''
+    Highlights the search's matches in the given messages; messages
+    that no longer exist are left out.
+    '''
+    if not message_ids:
+        return {}
+
+    query = select([column("id").label("message_id"), topic_column_sa(), column("rendered_content")],
+                   column("id").in_(message_ids),
+                   table("zerver_message"))
+    query = add_search_match_columns(query, operand)
+    # This is a hack to tag the query we use for testing
+    query = query.prefix_with("/* search_fields */")
+
+    sa_conn = get_sqlalchemy_connection()
+    search_fields = dict()  # type: Dict[int, Dict[str, str]]
+    for row in sa_conn.execute(query).fetchall():
+        message_id = row['message_id']
+        try:
+            search_fields[message_id] = get_search_fields(row['rendered_content'], row[DB_TOPIC_NAME],
+                                                          row['content_matches'], row['topic_matches'])
+        except UnicodeDecodeError as err:  # nocoverage
+            # No coverage for this block since it should be
+            # impossible, and we plan to remove it once we've
+            # debugged the case that makes it happen.
+            raise Exception(str(err), message_id, narrow)
+    return search_fields
+
 def narrow_parameter(json: str) -> Optional[List[Dict[str, Any]]]:
 
     data = ujson.loads(json)
@@ -607,6 +654,17 @@ def get_base_query_for_search(user_profile: UserProfile,
         inner_msg_id_col = literal_column("zerver_message.id")
         return (query, inner_msg_id_col)
 
+def get_search_operand(narrow: Optional[Iterable[Dict[str, Any]]]) -> Optional[str]:
+    '''
+    We combine all the search operands in a narrow into a single search.
+    '''
+    if narrow is None:
+        return None
+    search_operands = [term['operand'] for term in narrow if term['operator'] == 'search']
+    if not search_operands:
+        return None
+    return ' '.join(search_operands)
+
 def add_narrow_conditions(user_profile: UserProfile,
                           inner_msg_id_col: ColumnElement,
                           query: Query,
@@ -618,23 +676,20 @@ def add_narrow_conditions(user_profile: UserProfile,
 
     # Build the query for the narrow
     builder = NarrowBuilder(user_profile, inner_msg_id_col)
-    search_operands = []
 
     # As we loop through terms, builder does most of the work to extend
     # our query, but we need to collect the search operands and handle
     # them after the loop.
     for term in narrow:
-        if term['operator'] == 'search':
-            search_operands.append(term['operand'])
-        else:
+        if term['operator'] != 'search':
             query = builder.add_term(query, term)
 
-    if search_operands:
+    search_operand = get_search_operand(narrow)
+    if search_operand is not None:
         is_search = True
-        query = query.column(topic_column_sa()).column(column("rendered_content"))
         search_term = dict(
             operator='search',
-            operand=' '.join(search_operands)
+            operand=search_operand,
         )
         query = builder.add_term(query, search_term)
 
@@ -704,21 +759,9 @@ def zcommand_backend(request: HttpRequest, user_profile: UserProfile,
                      command: str=REQ('command')) -> HttpResponse:
     return json_success(process_zcommands(command, user_profile))
 
-@has_request_variables
-def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
-                         anchor: int=REQ(converter=int, default=None),
-                         num_before: int=REQ(converter=to_non_negative_int),
-                         num_after: int=REQ(converter=to_non_negative_int),
-                         narrow: Optional[List[Dict[str, Any]]]=REQ('narrow', converter=narrow_parameter,
-                                                                    default=None),
-                         use_first_unread_anchor: bool=REQ(validator=check_bool, default=False),
-                         client_gravatar: bool=REQ(validator=check_bool, default=False),
-                         apply_markdown: bool=REQ(validator=check_bool, default=True)) -> HttpResponse:
-    if anchor is None and not use_first_unread_anchor:
-        return json_error(_("Missing 'anchor' argument (or set 'use_first_unread_anchor'=True)."))
-    if num_before + num_after > MAX_MESSAGES_PER_FETCH:
-        return json_error(_("Too many messages requested (maximum %s)."
-                            % (MAX_MESSAGES_PER_FETCH,)))
+def get_narrow_query(request: HttpRequest,
+                     user_profile: UserProfile,
+                     narrow: Optional[List[Dict[str, Any]]]) -> Tuple[Query, ColumnElement, bool, bool]:
     include_history = ok_to_include_history(narrow, user_profile)
 
     if include_history:
@@ -762,6 +805,227 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
                 verbose_operators.append(term['operator'])
         request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
 
+    return (query, inner_msg_id_col, include_history, is_search)
+
+def get_flags_and_search_fields(rows: List[Any],
+                                user_profile: UserProfile,
+                                include_history: bool,
+                                is_search: bool,
+                                narrow: Optional[List[Dict[str, Any]]]
+                                ) -> Tuple[List[int], Dict[int, List[str]], Dict[int, Dict[str, str]]]:
+    # The following is a little messy, but ensures that the code paths
+    # are similar regardless of the value of include_history.  The
+    # 'user_messages' dictionary maps each message to the user's
+    # UserMessage object for that message, which we will attach to the
+    # rendered message dict before returning it.  We attempt to
+    # bulk-fetch rendered message dicts from remote cache using the
+    # 'messages' list.
+    message_ids = []  # type: List[int]
+    user_message_flags = {}  # type: Dict[int, List[str]]
+    if include_history:
+        message_ids = [row[0] for row in rows]
+
+        # TODO: This could be done with an outer join instead of two queries
+        um_rows = UserMessage.objects.filter(user_profile=user_profile,
+                                             message__id__in=message_ids)
+        user_message_flags = {um.message_id: um.flags_list() for um in um_rows}
+
+        for message_id in message_ids:
+            if message_id not in user_message_flags:
+                user_message_flags[message_id] = ["read", "historical"]
+    else:
+        for row in rows:
+            message_id = row[0]
+            flags = row[1]
+            user_message_flags[message_id] = UserMessage.flags_list_for_flags(flags)
+            message_ids.append(message_id)
+
+    search_fields = dict()  # type: Dict[int, Dict[str, str]]
+    if is_search:
+        search_operand = get_search_operand(narrow)
+        assert search_operand is not None
+        search_fields = get_search_fields_for_ids(message_ids, search_operand, narrow)
+        # Messages may have been deleted since we found them.
+        message_ids = [message_id for message_id in message_ids if message_id in search_fields]
+
+    return (message_ids, user_message_flags, search_fields)
+
+def search_results_cache_key(user_profile: UserProfile, narrow: List[Dict[str, Any]]) -> str:
+    terms = sorted(ujson.dumps(term, sort_keys=True) for term in narrow
+                   if term['operator'] != 'search')
+    narrow_digest = make_safe_digest(ujson.dumps([terms, get_search_operand(narrow)]))
+    return 'search_results:%s:%s' % (user_profile.id, narrow_digest)
+
+def search_results_cover_range(ids: List[int], low: int, high: int,
+                               before: Optional[Tuple[Optional[int], int]],
+                               after: Optional[Tuple[Optional[int], int]],
+                               anchor: int) -> bool:
+    '''
+    Whether cached search results can answer a request for the range
+    described by get_range_limits.  `ids` must contain every message
+    matching the search with low <= id <= high; low == 0 means there
+    are no older matches, and high == LARGER_THAN_MAX_MESSAGE_ID that
+    there are no newer ones.  The latter can't stay true while new
+    messages arrive, so we don't cache it, and requests for the newest
+    results always go to the database.
+    '''
+    if before is None and after is None:
+        return low <= anchor <= high
+    if before is not None:
+        before_anchor = before[0] if before[0] is not None else LARGER_THAN_MAX_MESSAGE_ID
+        if before_anchor > high:
+            return False
+        if low > 0 and len([i for i in ids if i <= before_anchor]) < before[1]:
+            return False
+    if after is not None:
+        after_anchor = after[0] or 0
+        if after_anchor < low:
+            return False
+        if (high < LARGER_THAN_MAX_MESSAGE_ID and
+                len([i for i in ids if i >= after_anchor]) < after[1]):
+            return False
+    return True
+
+def get_search_result_rows(sa_conn: Any,
+                           query: Query,
+                           inner_msg_id_col: ColumnElement,
+                           user_profile: UserProfile,
+                           narrow: List[Dict[str, Any]],
+                           num_before: int,
+                           num_after: int,
+                           anchor: int,
+                           anchored_to_left: bool,
+                           anchored_to_right: bool,
+                           first_visible_message_id: int) -> Tuple[List[Any], bool]:
+    '''
+    Returns the rows for a page of search results, and whether they
+    came from the search results cache.
+
+    Full-text search queries are expensive, and users typically page
+    through the results of a search, so we fetch up to
+    SEARCH_RESULTS_CACHE_PREFETCH results on each side of the anchor,
+    and cache their ids for settings.SEARCH_RESULTS_CACHE_SECONDS, so
+    that the next few pages can be sliced out of the cache.  A page
+    from the cache is checked by running the narrow's query for just
+    its ids; if any of them no longer match (e.g. the message was
+    moved, edited or deleted, or the user lost access to it), we drop
+    the cached results and search again.
+    '''
+    range_args = dict(
+        anchor=anchor,
+        anchored_to_left=anchored_to_left,
+        anchored_to_right=anchored_to_right,
+        first_visible_message_id=first_visible_message_id,
+    )  # type: Dict[str, Any]
+    before, after = get_range_limits(num_before=num_before, num_after=num_after, **range_args)
+
+    key = search_results_cache_key(user_profile, narrow)
+    cached = cache_get(key)
+    if cached is not None:
+        ids, low, high = cached[0]
+        if search_results_cover_range(ids, low, high, before, after, anchor):
+            page_ids = [row[0] for row in limit_rows_to_range(
+                [(message_id,) for message_id in ids],
+                num_before=num_before, num_after=num_after, **range_args)]
+            checked_query = query.where(inner_msg_id_col.in_(page_ids)).order_by(
+                inner_msg_id_col.asc())
+            # This is a hack to tag the query we use for testing
+            checked_query = checked_query.prefix_with("/* search_results_check */")
+            rows = list(sa_conn.execute(checked_query).fetchall())
+            if len(rows) == len(page_ids):
+                return (rows, True)
+            cache_delete(key)
+
+    def fetch_rows(num_before: int, num_after: Optional[int]) -> List[Any]:
+        limited_query = limit_query_to_range(
+            query=query,
+            num_before=num_before,
+            num_after=num_after,
+            id_col=inner_msg_id_col,
+            **range_args
+        )
+        main_query = alias(limited_query)
+        limited_query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+        # This is a hack to tag the query we use for testing
+        limited_query = limited_query.prefix_with("/* get_messages */")
+        return list(sa_conn.execute(limited_query).fetchall())
+
+    prefetch_before = max(num_before, SEARCH_RESULTS_CACHE_PREFETCH)
+    prefetch_after = None  # type: Optional[int]
+    if not anchored_to_right:
+        prefetch_after = max(num_after, SEARCH_RESULTS_CACHE_PREFETCH)
+    rows = fetch_rows(prefetch_before, prefetch_after)
+    ids = [row[0] for row in rows]
+
+    # Work out the range [low, high] in which we've fetched every
+    # matching message; high is LARGER_THAN_MAX_MESSAGE_ID if we've
+    # fetched all of the newest ones.
+    prefetch_before_range, prefetch_after_range = get_range_limits(
+        num_before=prefetch_before, num_after=prefetch_after, **range_args)
+    if prefetch_before_range is not None:
+        before_anchor, before_limit = prefetch_before_range
+        before_ids = [i for i in ids if before_anchor is None or i <= before_anchor]
+        low = before_ids[0] if len(before_ids) >= before_limit else 0
+        if (prefetch_after_range is not None and before_anchor is not None and
+                prefetch_after_range[0] != before_anchor + 1):
+            # The after query was bumped up to first_visible_message_id,
+            # so there's a gap between the two sides.
+            low = prefetch_after_range[0]
+    else:
+        assert prefetch_after_range is not None
+        low = prefetch_after_range[0] or 0
+    high = LARGER_THAN_MAX_MESSAGE_ID
+    if prefetch_after_range is not None:
+        after_anchor, after_limit = prefetch_after_range
+        if len([i for i in ids if i >= (after_anchor or 0)]) >= after_limit:
+            high = ids[-1]
+
+    rows = [row for row in rows if row[0] >= low]
+    ids = [row[0] for row in rows]
+    if ids:
+        cache_set(key, (ids, low, ids[-1]), timeout=settings.SEARCH_RESULTS_CACHE_SECONDS)
+
+    if not search_results_cover_range(ids, low, high, before, after, anchor):
+        # Only possible in corner cases involving first_visible_message_id.
+        return (fetch_rows(num_before, num_after), False)
+    return (limit_rows_to_range(rows, num_before=num_before, num_after=num_after, **range_args),
+            False)
+
+def log_search_timings(request: HttpRequest, timings: List[Tuple[str, float]],
+                       from_cache: bool) -> None:
+    '''
+    Adds the time spent in each phase of a search (finding the matching
+    messages, highlighting the matches along with fetching the flags,
+    and fetching the messages) to the request's log line and statsd.
+    '''
+    for name, delay in timings:
+        statsd.timing("search.%s" % (name,), timedelta_ms(delay))
+    breakdown = ' '.join('%s=%s' % (name, format_timedelta(delay)) for name, delay in timings)
+    if from_cache:
+        breakdown += ' (cached)'
+    request._log_data['extra'] += ' ' + breakdown
+
+@has_request_variables
+def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
+                         anchor: int=REQ(converter=int, default=None),
+                         num_before: int=REQ(converter=to_non_negative_int),
+                         num_after: int=REQ(converter=to_non_negative_int),
+                         narrow: Optional[List[Dict[str, Any]]]=REQ('narrow', converter=narrow_parameter,
+                                                                    default=None),
+                         use_first_unread_anchor: bool=REQ(validator=check_bool, default=False),
+                         client_gravatar: bool=REQ(validator=check_bool, default=False),
+                         apply_markdown: bool=REQ(validator=check_bool, default=True)) -> HttpResponse:
+    if anchor is None and not use_first_unread_anchor:
+        return json_error(_("Missing 'anchor' argument (or set 'use_first_unread_anchor'=True)."))
+    if num_before + num_after > MAX_MESSAGES_PER_FETCH:
+        return json_error(_("Too many messages requested (maximum %s)."
+                            % (MAX_MESSAGES_PER_FETCH,)))
+    query, inner_msg_id_col, include_history, is_search = get_narrow_query(
+        request=request,
+        user_profile=user_profile,
+        narrow=narrow,
+    )
+
     sa_conn = get_sqlalchemy_connection()
 
     if use_first_unread_anchor:
@@ -780,22 +1044,40 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         num_after = None
 
     first_visible_message_id = get_first_visible_message_id(user_profile.realm)
-    query = limit_query_to_range(
-        query=query,
-        num_before=num_before,
-        num_after=num_after,
-        anchor=anchor,
-        anchored_to_left=anchored_to_left,
-        anchored_to_right=anchored_to_right,
-        id_col=inner_msg_id_col,
-        first_visible_message_id=first_visible_message_id,
-    )
+    start = time.time()
+    from_cache = False
+    if is_search and settings.SEARCH_RESULTS_CACHE_SECONDS > 0:
+        rows, from_cache = get_search_result_rows(
+            sa_conn=sa_conn,
+            query=query,
+            inner_msg_id_col=inner_msg_id_col,
+            user_profile=user_profile,
+            narrow=narrow,
+            num_before=num_before,
+            num_after=num_after,
+            anchor=anchor,
+            anchored_to_left=anchored_to_left,
+            anchored_to_right=anchored_to_right,
+            first_visible_message_id=first_visible_message_id,
+        )
+    else:
+        query = limit_query_to_range(
+            query=query,
+            num_before=num_before,
+            num_after=num_after,
+            anchor=anchor,
+            anchored_to_left=anchored_to_left,
+            anchored_to_right=anchored_to_right,
+            id_col=inner_msg_id_col,
+            first_visible_message_id=first_visible_message_id,
+        )
 
-    main_query = alias(query)
-    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
-    # This is a hack to tag the query we use for testing
-    query = query.prefix_with("/* get_messages */")
-    rows = list(sa_conn.execute(query).fetchall())
+        main_query = alias(query)
+        query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+        # This is a hack to tag the query we use for testing
+        query = query.prefix_with("/* get_messages */")
+        rows = list(sa_conn.execute(query).fetchall())
+    match_time = time.time() - start
 
     query_info = post_process_limited_query(
         rows=rows,
@@ -808,50 +1090,18 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
     )
 
     rows = query_info['rows']
+    start = time.time()
+    message_ids, user_message_flags, search_fields = get_flags_and_search_fields(
+        rows=rows,
+        user_profile=user_profile,
+        include_history=include_history,
+        is_search=is_search,
+        narrow=narrow,
+    )
+    highlight_time = time.time() - start
 
-    # The following is a little messy, but ensures that the code paths
-    # are similar regardless of the value of include_history.  The
-    # 'user_messages' dictionary maps each message to the user's
-    # UserMessage object for that message, which we will attach to the
-    # rendered message dict before returning it.  We attempt to
-    # bulk-fetch rendered message dicts from remote cache using the
-    # 'messages' list.
-    message_ids = []  # type: List[int]
-    user_message_flags = {}  # type: Dict[int, List[str]]
-    if include_history:
-        message_ids = [row[0] for row in rows]
-
-        # TODO: This could be done with an outer join instead of two queries
-        um_rows = UserMessage.objects.filter(user_profile=user_profile,
-                                             message__id__in=message_ids)
-        user_message_flags = {um.message_id: um.flags_list() for um in um_rows}
-
-        for message_id in message_ids:
-            if message_id not in user_message_flags:
-                user_message_flags[message_id] = ["read", "historical"]
-    else:
-        for row in rows:
-            message_id = row[0]
-            flags = row[1]
-            user_message_flags[message_id] = UserMessage.flags_list_for_flags(flags)
-            message_ids.append(message_id)
-
-    search_fields = dict()  # type: Dict[int, Dict[str, str]]
-    if is_search:
-        for row in rows:
-            message_id = row[0]
-            (topic_name, rendered_content, content_matches, topic_matches) = row[-4:]
-
-            try:
-                search_fields[message_id] = get_search_fields(rendered_content, topic_name,
-                                                              content_matches, topic_matches)
-            except UnicodeDecodeError as err:  # nocoverage
-                # No coverage for this block since it should be
-                # impossible, and we plan to remove it once we've
-                # debugged the case that makes it happen.
-                raise Exception(str(err), message_id, narrow)
-
-    message_list = messages_for_ids(
+    start = time.time()
+    message_list = messages_for_ids_json(
         message_ids=message_ids,
         user_message_flags=user_message_flags,
         search_fields=search_fields,
@@ -859,32 +1109,101 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         client_gravatar=client_gravatar,
         allow_edit_history=user_profile.realm.allow_edit_history,
     )
+    hydrate_time = time.time() - start
+
+    if is_search:
+        log_search_timings(request, [('match', match_time),
+                                     ('highlight', highlight_time),
+                                     ('hydrate', hydrate_time)], from_cache)
 
     statsd.incr('loaded_old_messages', len(message_list))
 
     ret = dict(
-        messages=message_list,
-        result='success',
-        msg='',
         found_anchor=query_info['found_anchor'],
         found_oldest=query_info['found_oldest'],
         found_newest=query_info['found_newest'],
         history_limited=query_info['history_limited'],
         anchor=anchor,
     )
-    return json_success(ret)
+    return json_success_with_fragments(ret, 'messages', message_list)
 
-def limit_query_to_range(query: Query,
-                         num_before: int,
-                         num_after: int,
-                         anchor: int,
-                         anchored_to_left: bool,
-                         anchored_to_right: bool,
-                         id_col: ColumnElement,
-                         first_visible_message_id: int) -> Query:
+@has_request_variables
+def export_messages_backend(request: HttpRequest, user_profile: UserProfile,
+                            after_id: int=REQ(converter=to_non_negative_int, default=0),
+                            narrow: Optional[List[Dict[str, Any]]]=REQ('narrow', converter=narrow_parameter,
+                                                                       default=None),
+                            client_gravatar: bool=REQ(validator=check_bool, default=False),
+                            apply_markdown: bool=REQ(validator=check_bool, default=True)) -> HttpResponse:
     '''
-    This code is actually generic enough that we could move it to a
-    library, but our only caller for now is message search.
+    Streams every message matching the narrow with id > after_id, as
+    newline-delimited JSON in increasing id order, for clients (e.g.
+    compliance tooling) that need a whole narrow rather than a page
+    of it.  If the download is interrupted, it can be resumed by
+    passing the last id received as after_id.
+
+    The narrow query is built once, with the same access rules as
+    get_messages_backend, and then run repeatedly with keyset
+    pagination on the message id (id > last id seen, ORDER BY id,
+    LIMIT MESSAGES_PER_EXPORT_BATCH), so memory use doesn't depend
+    on the size of the result.
+    '''
+    query, inner_msg_id_col, include_history, is_search = get_narrow_query(
+        request=request,
+        user_profile=user_profile,
+        narrow=narrow,
+    )
+
+    first_visible_message_id = get_first_visible_message_id(user_profile.realm)
+    after_id = max(after_id, first_visible_message_id - 1)
+    allow_edit_history = user_profile.realm.allow_edit_history
+
+    def export_batches() -> Iterator[str]:
+        sa_conn = get_sqlalchemy_connection()
+        last_id = after_id
+        while True:
+            batch_query = query.where(inner_msg_id_col > last_id)
+            batch_query = batch_query.order_by(inner_msg_id_col.asc()).limit(MESSAGES_PER_EXPORT_BATCH)
+            # This is a hack to tag the query we use for testing
+            batch_query = batch_query.prefix_with("/* export_messages */")
+            rows = list(sa_conn.execute(batch_query).fetchall())
+            if not rows:
+                return
+
+            message_ids, user_message_flags, search_fields = get_flags_and_search_fields(
+                rows=rows,
+                user_profile=user_profile,
+                include_history=include_history,
+                is_search=is_search,
+                narrow=narrow,
+            )
+            message_list = messages_for_ids_json(
+                message_ids=message_ids,
+                user_message_flags=user_message_flags,
+                search_fields=search_fields,
+                apply_markdown=apply_markdown,
+                client_gravatar=client_gravatar,
+                allow_edit_history=allow_edit_history,
+            )
+            statsd.incr('exported_messages', len(message_list))
+            yield ''.join(message + '\n' for message in message_list)
+
+            if len(rows) < MESSAGES_PER_EXPORT_BATCH:
+                return
+            last_id = message_ids[-1]
+
+    return StreamingHttpResponse(export_batches(), content_type='application/x-ndjson')
+
+def get_range_limits(num_before: int,
+                     num_after: int,
+                     anchor: int,
+                     anchored_to_left: bool,
+                     anchored_to_right: bool,
+                     first_visible_message_id: int) -> Tuple[Optional[Tuple[Optional[int], int]],
+                                                             Optional[Tuple[Optional[int], int]]]:
+    '''
+    Returns the (bound, limit) pairs for the before and after queries
+    of limit_query_to_range, or None for a side we don't need; a
+    bound of None means that side isn't bounded by the anchor.
     '''
     need_before_query = (not anchored_to_left) and (num_before > 0)
     need_after_query = (not anchored_to_right) and (num_after > 0)
@@ -903,43 +1222,70 @@ def limit_query_to_range(query: Query,
     #
     # Note that in some cases, if the anchor row isn't found, we
     # actually may fetch an extra row at one of the extremes.
+    before = None  # type: Optional[Tuple[Optional[int], int]]
+    after = None  # type: Optional[Tuple[Optional[int], int]]
     if need_both_sides:
-        before_anchor = anchor - 1
-        after_anchor = max(anchor, first_visible_message_id)
-        before_limit = num_before
-        after_limit = num_after + 1
+        before = (anchor - 1, num_before)
+        after = (max(anchor, first_visible_message_id), num_after + 1)
     elif need_before_query:
-        before_anchor = anchor
-        before_limit = num_before
-        if not anchored_to_right:
-            before_limit += 1
+        if anchored_to_right:
+            before = (None, num_before)
+        else:
+            before = (anchor, num_before + 1)
     elif need_after_query:
-        after_anchor = max(anchor, first_visible_message_id)
-        after_limit = num_after + 1
+        if anchored_to_left:
+            after = (None, num_after + 1)
+        else:
+            after = (max(anchor, first_visible_message_id), num_after + 1)
 
-    if need_before_query:
+    return (before, after)
+
+def limit_query_to_range(query: Query,
+                         num_before: int,
+                         num_after: int,
+                         anchor: int,
+                         anchored_to_left: bool,
+                         anchored_to_right: bool,
+                         id_col: ColumnElement,
+                         first_visible_message_id: int) -> Query:
+    '''
+    This code is actually generic enough that we could move it to a
+    library, but our only caller for now is message search.
+    '''
+    before, after = get_range_limits(
+        num_before=num_before,
+        num_after=num_after,
+        anchor=anchor,
+        anchored_to_left=anchored_to_left,
+        anchored_to_right=anchored_to_right,
+        first_visible_message_id=first_visible_message_id,
+    )
+
+    if before is not None:
+        before_anchor, before_limit = before
         before_query = query
 
-        if not anchored_to_right:
+        if before_anchor is not None:
             before_query = before_query.where(id_col <= before_anchor)
 
         before_query = before_query.order_by(id_col.desc())
         before_query = before_query.limit(before_limit)
 
-    if need_after_query:
+    if after is not None:
+        after_anchor, after_limit = after
         after_query = query
 
-        if not anchored_to_left:
+        if after_anchor is not None:
             after_query = after_query.where(id_col >= after_anchor)
 
         after_query = after_query.order_by(id_col.asc())
         after_query = after_query.limit(after_limit)
 
-    if need_both_sides:
+    if before is not None and after is not None:
         query = union_all(before_query.self_group(), after_query.self_group())
-    elif need_before_query:
+    elif before is not None:
         query = before_query
-    elif need_after_query:
+    elif after is not None:
         query = after_query
     else:
         # If we don't have either a before_query or after_query, it's because
@@ -954,6 +1300,41 @@ def limit_query_to_range(query: Query,
 
     return query
 
+def limit_rows_to_range(rows: List[Any],
+                        num_before: int,
+                        num_after: int,
+                        anchor: int,
+                        anchored_to_left: bool,
+                        anchored_to_right: bool,
+                        first_visible_message_id: int) -> List[Any]:
+    '''
+    Selects, from rows sorted by message id, the rows that the query
+    from limit_query_to_range would return if `rows` were all the
+    messages matching the narrow.
+    '''
+    before, after = get_range_limits(
+        num_before=num_before,
+        num_after=num_after,
+        anchor=anchor,
+        anchored_to_left=anchored_to_left,
+        anchored_to_right=anchored_to_right,
+        first_visible_message_id=first_visible_message_id,
+    )
+    if before is None and after is None:
+        return [r for r in rows if r[0] == anchor]
+
+    before_rows = []  # type: List[Any]
+    after_rows = []  # type: List[Any]
+    if before is not None:
+        before_anchor, before_limit = before
+        before_rows = [r for r in rows if before_anchor is None or r[0] <= before_anchor]
+        before_rows = before_rows[max(len(before_rows) - before_limit, 0):]
+    if after is not None:
+        after_anchor, after_limit = after
+        after_rows = [r for r in rows if after_anchor is None or r[0] >= after_anchor]
+        after_rows = after_rows[:after_limit]
+    return before_rows + after_rows
+
 def post_process_limited_query(rows: List[Any],
                                num_before: int,
                                num_after: int,
@@ -1507,6 +1888,9 @@ def messages_in_narrow_backend(request: HttpRequest, user_profile: UserProfile,
     if narrow is not None:
         for term in narrow:
             query = builder.add_term(query, term)
+        search_operand = get_search_operand(narrow)
+        if search_operand is not None:
+            query = add_search_match_columns(query, search_operand)
 
     sa_conn = get_sqlalchemy_connection()
     query_result = list(sa_conn.execute(query).fetchall())
@@ -3,7 +3,7 @@ import datetime
 import time
 
 from django.conf import settings
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from django.http import HttpRequest, HttpResponse
 from django.utils.timezone import now as timezone_now
@@ -11,15 +11,24 @@ from django.utils.translation import ugettext as _
 
 from zerver.decorator import human_users_only
 from zerver.lib.actions import get_status_dict, update_user_presence
+from zerver.lib.presence import get_presence_snapshot_time
 from zerver.lib.request import has_request_variables, REQ, JsonableError
 from zerver.lib.response import json_success, json_error
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.validator import check_bool
 from zerver.models import UserActivity, UserPresence, UserProfile, get_active_user
 
-def get_status_list(requesting_user_profile: UserProfile) -> Dict[str, Any]:
-    return {'presences': get_status_dict(requesting_user_profile),
-            'server_timestamp': time.time()}
+def get_status_list(requesting_user_profile: UserProfile,
+                    since: Optional[float]=None) -> Dict[str, Any]:
+    # Clients pass back server_timestamp as `since` in their next
+    # request, so it must not be later than the data we return.  The
+    # snapshot's change times come from Redis's clock, not ours.
+    if settings.PRESENCE_SNAPSHOT_ENABLED:
+        server_timestamp = get_presence_snapshot_time()
+    else:
+        server_timestamp = time.time()
+    return {'presences': get_status_dict(requesting_user_profile, since),
+            'server_timestamp': server_timestamp}
 
 def get_presence_backend(request: HttpRequest, user_profile: UserProfile,
                          email: str) -> HttpResponse:
@@ -50,7 +59,8 @@ def get_presence_backend(request: HttpRequest, user_profile: UserProfile,
 def update_active_status_backend(request: HttpRequest, user_profile: UserProfile,
                                  status: str=REQ(),
                                  ping_only: bool=REQ(validator=check_bool, default=False),
-                                 new_user_input: bool=REQ(validator=check_bool, default=False)
+                                 new_user_input: bool=REQ(validator=check_bool, default=False),
+                                 since: Optional[float]=REQ(converter=float, default=None)
                                  ) -> HttpResponse:
     status_val = UserPresence.status_from_string(status)
     if status_val is None:
@@ -62,7 +72,7 @@ def update_active_status_backend(request: HttpRequest, user_profile: UserProfile
     if ping_only:
         ret = {}  # type: Dict[str, Any]
     else:
-        ret = get_status_list(user_profile)
+        ret = get_status_list(user_profile, since)
 
     if user_profile.realm.is_zephyr_mirror_realm:
         # In zephyr mirroring realms, users can't see the presence of other
@@ -80,5 +90,8 @@ def update_active_status_backend(request: HttpRequest, user_profile: UserProfile
 
     return json_success(ret)
 
-def get_statuses_for_realm(request: HttpRequest, user_profile: UserProfile) -> HttpResponse:
-    return json_success(get_status_list(user_profile))
+@has_request_variables
+def get_statuses_for_realm(request: HttpRequest, user_profile: UserProfile,
+                           since: Optional[float]=REQ(converter=float, default=None)
+                           ) -> HttpResponse:
+    return json_success(get_status_list(user_profile, since))
@@ -10,7 +10,7 @@ import smtplib
 import socket
 
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.handlers.base import BaseHandler
 from zerver.models import \
@@ -25,7 +25,7 @@ from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.notifications import handle_missedmessage_emails
 from zerver.lib.push_notifications import handle_push_notification, handle_remove_push_notification
 from zerver.lib.actions import do_send_confirmation_email, \
-    do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
+    do_update_user_activities, do_update_user_activity_intervals, do_update_user_presences, \
     internal_send_message, check_send_message, extract_recipients, \
     render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read
 from zerver.lib.url_preview import preview as url_preview
@@ -132,20 +132,24 @@ class QueueProcessingWorker:
         try:
             self.consume(data)
         except Exception:
-            self._log_problem()
-            if not os.path.exists(settings.QUEUE_ERROR_DIR):
-                os.mkdir(settings.QUEUE_ERROR_DIR)  # nocoverage
-            fname = '%s.errors' % (self.queue_name,)
-            fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
-            line = '%s\t%s\n' % (time.asctime(), ujson.dumps(data))
-            lock_fn = fn + '.lock'
-            with lockfile(lock_fn):
-                with open(fn, 'ab') as f:
-                    f.write(line.encode('utf-8'))
-            check_and_send_restart_signal()
+            self._handle_consume_exception([data])
         finally:
             reset_queries()
 
+    def _handle_consume_exception(self, events: List[Dict[str, Any]]) -> None:
+        self._log_problem()
+        if not os.path.exists(settings.QUEUE_ERROR_DIR):
+            os.mkdir(settings.QUEUE_ERROR_DIR)  # nocoverage
+        fname = '%s.errors' % (self.queue_name,)
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
+        lines = ''.join('%s\t%s\n' % (time.asctime(), ujson.dumps(event))
+                        for event in events)
+        lock_fn = fn + '.lock'
+        with lockfile(lock_fn):
+            with open(fn, 'ab') as f:
+                f.write(lines.encode('utf-8'))
+        check_and_send_restart_signal()
+
     def _log_problem(self) -> None:
         logging.exception("Problem handling data on queue %s" % (self.queue_name,))
 
@@ -164,10 +168,12 @@ class LoopQueueProcessingWorker(QueueProcessingWorker):
 
     def start(self) -> None:  # nocoverage
         while True:
-            # TODO: Probably it'd be better to share code with consume_wrapper()
             events = self.q.drain_queue(self.queue_name, json=True)
             try:
-                self.consume_batch(events)
+                if events:
+                    self.consume_batch(events)
+            except Exception:
+                self._handle_consume_exception(events)
             finally:
                 reset_queries()
             time.sleep(self.sleep_delay)
@@ -175,6 +181,29 @@ class LoopQueueProcessingWorker(QueueProcessingWorker):
     def consume_batch(self, event: List[Dict[str, Any]]) -> None:
         raise NotImplementedError
 
+    def consume_batch_or_each(self, events: List[Dict[str, Any]],
+                              consume_events: Callable[[List[Dict[str, Any]]], None]) -> None:
+        '''
+        Passes the events to consume_events as one batch, in a
+        transaction.  If that fails, retries them one at a time, so
+        that one bad event doesn't cost us the rest of the batch, and
+        logs only the events that fail on their own.
+        '''
+        try:
+            with transaction.atomic():
+                consume_events(events)
+            return
+        except Exception:
+            if len(events) == 1:
+                raise
+
+        for event in events:
+            try:
+                with transaction.atomic():
+                    consume_events([event])
+            except Exception:
+                self._handle_consume_exception([event])
+
     def consume(self, event: Dict[str, Any]) -> None:
         """In LoopQueueProcessingWorker, consume is used just for automated tests"""
         self.consume_batch([event])
@@ -237,31 +266,54 @@ class ConfirmationEmailWorker(QueueProcessingWorker):
             context=context,
             delay=datetime.timedelta(days=2))
 
-@assign_queue('user_activity')
-class UserActivityWorker(QueueProcessingWorker):
-    def consume(self, event: Mapping[str, Any]) -> None:
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        query = event["query"]
-        do_update_user_activity(user_profile, client, query, log_time)
-
-@assign_queue('user_activity_interval')
-class UserActivityIntervalWorker(QueueProcessingWorker):
-    def consume(self, event: Mapping[str, Any]) -> None:
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        log_time = timestamp_to_datetime(event["time"])
-        do_update_user_activity_interval(user_profile, log_time)
-
-@assign_queue('user_presence')
-class UserPresenceWorker(QueueProcessingWorker):
-    def consume(self, event: Mapping[str, Any]) -> None:
-        logging.debug("Received presence event: %s" % (event),)
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        status = event["status"]
-        do_update_user_presence(user_profile, client, log_time, status)
+# Clients report presence about once a minute, and nearly every API
+# request is logged to user_activity, so these workers handle the
+# events that accumulated over a short window together, which lets us
+# write them with a few multi-row statements rather than a transaction
+# per event.  Only the presence worker's window delays anything users
+# see (other users going online), so it's the shortest.
+
+@assign_queue('user_activity', queue_type="loop")
+class UserActivityWorker(LoopQueueProcessingWorker):
+    sleep_delay = 5
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        self.consume_batch_or_each(events, self.update_user_activities)
+
+    def update_user_activities(self, events: List[Dict[str, Any]]) -> None:
+        do_update_user_activities([
+            (event["user_profile_id"], get_client(event["client"]).id, event["query"],
+             timestamp_to_datetime(event["time"]))
+            for event in events
+        ])
+
+@assign_queue('user_activity_interval', queue_type="loop")
+class UserActivityIntervalWorker(LoopQueueProcessingWorker):
+    sleep_delay = 5
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        self.consume_batch_or_each(events, self.update_user_activity_intervals)
+
+    def update_user_activity_intervals(self, events: List[Dict[str, Any]]) -> None:
+        do_update_user_activity_intervals([
+            (event["user_profile_id"], timestamp_to_datetime(event["time"]))
+            for event in events
+        ])
+
+@assign_queue('user_presence', queue_type="loop")
+class UserPresenceWorker(LoopQueueProcessingWorker):
+    sleep_delay = 1
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        logging.debug("Received %d presence events" % (len(events),))
+        self.consume_batch_or_each(events, self.update_user_presences)
+
+    def update_user_presences(self, events: List[Dict[str, Any]]) -> None:
+        do_update_user_presences([
+            (get_user_profile_by_id(event["user_profile_id"]), get_client(event["client"]),
+             timestamp_to_datetime(event["time"]), event["status"])
+            for event in events
+        ])
 
 @assign_queue('missedmessage_emails', queue_type="loop")
 class MissedMessageWorker(QueueProcessingWorker):
@@ -0,0 +1,75 @@
+import random
+import re
+import string
+import time
+from typing import Any, List, Set
+
+from django.core.management.base import CommandParser
+
+from zerver.lib.alert_words import AlertWordMatcher
+from zerver.lib.management import ZulipBaseCommand
+
+def find_words_with_regexes(words: List[str], content: str) -> Set[str]:
+    # The previous implementation in AlertWordsNotificationProcessor:
+    # one regex per alert word.
+    content = content.lower()
+    allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
+    allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+    found = set()  # type: Set[str]
+    for word in words:
+        escaped = re.escape(word.lower())
+        match_re = re.compile('(?:%s)%s(?:%s)' %
+                              (allowed_before_punctuation,
+                               escaped,
+                               allowed_after_punctuation))
+        if re.search(match_re, content):
+            found.add(word)
+    return found
+
+class Command(ZulipBaseCommand):
+    help = """Compare alert word matching with one regex per word and with AlertWordMatcher.
+
+Uses random alert words and a typical message; doesn't touch the database.
+
+Usage: ./manage.py benchmark_alert_words --words 1000,10000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--words', dest='word_counts', type=str, default='1000,10000',
+                            help='Comma-separated list of alert word counts')
+        parser.add_argument('--messages', dest='num_messages', type=int, default=100,
+                            help='Number of messages to match against')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        random.seed(1)
+        num_messages = options['num_messages']
+
+        def random_word() -> str:
+            return ''.join(random.choice(string.ascii_lowercase)
+                           for i in range(random.randint(3, 10)))
+
+        print('%8s %14s %14s %14s' % ('words', 'regexes', 'matcher', 'matcher build'))
+        for word_count in [int(count) for count in options['word_counts'].split(',')]:
+            words = list({random_word() for i in range(word_count)})
+            # Messages of about 40 words, a couple of which are alert words.
+            messages = [
+                ' '.join([random_word() for i in range(40)] + random.sample(words, 2)) + '.'
+                for j in range(num_messages)
+            ]
+
+            start = time.time()
+            regex_results = [find_words_with_regexes(words, content) for content in messages]
+            regex_time = time.time() - start
+
+            start = time.time()
+            matcher = AlertWordMatcher(words)
+            build_time = time.time() - start
+
+            start = time.time()
+            matcher_results = [matcher.find_words(content) for content in messages]
+            matcher_time = time.time() - start
+
+            assert regex_results == matcher_results
+            print('%8d %11.3fms %11.3fms %11.3fms' % (
+                word_count, 1000 * regex_time / num_messages,
+                1000 * matcher_time / num_messages, 1000 * build_time))
+        print('(regexes and matcher are per message)')
@@ -0,0 +1,67 @@
+import time
+from typing import Any, Callable, List, Optional
+
+from django.core.management.base import CommandParser
+from django.db import transaction
+from django.test import override_settings
+
+from zerver.lib.actions import UserMessageLite, bulk_insert_ums, \
+    copy_insert_user_message_rows
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Message
+
+class Command(ZulipBaseCommand):
+    help = """Compare the INSERT ... VALUES and COPY paths for UserMessage rows.
+
+Each run inserts rows for synthetic recipients of an existing message
+inside a transaction that is rolled back, so the database is left
+unchanged.
+
+Usage: ./manage.py benchmark_bulk_insert_ums --sizes 1000,10000,50000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--sizes', dest='sizes', type=str, default='1000,10000,50000',
+                            help='Comma-separated list of recipient counts')
+        parser.add_argument('--runs', dest='runs', type=int, default=3,
+                            help='Number of runs per size; the fastest is reported')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        message_id = Message.objects.latest('id').id
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        def values_insert(ums: List[UserMessageLite]) -> None:
+            with override_settings(BULK_INSERT_UMS_COPY_THRESHOLD=len(ums) + 1):
+                bulk_insert_ums(ums)
+
+        def copy_insert(ums: List[UserMessageLite]) -> None:
+            copy_insert_user_message_rows(
+                (um.user_profile_id, um.message_id, um.flags) for um in ums)
+
+        def time_insert(insert: Callable[[List[UserMessageLite]], None],
+                        ums: List[UserMessageLite]) -> float:
+            best = None  # type: Optional[float]
+            for i in range(options['runs']):
+                with transaction.atomic():
+                    start = time.time()
+                    insert(ums)
+                    delay = time.time() - start
+                    # The foreign key constraints on zerver_usermessage
+                    # are deferred, so the synthetic user ids are never
+                    # checked before we roll back.
+                    transaction.set_rollback(True)
+                if best is None or delay < best:
+                    best = delay
+            assert best is not None
+            return best
+
+        print('%10s %12s %12s' % ('rows', 'VALUES', 'COPY'))
+        for size in sizes:
+            # Use user ids that can't collide with real UserMessage rows.
+            ums = [
+                UserMessageLite(user_profile_id=10**9 + i, message_id=message_id, flags=0)
+                for i in range(size)
+            ]
+            values_time = time_insert(values_insert, ums)
+            copy_time = time_insert(copy_insert, ums)
+            print('%10d %11.3fs %11.3fs' % (size, values_time, copy_time))
+
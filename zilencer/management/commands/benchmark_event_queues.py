@@ -0,0 +1,139 @@
+import heapq
+import mock
+import os
+import random
+import tempfile
+import time
+from typing import Any, Callable
+
+from django.core.management.base import CommandParser
+from django.test import override_settings
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import ClientDescriptor, EventQueue, \
+    add_to_client_dicts, checkpoint_event_queues, dump_event_queues, load_event_queues, \
+    persistent_queue_filename
+
+def make_client_descriptors(num_queues: int, events_per_queue: int) -> None:
+    '''
+    Fills Tornado's in-process queue dictionaries with synthetic
+    ClientDescriptors; this doesn't touch the database.
+    '''
+    for i in range(num_queues):
+        queue = EventQueue('benchmark:%d' % (i,))
+        for j in range(events_per_queue):
+            queue.push(dict(type='typing', op='start', sender=dict(user_id=i)))
+        client = ClientDescriptor(
+            user_profile_id=i,
+            user_profile_email='user%d@example.com' % (i,),
+            realm_id=i % 100,
+            event_queue=queue,
+            event_types=None,
+            client_type_name='website',
+        )
+        event_queue.clients[queue.id] = client
+        add_to_client_dicts(client)
+
+class Command(ZulipBaseCommand):
+    help = """Benchmark Tornado event queue maintenance with synthetic queues.
+
+Runs entirely in this process against synthetic ClientDescriptors, so
+it doesn't need (or affect) a running Tornado server.
+
+Usage: ./manage.py benchmark_event_queues persistence --queues 50000
+       ./manage.py benchmark_event_queues gc --queues 100000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('benchmark', choices=['persistence', 'gc'],
+                            help='Which benchmark to run')
+        parser.add_argument('--queues', dest='num_queues', type=int, default=50000,
+                            help='Number of synthetic event queues')
+        parser.add_argument('--events-per-queue', dest='events_per_queue', type=int,
+                            default=5, help='Number of events in each queue')
+        parser.add_argument('--changed-fraction', dest='changed_fraction', type=float,
+                            default=0.05,
+                            help='Fraction of queues changed between the last checkpoint '
+                                 'and shutdown')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        clear_queues()
+        make_client_descriptors(options['num_queues'], options['events_per_queue'])
+        if options['benchmark'] == 'persistence':
+            self.benchmark_persistence(options['num_queues'], options['changed_fraction'])
+        elif options['benchmark'] == 'gc':
+            self.benchmark_gc(options['num_queues'])
+
+    def benchmark_persistence(self, num_queues: int, changed_fraction: float) -> None:
+        port = 9993
+        tmp_dir = tempfile.mkdtemp()
+        pattern = os.path.join(tmp_dir, 'event_queues%s.json')
+
+        def timed(f: Callable[[], None]) -> float:
+            start = time.time()
+            f()
+            return time.time() - start
+
+        def reload() -> float:
+            clear_queues()
+            return timed(lambda: load_event_queues(port))
+
+        with override_settings(JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=pattern,
+                               INCREMENTAL_EVENT_QUEUE_PERSISTENCE=False):
+            dump_time = timed(lambda: dump_event_queues(port))
+            load_time = reload()
+        print('%-40s dump %8.3fs  load %8.3fs' % ('whole-file JSON', dump_time, load_time))
+
+        with override_settings(JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=pattern,
+                               INCREMENTAL_EVENT_QUEUE_PERSISTENCE=True):
+            os.remove(persistent_queue_filename(port))
+            event_queue.event_queue_log = None
+            event_queue.changed_queue_ids.update(event_queue.clients.keys())
+            checkpoint_time = timed(lambda: checkpoint_event_queues(port))
+
+            for qid in random.sample(list(event_queue.clients.keys()),
+                                     int(num_queues * changed_fraction)):
+                event_queue.clients[qid].event_queue.push(dict(type='heartbeat'))
+                event_queue.mark_queue_changed(qid)
+            dump_time = timed(lambda: dump_event_queues(port))
+            load_time = reload()
+        print('%-40s dump %8.3fs  load %8.3fs  (initial checkpoint %.3fs)' % (
+            'incremental log, %d%% changed' % (100 * changed_fraction,),
+            dump_time, load_time, checkpoint_time))
+
+    def benchmark_gc(self, num_queues: int) -> None:
+        # Spread the queues' last connections over the idle timeout,
+        # so that each GC pass finds a few expired queues, like it
+        # would on a real server.
+        start = time.time()
+        for client in event_queue.clients.values():
+            client.last_connection_time = start - random.uniform(0, event_queue.IDLE_EVENT_QUEUE_TIMEOUT_SECS)
+        event_queue.queue_expiry_heap[:] = [
+            (client.last_connection_time + client.queue_timeout, qid)
+            for (qid, client) in event_queue.clients.items()
+        ]
+        heapq.heapify(event_queue.queue_expiry_heap)
+
+        gc_interval = event_queue.EVENT_QUEUE_GC_FREQ_MSECS / 1000
+        for i in range(1, 4):
+            now = start + i * gc_interval
+            scan_start = time.time()
+            # What gc_event_queues did before the expiry index: check
+            # every queue.
+            num_idle = len([client for client in event_queue.clients.values()
+                            if client.idle(now)])
+            scan_time = time.time() - scan_start
+
+            gc_start = time.time()
+            with mock.patch('zerver.tornado.event_queue.time.time', return_value=now):
+                event_queue.gc_event_queues(9993)
+            gc_time = time.time() - gc_start
+            print('GC pass %d: %6d of %6d queues idle; full scan %8.2fms, indexed GC %8.2fms' % (
+                i, num_idle, num_idle + len(event_queue.clients), 1000 * scan_time,
+                1000 * gc_time))
+
+def clear_queues() -> None:
+    event_queue.clients.clear()
+    event_queue.user_clients.clear()
+    event_queue.realm_clients_all_streams.clear()
+    event_queue.changed_queue_ids.clear()
@@ -0,0 +1,82 @@
+import time
+from typing import Any, Callable, Dict, List
+
+import ujson
+from django.core.management.base import CommandParser
+from django.test import Client
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.message import messages_for_ids, messages_for_ids_json
+from zerver.lib.response import json_success, json_success_with_fragments
+from zerver.models import UserMessage
+
+class Command(ZulipBaseCommand):
+    help = """Benchmark assembling the response for fetching a user's recent messages.
+
+Compares building message dicts with messages_for_ids and serializing
+them with json_success, against splicing pre-serialized fragments with
+messages_for_ids_json, with the message cache warm; then times the
+whole GET /json/messages request.
+
+Usage: ./manage.py benchmark_get_messages -r zulip hamlet@zulip.com --messages 1000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('email', metavar='<email>', type=str,
+                            help='Email address of the user fetching messages')
+        parser.add_argument('--messages', dest='num_messages', type=int, default=1000,
+                            help='Number of recent messages to fetch')
+        parser.add_argument('--runs', dest='runs', type=int, default=5,
+                            help='Number of runs; the fastest is reported')
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        user_profile = self.get_user(options['email'], realm)
+
+        user_messages = UserMessage.objects.filter(user_profile=user_profile) \
+            .order_by('-message_id')[:options['num_messages']]
+        user_message_flags = {um.message_id: um.flags_list() for um in user_messages}
+        message_ids = sorted(user_message_flags)
+        kwargs = dict(
+            message_ids=message_ids,
+            user_message_flags=user_message_flags,
+            search_fields={},
+            apply_markdown=True,
+            client_gravatar=True,
+            allow_edit_history=realm.allow_edit_history,
+        )  # type: Dict[str, Any]
+
+        def dicts() -> None:
+            json_success(dict(messages=messages_for_ids(**kwargs), anchor=0))
+
+        def fragments() -> None:
+            json_success_with_fragments(dict(anchor=0), 'messages',
+                                        messages_for_ids_json(**kwargs))
+
+        client = Client()
+        client.force_login(user_profile)
+
+        def view() -> None:
+            result = client.get('/json/messages', dict(
+                anchor=message_ids[-1], num_before=len(message_ids), num_after=0,
+                client_gravatar=ujson.dumps(True)), HTTP_HOST=realm.host)
+            assert result.status_code == 200
+
+        def best_time(f: Callable[[], None]) -> float:
+            times = []  # type: List[float]
+            for i in range(options['runs']):
+                start = time.time()
+                f()
+                times.append(time.time() - start)
+            return min(times)
+
+        # Warm the message cache (and the per-process fragment cache).
+        dicts()
+        fragments()
+
+        print('%d messages' % (len(message_ids),))
+        for name, f in [('message dicts', dicts),
+                        ('JSON fragments', fragments),
+                        ('GET /json/messages', view)]:
+            print('%-20s %8.2fms' % (name, 1000 * best_time(f)))
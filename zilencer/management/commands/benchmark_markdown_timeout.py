@@ -0,0 +1,61 @@
+import threading
+import time
+from typing import Any, Callable, TypeVar
+
+import mock
+from django.core.management.base import CommandParser
+
+from zerver.lib import bugdown
+from zerver.lib.management import ZulipBaseCommand
+
+ResultT = TypeVar('ResultT')
+
+def thread_per_call_timeout(timeout: float, func: Callable[..., ResultT],
+                            *args: Any, **kwargs: Any) -> ResultT:
+    # Just the part of the previous zerver.lib.timeout.timeout that
+    # matters when nothing times out: a new thread for every call.
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func(*args, **kwargs)))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return result[0]
+
+class Command(ZulipBaseCommand):
+    help = """Measure the overhead of the rendering timeout on short messages.
+
+Renders N short messages with bugdown, with the timeout wrapper used by
+bugdown.do_convert, with a new thread per render (as before the timeout
+worker pool), and with no timeout at all.
+
+Usage: ./manage.py benchmark_markdown_timeout -r zulip --renders 10000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--renders', dest='num_renders', type=int, default=10000,
+                            help='Number of messages to render')
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        num_renders = options['num_renders']
+
+        def render_all() -> float:
+            start = time.time()
+            for i in range(num_renders):
+                bugdown.convert('Hello **world** number %d' % (i,), message_realm=realm)
+            return time.time() - start
+
+        def no_timeout(timeout: float, func: Callable[..., ResultT],
+                       *args: Any, **kwargs: Any) -> ResultT:
+            return func(*args, **kwargs)
+
+        # Warm up the markdown engine for the realm.
+        render_all()
+
+        for name, timeout_func in [('worker pool', bugdown.timeout),
+                                   ('thread per call', thread_per_call_timeout),
+                                   ('no timeout', no_timeout)]:
+            with mock.patch('zerver.lib.bugdown.timeout', side_effect=timeout_func):
+                delay = render_all()
+            print('%-16s %8.3fs (%.1fus/render)' % (name, delay, 10**6 * delay / num_renders))
@@ -0,0 +1,129 @@
+import mock
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple
+
+import redis
+from django.conf import settings
+from django.core.management.base import CommandParser
+from django.test import override_settings
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.rate_limiter import RateLimitedObject, api_calls_left, clear_history, \
+    client, is_ratelimited, max_api_calls, max_api_window, rate_limit_entity, rate_limit_script
+
+class BenchmarkRateLimitedObject(RateLimitedObject):
+    def __init__(self, rules: List[Tuple[int, int]]) -> None:
+        self._rules = rules
+
+    def key_fragment(self) -> str:
+        return "benchmark"
+
+    def rules(self) -> List[Tuple[int, int]]:
+        return self._rules
+
+def rate_limit_with_watch(entity: RateLimitedObject) -> int:
+    '''
+    The previous implementation in rate_limit_user: is_ratelimited,
+    then recording the request in a WATCH/MULTI transaction, then
+    api_calls_left.  Returns the number of transaction retries.
+    '''
+    is_ratelimited(entity)
+    list_key, set_key, _ = entity.get_keys()
+    now = time.time()
+    retries = 0
+    with client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(list_key)
+                last_val = pipe.lindex(list_key, max_api_calls(entity) - 1)
+                pipe.multi()
+                pipe.lpush(list_key, now)
+                pipe.ltrim(list_key, 0, max_api_calls(entity) - 1)
+                pipe.zadd(set_key, now, now)
+                if last_val is not None:
+                    pipe.zrem(set_key, last_val)
+                pipe.expire(list_key, max_api_window(entity))
+                pipe.expire(set_key, max_api_window(entity))
+                pipe.execute()
+                break
+            except redis.WatchError:
+                retries += 1
+    api_calls_left(entity)
+    return retries
+
+def rate_limit_with_script(entity: RateLimitedObject) -> int:
+    rate_limit_entity(entity)
+    return 0
+
+class Command(ZulipBaseCommand):
+    help = """Benchmark rate limiting, using a scratch key in Redis.
+
+contention: many concurrent workers make requests under a limit nobody
+reaches, comparing the Lua script used by rate_limit_user against the
+previous WATCH/MULTI transaction, which retries whenever another worker
+changes the key first.
+
+abusive: one client keeps making requests far beyond
+RATE_LIMITING_RULES, with and without RATE_LIMITING_LOCAL_PRECHECK.
+
+Usage: ./manage.py benchmark_rate_limiter contention --workers 1,8,32 --requests 500
+       ./manage.py benchmark_rate_limiter abusive --requests 100000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('benchmark', choices=['contention', 'abusive'],
+                            help='Which benchmark to run')
+        parser.add_argument('--workers', dest='worker_counts', type=str, default='1,8,32',
+                            help='Comma-separated list of numbers of concurrent workers '
+                                 '(contention only)')
+        parser.add_argument('--requests', dest='num_requests', type=int, default=500,
+                            help='Number of requests made by each worker')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options['benchmark'] == 'contention':
+            self.benchmark_contention(options['worker_counts'], options['num_requests'])
+        else:
+            self.benchmark_abusive(options['num_requests'])
+
+    def benchmark_contention(self, worker_counts: str, num_requests: int) -> None:
+        print('%8s %-8s %10s %12s %10s' % ('workers', 'method', 'total', 'per request', 'retries'))
+        for worker_count in [int(count) for count in worker_counts.split(',')]:
+            # A limit nobody reaches, so every request does the full update.
+            entity = BenchmarkRateLimitedObject([(3600, worker_count * num_requests)])
+            for name, f in [('watch', rate_limit_with_watch),
+                            ('script', rate_limit_with_script)]:
+                clear_history(entity)
+
+                def work(f: Callable[[RateLimitedObject], int]=f) -> int:
+                    return sum(f(entity) for i in range(num_requests))
+
+                start = time.time()
+                with ThreadPoolExecutor(max_workers=worker_count) as executor:
+                    futures = [executor.submit(work) for i in range(worker_count)]
+                    retries = sum(future.result() for future in futures)
+                total = time.time() - start
+
+                # Every request was recorded.
+                assert client.llen(entity.get_keys()[0]) == worker_count * num_requests
+                print('%8d %-8s %9.2fs %10.3fms %10d' % (
+                    worker_count, name, total,
+                    1000 * total / (worker_count * num_requests), retries))
+            clear_history(entity)
+
+    def benchmark_abusive(self, num_requests: int) -> None:
+        entity = BenchmarkRateLimitedObject(list(settings.RATE_LIMITING_RULES))
+        print('%-16s %12s %10s %10s' % ('local precheck', 'requests/s', 'allowed', 'redis calls'))
+        for precheck in [False, True]:
+            clear_history(entity)
+            allowed = 0
+            with override_settings(RATE_LIMITING_LOCAL_PRECHECK=precheck), \
+                    mock.patch('zerver.lib.rate_limiter.rate_limit_script',
+                               wraps=rate_limit_script) as script_mock:
+                start = time.time()
+                for i in range(num_requests):
+                    if not rate_limit_entity(entity)[0]:
+                        allowed += 1
+                total = time.time() - start
+            print('%-16s %12.0f %10d %10d' % (
+                precheck, num_requests / total, allowed, script_mock.call_count))
+        clear_history(entity)
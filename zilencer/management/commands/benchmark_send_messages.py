@@ -0,0 +1,90 @@
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.core.management.base import CommandParser
+from django.db import connection
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.actions import do_send_messages
+from zerver.lib.db import reset_queries
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Message, Subscription, UserProfile, \
+    get_client, get_stream, get_stream_recipient
+
+class Command(ZulipBaseCommand):
+    help = """Benchmark do_send_messages on a burst of stream messages.
+
+Sends N messages to a stream, first one do_send_messages call per
+message and then as a single batch, and reports the number of database
+queries and the wall time for each.  This writes real messages, so only
+run it against a development database.
+
+Usage: ./manage.py benchmark_send_messages -r zulip hamlet@zulip.com Denmark \\
+           --messages 200 --extra-subscribers 1000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('sender', metavar='<sender>', type=str,
+                            help='Email address of the sender')
+        parser.add_argument('stream', metavar='<stream>', type=str,
+                            help='Name of the stream to send to')
+        parser.add_argument('--messages', dest='num_messages', type=int, default=200,
+                            help='Number of messages to send per run')
+        parser.add_argument('--extra-subscribers', dest='extra_subscribers', type=int,
+                            default=0,
+                            help='Number of synthetic users to subscribe to the stream first')
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        sender = self.get_user(options['sender'], realm)
+        stream = get_stream(options['stream'], realm)
+        recipient = get_stream_recipient(stream.id)
+        sending_client = get_client('benchmark_send_messages')
+        num_messages = options['num_messages']
+
+        for i in range(options['extra_subscribers']):
+            user = UserProfile.objects.create(
+                realm=realm,
+                email='benchmark-%d-%d@example.com' % (stream.id, i),
+                pointer=0,
+            )
+            Subscription.objects.create(user_profile=user, recipient=recipient)
+
+        def make_message(i: int) -> Dict[str, Any]:
+            message = Message(
+                sender=sender,
+                recipient=recipient,
+                content='benchmark message %d' % (i,),
+                pub_date=timezone_now(),
+                sending_client=sending_client,
+            )
+            message.set_topic_name('benchmark')
+            return dict(message=message)
+
+        def measure(send: Callable[[], None]) -> Tuple[int, float]:
+            reset_queries()
+            start = time.time()
+            send()
+            delay = time.time() - start
+            return len(connection.connection.queries), delay
+
+        def send_one_at_a_time() -> None:
+            for i in range(num_messages):
+                do_send_messages([make_message(i)])
+
+        def send_batch() -> None:
+            do_send_messages([make_message(i) for i in range(num_messages)])
+
+        subscriber_count = Subscription.objects.filter(recipient=recipient, active=True).count()
+        print('Sending %d messages to %s (%d subscribers)' % (
+            num_messages, stream.name, subscriber_count))
+        results = []  # type: List[Tuple[str, int, float]]
+        for name, send in [('one at a time', send_one_at_a_time),
+                           ('batched', send_batch)]:
+            num_queries, delay = measure(send)
+            results.append((name, num_queries, delay))
+
+        for name, num_queries, delay in results:
+            print('%-15s %6d queries %8.3fs (%.2fms/message)' % (
+                name, num_queries, delay, 1000 * delay / num_messages))
@@ -0,0 +1,95 @@
+import time
+import tracemalloc
+from typing import Any, Callable, Tuple
+
+from django.core.management.base import CommandParser
+
+from zerver.lib.actions import UserMessageLite, create_user_messages
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Message, Recipient, UserMessage, get_stream, get_stream_recipient
+
+class Command(ZulipBaseCommand):
+    help = """Measure memory and CPU for computing UserMessage rows for one message.
+
+Compares the columnar UserMessageFanout built by create_user_messages
+with building one UserMessageLite object per recipient, for a message
+sent to N synthetic recipients.  Does not write to the database.
+
+Usage: ./manage.py benchmark_user_message_fanout -r zulip hamlet@zulip.com Denmark \\
+           --recipients 10000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('sender', metavar='<sender>', type=str,
+                            help='Email address of the sender')
+        parser.add_argument('stream', metavar='<stream>', type=str,
+                            help='Name of the stream the message is sent to')
+        parser.add_argument('--recipients', dest='num_recipients', type=int, default=10000,
+                            help='Number of synthetic recipients')
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        sender = self.get_user(options['sender'], realm)
+        stream = get_stream(options['stream'], realm)
+
+        message = Message(sender=sender, recipient=get_stream_recipient(stream.id),
+                          content='benchmark')
+        message.id = 1
+        message.mentions_wildcard = False
+        num_recipients = options['num_recipients']
+        user_ids = set(range(10**9, 10**9 + num_recipients))
+        # Mention and alert a few users, like a typical message.
+        mentioned_user_ids = set(list(user_ids)[:3])
+        message.user_ids_with_alert_words = set(list(user_ids)[3:10])
+        long_term_idle_user_ids = set(list(user_ids)[::2])
+
+        def fanout() -> Any:
+            result = create_user_messages(
+                message=message,
+                um_eligible_user_ids=user_ids,
+                long_term_idle_user_ids=long_term_idle_user_ids,
+                stream_push_user_ids=set(),
+                stream_email_user_ids=set(),
+                mentioned_user_ids=mentioned_user_ids,
+            )
+            return (result, result.flags_dict())
+
+        def objects() -> Any:
+            # The previous implementation of create_user_messages, with
+            # one UserMessageLite object per recipient.
+            ums = [UserMessageLite(user_profile_id=user_id, message_id=message.id, flags=0)
+                   for user_id in user_ids]
+            for um in ums:
+                if um.user_profile_id == sender.id and message.sent_by_human():
+                    um.flags |= UserMessage.flags.read
+                if message.mentions_wildcard:
+                    um.flags |= UserMessage.flags.wildcard_mentioned
+                if um.user_profile_id in mentioned_user_ids:
+                    um.flags |= UserMessage.flags.mentioned
+                if um.user_profile_id in message.user_ids_with_alert_words:
+                    um.flags |= UserMessage.flags.has_alert_word
+                if message.recipient.type in [Recipient.HUDDLE, Recipient.PERSONAL]:
+                    um.flags |= UserMessage.flags.is_private
+            ums = [um for um in ums
+                   if um.user_profile_id not in long_term_idle_user_ids or um.flags != 0]
+            return (ums, {um.user_profile_id: um.flags_list() for um in ums})
+
+        def measure(f: Callable[[], Any]) -> Tuple[float, int]:
+            tracemalloc.start()
+            start = time.time()
+            result = f()
+            delay = time.time() - start
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del result
+            return delay, peak
+
+        # Warm up any lazily loaded state (e.g. the recipient).
+        fanout()
+        objects()
+
+        print('%d recipients' % (num_recipients,))
+        for name, f in [('UserMessageLite', objects), ('UserMessageFanout', fanout)]:
+            delay, peak = measure(f)
+            print('%-20s %8.2fms %10.1fKB peak' % (name, 1000 * delay, peak / 1024))
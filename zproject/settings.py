@@ -345,6 +345,50 @@ DEFAULT_SETTINGS.update({
     'APNS_CERT_FILE': None,
     'APNS_SANDBOX': True,
 
+    # Number of UserMessage rows above which bulk_insert_ums loads
+    # rows with PostgreSQL's COPY rather than a multi-row INSERT.
+    'BULK_INSERT_UMS_COPY_THRESHOLD': 5000,
+
+    # Whether Tornado persists event queues across restarts with an
+    # append-only log that is checkpointed while running, rather than
+    # by writing every queue to one JSON file at shutdown.
+    'INCREMENTAL_EVENT_QUEUE_PERSISTENCE': False,
+
+    # Optional per-process cache in front of memcached for the default
+    # cache; see zerver/lib/cache.py.  Entries are invalidated across
+    # processes through Redis, and expire after the TTL regardless.
+    'REMOTE_CACHE_L1_ENABLED': False,
+    'REMOTE_CACHE_L1_MAX_BYTES': 32 * 1024 * 1024,
+    'REMOTE_CACHE_L1_TTL_SECONDS': 60,
+
+    # Whether /register reads users' unread messages from summaries
+    # maintained in Redis as messages are sent and read, rather than
+    # querying UserMessage; see zerver/lib/unread_summary.py.
+    'UNREAD_SUMMARY_ENABLED': False,
+
+    # Whether presence polls read the realm's presence from a snapshot
+    # maintained in Redis as presence updates are processed, rather
+    # than querying UserPresence; see zerver/lib/presence.py.
+    'PRESENCE_SNAPSHOT_ENABLED': False,
+
+    # Number of threads per process used to compute independent
+    # sections of the /register response concurrently, each with its
+    # own database connection; 0 computes them one after another.
+    # (Must be 0 in tests, since the other connections can't see the
+    # test's uncommitted transaction.)
+    'INITIAL_STATE_FETCH_THREADS': 0,
+
+    # How long to cache the ids of a user's search results, so that
+    # fetching further pages of them doesn't repeat the full-text
+    # search; 0 disables the cache.
+    'SEARCH_RESULTS_CACHE_SECONDS': 60,
+
+    # Whether each process also keeps its own token buckets for rate
+    # limiting, mirroring RATE_LIMITING_RULES, so that clients that
+    # are clearly over their limits are turned away without asking
+    # Redis; see zerver/lib/rate_limiter.py.
+    'RATE_LIMITING_LOCAL_PRECHECK': False,
+
     # Limits related to the size of file uploads; last few in MB.
     'DATA_UPLOAD_MAX_MEMORY_SIZE': 25 * 1024 * 1024,
     'MAX_AVATAR_FILE_SIZE': 5,
@@ -590,6 +634,9 @@ CORPORATE_ENABLED = 'corporate' in INSTALLED_APPS
 # We set it to None when running backend tests or populate_db.
 # We override the port number when running frontend tests.
 TORNADO_PROCESSES = int(get_config('application_server', 'tornado_processes', 1))
+if DEVELOPMENT and 'TORNADO_PROCESSES' in os.environ:
+    # Used by tools/test-tornado-sharding to run several Tornado processes.
+    TORNADO_PROCESSES = int(os.environ['TORNADO_PROCESSES'])
 TORNADO_SERVER = 'http://127.0.0.1:9993'
 RUNNING_INSIDE_TORNADO = False
 AUTORELOAD = DEBUG
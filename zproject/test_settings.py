@@ -154,6 +154,10 @@ SOCIAL_AUTH_SUBDOMAIN = 'www'
 TWO_FACTOR_AUTHENTICATION_ENABLED = False
 PUSH_NOTIFICATION_BOUNCER_URL = None
 
+# Most tests change messages between searches, so cached search
+# results would be stale; tests of the cache turn this on.
+SEARCH_RESULTS_CACHE_SECONDS = 0
+
 # Disable messages from slow queries as they affect backend tests.
 SLOW_QUERY_LOGS_STREAM = None
 
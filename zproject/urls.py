@@ -182,6 +182,8 @@ v1_api_and_json_patterns = [
         {'POST': 'zerver.views.messages.render_message_backend'}),
     url(r'^messages/flags$', rest_dispatch,
         {'POST': 'zerver.views.messages.update_message_flags'}),
+    url(r'^messages/export$', rest_dispatch,
+        {'GET': 'zerver.views.messages.export_messages_backend'}),
     url(r'^messages/(?P<message_id>\d+)/history$', rest_dispatch,
         {'GET': 'zerver.views.messages.get_message_edit_history'}),
     url(r'^messages/matches_narrow$', rest_dispatch,